@@ -2,6 +2,9 @@
 ASGI config for homeserve project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Serve it (e.g. ``uvicorn homeserve.asgi:application``) for the live update
+stream at /api/events/ (services/push.py), which holds a connection open per
+signed-in browser tab.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
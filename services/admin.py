@@ -1,16 +1,18 @@
 from django.contrib import admin
+from django.http import StreamingHttpResponse
 from django.utils.html import format_html
+from . import counters, ledger, loyalty, matching, page_cache, payouts, push, slots
 from .models import (
     ServiceCategory, ServiceProvider, Service, 
-    Booking, Review, ProviderPortfolio, ServiceRequest,
+    Booking, Review, ProviderPortfolio, ServiceRequest, ServiceRequestMatch, DispatchJob,
     # Payment & Wallet
     Wallet, Payment, Transaction,
     # Messaging
-    Message,
+    Conversation, Message,
     # Provider Analytics
-    ProviderEarnings, ProviderStats,
+    ProviderEarnings, PayoutBatch, PayoutLine, ProviderStats, ProviderCounters,
     # Promotions
-    Coupon, ServicePackage, Referral, LoyaltyPoints,
+    Coupon, CouponRedemption, ServicePackage, Referral, LoyaltyPoints, LoyaltyEvent,
     # Customer Features
     FavoriteProvider, CustomerAddress, Notification,
     # Verification
@@ -18,10 +20,23 @@ from .models import (
     # Advanced Booking
     RecurringBooking, BookingExtension,
     # Scheduling
-    ProviderAvailability, ProviderLeave
+    ProviderAvailability, ProviderLeave, BookingSlotClaim,
+    # Background jobs
+    JobWatermark,
 )
 
 
+def bump_pages(queryset, kind):
+    """Invalidate cached catalogue pages after a bulk update, which sends no signals"""
+    entities = [page_cache.entity(kind, pk) for pk in queryset.values_list('pk', flat=True)]
+    if kind == 'service':
+        entities += [
+            page_cache.entity('provider', pk)
+            for pk in set(queryset.values_list('provider_id', flat=True))
+        ]
+    page_cache.bump('catalog', *entities)
+
+
 @admin.register(ServiceCategory)
 class ServiceCategoryAdmin(admin.ModelAdmin):
     list_display = ['name', 'icon', 'is_active', 'total_services', 'created_at']
@@ -42,7 +57,7 @@ class ServiceProviderAdmin(admin.ModelAdmin):
     ]
     list_filter = ['verification_status', 'is_available', 'city', 'state', 'created_at']
     search_fields = ['business_name', 'user__username', 'email', 'contact_number', 'city']
-    readonly_fields = ['average_rating', 'total_reviews', 'total_bookings', 'created_at', 'updated_at']
+    readonly_fields = ['average_rating', 'total_reviews', 'rating_sum', 'total_bookings', 'created_at', 'updated_at']
     ordering = ['-average_rating', '-total_bookings']
     
     fieldsets = (
@@ -61,8 +76,12 @@ class ServiceProviderAdmin(admin.ModelAdmin):
         ('Verification', {
             'fields': ('verification_status', 'verification_document', 'verified_at')
         }),
+        ('Payout Bank Account', {
+            'fields': ('bank_account_name', 'bank_account_number', 'bank_ifsc'),
+            'classes': ('collapse',)
+        }),
         ('Statistics', {
-            'fields': ('average_rating', 'total_reviews', 'total_bookings'),
+            'fields': ('average_rating', 'total_reviews', 'rating_sum', 'total_bookings'),
             'classes': ('collapse',)
         }),
         ('Timestamps', {
@@ -89,11 +108,13 @@ class ServiceProviderAdmin(admin.ModelAdmin):
     def verify_providers(self, request, queryset):
         from django.utils import timezone
         updated = queryset.update(verification_status='verified', verified_at=timezone.now())
+        bump_pages(queryset, 'provider')
         self.message_user(request, f'{updated} provider(s) verified successfully.')
     verify_providers.short_description = 'Verify selected providers'
     
     def reject_providers(self, request, queryset):
         updated = queryset.update(verification_status='rejected')
+        bump_pages(queryset, 'provider')
         self.message_user(request, f'{updated} provider(s) rejected.')
     reject_providers.short_description = 'Reject selected providers'
 
@@ -146,11 +167,13 @@ class ServiceAdmin(admin.ModelAdmin):
     
     def approve_services(self, request, queryset):
         updated = queryset.update(approval_status='approved')
+        bump_pages(queryset, 'service')
         self.message_user(request, f'{updated} service(s) approved successfully.')
     approve_services.short_description = 'Approve selected services'
     
     def reject_services(self, request, queryset):
         updated = queryset.update(approval_status='rejected')
+        bump_pages(queryset, 'service')
         self.message_user(request, f'{updated} service(s) rejected.')
     reject_services.short_description = 'Reject selected services'
 
@@ -215,17 +238,30 @@ class BookingAdmin(admin.ModelAdmin):
     actions = ['confirm_bookings', 'mark_completed', 'cancel_bookings']
     
     def confirm_bookings(self, request, queryset):
+        provider_ids = set(queryset.values_list('provider_id', flat=True))
+        push.bulk_status_change(queryset, 'confirmed')
         updated = queryset.update(status='confirmed', confirmed_at=timezone.now())
+        counters.reconcile(provider_ids)
+        slots.forget(*provider_ids)
         self.message_user(request, f'{updated} booking(s) confirmed.')
     confirm_bookings.short_description = 'Confirm selected bookings'
     
     def mark_completed(self, request, queryset):
+        provider_ids = set(queryset.values_list('provider_id', flat=True))
+        push.bulk_status_change(queryset, 'completed')
         updated = queryset.update(status='completed', completed_at=timezone.now())
+        counters.reconcile(provider_ids)
+        slots.forget(*provider_ids)
         self.message_user(request, f'{updated} booking(s) marked as completed.')
     mark_completed.short_description = 'Mark as completed'
     
     def cancel_bookings(self, request, queryset):
+        provider_ids = set(queryset.values_list('provider_id', flat=True))
+        BookingSlotClaim.objects.filter(booking__in=queryset).delete()
+        push.bulk_status_change(queryset, 'cancelled')
         updated = queryset.update(status='cancelled')
+        counters.reconcile(provider_ids)
+        slots.forget(*provider_ids)
         self.message_user(request, f'{updated} booking(s) cancelled.')
     cancel_bookings.short_description = 'Cancel selected bookings'
 
@@ -288,6 +324,38 @@ class ProviderPortfolioAdmin(admin.ModelAdmin):
     ordering = ['-created_at']
 
 
+@admin.register(DispatchJob)
+class DispatchJobAdmin(admin.ModelAdmin):
+    list_display = [
+        'id', '__str__', 'category', 'priority', 'status', 'level',
+        'provider', 'accepted_by', 'requested_at', 'response_time'
+    ]
+    list_filter = ['status', 'priority', 'level', 'category']
+    ordering = ['status', 'priority', 'requested_at']
+    date_hierarchy = 'requested_at'
+    list_select_related = ['category', 'provider', 'accepted_by']
+    readonly_fields = [
+        'booking', 'service_request', 'category', 'geohash', 'priority', 'level', 'escalate_at',
+        'leased_by', 'lease_expires_at', 'attempts', 'requested_at', 'accepted_by', 'accepted_at', 'closed_at'
+    ]
+
+    def response_time(self, obj):
+        seconds = obj.response_seconds
+        return '-' if seconds is None else f'{seconds / 60:.1f} min'
+    response_time.short_description = 'Request to accept'
+
+
+class ServiceRequestMatchInline(admin.TabularInline):
+    model = ServiceRequestMatch
+    extra = 0
+    fields = ['rank', 'provider', 'score', 'distance_km']
+    readonly_fields = fields
+    can_delete = False
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
 @admin.register(ServiceRequest)
 class ServiceRequestAdmin(admin.ModelAdmin):
     list_display = [
@@ -346,6 +414,16 @@ class ServiceRequestAdmin(admin.ModelAdmin):
         )
     status_badge.short_description = 'Status'
 
+    inlines = [ServiceRequestMatchInline]
+    actions = ['match_requests']
+
+    def match_requests(self, request, queryset):
+        stats = matching.match_batch(list(queryset.filter(status='open')))
+        self.message_user(
+            request, f"{stats['requests']} open request(s) matched, {stats['assigned']} emergency request(s) assigned."
+        )
+    match_requests.short_description = 'Suggest providers for selected open requests'
+
 
 # ====================== PAYMENT & WALLET ADMIN ======================
 
@@ -354,7 +432,8 @@ class WalletAdmin(admin.ModelAdmin):
     list_display = ['user', 'balance_display', 'currency', 'is_active', 'created_at']
     list_filter = ['is_active', 'created_at']
     search_fields = ['user__username', 'user__email']
-    readonly_fields = ['created_at', 'updated_at']
+    # Balances only change through the ledger (services/ledger.py), which records a Transaction
+    readonly_fields = ['balance', 'created_at', 'updated_at']
     
     def balance_display(self, obj):
         color = 'green' if obj.balance > 0 else 'red'
@@ -400,6 +479,13 @@ class PaymentAdmin(admin.ModelAdmin):
         return format_html('<span style="color: {}; font-weight: bold;">● {}</span>', color, obj.get_status_display())
     status_badge.short_description = 'Status'
 
+    actions = ['refund_to_wallet']
+
+    def refund_to_wallet(self, request, queryset):
+        posted = ledger.refund_payments(queryset, reason=f'Refunded by {request.user.username}')
+        self.message_user(request, f'{len(posted)} payment(s) refunded to customer wallets.')
+    refund_to_wallet.short_description = 'Refund selected completed payments to wallets'
+
 
 @admin.register(Transaction)
 class TransactionAdmin(admin.ModelAdmin):
@@ -409,7 +495,7 @@ class TransactionAdmin(admin.ModelAdmin):
     ordering = ['-created_at']
     
     def amount_display(self, obj):
-        color = 'green' if obj.transaction_type == 'credit' else 'red'
+        color = 'red' if obj.transaction_type == 'debit' else 'green'
         return format_html('<span style="color: {}; font-weight: bold;">₹{}</span>', color, obj.amount)
     amount_display.short_description = 'Amount'
 
@@ -429,6 +515,18 @@ class MessageAdmin(admin.ModelAdmin):
     message_preview.short_description = 'Message'
 
 
+@admin.register(Conversation)
+class ConversationAdmin(admin.ModelAdmin):
+    list_display = ['user_a', 'user_b', 'last_activity_at', 'unread_a', 'unread_b']
+    search_fields = ['user_a__username', 'user_b__username']
+    list_select_related = ['user_a', 'user_b']
+    readonly_fields = ['user_a', 'user_b', 'last_message', 'last_activity_at', 'unread_a', 'unread_b', 'created_at']
+    ordering = ['-last_activity_at']
+
+    def has_add_permission(self, request):
+        return False
+
+
 # ====================== PROVIDER ANALYTICS ADMIN ======================
 
 @admin.register(ProviderEarnings)
@@ -436,22 +534,92 @@ class ProviderEarningsAdmin(admin.ModelAdmin):
     list_display = ['provider', 'booking', 'gross_amount', 'commission_amount', 'net_amount', 'payout_status', 'created_at']
     list_filter = ['payout_status', 'created_at']
     search_fields = ['provider__business_name', 'booking__id']
-    readonly_fields = ['created_at']
+    readonly_fields = ['payout_batch', 'created_at']
+    ordering = ['-created_at']
+
+
+class PayoutLineInline(admin.TabularInline):
+    model = PayoutLine
+    extra = 0
+    fields = ['provider', 'amount', 'earnings_count', 'status', 'account_name', 'account_number', 'ifsc']
+    readonly_fields = fields
+    can_delete = False
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(PayoutBatch)
+class PayoutBatchAdmin(admin.ModelAdmin):
+    # Batches are built with `python manage.py run_payouts`, which can take minutes at month end
+    list_display = ['reference', 'cutoff', 'status', 'provider_count', 'earnings_count', 'total_amount', 'created_at']
+    list_filter = ['status', 'created_at']
+    readonly_fields = [field.name for field in PayoutBatch._meta.fields]
     ordering = ['-created_at']
+    inlines = [PayoutLineInline]
+    actions = ['download_transfer_file', 'settle_batches', 'cancel_batches']
+
+    def has_add_permission(self, request):
+        return False
+
+    def download_transfer_file(self, request, queryset):
+        batches = list(queryset[:2])
+        if len(batches) != 1 or batches[0].status not in ('ready', 'paid'):
+            self.message_user(request, 'Select one ready or paid batch.', level='error')
+            return None
+        response = StreamingHttpResponse(payouts.transfer_file(batches[0]), content_type='text/csv')
+        response['Content-Disposition'] = f'attachment; filename="{batches[0].reference}.csv"'
+        return response
+    download_transfer_file.short_description = 'Download NEFT transfer file'
+
+    def settle_batches(self, request, queryset):
+        paid = sum(payouts.settle(batch) for batch in queryset.filter(status='ready'))
+        self.message_user(request, f'{paid} earning(s) marked paid.')
+    settle_batches.short_description = 'Mark selected ready batches paid'
+
+    def cancel_batches(self, request, queryset):
+        returned = sum(payouts.cancel(batch) for batch in queryset.filter(status__in=['building', 'ready']))
+        self.message_user(request, f'{returned} earning(s) returned to pending.')
+    cancel_batches.short_description = 'Cancel selected batches'
 
 
 @admin.register(ProviderStats)
 class ProviderStatsAdmin(admin.ModelAdmin):
-    list_display = ['provider', 'date', 'bookings_received', 'bookings_completed', 'revenue', 'average_rating_day']
-    list_filter = ['date', 'provider']
+    list_display = ['provider', 'period', 'date', 'bookings_received', 'bookings_completed', 'revenue', 'average_rating_day']
+    list_filter = ['period', 'date', 'provider']
     search_fields = ['provider__business_name']
     readonly_fields = ['created_at', 'updated_at']
     ordering = ['-date']
     date_hierarchy = 'date'
 
 
+@admin.register(ProviderCounters)
+class ProviderCountersAdmin(admin.ModelAdmin):
+    list_display = [
+        'provider', 'bookings_pending', 'bookings_confirmed', 'bookings_completed',
+        'bookings_total', 'pending_payout', 'unread_messages', 'active_services', 'updated_at'
+    ]
+    search_fields = ['provider__business_name']
+    readonly_fields = [field.name for field in ProviderCounters._meta.fields]
+    ordering = ['provider']
+
+    def has_add_permission(self, request):
+        return False
+
+
 # ====================== PROMOTIONS ADMIN ======================
 
+class CouponRedemptionInline(admin.TabularInline):
+    model = CouponRedemption
+    extra = 0
+    fields = ['user', 'booking', 'sequence', 'order_value', 'discount_amount', 'redeemed_at']
+    readonly_fields = fields
+    can_delete = False
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
 @admin.register(Coupon)
 class CouponAdmin(admin.ModelAdmin):
     list_display = ['code', 'coupon_type', 'discount_value', 'usage_stats', 'validity_badge', 'is_active']
@@ -492,6 +660,9 @@ class CouponAdmin(admin.ModelAdmin):
         return format_html('<span style="color: red;">✗ Expired</span>')
     validity_badge.short_description = 'Validity'
 
+    # Redemptions are only made by services/coupons.py, which also counts them in used_count
+    inlines = [CouponRedemptionInline]
+
 
 @admin.register(ServicePackage)
 class ServicePackageAdmin(admin.ModelAdmin):
@@ -509,6 +680,12 @@ class ReferralAdmin(admin.ModelAdmin):
     search_fields = ['referrer__username', 'referred__username', 'referral_code']
     readonly_fields = ['created_at', 'completed_at']
     ordering = ['-created_at']
+    actions = ['pay_rewards']
+
+    def pay_rewards(self, request, queryset):
+        posted = ledger.pay_referral_rewards(queryset)
+        self.message_user(request, f'{len(posted)} referral reward(s) credited to wallets.')
+    pay_rewards.short_description = 'Credit rewards of selected completed referrals'
 
 
 @admin.register(LoyaltyPoints)
@@ -516,7 +693,9 @@ class LoyaltyPointsAdmin(admin.ModelAdmin):
     list_display = ['user', 'points', 'tier_badge', 'total_earned', 'total_redeemed', 'updated_at']
     list_filter = ['tier', 'created_at']
     search_fields = ['user__username']
-    readonly_fields = ['created_at', 'updated_at']
+    # Points only change through services/loyalty.py, which records a LoyaltyEvent
+    readonly_fields = ['points', 'tier', 'total_earned', 'total_redeemed', 'created_at', 'updated_at']
+    actions = ['audit_balances']
     
     def tier_badge(self, obj):
         colors = {'bronze': '#CD7F32', 'silver': '#C0C0C0', 'gold': '#FFD700', 'platinum': '#E5E4E2'}
@@ -524,6 +703,37 @@ class LoyaltyPointsAdmin(admin.ModelAdmin):
         return format_html('<span style="color: {}; font-weight: bold;">★ {}</span>', color, obj.tier.upper())
     tier_badge.short_description = 'Tier'
 
+    def audit_balances(self, request, queryset):
+        mismatches = loyalty.audit(queryset.values_list('user_id', flat=True))
+        if mismatches:
+            users = ', '.join(f'#{row[0]}' for row in mismatches)
+            self.message_user(request, f'{len(mismatches)} balance(s) disagree with the ledger: users {users}.',
+                              level='warning')
+        else:
+            self.message_user(request, 'Every selected balance matches the ledger.')
+    audit_balances.short_description = 'Check selected balances against the points ledger'
+
+
+@admin.register(LoyaltyEvent)
+class LoyaltyEventAdmin(admin.ModelAdmin):
+    list_display = ['user', 'points_display', 'event_type', 'description', 'booking', 'created_at']
+    list_filter = ['event_type', 'created_at']
+    search_fields = ['user__username', 'description']
+    ordering = ['-created_at']
+    readonly_fields = ['user', 'event_type', 'points', 'booking', 'description', 'created_at']
+
+    def points_display(self, obj):
+        color = 'red' if obj.points < 0 else 'green'
+        return format_html('<span style="color: {}; font-weight: bold;">{}</span>', color, f'{obj.points:+d}')
+    points_display.short_description = 'Points'
+
+    # The ledger is append-only
+    def has_add_permission(self, request):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
 
 # ====================== CUSTOMER FEATURES ADMIN ======================
 
@@ -555,7 +765,9 @@ class NotificationAdmin(admin.ModelAdmin):
     
     def mark_as_read(self, request, queryset):
         from django.utils import timezone
+        user_ids = set(queryset.values_list('user_id', flat=True))
         updated = queryset.update(is_read=True, read_at=timezone.now())
+        counters.reconcile(ServiceProvider.objects.filter(user_id__in=user_ids).values_list('id', flat=True))
         self.message_user(request, f'{updated} notification(s) marked as read.')
     mark_as_read.short_description = 'Mark selected as read'
 
@@ -689,3 +901,23 @@ class ProviderLeaveAdmin(admin.ModelAdmin):
     ordering = ['-start_date']
     date_hierarchy = 'start_date'
 
+
+@admin.register(BookingSlotClaim)
+class BookingSlotClaimAdmin(admin.ModelAdmin):
+    list_display = ['provider', 'slot_start', 'booking']
+    search_fields = ['provider__business_name']
+    readonly_fields = ['provider', 'booking', 'slot_start']
+    ordering = ['-slot_start']
+    date_hierarchy = 'slot_start'
+
+    def has_add_permission(self, request):
+        return False
+
+
+# ====================== BACKGROUND JOBS ADMIN ======================
+
+@admin.register(JobWatermark)
+class JobWatermarkAdmin(admin.ModelAdmin):
+    list_display = ['name', 'position', 'updated_at']
+    readonly_fields = ['updated_at']
+    ordering = ['name']
@@ -0,0 +1,54 @@
+"""
+Single-query histograms
+
+``histograms`` turns "one COUNT per status" code into one aggregate query
+with a FILTER (or CASE, depending on the backend) clause per bucket:
+
+    histograms(Booking.objects.filter(user=user), 'status')
+    -> {'total': 12, 'status': {'pending': 2, 'confirmed': 1, 'in_progress': 0, ...}}
+
+Several fields can be bucketed at once, and ``sum_of`` sums a column per
+bucket instead of counting rows:
+
+    histograms(earnings, 'payout_status', sum_of='net_amount')
+    -> {'total': Decimal('5400.00'), 'payout_status': {'pending': ..., 'paid': ..., ...}}
+"""
+from django.db.models import Count, Q, Sum
+
+
+def _bucket_values(model, field, values):
+    if values and field in values:
+        return list(values[field])
+    choices = model._meta.get_field(field).choices
+    if not choices:
+        raise ValueError(f'{model.__name__}.{field} has no choices; pass values={{{field!r}: [...]}}')
+    return [value for value, _ in choices]
+
+
+def histograms(queryset, *fields, sum_of=None, values=None):
+    """
+    Count rows (or sum `sum_of`) per value of each of `fields` in one query.
+
+    Buckets default to the field's choices; pass `values` ({field: iterable})
+    for fields without choices, such as ratings or booleans. Every bucket is
+    present in the result, empty ones as 0. 'total' covers all rows.
+    """
+    aggregate = Count if sum_of is None else Sum
+    measure = 'pk' if sum_of is None else sum_of
+
+    aggregates = {'total': aggregate(measure)}
+    buckets = {}
+    for field in fields:
+        for index, value in enumerate(_bucket_values(queryset.model, field, values)):
+            alias = f'{field}_{index}'
+            aggregates[alias] = aggregate(measure, filter=Q(**{field: value}))
+            buckets[alias] = (field, value)
+
+    row = queryset.order_by().aggregate(**aggregates)
+
+    result = {'total': row['total'] or 0}
+    for field in fields:
+        result[field] = {}
+    for alias, (field, value) in buckets.items():
+        result[field][value] = row[alias] or 0
+    return result
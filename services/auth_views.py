@@ -91,7 +91,7 @@ def profile_view(request):
 def provider_onboarding_view(request):
     """Create a ServiceProvider profile for the logged-in user"""
     # If provider profile already exists, skip onboarding
-    if hasattr(request.user, 'provider_profile'):
+    if request.role == 'provider':
         messages.info(request, 'Your provider profile already exists.')
         return redirect('profile')
 
@@ -0,0 +1,153 @@
+"""
+Conversation inbox
+
+Each pair of users who have exchanged messages shares one Conversation row
+holding what an inbox shows: the last message, when it was sent and how many
+messages each participant has not read. The signal handlers in
+services/signals.py keep it current as messages come and go:
+
+    message sent     attached to the pair's conversation (created with the
+                     first message); one UPDATE makes it the last message and
+                     adds one to the receiver's unread counter
+    message read     one F() UPDATE takes one off the receiver's counter
+    message deleted  the conversation is recomputed from its messages
+
+so an inbox page costs one query for the conversations on it, however long
+the history behind them.
+
+Changes that bypass signals (QuerySet.update(), bulk_create()) are repaired
+by ``reconcile()``, also available as ``python manage.py reconcile_conversations``.
+"""
+from collections import Counter
+
+from django.db.models import BigIntegerField, Case, Count, F, IntegerField, OuterRef, Q, Subquery, Value, When
+from django.db.models.functions import Coalesce, Greatest
+
+from services import counters
+from services.models import Conversation, Message
+
+
+def participants(user_id, other_id):
+    """Return the (user_a_id, user_b_id) pair of a conversation, lower ID first"""
+    return (user_id, other_id) if user_id <= other_id else (other_id, user_id)
+
+
+def unread_field(sender_id, receiver_id):
+    """Name of the counter that a message from `sender_id` to `receiver_id` counts towards"""
+    return 'unread_a' if receiver_id <= sender_id else 'unread_b'
+
+
+def for_user(user):
+    """Conversations `user` takes part in, most recently active first"""
+    return Conversation.objects.filter(Q(user_a=user) | Q(user_b=user)).order_by('-last_activity_at', '-id')
+
+
+def conversation_for(message):
+    """Return the conversation `message` belongs to, creating it for the pair's first message"""
+    user_a_id, user_b_id = participants(message.sender_id, message.receiver_id)
+    conversation, _ = Conversation.objects.get_or_create(
+        user_a_id=user_a_id, user_b_id=user_b_id, defaults={'last_activity_at': message.created_at},
+    )
+    return conversation
+
+
+def snapshot(message):
+    """Return (conversation_id, sender_id, receiver_id, is_read), or None if any of them is deferred"""
+    values = message.__dict__
+    fields = ('conversation_id', 'sender_id', 'receiver_id', 'is_read')
+    if any(field not in values for field in fields):
+        return None
+    return tuple(values[field] for field in fields)
+
+
+def record_message(message):
+    """Make a newly saved message its conversation's latest and count it as unread for the receiver"""
+    newer = Q(last_activity_at__lte=message.created_at)
+    updates = {
+        # Both expressions read the row from before the UPDATE, so an older (imported) message changes neither
+        'last_message': Case(
+            When(newer, then=Value(message.id)), default=F('last_message'), output_field=BigIntegerField(),
+        ),
+        'last_activity_at': Case(When(newer, then=Value(message.created_at)), default=F('last_activity_at')),
+    }
+    if not message.is_read:
+        field = unread_field(message.sender_id, message.receiver_id)
+        updates[field] = F(field) + 1
+    Conversation.objects.filter(pk=message.conversation_id).update(**updates)
+
+
+def apply_change(old, new):
+    """Move the unread counters from the `old` snapshot of a message to the `new` one"""
+    deltas = Counter()
+    for values, sign in ((old, -1), (new, 1)):
+        if values is None:
+            continue
+        conversation_id, sender_id, receiver_id, is_read = values
+        if conversation_id is not None and not is_read:
+            deltas[conversation_id, unread_field(sender_id, receiver_id)] += sign
+
+    for (conversation_id, field), delta in deltas.items():
+        if delta:
+            Conversation.objects.filter(pk=conversation_id).update(**{field: F(field) + delta})
+
+
+def mark_read(conversation, user, now):
+    """Mark every message `user` received in `conversation` as read; returns the number of messages"""
+    updated = Message.objects.filter(conversation=conversation, receiver=user, is_read=False).update(
+        is_read=True, read_at=now,
+    )
+    if updated:
+        # QuerySet.update() skips the signal handlers; subtract what was marked rather than
+        # zeroing, so a message arriving meanwhile stays counted
+        field = 'unread_a' if user.id == conversation.user_a_id else 'unread_b'
+        Conversation.objects.filter(pk=conversation.pk).update(**{field: Greatest(F(field) - updated, 0)})
+        setattr(conversation, field, max(getattr(conversation, field) - updated, 0))
+        counters.apply_change(Message, (user.id, False), (user.id, True), count=updated)
+    return updated
+
+
+def attach_orphans():
+    """Give messages saved without signals (bulk_create) their conversation; returns the conversation IDs"""
+    orphans = Message.objects.filter(conversation__isnull=True)
+    pairs = {participants(*pair) for pair in orphans.order_by().values_list('sender_id', 'receiver_id').distinct()}
+    conversation_ids = []
+    for user_a_id, user_b_id in pairs:
+        conversation, _ = Conversation.objects.get_or_create(user_a_id=user_a_id, user_b_id=user_b_id)
+        orphans.filter(
+            Q(sender_id=user_a_id, receiver_id=user_b_id) | Q(sender_id=user_b_id, receiver_id=user_a_id)
+        ).update(conversation=conversation)
+        conversation_ids.append(conversation.id)
+    return conversation_ids
+
+
+def reconcile(conversation_ids=None, batch_size=500):
+    """
+    Rebuild last_message, last_activity_at and the unread counters of
+    `conversation_ids` from the messages table. When conversation_ids is
+    None, orphaned messages are attached first and every conversation is
+    recomputed. Returns the number of conversations updated.
+    """
+    conversations = Conversation.objects.order_by('id')
+    if conversation_ids is None:
+        attach_orphans()
+    else:
+        conversations = conversations.filter(id__in=conversation_ids)
+
+    thread = Message.objects.filter(conversation=OuterRef('pk'))
+    latest = thread.order_by('-created_at', '-id')
+
+    def unread(receiver):
+        counts = thread.filter(receiver=OuterRef(receiver), is_read=False).order_by().values('conversation')
+        return Coalesce(
+            Subquery(counts.annotate(total=Count('id')).values('total'), output_field=IntegerField()), 0,
+        )
+
+    ids = list(conversations.values_list('id', flat=True))
+    for start in range(0, len(ids), batch_size):
+        Conversation.objects.filter(id__in=ids[start:start + batch_size]).update(
+            last_message=Subquery(latest.values('id')[:1]),
+            last_activity_at=Coalesce(Subquery(latest.values('created_at')[:1]), F('created_at')),
+            unread_a=unread('user_a'),
+            unread_b=unread('user_b'),
+        )
+    return len(ids)
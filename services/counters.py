@@ -0,0 +1,209 @@
+"""
+Incrementally maintained provider dashboard counters
+
+Every tracked model contributes to a ProviderCounters row (a booking adds one
+to its status column, a pending earning adds its net amount to the payout,
+...). When a tracked row is saved or deleted the signal handlers in
+services/signals.py read the row as stored, locked inside the transaction
+of the write (models.CountedModel), and apply the difference between its
+old and new contribution with a single F() UPDATE, so dashboards read one
+row instead of running a dozen aggregates.
+
+Changes that bypass model signals (QuerySet.update(), bulk_create(), raw SQL)
+are repaired by ``reconcile()``, also available as
+``python manage.py reconcile_provider_counters``.
+"""
+from django.db.models import Count, F, Sum
+
+from services.models import (
+    Booking, Message, Notification, ProviderCounters, ProviderEarnings, Service, ServiceProvider,
+)
+
+BOOKING_STATUS_FIELDS = {status: f'bookings_{status}' for status, _ in Booking.BOOKING_STATUS}
+
+
+def _booking(provider_id, status):
+    contribution = {'bookings_total': 1}
+    if status in BOOKING_STATUS_FIELDS:
+        contribution[BOOKING_STATUS_FIELDS[status]] = 1
+    return ('provider_id', provider_id), contribution
+
+
+def _earning(provider_id, payout_status, net_amount):
+    return ('provider_id', provider_id), {'pending_payout': net_amount if payout_status == 'pending' else 0}
+
+
+def _message(receiver_id, is_read):
+    return ('provider__user_id', receiver_id), {'unread_messages': 0 if is_read else 1}
+
+
+def _notification(user_id, is_read):
+    return ('provider__user_id', user_id), {'unread_notifications': 0 if is_read else 1}
+
+
+def _service(provider_id, is_active):
+    return ('provider_id', provider_id), {'active_services': 1 if is_active else 0}
+
+
+# model -> (fields snapshotted on load, contribution of one row)
+TRACKED_MODELS = {
+    Booking: (('provider_id', 'status'), _booking),
+    ProviderEarnings: (('provider_id', 'payout_status', 'net_amount'), _earning),
+    Message: (('receiver_id', 'is_read'), _message),
+    Notification: (('user_id', 'is_read'), _notification),
+    Service: (('provider_id', 'is_active'), _service),
+}
+
+
+def snapshot(instance, stored=None):
+    """
+    Return the tracked field values of an instance. Deferred fields are
+    taken from `stored` (the row as saved, which they were not written
+    over); without it, returns None if any are deferred.
+    """
+    fields, _ = TRACKED_MODELS[type(instance)]
+    values = instance.__dict__
+    if stored is not None:
+        return tuple(values.get(field, old) for field, old in zip(fields, stored))
+    if any(field not in values for field in fields):
+        return None
+    return tuple(values[field] for field in fields)
+
+
+def stored_snapshot(instance):
+    """
+    Read the tracked field values of an instance's row from the database,
+    locking it until the transaction ends; None if there is no such row.
+    Called inside the transaction of the save or delete (see CountedModel),
+    so two requests moving the same row count the move once each from
+    what the other left, rather than both from what they loaded.
+    """
+    model = type(instance)
+    fields, _ = TRACKED_MODELS[model]
+    return model._base_manager.select_for_update().filter(pk=instance.pk).values_list(*fields).first()
+
+
+def touches(model, update_fields):
+    """Whether a save limited to `update_fields` can change the tracked fields of `model`"""
+    fields, _ = TRACKED_MODELS[model]
+    names = set(update_fields)
+    return any(field in names or field.removesuffix('_id') in names for field in fields)
+
+
+def apply_change(model, old, new, count=1):
+    """Move the counters from the `old` snapshot's contribution to the `new` one's, for `count` rows"""
+    _, contribute = TRACKED_MODELS[model]
+    changes = {}
+    for values, sign in ((old, -count), (new, count)):
+        if values is None:
+            continue
+        key, contribution = contribute(*values)
+        bucket = changes.setdefault(key, {})
+        for field, amount in contribution.items():
+            bucket[field] = bucket.get(field, 0) + sign * amount
+
+    for (lookup, value), deltas in changes.items():
+        updates = {field: F(field) + delta for field, delta in deltas.items() if delta}
+        if updates and value is not None:
+            # Providers without a counters row yet get one from reconcile() on first read
+            ProviderCounters.objects.filter(**{lookup: value}).update(**updates)
+
+
+def reconcile_affected(model, values):
+    """Recompute the counters row a tracked row contributes to"""
+    _, contribute = TRACKED_MODELS[model]
+    (lookup, value), _ = contribute(*values)
+    if lookup == 'provider_id':
+        reconcile([value])
+    else:
+        reconcile(ServiceProvider.objects.filter(user_id=value).values_list('id', flat=True))
+
+
+def reconcile(provider_ids=None, batch_size=500):
+    """
+    Recompute counters from the source tables and upsert them.
+    Recomputes every provider when provider_ids is None. Returns the number of rows written.
+    """
+    providers = ServiceProvider.objects.order_by('id')
+    if provider_ids is not None:
+        providers = providers.filter(id__in=list(provider_ids))
+
+    written = 0
+    batch = []
+    for row in providers.values_list('id', 'user_id').iterator(chunk_size=batch_size):
+        batch.append(row)
+        if len(batch) >= batch_size:
+            written += _reconcile_batch(batch)
+            batch = []
+    if batch:
+        written += _reconcile_batch(batch)
+    return written
+
+
+def _reconcile_batch(providers):
+    ids = [provider_id for provider_id, _ in providers]
+    user_ids = [user_id for _, user_id in providers]
+
+    counters = {provider_id: ProviderCounters(provider_id=provider_id) for provider_id in ids}
+
+    bookings = (
+        Booking.objects.filter(provider_id__in=ids)
+        .values('provider_id', 'status').annotate(total=Count('id')).order_by()
+    )
+    for row in bookings:
+        row_counters = counters[row['provider_id']]
+        row_counters.bookings_total += row['total']
+        field = BOOKING_STATUS_FIELDS.get(row['status'])
+        if field:
+            setattr(row_counters, field, row['total'])
+
+    payouts = (
+        ProviderEarnings.objects.filter(provider_id__in=ids, payout_status='pending')
+        .values('provider_id').annotate(total=Sum('net_amount')).order_by()
+    )
+    for row in payouts:
+        counters[row['provider_id']].pending_payout = row['total']
+
+    services = (
+        Service.objects.filter(provider_id__in=ids, is_active=True)
+        .values('provider_id').annotate(total=Count('id')).order_by()
+    )
+    for row in services:
+        counters[row['provider_id']].active_services = row['total']
+
+    provider_for_user = {user_id: provider_id for provider_id, user_id in providers}
+    unread_messages = (
+        Message.objects.filter(receiver_id__in=user_ids, is_read=False)
+        .values('receiver_id').annotate(total=Count('id')).order_by()
+    )
+    for row in unread_messages:
+        counters[provider_for_user[row['receiver_id']]].unread_messages = row['total']
+
+    unread_notifications = (
+        Notification.objects.filter(user_id__in=user_ids, is_read=False)
+        .values('user_id').annotate(total=Count('id')).order_by()
+    )
+    for row in unread_notifications:
+        counters[provider_for_user[row['user_id']]].unread_notifications = row['total']
+
+    ProviderCounters.objects.bulk_create(
+        counters.values(),
+        update_conflicts=True,
+        unique_fields=['provider'],
+        update_fields=[
+            'bookings_pending', 'bookings_confirmed', 'bookings_in_progress',
+            'bookings_completed', 'bookings_cancelled', 'bookings_total',
+            'pending_payout', 'unread_messages', 'unread_notifications', 'active_services',
+            'updated_at',
+        ],
+    )
+    return len(counters)
+
+
+def get_counters(provider):
+    """Return the provider's counters row, computing it on first use"""
+    counters = ProviderCounters.objects.filter(provider=provider).first()
+    if counters is None:
+        reconcile([provider.id])
+        counters = ProviderCounters.objects.get(provider=provider)
+    return counters
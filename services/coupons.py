@@ -0,0 +1,209 @@
+"""
+Coupon engine
+
+Applying a coupon to a booking checks every rule of the Coupon:
+
+    window          is_active and valid_from <= now <= valid_to
+    applicability   the booking's service is one of applicable_services or
+                    its category one of applicable_categories; a coupon
+                    with neither applies everywhere
+    order value     the booking amount is at least min_order_value
+    first booking   'first_booking' coupons only apply to a customer's
+                    first booking
+    per user        a customer uses the coupon at most per_user_limit times.
+                    Every use is a CouponRedemption taking the customer's
+                    lowest free number from 1 to per_user_limit, and a
+                    unique constraint on the number lets only one of two
+                    concurrent redemptions have it
+    usage limit     used_count is raised with one conditional UPDATE that
+                    only matches while it is below usage_limit, so a flash
+                    sale hands out exactly usage_limit uses however many
+                    customers redeem at once
+
+'percentage' and 'first_booking' coupons take discount_value percent off,
+'fixed' ones discount_value; max_discount and the amount itself cap both.
+
+The rules of active coupons are compiled once per process into an index by
+code, service and category (``rules()``). It is rebuilt when the 'coupons'
+version in services/page_cache.py changes; the signal handlers in
+services/signals.py bump it when a coupon or its applicability changes.
+used_count is left out, so redemptions never invalidate the index, and
+applying a coupon costs the same few queries however many coupons exist.
+
+Deleting a booking deletes its redemption and gives the use back: its
+number is free again and ``release()`` lowers used_count.
+"""
+from collections import defaultdict, namedtuple
+from decimal import Decimal
+from itertools import chain
+
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from services import page_cache
+from services.models import Booking, Coupon, CouponRedemption
+
+CENT = Decimal('0.01')
+
+Rule = namedtuple('Rule', [
+    'id', 'code', 'description', 'coupon_type', 'discount_value', 'max_discount', 'min_order_value',
+    'per_user_limit', 'valid_from', 'valid_to', 'category_ids', 'service_ids',
+])
+Index = namedtuple('Index', 'by_code by_category by_service everywhere')
+
+_index = (None, None)  # (coupons version, Index)
+
+
+class CouponError(Exception):
+    """A coupon cannot be applied; the message says why"""
+
+
+def normalize(code):
+    return (code or '').strip().upper()
+
+
+def _compile():
+    coupons = list(Coupon.objects.filter(is_active=True, valid_to__gte=timezone.now()))
+    ids = [coupon.id for coupon in coupons]
+    categories, services = defaultdict(set), defaultdict(set)
+    for coupon_id, category_id in Coupon.applicable_categories.through.objects.filter(
+        coupon_id__in=ids
+    ).values_list('coupon_id', 'servicecategory_id'):
+        categories[coupon_id].add(category_id)
+    for coupon_id, service_id in Coupon.applicable_services.through.objects.filter(
+        coupon_id__in=ids
+    ).values_list('coupon_id', 'service_id'):
+        services[coupon_id].add(service_id)
+
+    index = Index({}, defaultdict(list), defaultdict(list), [])
+    for coupon in coupons:
+        rule = Rule(
+            coupon.id, coupon.code, coupon.description, coupon.coupon_type, coupon.discount_value,
+            coupon.max_discount, coupon.min_order_value, coupon.per_user_limit, coupon.valid_from,
+            coupon.valid_to, frozenset(categories[coupon.id]), frozenset(services[coupon.id]),
+        )
+        index.by_code[normalize(coupon.code)] = rule
+        for category_id in rule.category_ids:
+            index.by_category[category_id].append(rule)
+        for service_id in rule.service_ids:
+            index.by_service[service_id].append(rule)
+        if not rule.category_ids and not rule.service_ids:
+            index.everywhere.append(rule)
+    return index
+
+
+def rules():
+    """Return the Index of active coupons, rebuilding it if a coupon changed since it was built"""
+    global _index
+    version = page_cache.versions(['coupons'])['coupons']
+    if _index[0] != version:
+        _index = (version, _compile())
+    return _index[1]
+
+
+def discount(rule, amount):
+    """The discount `rule` gives on `amount`"""
+    if rule.coupon_type == 'fixed':
+        value = rule.discount_value
+    else:
+        value = (amount * rule.discount_value / 100).quantize(CENT)
+    if rule.max_discount is not None:
+        value = min(value, rule.max_discount)
+    return min(value, amount)
+
+
+def applies_to(rule, service):
+    return (
+        (not rule.category_ids and not rule.service_ids)
+        or service.id in rule.service_ids
+        or service.category_id in rule.category_ids
+    )
+
+
+def for_service(service, now=None):
+    """Coupons that can be used on `service` now, largest discount on its price first"""
+    now = now or timezone.now()
+    index = rules()
+    found = {
+        rule.id: rule
+        for rule in chain(index.by_service.get(service.id, ()), index.by_category.get(service.category_id, ()),
+                          index.everywhere)
+        if rule.valid_from <= now <= rule.valid_to
+    }
+    return sorted(found.values(), key=lambda rule: (-discount(rule, service.price), rule.code))
+
+
+def evaluate(code, service, amount, user=None, now=None):
+    """
+    Return (rule, discount) for using `code` on a booking of `service` worth
+    `amount`; raises CouponError if it cannot be used. Checks the customer's
+    own limits when `user` is given, but not the coupon's overall usage
+    limit, which only apply() can settle.
+    """
+    now = now or timezone.now()
+    rule = rules().by_code.get(normalize(code))
+    if rule is None or not rule.valid_from <= now <= rule.valid_to:
+        raise CouponError('This coupon code is invalid or has expired')
+    if not applies_to(rule, service):
+        raise CouponError(f'{rule.code} cannot be used on this service')
+    if amount < rule.min_order_value:
+        raise CouponError(f'{rule.code} needs an order of at least ₹{rule.min_order_value}')
+    if user is not None:
+        if rule.coupon_type == 'first_booking' and Booking.objects.filter(user=user).exists():
+            raise CouponError(f'{rule.code} is only valid on your first booking')
+        if CouponRedemption.objects.filter(coupon_id=rule.id, user=user).count() >= rule.per_user_limit:
+            raise CouponError(f'You have already used {rule.code}')
+    return rule, discount(rule, amount)
+
+
+def _free_sequence(rule, user_id):
+    """The lowest use number up to per_user_limit the customer has not taken, or None"""
+    taken = set(CouponRedemption.objects.filter(coupon_id=rule.id, user_id=user_id).values_list('sequence', flat=True))
+    return next((number for number in range(1, rule.per_user_limit + 1) if number not in taken), None)
+
+
+def apply(booking, code, now=None):
+    """
+    Redeem `code` on a booking that was just saved: records the redemption,
+    counts the use and lowers booking.total_amount. Returns the discount, or
+    raises CouponError and leaves everything as it was. `booking.service`
+    should already be loaded.
+    """
+    if booking.user_id is None:
+        raise CouponError('Sign in to use a coupon')
+    now = now or timezone.now()
+    amount = booking.total_amount
+    rule, value = evaluate(code, booking.service, amount, now=now)
+    if rule.coupon_type == 'first_booking' and Booking.objects.filter(
+        user_id=booking.user_id
+    ).exclude(pk=booking.pk).exists():
+        raise CouponError(f'{rule.code} is only valid on your first booking')
+    sequence = _free_sequence(rule, booking.user_id)
+    if sequence is None:
+        raise CouponError(f'You have already used {rule.code}')
+
+    try:
+        with transaction.atomic():
+            # Re-checks the window as well, in case the coupon changed without signals
+            taken = Coupon.objects.filter(
+                Q(usage_limit__isnull=True) | Q(used_count__lt=F('usage_limit')),
+                pk=rule.id, is_active=True, valid_from__lte=now, valid_to__gte=now,
+            ).update(used_count=F('used_count') + 1)
+            if not taken:
+                raise CouponError(f'{rule.code} has been fully redeemed')
+            CouponRedemption.objects.create(
+                coupon_id=rule.id, user_id=booking.user_id, booking=booking, sequence=sequence,
+                order_value=amount, discount_amount=value, redeemed_at=now,
+            )
+            Booking.objects.filter(pk=booking.pk).update(total_amount=amount - value)
+    except IntegrityError:
+        # A concurrent redemption by the same customer took this use
+        raise CouponError(f'You have already used {rule.code}')
+    booking.total_amount = amount - value
+    return value
+
+
+def release(redemption):
+    """Give back the use of a deleted redemption"""
+    Coupon.objects.filter(pk=redemption.coupon_id, used_count__gt=0).update(used_count=F('used_count') - 1)
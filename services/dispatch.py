@@ -0,0 +1,333 @@
+"""
+Emergency dispatch queue
+
+Emergency bookings and high or emergency urgency service requests get a
+DispatchJob when they are created (signal handlers in services/signals.py).
+Providers work the queue with a claim/lease protocol:
+
+    claim()     leases the most urgent job the provider may take, oldest
+                first within a priority, for LEASE_SECONDS. The lease is
+                taken with one conditional UPDATE, so when several providers
+                go for the same job exactly one gets it and the others move
+                on to the next one
+    accept()    turns a live lease into the assignment: the booking is
+                confirmed, or the request is assigned to the provider
+    release()   hands a leased job back to the queue
+
+A lease that runs out puts the job back in the queue. A booking's job goes
+to the booked provider, and a request's job to the provider it was matched
+to (services/matching.py). Otherwise the job is open to every provider who
+offers its category (emergency service, for emergencies) and is within
+about matching.MAX_DISTANCE_KM of it.
+
+Jobs that nobody accepts escalate on a timer (ESCALATION_MINUTES). Run
+``escalate()`` every minute with ``python manage.py escalate_dispatch_jobs``,
+which first queues what was saved without signals (``backfill()``):
+
+    level 1   an unassigned request's job opens to every eligible provider
+              nearby and its suggested providers are notified; a booking's
+              provider, or the provider a request was assigned to (matching
+              assigns emergencies itself), is reminded and keeps the job
+    level 2   staff are notified
+
+``metrics()`` reports request-to-accept times per priority against
+TARGET_MINUTES.
+"""
+import math
+from collections import defaultdict
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from services import counters, geo, matching
+from services.models import Booking, DispatchJob, Notification, ServiceProvider, ServiceRequest
+
+EMERGENCY, HIGH = 0, 1
+URGENCY_PRIORITY = {'emergency': EMERGENCY, 'high': HIGH}
+OPEN_STATUSES = ('queued', 'leased')
+LEASE_SECONDS = 120
+CLAIM_CANDIDATES = 5  # jobs tried per claim before giving up on a busy queue
+ESCALATION_MINUTES = {EMERGENCY: (5, 15), HIGH: (30, 120)}  # after the request, per level
+TARGET_MINUTES = {EMERGENCY: 15, HIGH: 60}
+METRICS_DAYS = 7
+
+
+class LeaseLost(Exception):
+    """The provider's lease on a job expired or was never theirs, or its request went to someone else"""
+
+
+def _escalation_time(priority, requested_at, level):
+    steps = ESCALATION_MINUTES[priority]
+    return requested_at + timedelta(minutes=steps[level]) if level < len(steps) else None
+
+
+def _booking_job(booking):
+    return DispatchJob(
+        booking=booking,
+        category_id=booking.service.category_id,
+        provider_id=booking.provider_id,
+        priority=EMERGENCY,
+        requested_at=booking.created_at,
+        escalate_at=_escalation_time(EMERGENCY, booking.created_at, 0),
+    )
+
+
+def _request_job(service_request):
+    priority = URGENCY_PRIORITY[service_request.urgency]
+    point = geo.locate(service_request.pincode, service_request.city)
+    return DispatchJob(
+        service_request=service_request,
+        category_id=service_request.category_id,
+        provider_id=service_request.assigned_provider_id,
+        geohash=geo.encode(*point) if point else '',
+        priority=priority,
+        requested_at=service_request.created_at,
+        escalate_at=_escalation_time(priority, service_request.created_at, 0),
+    )
+
+
+def enqueue_booking(booking):
+    """Queue an emergency booking for its provider"""
+    job = _booking_job(booking)
+    job.save()
+    return job
+
+
+def enqueue_request(service_request):
+    """Queue a high or emergency urgency request; returns the job, or None for other urgencies"""
+    if service_request.urgency not in URGENCY_PRIORITY:
+        return None
+    job = _request_job(service_request)
+    job.save()
+    return job
+
+
+def backfill():
+    """Queue pending emergency bookings and open urgent requests saved without signals; returns the number queued"""
+    bookings = Booking.objects.filter(
+        is_emergency=True, status='pending', dispatch_job__isnull=True
+    ).select_related('service')
+    # Requests already assigned have nobody left to dispatch to
+    requests = ServiceRequest.objects.filter(
+        status='open', urgency__in=list(URGENCY_PRIORITY), dispatch_job__isnull=True
+    )
+    jobs = [_booking_job(booking) for booking in bookings] + [_request_job(request) for request in requests]
+    DispatchJob.objects.bulk_create(jobs)
+    return len(jobs)
+
+
+def claimable(now):
+    """Q matching jobs nobody holds a live lease on"""
+    return Q(status='queued') | Q(status='leased', lease_expires_at__lt=now)
+
+
+def eligible(provider):
+    """Q matching the jobs `provider` may take"""
+    categories, emergency_categories = set(), set()
+    for category_id, emergency in provider.services.filter(
+        is_active=True, approval_status='approved'
+    ).values_list('category_id', 'is_emergency_available'):
+        categories.add(category_id)
+        if emergency:
+            emergency_categories.add(category_id)
+
+    untargeted = Q(provider__isnull=True) & (
+        Q(priority=EMERGENCY, category_id__in=emergency_categories)
+        | Q(priority__gt=EMERGENCY, category_id__in=categories)
+    )
+    if provider.latitude is not None and provider.longitude is not None:
+        cells = geo.covering_cells(float(provider.latitude), float(provider.longitude), matching.MAX_DISTANCE_KM)
+        untargeted &= geo.cell_filter('', cells) | Q(geohash='')
+    return Q(provider=provider) | untargeted
+
+
+def queue(provider, now=None):
+    """Open jobs `provider` may take, most urgent and oldest first"""
+    now = now or timezone.now()
+    return DispatchJob.objects.filter(claimable(now) | Q(leased_by=provider, status='leased'), eligible(provider))
+
+
+def claim(provider, now=None):
+    """
+    Lease the most urgent job `provider` may take and return it, or None if
+    there is none. A provider holds one lease at a time: while it lasts,
+    claiming again returns the same job.
+    """
+    now = now or timezone.now()
+    held = DispatchJob.objects.filter(leased_by=provider, status='leased', lease_expires_at__gte=now).first()
+    if held is not None:
+        return held
+
+    candidates = list(
+        DispatchJob.objects.filter(claimable(now), eligible(provider))
+        .order_by('priority', 'requested_at', 'id').values_list('id', flat=True)[:CLAIM_CANDIDATES]
+    )
+    for job_id in candidates:
+        # Only one of several providers racing for the job matches claimable() when its UPDATE runs
+        leased = DispatchJob.objects.filter(claimable(now), pk=job_id).update(
+            status='leased', leased_by=provider, lease_expires_at=now + timedelta(seconds=LEASE_SECONDS),
+            attempts=F('attempts') + 1,
+        )
+        if leased:
+            return DispatchJob.objects.get(pk=job_id)
+    return None
+
+
+def accept(job, provider, now=None):
+    """Accept a job `provider` holds a live lease on; raises LeaseLost otherwise"""
+    now = now or timezone.now()
+    with transaction.atomic():
+        accepted = DispatchJob.objects.filter(
+            pk=job.pk, status='leased', leased_by=provider, lease_expires_at__gte=now,
+        ).update(status='accepted', accepted_by=provider, accepted_at=now, closed_at=now, escalate_at=None)
+        if not accepted:
+            raise LeaseLost('The lease on this job expired or belongs to another provider')
+        job.refresh_from_db()
+
+        if job.booking_id:
+            booking = job.booking
+            booking.status = 'confirmed'
+            booking.confirmed_at = now
+            booking.save()
+        else:
+            service_request = job.service_request
+            if service_request.assigned_provider_id not in (None, provider.id):
+                # Rolls the acceptance back: the request stays with the provider it was assigned to
+                raise LeaseLost('This request is already assigned to another provider')
+            service_request.assigned_provider = provider
+            service_request.status = 'assigned'
+            service_request.save()
+    return job
+
+
+def release(job, provider):
+    """Hand a job `provider` leased back to the queue; returns whether they held it"""
+    return bool(DispatchJob.objects.filter(pk=job.pk, status='leased', leased_by=provider).update(
+        status='queued', leased_by=None, lease_expires_at=None,
+    ))
+
+
+def _close(jobs, provider_id, accepted, now):
+    jobs = jobs.filter(status__in=OPEN_STATUSES)
+    if accepted:
+        jobs.update(status='accepted', accepted_by_id=provider_id, accepted_at=now, closed_at=now, escalate_at=None)
+    else:
+        jobs.update(status='cancelled', closed_at=now, escalate_at=None)
+
+
+def booking_changed(booking):
+    """Close the job of an emergency booking confirmed or cancelled outside the queue"""
+    if booking.status != 'pending':
+        _close(DispatchJob.objects.filter(booking=booking), booking.provider_id,
+               booking.status != 'cancelled', timezone.now())
+
+
+def request_changed(service_request):
+    """Close the job of a request assigned or closed outside the queue"""
+    if service_request.status != 'open' and service_request.urgency in URGENCY_PRIORITY:
+        _close(DispatchJob.objects.filter(service_request=service_request), service_request.assigned_provider_id,
+               service_request.status == 'assigned', timezone.now())
+
+
+def _escalation_notice(job, user_id, now):
+    minutes = int((now - job.requested_at).total_seconds() // 60)
+    return Notification(
+        user_id=user_id,
+        notification_type='system',
+        title=f'{job.get_priority_display()} job waiting for {minutes} min',
+        message=str(job),
+        related_booking_id=job.booking_id,
+        action_url=f'/api/dispatch/{job.id}/',
+    )
+
+
+def escalate(now=None):
+    """Escalate the open jobs whose timer ran out; returns the number escalated"""
+    now = now or timezone.now()
+    jobs = list(
+        DispatchJob.objects.filter(status__in=OPEN_STATUSES, escalate_at__lte=now)
+        .select_related('service_request__assigned_provider', 'provider').prefetch_related('service_request__matches__provider')
+    )
+    if not jobs:
+        return 0
+
+    staff_ids = None
+    recipients = defaultdict(list)  # user ID -> jobs to tell them about
+    for job in jobs:
+        job.level += 1
+        job.escalate_at = _escalation_time(job.priority, job.requested_at, job.level)
+        if job.level > 1:
+            if staff_ids is None:
+                staff_ids = list(User.objects.filter(is_staff=True, is_active=True).values_list('id', flat=True))
+            for user_id in staff_ids:
+                recipients[user_id].append(job)
+        elif job.booking_id:
+            recipients[job.provider.user_id].append(job)
+        elif job.service_request.assigned_provider_id is not None:
+            # Assigned without the queue (matching.auto_assign): the job stays with the assignee
+            job.provider = job.service_request.assigned_provider
+            recipients[job.provider.user_id].append(job)
+        else:
+            job.provider = None
+            for match in job.service_request.matches.all():
+                recipients[match.provider.user_id].append(job)
+
+    with transaction.atomic():
+        DispatchJob.objects.bulk_update(jobs, ['level', 'escalate_at', 'provider'])
+        Notification.objects.bulk_create([
+            _escalation_notice(job, user_id, now) for user_id, user_jobs in recipients.items() for job in user_jobs
+        ])
+    # bulk_create bypasses the signal handlers that count unread notifications
+    counters.reconcile(ServiceProvider.objects.filter(user_id__in=recipients).values_list('id', flat=True))
+    return len(jobs)
+
+
+def _percentile(ordered, fraction):
+    """Nearest-rank percentile of a sorted list"""
+    return ordered[max(math.ceil(fraction * len(ordered)) - 1, 0)] if ordered else None
+
+
+def metrics(since=None, now=None):
+    """
+    Request-to-accept statistics per priority for jobs requested since
+    `since` (default: the last METRICS_DAYS days). Times are in seconds.
+    """
+    now = now or timezone.now()
+    since = since or now - timedelta(days=METRICS_DAYS)
+    report = {}
+    seconds = defaultdict(list)
+    for priority, label in DispatchJob.PRIORITY_CHOICES:
+        report[priority] = {
+            'priority': label.lower(), 'requested': 0, 'accepted': 0, 'cancelled': 0, 'waiting': 0,
+            'escalated': 0, 'longest_wait_seconds': None,
+        }
+
+    for priority, status, level, requested_at, accepted_at in DispatchJob.objects.filter(
+        requested_at__gte=since
+    ).values_list('priority', 'status', 'level', 'requested_at', 'accepted_at'):
+        row = report[priority]
+        row['requested'] += 1
+        row['escalated'] += level > 0
+        if status == 'accepted':
+            row['accepted'] += 1
+            seconds[priority].append((accepted_at - requested_at).total_seconds())
+        elif status == 'cancelled':
+            row['cancelled'] += 1
+        else:
+            row['waiting'] += 1
+            waited = (now - requested_at).total_seconds()
+            row['longest_wait_seconds'] = max(row['longest_wait_seconds'] or 0, waited)
+
+    for priority, row in report.items():
+        times = sorted(seconds[priority])
+        target = TARGET_MINUTES[priority] * 60
+        row.update({
+            'median_seconds': _percentile(times, 0.5),
+            'p90_seconds': _percentile(times, 0.9),
+            'target_seconds': target,
+            'within_target': round(sum(t <= target for t in times) / len(times), 3) if times else None,
+        })
+    return list(report.values())
@@ -6,6 +6,15 @@ from .models import Booking, ServiceProvider
 
 class BookingForm(forms.ModelForm):
     """Form for booking a service (for both logged-in and guest users)"""
+    coupon_code = forms.CharField(
+        required=False,
+        max_length=50,
+        label='Coupon Code',
+        widget=forms.TextInput(attrs={
+            'class': 'form-control',
+            'placeholder': 'Have a coupon? Sign in and enter it here (optional)'
+        })
+    )
     
     class Meta:
         model = Booking
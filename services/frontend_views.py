@@ -2,32 +2,36 @@
 Django views for HomeServe frontend pages
 Server-side rendering without JavaScript
 """
+from decimal import Decimal
+
 from django.shortcuts import render, get_object_or_404, redirect
+from django.http import Http404
 from django.core.paginator import Paginator
+from django.db import transaction
+from services import coupons, slots
 from services.models import ServiceCategory, Service, ServiceProvider, Booking, Payment
+from services.aggregates import histograms
+from services.counters import get_counters
 from services.forms import BookingForm
+from services.page_cache import cache_anonymous_page, depends_on, entity
+from services.search import search_services
 from django.db.models import Q
 from django.contrib import messages
 from django.utils import timezone
 from django.contrib.auth.decorators import login_required
 
 
+@cache_anonymous_page
 def home_view(request):
     """Homepage with service categories"""
     # Redirect logged-in providers to their dashboard
-    if request.user.is_authenticated:
-        try:
-            provider = ServiceProvider.objects.get(user=request.user)
-            return redirect('/provider/')
-        except ServiceProvider.DoesNotExist:
-            # Not a provider, show regular home page
-            pass
-    
-    categories = ServiceCategory.objects.filter(is_active=True).prefetch_related('services')
+    if request.role == 'provider':
+        return redirect('/provider/')
     
-    # Add service count to each category
-    for category in categories:
-        category.service_count = category.services.filter(is_active=True).count()
+    depends_on(request, 'catalog')
+
+    # Active service count per category, annotated in the same query
+    categories = ServiceCategory.objects.filter(is_active=True).with_service_counts()
     
     context = {
         'categories': categories,
@@ -37,16 +41,15 @@ def home_view(request):
     return render(request, 'frontend/index.html', context)
 
 
+@cache_anonymous_page
 def services_view(request):
     """Services listing page with filters"""
     # Redirect logged-in providers to their dashboard
-    if request.user.is_authenticated:
-        try:
-            provider = ServiceProvider.objects.get(user=request.user)
-            return redirect('/provider/services/')
-        except ServiceProvider.DoesNotExist:
-            pass
+    if request.role == 'provider':
+        return redirect('/provider/services/')
     
+    depends_on(request, 'catalog')
+
     # Get filter parameters
     category_id = request.GET.get('category')
     category_name = request.GET.get('category_name')
@@ -67,11 +70,7 @@ def services_view(request):
         services = services.filter(provider__city__icontains=district)
     
     if search_query and search_query != 'None':
-        services = services.filter(
-            Q(title__icontains=search_query) |
-            Q(description__icontains=search_query) |
-            Q(provider__business_name__icontains=search_query)
-        )
+        services = search_services(services, search_query)
     
     if price_range:
         if price_range == '5000+':
@@ -121,21 +120,22 @@ def services_view(request):
     return render(request, 'frontend/services.html', context)
 
 
+@cache_anonymous_page
 def service_detail_view(request, service_id):
     """Service detail page"""
     # Redirect logged-in providers to their dashboard
-    if request.user.is_authenticated:
-        try:
-            provider = ServiceProvider.objects.get(user=request.user)
-            return redirect('/provider/services/')
-        except ServiceProvider.DoesNotExist:
-            pass
-    
-    service = get_object_or_404(
-        Service.objects.select_related('category', 'provider'),
-        id=service_id,
-        is_active=True
-    )
+    if request.role == 'provider':
+        return redirect('/provider/services/')
+    
+    # Every dependency is registered before the rows it covers are read, so a change in
+    # between bumps a version the page is stored under instead of being cached over
+    depends_on(request, entity('service', service_id))
+    services = Service.objects.filter(id=service_id, is_active=True)
+    related = services.values_list('provider_id', 'category_id').first()
+    if related is None:
+        raise Http404('No Service matches the given query.')
+    depends_on(request, entity('provider', related[0]), entity('category', related[1]))
+    service = get_object_or_404(services.select_related('category', 'provider'))
     
     context = {
         'service': service,
@@ -146,13 +146,9 @@ def service_detail_view(request, service_id):
 def book_service_view(request, service_id):
     """Booking page for a service - accessible to both logged-in and guest users"""
     # Redirect logged-in providers to their dashboard
-    if request.user.is_authenticated:
-        try:
-            provider = ServiceProvider.objects.get(user=request.user)
-            messages.info(request, 'Providers cannot book services. Please use a customer account.')
-            return redirect('/provider/')
-        except ServiceProvider.DoesNotExist:
-            pass
+    if request.role == 'provider':
+        messages.info(request, 'Providers cannot book services. Please use a customer account.')
+        return redirect('/provider/')
     
     service = get_object_or_404(
         Service.objects.select_related('category', 'provider'),
@@ -172,28 +168,38 @@ def book_service_view(request, service_id):
             if request.user.is_authenticated:
                 booking.user = request.user
             
-            booking.save()
-            
-            # Create payment record automatically
-            from decimal import Decimal
-            from django.utils import timezone
-            commission_pct = Decimal('15.00')
-            provider_amt = booking.total_amount * (Decimal('100.00') - commission_pct) / Decimal('100.00')
-            
-            Payment.objects.create(
-                booking=booking,
-                user=booking.user,
-                amount=booking.total_amount,
-                payment_method='online',  # Default, can be updated later
-                status='completed',  # Auto-complete for now, can add payment gateway later
-                transaction_id=f'TXN{booking.id}',
-                platform_commission=commission_pct,
-                provider_amount=provider_amt,
-                paid_at=timezone.now()
-            )
-            
-            messages.success(request, 'Your booking request has been submitted successfully!')
-            return redirect('booking_confirmation', booking_id=booking.id)
+            try:
+                # Booking, slot claim and payment commit together or not at all
+                with transaction.atomic():
+                    booking.save()
+                    slots.claim(booking)
+                    if form.cleaned_data['coupon_code']:
+                        coupons.apply(booking, form.cleaned_data['coupon_code'])
+                    
+                    # Create payment record automatically
+                    commission_pct = Decimal('15.00')
+                    provider_amt = booking.total_amount * (Decimal('100.00') - commission_pct) / Decimal('100.00')
+                    
+                    Payment.objects.create(
+                        booking=booking,
+                        user=booking.user,
+                        amount=booking.total_amount,
+                        payment_method='online',  # Default, can be updated later
+                        status='completed',  # Auto-complete for now, can add payment gateway later
+                        transaction_id=f'TXN{booking.id}',
+                        platform_commission=commission_pct,
+                        provider_amount=provider_amt,
+                        paid_at=timezone.now()
+                    )
+            except slots.SlotTaken as taken:
+                form.add_error('booking_time', str(taken))
+                messages.error(request, str(taken))
+            except coupons.CouponError as error:
+                form.add_error('coupon_code', str(error))
+                messages.error(request, str(error))
+            else:
+                messages.success(request, 'Your booking request has been submitted successfully!')
+                return redirect('booking_confirmation', booking_id=booking.id)
         else:
             messages.error(request, 'Please correct the errors below.')
     else:
@@ -202,6 +208,7 @@ def book_service_view(request, service_id):
     context = {
         'service': service,
         'form': form,
+        'coupons': coupons.for_service(service),
     }
     return render(request, 'frontend/book_service.html', context)
 
@@ -224,30 +231,23 @@ def booking_confirmation_view(request, booking_id):
 def how_it_works_view(request):
     """How It Works page"""
     # Redirect logged-in providers to their dashboard
-    if request.user.is_authenticated:
-        try:
-            provider = ServiceProvider.objects.get(user=request.user)
-            return redirect('/provider/')
-        except ServiceProvider.DoesNotExist:
-            pass
+    if request.role == 'provider':
+        return redirect('/provider/')
     
     return render(request, 'frontend/how_it_works.html')
 
 
+@cache_anonymous_page
 def provider_detail_view(request, provider_id):
     """Provider detail page"""
     # Redirect logged-in providers to their own profile
-    if request.user.is_authenticated:
-        try:
-            own_provider = ServiceProvider.objects.get(user=request.user)
-            if own_provider.id == provider_id:
-                return redirect('/provider/profile/')
-            else:
-                messages.info(request, 'You are viewing this as a provider. Switch to customer view to see other providers.')
-                return redirect('/provider/')
-        except ServiceProvider.DoesNotExist:
-            pass
+    if request.role == 'provider':
+        if request.provider_id == provider_id:
+            return redirect('/provider/profile/')
+        messages.info(request, 'You are viewing this as a provider. Switch to customer view to see other providers.')
+        return redirect('/provider/')
     
+    depends_on(request, entity('provider', provider_id))
     provider = get_object_or_404(ServiceProvider, id=provider_id)
     services = Service.objects.filter(provider=provider, is_active=True, approval_status='approved')
     
@@ -261,7 +261,7 @@ def provider_detail_view(request, provider_id):
 @login_required
 def dashboard_view(request):
     """Route users to the appropriate dashboard based on their role"""
-    if hasattr(request.user, 'provider_profile'):
+    if request.role == 'provider':
         return redirect('/provider/')  # Redirect to provider portal
     return redirect('customer_dashboard')
 
@@ -269,7 +269,7 @@ def dashboard_view(request):
 @login_required
 def provider_dashboard_view(request):
     """Enhanced dashboard for service providers with all features"""
-    if not hasattr(request.user, 'provider_profile'):
+    if request.role != 'provider':
         messages.info(request, 'Create a provider profile to access provider dashboard.')
         return redirect('provider_onboarding')
 
@@ -283,22 +283,14 @@ def provider_dashboard_view(request):
     from datetime import date, timedelta
     from django.db.models import Sum, Avg, Count
 
-    # Booking metrics
-    pending_count = Booking.objects.filter(provider=provider, status='pending').count()
-    confirmed_count = Booking.objects.filter(provider=provider, status='confirmed').count()
-    completed_count = Booking.objects.filter(provider=provider, status='completed').count()
-    total_bookings = Booking.objects.filter(provider=provider).count()
+    # Booking, payout, inbox and service counters
+    counters = get_counters(provider)
 
     # Earnings metrics
-    total_earnings = ProviderEarnings.objects.filter(
-        provider=provider, 
-        payout_status='paid'
-    ).aggregate(total=Sum('net_amount'))['total'] or 0
-    
-    pending_earnings = ProviderEarnings.objects.filter(
-        provider=provider, 
-        payout_status='pending'
-    ).aggregate(total=Sum('net_amount'))['total'] or 0
+    payouts = histograms(
+        ProviderEarnings.objects.filter(provider=provider), 'payout_status', sum_of='net_amount'
+    )
+    total_earnings = payouts['payout_status']['paid']
     
     # This month's earnings
     this_month_start = date.today().replace(day=1)
@@ -311,6 +303,7 @@ def provider_dashboard_view(request):
     thirty_days_ago = date.today() - timedelta(days=30)
     recent_stats = ProviderStats.objects.filter(
         provider=provider,
+        period='day',
         date__gte=thirty_days_ago
     ).aggregate(
         total_bookings=Sum('bookings_received'),
@@ -319,28 +312,12 @@ def provider_dashboard_view(request):
         avg_rating=Avg('average_rating_day')
     )
 
-    # Unread messages count
-    unread_messages = Message.objects.filter(
-        receiver=request.user,
-        is_read=False
-    ).count()
-
-    # Unread notifications
-    unread_notifications = Notification.objects.filter(
-        user=request.user,
-        is_read=False
-    ).count()
-
     # Verification status
-    verified_docs = ProviderDocument.objects.filter(
-        provider=provider,
-        verification_status='verified'
-    ).count()
-    
-    pending_docs = ProviderDocument.objects.filter(
-        provider=provider,
-        verification_status='pending'
-    ).count()
+    documents = histograms(
+        ProviderDocument.objects.filter(provider=provider), 'verification_status'
+    )['verification_status']
+    verified_docs = documents['verified']
+    pending_docs = documents['pending']
     
     has_insurance = ProviderInsurance.objects.filter(
         provider=provider,
@@ -362,9 +339,7 @@ def provider_dashboard_view(request):
     )
     
     # My services
-    my_services_query = Service.objects.filter(provider=provider).order_by('-created_at')
-    active_services = my_services_query.filter(is_active=True).count()
-    my_services = my_services_query[:10]
+    my_services = Service.objects.filter(provider=provider).order_by('-created_at')[:10]
     
     # Recent reviews
     recent_reviews = provider.reviews.order_by('-created_at')[:5]
@@ -382,15 +357,15 @@ def provider_dashboard_view(request):
     context = {
         'provider': provider,
         'metrics': {
-            'pending': pending_count,
-            'confirmed': confirmed_count,
-            'completed': completed_count,
-            'total_bookings': total_bookings,
-            'active_services': active_services,
+            'pending': counters.bookings_pending,
+            'confirmed': counters.bookings_confirmed,
+            'completed': counters.bookings_completed,
+            'total_bookings': counters.bookings_total,
+            'active_services': counters.active_services,
         },
         'earnings': {
             'total': total_earnings,
-            'pending': pending_earnings,
+            'pending': counters.pending_payout,
             'monthly': monthly_earnings,
         },
         'stats': recent_stats,
@@ -400,8 +375,8 @@ def provider_dashboard_view(request):
             'has_insurance': has_insurance,
             'status': provider.verification_status,
         },
-        'unread_messages': unread_messages,
-        'unread_notifications': unread_notifications,
+        'unread_messages': counters.unread_messages,
+        'unread_notifications': counters.unread_notifications,
         'upcoming_bookings': upcoming_bookings,
         'recent_bookings': recent_bookings,
         'services': my_services,
@@ -423,10 +398,12 @@ def customer_dashboard_view(request):
     
     # Booking metrics
     my_bookings = Booking.objects.filter(user=request.user).order_by('-created_at')
-    open_count = my_bookings.filter(status__in=['pending', 'confirmed', 'in_progress']).count()
-    completed_count = my_bookings.filter(status='completed').count()
-    cancelled_count = my_bookings.filter(status='cancelled').count()
-    total_bookings = my_bookings.count()
+    booking_stats = histograms(my_bookings, 'status')
+    by_status = booking_stats['status']
+    open_count = by_status['pending'] + by_status['confirmed'] + by_status['in_progress']
+    completed_count = by_status['completed']
+    cancelled_count = by_status['cancelled']
+    total_bookings = booking_stats['total']
 
     # Recent bookings
     recent_bookings = my_bookings[:10]
@@ -516,7 +493,7 @@ def customer_dashboard_view(request):
 def provider_confirm_booking_view(request, booking_id):
     """Provider action: confirm a pending booking"""
     booking = get_object_or_404(Booking, id=booking_id)
-    if not hasattr(request.user, 'provider_profile') or booking.provider.user != request.user:
+    if booking.provider_id != request.provider_id:
         messages.error(request, 'You are not authorized to confirm this booking.')
         return redirect('provider_dashboard')
 
@@ -532,7 +509,7 @@ def provider_confirm_booking_view(request, booking_id):
 def provider_complete_booking_view(request, booking_id):
     """Provider action: mark booking as completed"""
     booking = get_object_or_404(Booking, id=booking_id)
-    if not hasattr(request.user, 'provider_profile') or booking.provider.user != request.user:
+    if booking.provider_id != request.provider_id:
         messages.error(request, 'You are not authorized to complete this booking.')
         return redirect('provider_dashboard')
 
@@ -0,0 +1,215 @@
+"""
+Provider proximity index
+
+Every provider with coordinates stores the geohash of its location
+(GEOHASH_PRECISION characters, cells of about 1.2 x 0.6 km) in an indexed
+column. Geohash cells nest: the cells inside a cell all start with its
+geohash, so the providers in a cell of any size are one contiguous range of
+that index.
+
+A radius query covers the circle's bounding box with the finest cells that
+need no more than MAX_CELLS of them, reads those index ranges and measures
+only the providers found there exactly (haversine). k-nearest queries start
+at START_RADIUS_KM and double the radius until k providers are in range, so
+both cost the same whatever the number of providers elsewhere.
+
+Coordinates can be set explicitly; otherwise they come from the bundled
+centroid table of Kerala pincodes (services/data/kerala_pincodes.csv): the
+exact pincode, else its three-digit sorting district, else the city name.
+The table only holds the district head offices and the sorting districts
+they belong to, so a provider placed from it sits at a district-level
+centroid, and one whose pincode prefix and city are both missing gets no
+coordinates at all. Radius and nearest queries (the nearby endpoints,
+matching, dispatch) never find such providers. ``unlocated()`` lists them
+and ``geocode_providers`` reports them, so their coordinates can be set by
+hand or their district added to the table.
+Changes that bypass model signals (bulk_create(), QuerySet.update()) are
+repaired by ``backfill()``, also available as ``python manage.py geocode_providers``.
+"""
+import csv
+import math
+from functools import lru_cache
+from pathlib import Path
+
+from django.db.models import F, Q
+
+from services.models import ServiceProvider
+
+GEOHASH_PRECISION = 6
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+MAX_CELLS = 16
+START_RADIUS_KM = 2
+MAX_RADIUS_KM = 50
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+CENTROIDS_FILE = Path(__file__).resolve().parent / 'data' / 'kerala_pincodes.csv'
+
+
+def encode(latitude, longitude, precision=GEOHASH_PRECISION):
+    """Return the geohash of a point"""
+    lat_range, lng_range = [-90.0, 90.0], [-180.0, 180.0]
+    code, bits, value, even = [], 0, 0, True
+    while len(code) < precision:
+        interval, point = (lng_range, longitude) if even else (lat_range, latitude)
+        middle = (interval[0] + interval[1]) / 2
+        value <<= 1
+        if point >= middle:
+            value |= 1
+            interval[0] = middle
+        else:
+            interval[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            code.append(BASE32[value])
+            bits, value = 0, 0
+    return ''.join(code)
+
+
+def cell_size(precision):
+    """Return the (latitude, longitude) size in degrees of a geohash cell"""
+    bits = 5 * precision
+    return 180 / 2 ** (bits // 2), 360 / 2 ** (bits - bits // 2)
+
+
+def distance_km(latitude, longitude, other_latitude, other_longitude):
+    """Great-circle distance between two points"""
+    lat1, lat2 = math.radians(latitude), math.radians(other_latitude)
+    half_chord = (
+        math.sin((lat2 - lat1) / 2) ** 2
+        + math.cos(lat1) * math.cos(lat2) * math.sin(math.radians(other_longitude - longitude) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(min(half_chord, 1.0)))
+
+
+def covering_cells(latitude, longitude, radius_km):
+    """Return geohash prefixes whose cells together cover the circle around a point"""
+    lat_margin = radius_km / KM_PER_DEGREE
+    lng_margin = radius_km / (KM_PER_DEGREE * max(math.cos(math.radians(latitude)), 0.01))
+    south, north = latitude - lat_margin, latitude + lat_margin
+    west, east = longitude - lng_margin, longitude + lng_margin
+
+    for precision in range(GEOHASH_PRECISION, 0, -1):
+        height, width = cell_size(precision)
+        rows = math.floor((north + 90) / height) - math.floor((south + 90) / height) + 1
+        columns = math.floor((east + 180) / width) - math.floor((west + 180) / width) + 1
+        if rows * columns <= MAX_CELLS or precision == 1:
+            break
+    # Encode the centre of every cell the bounding box touches
+    first_row = math.floor((south + 90) / height)
+    first_column = math.floor((west + 180) / width)
+    return sorted({
+        encode(
+            min((first_row + row + 0.5) * height - 90, 90.0),
+            (first_column + column + 0.5) * width - 180,
+            precision,
+        )
+        for row in range(rows)
+        for column in range(columns)
+    })
+
+
+def cell_filter(path, cells):
+    """Q matching rows whose geohash lies in any of `cells` (one index range each)"""
+    field = f'{path}geohash'
+    condition = Q()
+    for cell in cells:
+        condition |= Q(**{f'{field}__gte': cell, f'{field}__lt': cell + '~'})
+    return condition
+
+
+def within(queryset, latitude, longitude, radius_km, path=''):
+    """
+    Return the rows of `queryset` within `radius_km` of a point, nearest
+    first, each with a ``distance_km`` attribute. `path` leads from the
+    queryset's model to the provider ('provider__' for services).
+    """
+    rows = queryset.order_by().filter(cell_filter(path, covering_cells(latitude, longitude, radius_km))).annotate(
+        point_latitude=F(f'{path}latitude'), point_longitude=F(f'{path}longitude'),
+    )
+    found = []
+    for row in rows:
+        row.distance_km = distance_km(latitude, longitude, float(row.point_latitude), float(row.point_longitude))
+        if row.distance_km <= radius_km:
+            found.append(row)
+    found.sort(key=lambda row: (row.distance_km, row.pk))
+    return found
+
+
+def nearest(queryset, latitude, longitude, k, path='', max_radius_km=MAX_RADIUS_KM):
+    """Return the `k` rows of `queryset` nearest to a point within `max_radius_km`, nearest first"""
+    radius = min(START_RADIUS_KM, max_radius_km)
+    while True:
+        found = within(queryset, latitude, longitude, radius, path)
+        # Anything outside the radius is farther than everything found inside it
+        if len(found) >= k or radius >= max_radius_km:
+            return found[:k]
+        radius = min(radius * 2, max_radius_km)
+
+
+# ====================== GEOCODING ======================
+
+@lru_cache(maxsize=None)
+def centroids():
+    """Return ({pincode or 3-digit prefix: (lat, lng)}, {lowercase place or district: (lat, lng)})"""
+    by_pincode, by_name = {}, {}
+    with open(CENTROIDS_FILE, newline='', encoding='utf-8') as handle:
+        for row in csv.DictReader(handle):
+            point = (float(row['latitude']), float(row['longitude']))
+            by_pincode[row['pincode']] = point
+            by_name.setdefault(row['place'].lower(), point)
+            by_name.setdefault(row['district'].lower(), point)  # the district's first (head) office
+    return by_pincode, by_name
+
+
+def locate(pincode, city=''):
+    """Return the (latitude, longitude) centroid of a pincode (or, failing that, a city), or None"""
+    by_pincode, by_name = centroids()
+    pincode = (pincode or '').strip()
+    return by_pincode.get(pincode) or by_pincode.get(pincode[:3]) or by_name.get((city or '').strip().lower())
+
+
+def place(provider):
+    """
+    Fill in a provider's coordinates from its pincode when they are missing
+    or the pincode changed, and derive the geohash. Called before every save.
+    """
+    previous = getattr(provider, '_geo_snapshot', None)
+    moved = previous is not None and previous[0] != provider.pincode and previous[1:] == (
+        provider.latitude, provider.longitude,
+    )
+    if provider.latitude is None or provider.longitude is None or moved:
+        point = locate(provider.pincode, provider.city)
+        provider.latitude, provider.longitude = point or (None, None)
+    if provider.latitude is None or provider.longitude is None:
+        provider.geohash = ''
+    else:
+        provider.geohash = encode(float(provider.latitude), float(provider.longitude))
+
+
+def snapshot(provider):
+    """Return (pincode, latitude, longitude) of a provider, or None if any of them is deferred"""
+    values = provider.__dict__
+    fields = ('pincode', 'latitude', 'longitude')
+    if any(field not in values for field in fields):
+        return None
+    return tuple(values[field] for field in fields)
+
+
+def unlocated():
+    """Providers without coordinates, whom radius and nearest queries never find"""
+    return ServiceProvider.objects.filter(Q(latitude__isnull=True) | Q(longitude__isnull=True))
+
+
+def backfill(batch_size=500):
+    """Geocode providers saved without signals and fix stale geohashes; returns the number updated"""
+    changed = []
+    providers = ServiceProvider.objects.only('id', 'pincode', 'city', 'latitude', 'longitude', 'geohash')
+    for provider in providers.order_by('id').iterator(chunk_size=batch_size):
+        before = (provider.latitude, provider.longitude, provider.geohash)
+        provider._geo_snapshot = None
+        place(provider)
+        if (provider.latitude, provider.longitude, provider.geohash) != before:
+            changed.append(provider)
+    ServiceProvider.objects.bulk_update(changed, ['latitude', 'longitude', 'geohash'], batch_size=batch_size)
+    return len(changed)
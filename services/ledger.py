@@ -0,0 +1,188 @@
+"""
+Wallet ledger
+
+Every change to a wallet balance is posted here, never by saving the Wallet
+row. ``post_many()`` takes a batch of entries and, in one database
+transaction,
+
+    1. moves the balance of every wallet in the batch with a conditional
+       UPDATE: balance = balance + net change, only where the wallet is
+       active and its balance covers the most its entries take out at any
+       point. An uncovered debit matches no row, so two concurrent debits
+       can never both pass the check: the second UPDATE waits for the
+       first and sees its result
+    2. reads the new balances back (the rows stay locked until commit)
+    3. appends one Transaction per entry with its balance_after
+
+If any wallet is not covered the whole batch is rolled back and
+InsufficientFunds is raised. Wallets whose entries move them by the same
+amount share one WHEN of the UPDATE, so a batch of refunds or referral
+payouts costs a handful of statements whatever its size. ``credit()`` and
+``debit()`` post a single entry; Wallet.add_funds() and deduct_funds() use
+them.
+"""
+from collections import defaultdict, namedtuple
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Case, F, Q, Value, When
+from django.db.models.functions import Round
+from django.utils import timezone
+
+from services.models import Payment, Referral, Transaction, Wallet
+
+SIGN = {'credit': 1, 'refund': 1, 'debit': -1}
+WALLETS_PER_STATEMENT = 500  # keeps the UPDATE well inside SQLite's parameter limit
+
+Entry = namedtuple('Entry', 'wallet_id transaction_type amount description reference_id', defaults=('',))
+
+
+class LedgerError(Exception):
+    """A posting was rejected; nothing was written"""
+
+
+class InsufficientFunds(LedgerError):
+    """A debit is larger than the wallet's balance"""
+
+
+def _move(wallet_ids, change, needed, now):
+    """Apply `change` to the wallets whose balance covers `needed`; returns the number of wallets moved"""
+    covered, moves = defaultdict(list), defaultdict(list)
+    for wallet_id in wallet_ids:
+        covered[needed[wallet_id]].append(wallet_id)
+        moves[change[wallet_id]].append(wallet_id)
+    condition = Q()
+    for minimum, ids in covered.items():
+        condition |= Q(pk__in=ids, balance__gte=minimum)
+    field = Wallet._meta.get_field('balance')
+    # Round so SQLite, which does the arithmetic in floating point, stores whole cents
+    return Wallet.objects.filter(condition, is_active=True).update(
+        balance=Case(
+            *[When(pk__in=ids, then=Round(F('balance') + Value(amount), field.decimal_places))
+              for amount, ids in moves.items()],
+            output_field=field,
+        ),
+        updated_at=now,
+    )
+
+
+def _refusal(wallet_ids):
+    usable = set(Wallet.objects.filter(pk__in=wallet_ids, is_active=True).values_list('pk', flat=True))
+    unusable = sorted(set(wallet_ids) - usable)
+    if unusable:
+        return LedgerError(f'Wallet #{unusable[0]} is inactive or does not exist')
+    return InsufficientFunds('Insufficient wallet balance')
+
+
+def post_many(entries):
+    """Post `entries` (Entry tuples) all together or not at all; returns the created Transactions"""
+    entries = list(entries)
+    change, needed = defaultdict(Decimal), defaultdict(Decimal)
+    for entry in entries:
+        if entry.transaction_type not in SIGN:
+            raise LedgerError(f'Unknown transaction type {entry.transaction_type!r}')
+        if Decimal(entry.amount) <= 0:
+            raise LedgerError('Amounts must be positive')
+        change[entry.wallet_id] += SIGN[entry.transaction_type] * Decimal(entry.amount)
+        needed[entry.wallet_id] = max(needed[entry.wallet_id], -change[entry.wallet_id])
+    if not entries:
+        return []
+
+    wallet_ids = sorted(change)
+    now = timezone.now()
+    with transaction.atomic():
+        for start in range(0, len(wallet_ids), WALLETS_PER_STATEMENT):
+            chunk = wallet_ids[start:start + WALLETS_PER_STATEMENT]
+            if _move(chunk, change, needed, now) != len(chunk):
+                raise _refusal(chunk)
+
+        balances = {}
+        for start in range(0, len(wallet_ids), WALLETS_PER_STATEMENT):
+            balances.update(Wallet.objects.filter(
+                pk__in=wallet_ids[start:start + WALLETS_PER_STATEMENT]
+            ).values_list('pk', 'balance'))
+        # Replay the entries from the balance before the batch
+        running = {wallet_id: balances[wallet_id] - change[wallet_id] for wallet_id in wallet_ids}
+        rows = []
+        for entry in entries:
+            running[entry.wallet_id] += SIGN[entry.transaction_type] * Decimal(entry.amount)
+            rows.append(Transaction(
+                wallet_id=entry.wallet_id, transaction_type=entry.transaction_type, amount=entry.amount,
+                description=entry.description, reference_id=entry.reference_id,
+                balance_after=running[entry.wallet_id], created_at=now,
+            ))
+        return Transaction.objects.bulk_create(rows)
+
+
+def _post(wallet, transaction_type, amount, description, reference_id):
+    posted = post_many([Entry(wallet.pk, transaction_type, amount, description, reference_id)])[0]
+    wallet.balance = posted.balance_after
+    return posted
+
+
+def credit(wallet, amount, description='Funds added', reference_id='', transaction_type='credit'):
+    """Add `amount` to `wallet` and return the Transaction; wallet.balance is updated"""
+    return _post(wallet, transaction_type, amount, description, reference_id)
+
+
+def debit(wallet, amount, description='Payment', reference_id=''):
+    """Take `amount` from `wallet` and return the Transaction; raises InsufficientFunds if it is not covered"""
+    return _post(wallet, 'debit', amount, description, reference_id)
+
+
+def wallets_for(user_ids):
+    """Return {user_id: wallet_id}, opening wallets for users who have none"""
+    user_ids = set(user_ids)
+    Wallet.objects.bulk_create([Wallet(user_id=user_id) for user_id in user_ids], ignore_conflicts=True)
+    return dict(Wallet.objects.filter(user_id__in=user_ids).values_list('user_id', 'pk'))
+
+
+# ====================== BATCHED POSTINGS ======================
+
+def refund_payments(payments, reason=''):
+    """
+    Refund completed payments to their customers' wallets (whatever part of
+    each is not refunded yet) and mark them refunded. Payments refunded
+    meanwhile are skipped. Returns the created Transactions.
+    """
+    with transaction.atomic():
+        rows = list(Payment.objects.select_for_update().filter(
+            pk__in=[payment.pk for payment in payments], status='completed', user__isnull=False,
+        ).values_list('pk', 'user_id', 'amount', 'refund_amount'))
+        wallets = wallets_for(user_id for _, user_id, _, _ in rows)
+        now = timezone.now()
+        Payment.objects.filter(pk__in=[pk for pk, _, _, _ in rows]).update(
+            status='refunded', refund_amount=F('amount'), refund_reason=reason, refunded_at=now, updated_at=now,
+        )
+        return post_many(
+            Entry(wallets[user_id], 'refund', amount - refunded, f'Refund of payment #{pk}', f'REFUND{pk}')
+            for pk, user_id, amount, refunded in rows
+            if amount > refunded
+        )
+
+
+def pay_referral_rewards(referrals=None):
+    """
+    Credit the rewards of completed referrals that were not paid yet (all of
+    them, or those among `referrals`) to both users. Returns the created
+    Transactions.
+    """
+    pending = Referral.objects.filter(is_completed=True, rewards_credited=False)
+    if referrals is not None:
+        pending = pending.filter(pk__in=[referral.pk for referral in referrals])
+    with transaction.atomic():
+        rows = list(pending.select_for_update().values_list(
+            'pk', 'referral_code', 'referrer_id', 'referrer_reward', 'referred_id', 'referred_reward',
+        ))
+        wallets = wallets_for(
+            user_id for _, _, referrer_id, _, referred_id, _ in rows for user_id in (referrer_id, referred_id)
+        )
+        Referral.objects.filter(pk__in=[row[0] for row in rows]).update(rewards_credited=True)
+        entries = []
+        for pk, code, referrer_id, referrer_reward, referred_id, referred_reward in rows:
+            for user_id, reward, role in ((referrer_id, referrer_reward, 'referrer'),
+                                          (referred_id, referred_reward, 'referred')):
+                if reward > 0:
+                    entries.append(Entry(wallets[user_id], 'credit', reward,
+                                         f'Referral reward ({role}, {code})', f'REFERRAL{pk}'))
+        return post_many(entries)
@@ -0,0 +1,192 @@
+"""
+Loyalty points ledger
+
+Every change to a customer's points is a LoyaltyEvent that is only ever
+appended. LoyaltyPoints keeps the running totals (points, total_earned,
+total_redeemed) and the tier, so a balance is read from one row, while
+``audit()`` checks those totals against the sum of the events.
+
+    earn(), redeem()  post one event and move one customer's totals with a
+                      conditional UPDATE in the same transaction; a
+                      redemption only matches while the balance covers it
+    accrue()          the batch job: every completed booking since the
+                      'loyalty_accrual' JobWatermark earns one point per
+                      RUPEES_PER_POINT of its total. Events are inserted
+                      CHUNK_SIZE bookings at a time with bulk_create, and the
+                      totals of the chunk's customers move in one UPDATE
+                      whose WHENs group customers by the points they earned
+    retier()          recomputes every tier from total_earned in a single
+                      UPDATE, which accrue() runs once at the end
+
+A booking earns points once: a unique constraint on its 'earned' event
+makes re-running over the same bookings harmless, so the watermark looks
+back LATE_COMMITS to pick up bookings completed in transactions that were
+still open when the previous run started. ``python manage.py
+accrue_loyalty_points`` runs the job.
+"""
+from collections import Counter, defaultdict
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Case, CharField, Exists, F, IntegerField, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from services.models import Booking, JobWatermark, LoyaltyEvent, LoyaltyPoints
+
+WATERMARK = 'loyalty_accrual'
+RUPEES_PER_POINT = 10
+CHUNK_SIZE = 2000
+USERS_PER_STATEMENT = 500  # keeps the UPDATE well inside SQLite's parameter limit
+LATE_COMMITS = timedelta(minutes=5)
+
+
+class LoyaltyError(Exception):
+    """A posting was rejected; nothing was written"""
+
+
+class InsufficientPoints(LoyaltyError):
+    """A redemption is larger than the customer's balance"""
+
+
+def points_for(amount):
+    """Points a booking worth `amount` earns"""
+    return int(amount // RUPEES_PER_POINT)
+
+
+def tier_expression(earning=0):
+    """The tier of a LoyaltyPoints row once `earning` more points are added to its total_earned"""
+    return Case(
+        *[When(total_earned__gte=needed - earning, then=Value(tier)) for needed, tier in LoyaltyPoints.TIERS],
+        default=Value('bronze'),
+        output_field=CharField(),
+    )
+
+
+def _post(account, event_type, points, description, booking=None):
+    if points <= 0:
+        raise LoyaltyError('Points must be positive')
+    now = timezone.now()
+    with transaction.atomic():
+        if event_type == 'redeemed':
+            moved = LoyaltyPoints.objects.filter(pk=account.pk, points__gte=points).update(
+                points=F('points') - points, total_redeemed=F('total_redeemed') + points, updated_at=now,
+            )
+            if not moved:
+                raise InsufficientPoints('Not enough loyalty points')
+        else:
+            LoyaltyPoints.objects.filter(pk=account.pk).update(
+                points=F('points') + points, total_earned=F('total_earned') + points,
+                tier=tier_expression(points), updated_at=now,
+            )
+        event = LoyaltyEvent.objects.create(
+            user_id=account.user_id, event_type=event_type, booking=booking, description=description,
+            points=-points if event_type == 'redeemed' else points, created_at=now,
+        )
+    account.refresh_from_db(fields=['points', 'tier', 'total_earned', 'total_redeemed', 'updated_at'])
+    return event
+
+
+def earn(account, points, description='', booking=None):
+    """Add `points` to a LoyaltyPoints account and return the LoyaltyEvent; the account is refreshed"""
+    return _post(account, 'earned', points, description, booking)
+
+
+def redeem(account, points, description='Points redeemed'):
+    """Take `points` from an account and return the LoyaltyEvent; raises InsufficientPoints if not covered"""
+    return _post(account, 'redeemed', points, description)
+
+
+def _credit(earned, now):
+    """Add earned[user_id] points to the balance and total_earned of each customer, opening accounts as needed"""
+    user_ids = sorted(earned)
+    LoyaltyPoints.objects.bulk_create([LoyaltyPoints(user_id=user_id) for user_id in user_ids], ignore_conflicts=True)
+    for start in range(0, len(user_ids), USERS_PER_STATEMENT):
+        chunk = user_ids[start:start + USERS_PER_STATEMENT]
+        groups = defaultdict(list)
+        for user_id in chunk:
+            groups[earned[user_id]].append(user_id)
+
+        def plus(field):
+            return Case(
+                *[When(user_id__in=ids, then=F(field) + Value(points)) for points, ids in groups.items()],
+                output_field=IntegerField(),
+            )
+
+        LoyaltyPoints.objects.filter(user_id__in=chunk).update(
+            points=plus('points'), total_earned=plus('total_earned'), updated_at=now,
+        )
+
+
+def retier():
+    """Set every tier from total_earned in one UPDATE; returns the number of customers whose tier changed"""
+    return LoyaltyPoints.objects.exclude(tier=tier_expression()).update(tier=tier_expression())
+
+
+def accrue(since=None):
+    """
+    Award points for the completed bookings since `since` (default: the
+    watermark; all of them on the first run) that have not earned any yet,
+    then retier and advance the watermark. Returns a Counter of 'bookings',
+    'customers' and 'points'.
+    """
+    started = timezone.now()
+    if since is None:
+        since = JobWatermark.get_position(WATERMARK)
+    bookings = Booking.objects.filter(
+        status='completed', user__isnull=False, total_amount__gte=RUPEES_PER_POINT,
+    ).exclude(Exists(LoyaltyEvent.objects.filter(booking=OuterRef('pk'), event_type='earned')))
+    if since is not None:
+        bookings = bookings.filter(completed_at__gte=since - LATE_COMMITS)
+
+    stats, customers, last_id = Counter(), set(), 0
+    while True:
+        rows = list(
+            bookings.filter(id__gt=last_id).order_by('id').values_list('id', 'user_id', 'total_amount')[:CHUNK_SIZE]
+        )
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        events = [
+            LoyaltyEvent(user_id=user_id, event_type='earned', points=points_for(amount), booking_id=booking_id,
+                         description=f'Booking #{booking_id} completed', created_at=started)
+            for booking_id, user_id, amount in rows
+        ]
+        earned = defaultdict(int)
+        for event in events:
+            earned[event.user_id] += event.points
+        with transaction.atomic():
+            LoyaltyEvent.objects.bulk_create(events)
+            _credit(earned, started)
+        stats['bookings'] += len(events)
+        stats['points'] += sum(earned.values())
+        customers.update(earned)
+        if len(rows) < CHUNK_SIZE:
+            break
+
+    stats['customers'] = len(customers)
+    retier()
+    JobWatermark.set_position(WATERMARK, started)
+    return stats
+
+
+def audit(user_ids=None):
+    """
+    Compare stored totals with the ledger. Returns (user_id, points,
+    points from events, total_earned, earned from events) for every
+    customer whose account disagrees with their events.
+    """
+    events = LoyaltyEvent.objects.filter(user_id=OuterRef('user_id')).order_by().values('user_id')
+
+    def total(condition=Q()):
+        summed = events.filter(condition).annotate(total=Sum('points')).values('total')
+        return Coalesce(Subquery(summed, output_field=IntegerField()), 0)
+
+    accounts = LoyaltyPoints.objects.annotate(ledger_points=total(), ledger_earned=total(Q(event_type='earned')))
+    if user_ids is not None:
+        accounts = accounts.filter(user_id__in=user_ids)
+    return list(
+        accounts.exclude(points=F('ledger_points'), total_earned=F('ledger_earned'))
+        .order_by('user_id')
+        .values_list('user_id', 'points', 'ledger_points', 'total_earned', 'ledger_earned')
+    )
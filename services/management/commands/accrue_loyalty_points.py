@@ -0,0 +1,35 @@
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from services import loyalty
+
+
+class Command(BaseCommand):
+    help = 'Award loyalty points for completed bookings and bring customer tiers up to date'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', help='Revisit bookings completed since this date (YYYY-MM-DD) instead of the watermark')
+        parser.add_argument('--audit', action='store_true', help='Also check every balance against the points ledger')
+
+    def handle(self, *args, **options):
+        since = None
+        if options['since']:
+            try:
+                since = timezone.make_aware(datetime.strptime(options['since'], '%Y-%m-%d'))
+            except ValueError:
+                raise CommandError('--since must be a date in YYYY-MM-DD format')
+
+        stats = loyalty.accrue(since=since)
+        self.stdout.write(self.style.SUCCESS(
+            f'✓ Awarded {stats["points"]} points for {stats["bookings"]} booking(s) to {stats["customers"]} customer(s)'
+        ))
+        if options['audit']:
+            mismatches = loyalty.audit()
+            for user_id, points, ledger_points, earned, ledger_earned in mismatches:
+                self.stdout.write(self.style.WARNING(
+                    f'  User #{user_id}: {points} points ({ledger_points} in the ledger), '
+                    f'{earned} earned ({ledger_earned} in the ledger)'
+                ))
+            if not mismatches:
+                self.stdout.write('  Every balance matches the ledger')
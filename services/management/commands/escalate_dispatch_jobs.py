@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from services import dispatch
+
+
+class Command(BaseCommand):
+    help = 'Queue missed emergency jobs and escalate those nobody accepted in time (run every minute)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--report', action='store_true',
+                            help=f'Also print request-to-accept times of the last {dispatch.METRICS_DAYS} days')
+
+    def handle(self, *args, **options):
+        queued = dispatch.backfill()
+        count = dispatch.escalate()
+        self.stdout.write(self.style.SUCCESS(f'✓ Queued {queued} and escalated {count} dispatch job(s)'))
+        if options['report']:
+            for row in dispatch.metrics():
+                median = '-' if row['median_seconds'] is None else f"{row['median_seconds'] / 60:.1f} min"
+                within = '-' if row['within_target'] is None else f"{row['within_target']:.0%}"
+                self.stdout.write(
+                    f"{row['priority']:<10} requested {row['requested']:>5}  accepted {row['accepted']:>5}  "
+                    f"waiting {row['waiting']:>4}  median {median:>9}  within target {within:>4}"
+                )
@@ -0,0 +1,100 @@
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+from services import geo
+from services.models import (
+    Booking, Conversation, DispatchJob, Message, Notification, ProviderEarnings, Review, Service, ServiceProvider,
+    ServiceRequest,
+)
+
+
+def portal_queries(provider_id, user_id, category_id):
+    """The hot filters behind the provider and customer portals, by name"""
+    today = date.today()
+    now = timezone.now()
+    return {
+        'provider bookings by status': Booking.objects.filter(provider_id=provider_id, status='pending'),
+        'provider bookings for a day': Booking.objects.filter(
+            provider_id=provider_id, booking_date=today
+        ).order_by('booking_time'),
+        'provider upcoming bookings': Booking.objects.filter(
+            provider_id=provider_id, status__in=['pending', 'confirmed']
+        ).order_by('booking_date', 'booking_time')[:10],
+        'provider recent bookings': Booking.objects.filter(provider_id=provider_id).order_by('-created_at')[:5],
+        'customer bookings by status': Booking.objects.filter(user_id=user_id, status='completed'),
+        'latest bookings': Booking.objects.order_by('-created_at', '-id')[:20],
+        'unread messages': Message.objects.filter(receiver_id=user_id, is_read=False),
+        'conversation inbox': Conversation.objects.filter(
+            Q(user_a_id=user_id) | Q(user_b_id=user_id)
+        ).order_by('-last_activity_at', '-id')[:20],
+        'unread notifications': Notification.objects.filter(user_id=user_id, is_read=False),
+        'provider payouts': ProviderEarnings.objects.filter(
+            provider_id=provider_id, payout_status='pending', created_at__gte=now - timedelta(days=30)
+        ),
+        'provider reviews': Review.objects.filter(provider_id=provider_id).order_by('-created_at', '-id')[:20],
+        'providers near a point': ServiceProvider.objects.filter(
+            geo.cell_filter('', geo.covering_cells(9.9658, 76.2421, 10))
+        ),
+        'open request backlog': ServiceRequest.objects.filter(status='open', id__gt=0).order_by('id')[:500],
+        'dispatch queue': DispatchJob.objects.filter(
+            status__in=['queued', 'leased']
+        ).order_by('priority', 'requested_at', 'id')[:5],
+        'dispatch escalations': DispatchJob.objects.filter(
+            status__in=['queued', 'leased'], escalate_at__lte=now
+        ),
+        'payout run claim': ProviderEarnings.objects.filter(
+            payout_status='pending', created_at__lt=now, id__gt=0
+        ).exclude(provider__bank_account_number='').order_by('id')[:2000],
+        'category catalog': Service.objects.filter(
+            is_active=True, approval_status='approved', category_id=category_id
+        ),
+    }
+
+
+def full_scans(queryset):
+    """Return the lines of the queryset's plan that read a whole table"""
+    plan = queryset.explain()
+    if connection.vendor == 'sqlite':
+        # 'SCAN t' reads every row. 'SCAN t USING INDEX' walks a whole index in order,
+        # which is only acceptable when a LIMIT stops it after the first rows.
+        limited = queryset.query.high_mark is not None
+        return [
+            line.strip() for line in plan.splitlines()
+            if ' SCAN ' in f' {line}' and not (limited and 'USING' in line)
+        ]
+    return [line.strip() for line in plan.splitlines() if 'Seq Scan' in line]
+
+
+class Command(BaseCommand):
+    help = 'Run EXPLAIN on the provider/customer portal queries and fail if any of them scans a whole table'
+
+    def handle(self, *args, **options):
+        provider = ServiceProvider.objects.values('id', 'user_id').first() or {'id': 0, 'user_id': 0}
+        category_id = Service.objects.values_list('category_id', flat=True).first() or 0
+
+        postgres = connection.vendor == 'postgresql'
+        if postgres:
+            # Small tables make sequential scans look cheap; ask what the planner would do at scale
+            with connection.cursor() as cursor:
+                cursor.execute('SET enable_seqscan = off')
+
+        failures = []
+        try:
+            for name, queryset in portal_queries(provider['id'], provider['user_id'], category_id).items():
+                scans = full_scans(queryset)
+                if scans:
+                    failures.append(name)
+                    self.stdout.write(self.style.ERROR(f'✗ {name}: {"; ".join(scans)}'))
+                else:
+                    self.stdout.write(f'✓ {name}')
+        finally:
+            if postgres:
+                with connection.cursor() as cursor:
+                    cursor.execute('RESET enable_seqscan')
+
+        if failures:
+            raise CommandError(f'{len(failures)} portal query(ies) do a full table scan: {", ".join(failures)}')
+        self.stdout.write(self.style.SUCCESS('✓ Every portal query uses an index'))
@@ -0,0 +1,51 @@
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from services import exports
+
+
+class Command(BaseCommand):
+    help = 'Export the database as one gzip-compressed JSON Lines file per model, resuming an unfinished export'
+
+    def add_arguments(self, parser):
+        parser.add_argument('labels', nargs='*', metavar='app_label[.ModelName]',
+                            help='Only export these apps or models (default: all)')
+        parser.add_argument('--output', default='export',
+                            help='Directory to write each run to, in a subdirectory named after its start time')
+        parser.add_argument('--incremental', action='store_true',
+                            help='Only export rows changed since the last complete export')
+        parser.add_argument('--since', help='With --incremental: rows changed since this date (YYYY-MM-DD) instead')
+        parser.add_argument('--workers', type=int, default=4, help='Models exported at the same time')
+        parser.add_argument('--chunk-size', type=int, default=exports.CHUNK_SIZE, help='Rows fetched per query')
+        parser.add_argument('--restart', action='store_true',
+                            help='Start over instead of resuming an unfinished export in --output')
+
+    def handle(self, *args, **options):
+        since = None
+        if options['since']:
+            try:
+                since = timezone.make_aware(datetime.strptime(options['since'], '%Y-%m-%d'))
+            except ValueError:
+                raise CommandError('--since must be a date in YYYY-MM-DD format')
+        labels = {label.lower() for label in options['labels']} or None
+
+        previous = exports.latest_run(options['output'])
+        if previous and not previous[1]['finished_at'] and not options['restart']:
+            self.stdout.write(f'Resuming the export started at {previous[1]["started_at"]}')
+        try:
+            directory, manifest, exported = exports.run(
+                options['output'], incremental=options['incremental'] or since is not None, since=since,
+                labels=labels, workers=max(options['workers'], 1), chunk_size=options['chunk_size'],
+                restart=options['restart'],
+            )
+        except LookupError as error:
+            raise CommandError(str(error))
+
+        entries = [manifest['models'][label] for label in exported]
+        scope = f'changes since {manifest["since"]}' if manifest['since'] else 'everything'
+        self.stdout.write(self.style.SUCCESS(
+            f'✓ Exported {sum(entry["rows"] for entry in entries)} rows of {len(entries)} model(s) ({scope}) '
+            f'to {directory}, {sum(entry["bytes"] for entry in entries)} bytes compressed'
+        ))
+        self.stdout.write(f'  Load with: python manage.py loaddata {directory}/*.jsonl.gz')
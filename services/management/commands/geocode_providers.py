@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from services import geo
+
+
+class Command(BaseCommand):
+    help = 'Fill in missing provider coordinates from the pincode centroid table and refresh geohashes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Providers updated per statement')
+
+    def handle(self, *args, **options):
+        count = geo.backfill(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'✓ Geocoded {count} provider(s)'))
+
+        missing = list(geo.unlocated().order_by('id').values_list('id', 'business_name', 'pincode', 'city'))
+        if missing:
+            self.stdout.write(self.style.WARNING(
+                f'! {len(missing)} provider(s) have no coordinates: neither their pincode nor their city is in '
+                f'{geo.CENTROIDS_FILE.name}, so nearby searches, matching and dispatch leave them out'
+            ))
+            for provider_id, business_name, pincode, city in missing:
+                self.stdout.write(f'  #{provider_id} {business_name} ({pincode or "no pincode"}, {city or "no city"})')
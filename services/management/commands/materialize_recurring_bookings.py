@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+from services import recurring
+
+
+class Command(BaseCommand):
+    help = 'Create the upcoming bookings of active recurring bookings (safe to run repeatedly)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=28, help='How far ahead to book')
+        parser.add_argument('--occurrences', type=int, default=4, help='Bookings created per subscription per run')
+        parser.add_argument('--batch-size', type=int, default=500, help='Subscriptions materialized per transaction')
+
+    def handle(self, *args, **options):
+        if min(options['days'], options['occurrences'], options['batch_size']) < 1:
+            raise CommandError('--days, --occurrences and --batch-size must be positive')
+
+        stats = recurring.run(days=options['days'], occurrences=options['occurrences'], batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f'✓ Created {stats["created"]} booking(s) for {stats["subscriptions"]} recurring booking(s)'
+        ))
+        if stats['on_leave'] or stats['taken']:
+            self.stdout.write(
+                f'  Skipped {stats["on_leave"]} occurrence(s) on provider leave '
+                f'and {stats["taken"]} at already booked times'
+            )
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from services import search
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the service full-text search index'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Services indexed per batch')
+
+    def handle(self, *args, **options):
+        backend = 'SQLite FTS5' if search.uses_fts() else 'inverted term table'
+        self.stdout.write(f'Rebuilding search index ({backend})...')
+        count = search.rebuild_index(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'✓ Indexed {count} services'))
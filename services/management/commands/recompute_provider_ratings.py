@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from services import ratings
+
+
+class Command(BaseCommand):
+    help = 'Recompute provider rating totals and averages from their reviews'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--provider', type=int, action='append', dest='providers',
+                            help='Provider ID to recompute (repeatable, default: all providers)')
+        parser.add_argument('--batch-size', type=int, default=500, help='Providers updated per statement')
+
+    def handle(self, *args, **options):
+        count = ratings.recompute(options['providers'], batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'✓ Recomputed ratings for {count} provider(s)'))
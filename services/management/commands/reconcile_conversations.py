@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from services import conversations
+
+
+class Command(BaseCommand):
+    help = 'Attach orphaned messages to their conversation and recompute last messages and unread counts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--conversation', type=int, action='append', dest='conversations',
+                            help='Conversation ID to reconcile (repeatable, default: all conversations)')
+        parser.add_argument('--batch-size', type=int, default=500, help='Conversations updated per statement')
+
+    def handle(self, *args, **options):
+        conversation_ids = options['conversations']
+        if conversation_ids is not None:
+            # A full run attaches orphans itself
+            conversation_ids += conversations.attach_orphans()
+        count = conversations.reconcile(conversation_ids, batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'✓ Reconciled {count} conversation(s)'))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from services import counters
+
+
+class Command(BaseCommand):
+    help = 'Recompute provider dashboard counters from bookings, earnings, messages, notifications and services'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--provider', type=int, action='append', dest='providers',
+                            help='Provider ID to reconcile (repeatable, default: all providers)')
+        parser.add_argument('--batch-size', type=int, default=500, help='Providers recomputed per batch')
+
+    def handle(self, *args, **options):
+        count = counters.reconcile(options['providers'], batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'✓ Reconciled counters for {count} provider(s)'))
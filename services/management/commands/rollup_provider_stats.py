@@ -0,0 +1,26 @@
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from services import rollups
+
+
+class Command(BaseCommand):
+    help = 'Roll bookings, earnings and reviews up into daily, weekly and monthly ProviderStats'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true', help='Rebuild every period instead of resuming from the watermark')
+        parser.add_argument('--since', help='Revisit rows changed since this date (YYYY-MM-DD) instead of the watermark')
+        parser.add_argument('--batch-size', type=int, default=2000, help='Rows fetched and upserted per batch')
+
+    def handle(self, *args, **options):
+        since = None
+        if options['since']:
+            try:
+                since = timezone.make_aware(datetime.strptime(options['since'], '%Y-%m-%d'))
+            except ValueError:
+                raise CommandError('--since must be a date in YYYY-MM-DD format')
+
+        provider_ids, upserted = rollups.run(full=options['full'], since=since, batch_size=options['batch_size'])
+        scope = 'all providers' if provider_ids is None else f'{len(provider_ids)} changed provider(s)'
+        self.stdout.write(self.style.SUCCESS(f'✓ Upserted {upserted} stats rows for {scope}'))
@@ -0,0 +1,62 @@
+from datetime import datetime, time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from services import payouts
+from services.models import PayoutBatch
+
+
+class Command(BaseCommand):
+    help = 'Pay providers their pending earnings: build a payout batch and write its NEFT transfer file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--cutoff', type=str,
+                            help='Pay earnings created before this date, YYYY-MM-DD (default: today)')
+        parser.add_argument('--output', type=str, help='Write the transfer file of the batch to this path')
+        parser.add_argument('--settle', type=int, metavar='BATCH_ID',
+                            help='Mark a ready batch paid once the bank has made the transfers')
+        parser.add_argument('--returned', type=int, nargs='*', default=[], metavar='PROVIDER_ID',
+                            help='With --settle: providers whose transfer was returned')
+        parser.add_argument('--cancel', type=int, metavar='BATCH_ID', help='Return the earnings of a batch to pending')
+
+    def batch(self, batch_id):
+        try:
+            return PayoutBatch.objects.get(pk=batch_id)
+        except PayoutBatch.DoesNotExist:
+            raise CommandError(f'Payout batch {batch_id} does not exist')
+
+    def handle(self, *args, **options):
+        try:
+            if options['settle']:
+                batch = self.batch(options['settle'])
+                paid = payouts.settle(batch, options['returned'])
+                self.stdout.write(self.style.SUCCESS(f'✓ {batch.reference}: {paid} earning(s) marked paid'))
+                return
+            if options['cancel']:
+                batch = self.batch(options['cancel'])
+                returned = payouts.cancel(batch)
+                self.stdout.write(self.style.SUCCESS(f'✓ {batch.reference} cancelled, {returned} earning(s) pending again'))
+                return
+
+            try:
+                day = datetime.strptime(options['cutoff'], '%Y-%m-%d').date() if options['cutoff'] else timezone.localdate()
+            except ValueError:
+                raise CommandError('--cutoff must be a date in YYYY-MM-DD format')
+            batch, created = payouts.start(timezone.make_aware(datetime.combine(day, time.min)))
+            if not created:
+                self.stdout.write(f'Resuming {batch.reference}, left unfinished by an earlier run')
+            stats = payouts.build(batch)
+        except ValueError as error:
+            raise CommandError(str(error))
+
+        self.stdout.write(self.style.SUCCESS(
+            f'✓ {batch.reference}: ₹{batch.total_amount} to {batch.provider_count} provider(s) '
+            f'for {batch.earnings_count} earning(s)'
+        ))
+        if stats['skipped']:
+            self.stdout.write(f'  {stats["skipped"]} provider(s) with pending earnings have no bank details')
+        if options['output']:
+            with open(options['output'], 'w', newline='', encoding='utf-8') as handle:
+                handle.writelines(payouts.transfer_file(batch))
+            self.stdout.write(f'  Transfer file written to {options["output"]}')
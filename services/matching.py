@@ -0,0 +1,195 @@
+"""
+Service request matching
+
+Scores the providers that could take an open ServiceRequest and keeps the
+best MATCH_COUNT of them as ServiceRequestMatch rows, so the customer gets
+ranked suggestions instead of having to look a provider up by hand. A
+candidate's score (0-1) weighs
+
+    distance    kilometres between the request's pincode and the provider
+                (services/geo.py); providers more than MAX_DISTANCE_KM away
+                are left out, as are other cities when either side has no
+                coordinates
+    rating      average_rating out of 5
+    load        active bookings plus assigned requests; FULL_LOAD or more
+                scores nothing here
+    emergency   for 'high' and 'emergency' requests, whether the provider
+                offers emergency service in the category; required for
+                'emergency' requests
+
+Candidates come from per-category pools (verified, available providers with
+an approved, active service in the category). Each process builds a pool
+once and reuses it until the 'catalog' version in services/page_cache.py
+changes, i.e. until a service, provider or review is saved. Loads are read
+fresh for every batch.
+
+The signal handlers in services/signals.py match new requests as they are
+created, and emergency requests are assigned to their best match straight
+away. The backlog of open requests is re-scored in batches by ``run()``, also
+available as ``python manage.py match_service_requests``.
+"""
+from collections import Counter, namedtuple
+
+from django.db import transaction
+from django.db.models import Count
+from django.utils import timezone
+
+from services import geo, page_cache
+from services.models import Notification, ProviderCounters, Service, ServiceRequest, ServiceRequestMatch
+
+MATCH_COUNT = 5
+MAX_DISTANCE_KM = 50
+FULL_LOAD = 10
+WEIGHTS = {'distance': 0.4, 'rating': 0.3, 'load': 0.2, 'emergency': 0.1}
+URGENT = ('high', 'emergency')
+
+Candidate = namedtuple('Candidate', 'provider_id user_id city latitude longitude rating emergency')
+
+_pools = {}  # category ID -> (catalog version, [Candidate])
+
+
+def pools(category_ids):
+    """Return {category_id: [Candidate]}, rebuilding pools built before the catalogue last changed"""
+    category_ids = set(category_ids)
+    version = page_cache.versions(['catalog'])['catalog']
+    stale = [category_id for category_id in category_ids if _pools.get(category_id, (None,))[0] != version]
+    if stale:
+        loaded = {category_id: {} for category_id in stale}
+        rows = Service.objects.filter(
+            category_id__in=stale, is_active=True, approval_status='approved',
+            provider__verification_status='verified', provider__is_available=True,
+        ).values_list(
+            'category_id', 'provider_id', 'provider__user_id', 'provider__city',
+            'provider__latitude', 'provider__longitude', 'provider__average_rating', 'is_emergency_available',
+        )
+        for category_id, provider_id, user_id, city, latitude, longitude, rating, emergency in rows:
+            known = loaded[category_id].get(provider_id)
+            loaded[category_id][provider_id] = Candidate(
+                provider_id, user_id, city.strip().lower(),
+                None if latitude is None else float(latitude),
+                None if longitude is None else float(longitude),
+                float(rating),
+                emergency or (known is not None and known.emergency),
+            )
+        for category_id, candidates in loaded.items():
+            _pools[category_id] = (version, list(candidates.values()))
+    return {category_id: _pools[category_id][1] for category_id in category_ids}
+
+
+def loads(provider_ids):
+    """Return a Counter of active bookings plus assigned requests per provider"""
+    load = Counter()
+    for provider_id, pending, confirmed, in_progress in ProviderCounters.objects.filter(
+        provider_id__in=provider_ids
+    ).values_list('provider_id', 'bookings_pending', 'bookings_confirmed', 'bookings_in_progress'):
+        load[provider_id] += pending + confirmed + in_progress
+    for provider_id, assigned in ServiceRequest.objects.filter(
+        assigned_provider_id__in=provider_ids, status='assigned'
+    ).values('assigned_provider_id').annotate(total=Count('id')).values_list('assigned_provider_id', 'total'):
+        load[provider_id] += assigned
+    return load
+
+
+def score(service_request, point, candidate, load):
+    """Return (score, distance_km) of `candidate` for a request located at `point`, or None if it cannot take it"""
+    if service_request.urgency == 'emergency' and not candidate.emergency:
+        return None
+    if point is not None and candidate.latitude is not None:
+        distance = geo.distance_km(point[0], point[1], candidate.latitude, candidate.longitude)
+        if distance > MAX_DISTANCE_KM:
+            return None
+        closeness = 1 - distance / MAX_DISTANCE_KM
+    elif candidate.city == service_request.city.strip().lower():
+        distance, closeness = None, 1.0
+    else:
+        return None
+
+    parts = {
+        'distance': closeness,
+        'rating': candidate.rating / 5,
+        'load': 1 - min(load, FULL_LOAD) / FULL_LOAD,
+        'emergency': 1.0 if candidate.emergency and service_request.urgency in URGENT else 0.0,
+    }
+    return round(sum(WEIGHTS[name] * value for name, value in parts.items()), 4), distance
+
+
+def rank(service_request, candidates, load):
+    """Return the best [(score, distance_km, Candidate)] for a request, best first"""
+    point = geo.locate(service_request.pincode, service_request.city)
+    scored = []
+    for candidate in candidates:
+        result = score(service_request, point, candidate, load[candidate.provider_id])
+        if result is not None:
+            scored.append((*result, candidate))
+    scored.sort(key=lambda row: (-row[0], row[2].provider_id))
+    return scored[:MATCH_COUNT]
+
+
+def auto_assign(service_request, candidate):
+    """Assign an open, unassigned request to `candidate` and notify them; returns whether it was still open"""
+    assigned = ServiceRequest.objects.filter(
+        pk=service_request.pk, status='open', assigned_provider__isnull=True,
+    ).update(status='assigned', assigned_provider_id=candidate.provider_id, updated_at=timezone.now())
+    if assigned:
+        service_request.status, service_request.assigned_provider_id = 'assigned', candidate.provider_id
+        Notification.objects.create(
+            user_id=candidate.user_id,
+            notification_type='system',
+            title='Emergency request assigned to you',
+            message=f'{service_request.title} in {service_request.city}',
+            action_url=f'/api/service-requests/{service_request.pk}/',
+        )
+    return bool(assigned)
+
+
+def match_batch(service_requests, replace=True):
+    """
+    Store the top matches of `service_requests` and assign the emergency ones
+    to their best match. Returns a Counter with the number of requests,
+    'unmatched' ones and emergency requests 'assigned'.
+    """
+    stats = Counter(requests=len(service_requests))
+    candidate_pools = pools(request.category_id for request in service_requests)
+    load = loads({candidate.provider_id for pool in candidate_pools.values() for candidate in pool})
+
+    matches, assignments = [], []
+    for service_request in service_requests:
+        best = rank(service_request, candidate_pools[service_request.category_id], load)
+        if not best:
+            stats['unmatched'] += 1
+        matches.extend(
+            ServiceRequestMatch(
+                service_request=service_request, provider_id=candidate.provider_id,
+                rank=position, score=match_score, distance_km=distance,
+            )
+            for position, (match_score, distance, candidate) in enumerate(best, start=1)
+        )
+        if best and service_request.urgency == 'emergency' and service_request.assigned_provider_id is None:
+            assignments.append((service_request, best[0][2]))
+            # Later emergencies of the batch see the extra job
+            load[best[0][2].provider_id] += 1
+
+    with transaction.atomic():
+        if replace:
+            ServiceRequestMatch.objects.filter(service_request__in=service_requests).delete()
+        ServiceRequestMatch.objects.bulk_create(matches)
+        for service_request, candidate in assignments:
+            stats['assigned'] += auto_assign(service_request, candidate)
+    return stats
+
+
+def match(service_request):
+    """Match a newly created request"""
+    return match_batch([service_request], replace=False)
+
+
+def run(batch_size=500):
+    """Re-score every open request, oldest first; returns the summed Counter of match_batch()"""
+    stats = Counter()
+    last_id = 0
+    while True:
+        batch = list(ServiceRequest.objects.filter(status='open', id__gt=last_id).order_by('id')[:batch_size])
+        if not batch:
+            return stats
+        last_id = batch[-1].id
+        stats += match_batch(batch)
@@ -0,0 +1,67 @@
+"""
+Request middleware for HomeServe
+"""
+from django.core.cache import caches
+from django.utils.connection import ConnectionProxy
+from django.utils.functional import SimpleLazyObject
+
+from services.models import ServiceProvider
+
+ROLE_CACHE_TIMEOUT = 5 * 60
+
+cache = ConnectionProxy(caches, 'shared')  # the cache every worker process sees
+
+
+def role_cache_key(user_id):
+    return f'homeserve:role:{user_id}'
+
+
+def resolve_provider_id(user):
+    """Return the provider id of `user`, or None for customers (cached per user)"""
+    key = role_cache_key(user.id)
+    provider_id = cache.get(key)
+    if provider_id is None:
+        provider = ServiceProvider.objects.filter(user=user).first()
+        if provider is not None:
+            # Prime user.provider_profile so provider views don't fetch it again
+            user.provider_profile = provider
+        provider_id = provider.id if provider is not None else 0
+        cache.set(key, provider_id, ROLE_CACHE_TIMEOUT)
+    return provider_id or None
+
+
+def forget_role(user_id):
+    """Drop the cached role, e.g. when a provider profile is created or deleted"""
+    cache.delete(role_cache_key(user_id))
+
+
+class RoleMiddleware:
+    """
+    Resolve the user's role at most once per request:
+
+        request.role         'anonymous', 'customer' or 'provider'
+        request.provider_id  the user's ServiceProvider id, or None
+
+    Both are lazy, so requests that never look at them (the REST API) pay
+    nothing. Must come after AuthenticationMiddleware.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.provider_id = SimpleLazyObject(lambda: _provider_id(request))
+        request.role = SimpleLazyObject(lambda: _role(request))
+        return self.get_response(request)
+
+
+def _provider_id(request):
+    if not request.user.is_authenticated:
+        return None
+    return resolve_provider_id(request.user)
+
+
+def _role(request):
+    if not request.user.is_authenticated:
+        return 'anonymous'
+    return 'provider' if request.provider_id else 'customer'
@@ -0,0 +1,93 @@
+# Generated by Django 5.2.8 on 2026-10-17 21:48
+
+import re
+
+import django.db.models.deletion
+from django.db import OperationalError, migrations, models
+
+# Frozen copies of services/search.py as of this migration, which must not import live code
+FTS_TABLE = 'services_service_fts'
+FTS_CREATE_SQL = (
+    f'CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} '
+    "USING fts5(title, provider_name, description, tokenize='unicode61', prefix='2 3')"
+)
+FIELD_WEIGHTS = {'title': 10, 'provider_name': 5, 'description': 1}
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+_REPEATED_LATIN_RE = re.compile(r'([a-z])\1+')
+
+
+def tokenize(text):
+    return [_REPEATED_LATIN_RE.sub(r'\1', token.casefold())[:100] for token in _TOKEN_RE.findall(text or '')]
+
+
+def build_document(title, provider_name, description):
+    return {
+        'title': ' '.join(tokenize(title)),
+        'provider_name': ' '.join(tokenize(provider_name)),
+        'description': ' '.join(tokenize(description)),
+    }
+
+
+def term_weights(document):
+    weights = {}
+    for field, text in document.items():
+        for term in text.split():
+            weights[term] = weights.get(term, 0) + FIELD_WEIGHTS[field]
+    return weights
+
+
+def create_search_index(apps, schema_editor):
+    """Create the FTS5 table where supported and index existing services"""
+    Service = apps.get_model('services', 'Service')
+    ServiceSearchTerm = apps.get_model('services', 'ServiceSearchTerm')
+
+    use_fts = False
+    if schema_editor.connection.vendor == 'sqlite':
+        try:
+            schema_editor.execute(FTS_CREATE_SQL)
+            use_fts = True
+        except OperationalError:
+            # SQLite built without FTS5 - fall back to the term table
+            pass
+
+    services = Service.objects.select_related('provider').order_by('id')
+    for service in services.iterator(chunk_size=1000):
+        document = build_document(service.title, service.provider.business_name, service.description)
+        if use_fts:
+            schema_editor.execute(
+                f'INSERT INTO {FTS_TABLE} (rowid, title, provider_name, description) VALUES (%s, %s, %s, %s)',
+                [service.id, document['title'], document['provider_name'], document['description']]
+            )
+        else:
+            ServiceSearchTerm.objects.bulk_create([
+                ServiceSearchTerm(service_id=service.id, term=term, weight=weight)
+                for term, weight in term_weights(document).items()
+            ])
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute(f'DROP TABLE IF EXISTS {FTS_TABLE}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('services', '0005_service_approval_status_service_rejection_reason'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ServiceSearchTerm',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.CharField(max_length=100)),
+                ('weight', models.PositiveIntegerField(default=1, help_text='Sum of field weights for this term')),
+                ('service', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_terms', to='services.service')),
+            ],
+            options={
+                'unique_together': {('term', 'service')},
+            },
+        ),
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
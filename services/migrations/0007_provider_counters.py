@@ -0,0 +1,35 @@
+# Generated by Django 5.2.8 on 2026-10-17 21:56
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('services', '0006_service_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProviderCounters',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bookings_pending', models.IntegerField(default=0)),
+                ('bookings_confirmed', models.IntegerField(default=0)),
+                ('bookings_in_progress', models.IntegerField(default=0)),
+                ('bookings_completed', models.IntegerField(default=0)),
+                ('bookings_cancelled', models.IntegerField(default=0)),
+                ('bookings_total', models.IntegerField(default=0)),
+                ('pending_payout', models.DecimalField(decimal_places=2, default=0.0, max_digits=12)),
+                ('unread_messages', models.IntegerField(default=0)),
+                ('unread_notifications', models.IntegerField(default=0)),
+                ('active_services', models.IntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('provider', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='counters', to='services.serviceprovider')),
+            ],
+            options={
+                'verbose_name_plural': 'Provider Counters',
+            },
+        ),
+    ]
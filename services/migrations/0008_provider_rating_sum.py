@@ -0,0 +1,31 @@
+# Generated by Django 5.2.8 on 2026-10-17 21:59
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def backfill_rating_totals(apps, schema_editor):
+    ServiceProvider = apps.get_model('services', 'ServiceProvider')
+    Review = apps.get_model('services', 'Review')
+    reviews = Review.objects.filter(provider=OuterRef('pk')).order_by().values('provider')
+    ServiceProvider.objects.update(
+        rating_sum=Coalesce(Subquery(reviews.annotate(total=Sum('rating')).values('total')), 0),
+        total_reviews=Coalesce(Subquery(reviews.annotate(total=Count('id')).values('total')), 0),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('services', '0007_provider_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='serviceprovider',
+            name='rating_sum',
+            field=models.PositiveIntegerField(default=0, help_text='Sum of all review ratings'),
+        ),
+        migrations.RunPython(backfill_rating_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 5.2.8 on 2026-10-17 22:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('services', '0008_provider_rating_sum'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='JobWatermark',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('position', models.DateTimeField(blank=True, help_text='Rows changed before this were processed', null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'ordering': ['name'],
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='providerstats',
+            unique_together=set(),
+        ),
+        migrations.AddField(
+            model_name='providerstats',
+            name='period',
+            field=models.CharField(choices=[('day', 'Daily'), ('week', 'Weekly'), ('month', 'Monthly')], default='day', max_length=5),
+        ),
+        migrations.AlterField(
+            model_name='providerstats',
+            name='date',
+            field=models.DateField(help_text='First day of the period'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='providerstats',
+            unique_together={('provider', 'period', 'date')},
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 5.2.8 on 2026-10-17 22:13
+
+from datetime import datetime, time, timedelta
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.utils import timezone
+
+SLOT_STEP = 30
+
+
+def claim_active_bookings(apps, schema_editor):
+    """Claim the cells of every upcoming active booking; existing double bookings keep the first claim"""
+    Booking = apps.get_model('services', 'Booking')
+    BookingSlotClaim = apps.get_model('services', 'BookingSlotClaim')
+    bookings = Booking.objects.filter(
+        status__in=['pending', 'confirmed', 'in_progress'], booking_date__gte=timezone.localdate()
+    ).order_by('created_at').values_list('id', 'provider_id', 'booking_date', 'booking_time', 'service__duration_minutes')
+
+    claims = []
+    for booking_id, provider_id, day, start_time, duration in bookings.iterator():
+        start = start_time.hour * 60 + start_time.minute
+        midnight = datetime.combine(day, time.min)
+        for minute in range(start - start % SLOT_STEP, start + (duration or 60), SLOT_STEP):
+            claims.append(BookingSlotClaim(
+                booking_id=booking_id, provider_id=provider_id,
+                slot_start=timezone.make_aware(midnight + timedelta(minutes=minute)),
+            ))
+    BookingSlotClaim.objects.bulk_create(claims, batch_size=1000, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('services', '0011_portal_filter_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BookingSlotClaim',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('slot_start', models.DateTimeField()),
+                ('booking', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='slot_claims', to='services.booking')),
+                ('provider', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='slot_claims', to='services.serviceprovider')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('provider', 'slot_start'), name='unique_provider_slot_claim')],
+            },
+        ),
+        migrations.RunPython(claim_active_bookings, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.8 on 2026-10-17 22:25
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('services', '0012_booking_slot_claims'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='booking',
+            name='recurring_booking',
+            field=models.ForeignKey(blank=True, help_text='Subscription this booking was materialized from', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='bookings', to='services.recurringbooking'),
+        ),
+        migrations.AddIndex(
+            model_name='recurringbooking',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['next_booking_date', 'id'], name='recurring_due_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='booking',
+            constraint=models.UniqueConstraint(fields=('recurring_booking', 'booking_date'), name='unique_recurring_occurrence'),
+        ),
+    ]
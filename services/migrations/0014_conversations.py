@@ -0,0 +1,80 @@
+# Generated by Django 5.2.8 on 2026-10-17 22:28
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, F, IntegerField, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_conversations(apps, schema_editor):
+    """Create a conversation per pair of users with messages and fill in its inbox fields"""
+    Conversation = apps.get_model('services', 'Conversation')
+    Message = apps.get_model('services', 'Message')
+    pairs = {tuple(sorted(pair)) for pair in Message.objects.values_list('sender_id', 'receiver_id').distinct()}
+    for user_a_id, user_b_id in pairs:
+        conversation = Conversation.objects.create(user_a_id=user_a_id, user_b_id=user_b_id)
+        Message.objects.filter(
+            Q(sender_id=user_a_id, receiver_id=user_b_id) | Q(sender_id=user_b_id, receiver_id=user_a_id)
+        ).update(conversation=conversation)
+
+    thread = Message.objects.filter(conversation=OuterRef('pk'))
+    latest = thread.order_by('-created_at', '-id')
+
+    def unread(receiver):
+        counts = thread.filter(receiver=OuterRef(receiver), is_read=False).order_by().values('conversation')
+        return Coalesce(Subquery(counts.annotate(total=Count('id')).values('total'), output_field=IntegerField()), 0)
+
+    Conversation.objects.update(
+        last_message=Subquery(latest.values('id')[:1]),
+        last_activity_at=Coalesce(Subquery(latest.values('created_at')[:1]), F('created_at')),
+        unread_a=unread('user_a'),
+        unread_b=unread('user_b'),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('services', '0013_recurring_materializer'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Conversation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_activity_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('unread_a', models.PositiveIntegerField(default=0, help_text='Messages to user_a not read yet')),
+                ('unread_b', models.PositiveIntegerField(default=0, help_text='Messages to user_b not read yet')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_message', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='services.message')),
+                ('user_a', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user_b', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='conversation',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='services.conversation'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation', '-created_at', '-id'], name='message_thread_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(fields=['user_a', '-last_activity_at', '-id'], name='conversation_user_a_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(fields=['user_b', '-last_activity_at', '-id'], name='conversation_user_b_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='conversation',
+            constraint=models.UniqueConstraint(fields=('user_a', 'user_b'), name='unique_conversation_pair'),
+        ),
+        migrations.RunPython(backfill_conversations, migrations.RunPython.noop),
+    ]
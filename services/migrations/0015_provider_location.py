@@ -0,0 +1,92 @@
+# Generated by Django 5.2.8 on 2026-10-17 22:38
+
+import csv
+from pathlib import Path
+
+from django.conf import settings
+from django.db import migrations, models
+
+# Frozen copies of services/geo.py as of this migration, which must not import live code
+CENTROIDS_FILE = Path(__file__).resolve().parent.parent / 'data' / 'kerala_pincodes.csv'
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+
+def encode(latitude, longitude, precision=6):
+    lat_range, lng_range = [-90.0, 90.0], [-180.0, 180.0]
+    code, bits, value, even = [], 0, 0, True
+    while len(code) < precision:
+        interval, point = (lng_range, longitude) if even else (lat_range, latitude)
+        middle = (interval[0] + interval[1]) / 2
+        value <<= 1
+        if point >= middle:
+            value |= 1
+            interval[0] = middle
+        else:
+            interval[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            code.append(BASE32[value])
+            bits, value = 0, 0
+    return ''.join(code)
+
+
+def centroids():
+    by_pincode, by_name = {}, {}
+    with open(CENTROIDS_FILE, newline='', encoding='utf-8') as handle:
+        for row in csv.DictReader(handle):
+            point = (float(row['latitude']), float(row['longitude']))
+            by_pincode[row['pincode']] = point
+            by_name.setdefault(row['place'].lower(), point)
+            by_name.setdefault(row['district'].lower(), point)
+    return by_pincode, by_name
+
+
+def locate_providers(apps, schema_editor):
+    """Place existing providers at their pincode's centroid from the bundled table"""
+    ServiceProvider = apps.get_model('services', 'ServiceProvider')
+    by_pincode, by_name = centroids()
+
+    def locate(pincode, city):
+        pincode = (pincode or '').strip()
+        return by_pincode.get(pincode) or by_pincode.get(pincode[:3]) or by_name.get((city or '').strip().lower())
+
+    providers = []
+    for provider in ServiceProvider.objects.only('id', 'pincode', 'city'):
+        point = locate(provider.pincode, provider.city)
+        if point:
+            provider.latitude, provider.longitude = point
+            provider.geohash = encode(*point)
+            providers.append(provider)
+    ServiceProvider.objects.bulk_update(providers, ['latitude', 'longitude', 'geohash'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('services', '0014_conversations'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='serviceprovider',
+            name='geohash',
+            field=models.CharField(blank=True, editable=False, max_length=12),
+        ),
+        migrations.AddField(
+            model_name='serviceprovider',
+            name='latitude',
+            field=models.DecimalField(blank=True, decimal_places=6, max_digits=9, null=True),
+        ),
+        migrations.AddField(
+            model_name='serviceprovider',
+            name='longitude',
+            field=models.DecimalField(blank=True, decimal_places=6, max_digits=9, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='serviceprovider',
+            index=models.Index(fields=['geohash'], name='provider_geohash_idx'),
+        ),
+        migrations.RunPython(locate_providers, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 5.2.8 on 2026-10-17 22:42
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('services', '0015_provider_location'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ServiceRequestMatch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rank', models.PositiveSmallIntegerField()),
+                ('score', models.FloatField(help_text='0-1, higher is a better match')),
+                ('distance_km', models.FloatField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'verbose_name_plural': 'Service Request Matches',
+                'ordering': ['service_request', 'rank'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='servicerequest',
+            index=models.Index(fields=['status', 'id'], name='service_request_status_idx'),
+        ),
+        migrations.AddField(
+            model_name='servicerequestmatch',
+            name='provider',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='request_matches', to='services.serviceprovider'),
+        ),
+        migrations.AddField(
+            model_name='servicerequestmatch',
+            name='service_request',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='matches', to='services.servicerequest'),
+        ),
+        migrations.AddConstraint(
+            model_name='servicerequestmatch',
+            constraint=models.UniqueConstraint(fields=('service_request', 'rank'), name='unique_request_match_rank'),
+        ),
+    ]
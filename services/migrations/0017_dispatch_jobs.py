@@ -0,0 +1,41 @@
+# Generated by Django 5.2.8 on 2026-10-17 22:47
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('services', '0016_service_request_matches'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DispatchJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('geohash', models.CharField(blank=True, help_text='Where the job is, for nearby providers', max_length=12)),
+                ('priority', models.PositiveSmallIntegerField(choices=[(0, 'Emergency'), (1, 'High')])),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('leased', 'Claimed, awaiting acceptance'), ('accepted', 'Accepted'), ('cancelled', 'Cancelled')], default='queued', max_length=20)),
+                ('level', models.PositiveSmallIntegerField(default=0)),
+                ('escalate_at', models.DateTimeField(blank=True, null=True)),
+                ('lease_expires_at', models.DateTimeField(blank=True, null=True)),
+                ('attempts', models.PositiveIntegerField(default=0, help_text='Times the job was claimed')),
+                ('requested_at', models.DateTimeField()),
+                ('accepted_at', models.DateTimeField(blank=True, null=True)),
+                ('closed_at', models.DateTimeField(blank=True, null=True)),
+                ('accepted_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='accepted_dispatch_jobs', to='services.serviceprovider')),
+                ('booking', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='dispatch_job', to='services.booking')),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='services.servicecategory')),
+                ('leased_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='services.serviceprovider')),
+                ('provider', models.ForeignKey(blank=True, help_text='The only provider who may take the job; anyone eligible nearby when empty', null=True, on_delete=django.db.models.deletion.CASCADE, related_name='targeted_dispatch_jobs', to='services.serviceprovider')),
+                ('service_request', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='dispatch_job', to='services.servicerequest')),
+            ],
+            options={
+                'ordering': ['priority', 'requested_at', 'id'],
+                'indexes': [models.Index(fields=['status', 'priority', 'requested_at', 'id'], name='dispatch_queue_idx'), models.Index(fields=['status', 'escalate_at'], name='dispatch_escalation_idx')],
+                'constraints': [models.CheckConstraint(condition=models.Q(models.Q(('booking__isnull', False), ('service_request__isnull', True)), models.Q(('booking__isnull', True), ('service_request__isnull', False)), _connector='OR'), name='dispatch_job_has_one_source')],
+            },
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.8 on 2026-10-17 22:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('services', '0017_dispatch_jobs'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['wallet', '-created_at'], name='wallet_transaction_idx'),
+        ),
+    ]
@@ -0,0 +1,94 @@
+# Generated by Django 5.2.8 on 2026-10-17 22:54
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('services', '0018_wallet_transaction_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PayoutLine',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('earnings_count', models.PositiveIntegerField()),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('paid', 'Paid'), ('returned', 'Returned by Bank')], default='pending', max_length=20)),
+                ('account_name', models.CharField(max_length=100)),
+                ('account_number', models.CharField(max_length=20)),
+                ('ifsc', models.CharField(max_length=11)),
+            ],
+            options={
+                'ordering': ['batch', 'id'],
+            },
+        ),
+        migrations.AddField(
+            model_name='serviceprovider',
+            name='bank_account_name',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='serviceprovider',
+            name='bank_account_number',
+            field=models.CharField(blank=True, max_length=20),
+        ),
+        migrations.AddField(
+            model_name='serviceprovider',
+            name='bank_ifsc',
+            field=models.CharField(blank=True, help_text="IFSC code of the account's branch", max_length=11),
+        ),
+        migrations.CreateModel(
+            name='PayoutBatch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('cutoff', models.DateTimeField(help_text='Earnings created before this are included')),
+                ('status', models.CharField(choices=[('building', 'Building'), ('ready', 'Ready for Transfer'), ('paid', 'Paid'), ('cancelled', 'Cancelled')], default='building', max_length=20)),
+                ('last_earning_id', models.PositiveBigIntegerField(default=0, help_text='Earnings up to this ID have been claimed')),
+                ('provider_count', models.PositiveIntegerField(default=0)),
+                ('earnings_count', models.PositiveIntegerField(default=0)),
+                ('total_amount', models.DecimalField(decimal_places=2, default=0.0, max_digits=14)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('ready_at', models.DateTimeField(blank=True, null=True)),
+                ('closed_at', models.DateTimeField(blank=True, null=True)),
+                ('created_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name_plural': 'Payout Batches',
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.AddField(
+            model_name='providerearnings',
+            name='payout_batch',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='earnings', to='services.payoutbatch'),
+        ),
+        migrations.AddIndex(
+            model_name='providerearnings',
+            index=models.Index(fields=['payout_status', 'id'], name='earnings_payout_queue_idx'),
+        ),
+        migrations.AddField(
+            model_name='payoutline',
+            name='batch',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lines', to='services.payoutbatch'),
+        ),
+        migrations.AddField(
+            model_name='payoutline',
+            name='provider',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='payout_lines', to='services.serviceprovider'),
+        ),
+        migrations.AddConstraint(
+            model_name='payoutbatch',
+            constraint=models.UniqueConstraint(condition=models.Q(('status', 'building')), fields=('status',), name='single_building_payout_batch'),
+        ),
+        migrations.AddConstraint(
+            model_name='payoutline',
+            constraint=models.UniqueConstraint(fields=('batch', 'provider'), name='unique_payout_line'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.8 on 2026-10-17 23:00
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('services', '0019_payout_batches'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CouponRedemption',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sequence', models.PositiveIntegerField(help_text="1 for the customer's first use of the coupon, 2 for the next, ...")),
+                ('order_value', models.DecimalField(decimal_places=2, help_text='Booking amount before the discount', max_digits=10)),
+                ('discount_amount', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('redeemed_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('booking', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='coupon_redemption', to='services.booking')),
+                ('coupon', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='redemptions', to='services.coupon')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='coupon_redemptions', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-redeemed_at'],
+                'constraints': [models.UniqueConstraint(fields=('coupon', 'user', 'sequence'), name='coupon_redemption_per_user')],
+            },
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 5.2.8 on 2026-10-17 23:04
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+def open_balances(apps, schema_editor):
+    """Record each existing balance as ledger events, so every balance adds up from its events"""
+    LoyaltyPoints = apps.get_model('services', 'LoyaltyPoints')
+    LoyaltyEvent = apps.get_model('services', 'LoyaltyEvent')
+    events = []
+    for user_id, points, earned, redeemed in LoyaltyPoints.objects.values_list(
+        'user_id', 'points', 'total_earned', 'total_redeemed'
+    ).iterator():
+        for event_type, change in (('earned', earned), ('redeemed', -redeemed), ('adjusted', points - earned + redeemed)):
+            if change:
+                events.append(LoyaltyEvent(user_id=user_id, event_type=event_type, points=change,
+                                           description='Opening balance'))
+    LoyaltyEvent.objects.bulk_create(events, batch_size=2000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('services', '0020_coupon_redemptions'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LoyaltyEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_type', models.CharField(choices=[('earned', 'Earned'), ('redeemed', 'Redeemed'), ('adjusted', 'Adjusted')], max_length=10)),
+                ('points', models.IntegerField(help_text='Negative for redemptions')),
+                ('description', models.CharField(blank=True, max_length=200)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('booking', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='loyalty_events', to='services.booking')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='loyalty_events', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-created_at'],
+                'indexes': [models.Index(fields=['user', '-created_at'], name='loyalty_event_user_idx')],
+                'constraints': [models.UniqueConstraint(condition=models.Q(('event_type', 'earned')), fields=('booking',), name='loyalty_points_per_booking')],
+            },
+        ),
+        migrations.RunPython(open_balances, migrations.RunPython.noop),
+    ]
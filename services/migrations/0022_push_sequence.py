@@ -0,0 +1,23 @@
+# Generated by Django 5.2.8 on 2026-10-17 23:24
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('services', '0021_loyalty_events'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PushSequence',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='push_sequence', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('last_id', models.PositiveBigIntegerField(default=0)),
+            ],
+        ),
+    ]
@@ -1,9 +1,49 @@
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.utils import timezone
 
 
+class ServiceCategoryQuerySet(models.QuerySet):
+    def with_service_counts(self):
+        """Annotate each category with its number of active services as `service_count`"""
+        return self.annotate(
+            service_count=models.Count('services', filter=models.Q(services__is_active=True))
+        )
+
+    def service_counts(self):
+        """Return {category_id: active service count} for every category in one query"""
+        rows = (
+            Service.objects
+            .filter(is_active=True, category__in=self)
+            .values('category_id')
+            .annotate(total=models.Count('id'))
+            .order_by()
+        )
+        return {row['category_id']: row['total'] for row in rows}
+
+
+class CountedModel(models.Model):
+    """
+    A model feeding ProviderCounters (services/counters.py). Saves and deletes
+    run in a transaction, so the counter signal handlers read and lock the
+    row as it was before the write, and move the counters in the same
+    transaction as the row.
+    """
+
+    class Meta:
+        abstract = True
+
+    # No savepoint inside an outer transaction, as Model.save_base() does for multi-table saves
+    def save(self, *args, **kwargs):
+        with transaction.atomic(using=kwargs.get('using'), savepoint=False):
+            super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic(using=kwargs.get('using'), savepoint=False):
+            return super().delete(*args, **kwargs)
+
+
 class ServiceCategory(models.Model):
     """Categories for home services like Plumbing, Electrical, Cleaning, etc."""
     name = models.CharField(max_length=100, unique=True)
@@ -13,6 +53,8 @@ class ServiceCategory(models.Model):
     created_at = models.DateTimeField(default=timezone.now)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = ServiceCategoryQuerySet.as_manager()
+
     class Meta:
         verbose_name_plural = "Service Categories"
         ordering = ['name']
@@ -38,11 +80,21 @@ class ServiceProvider(models.Model):
     city = models.CharField(max_length=100)
     state = models.CharField(max_length=100)
     pincode = models.CharField(max_length=10)
+
+    # Location (services/geo.py); filled in from the pincode when not given
+    latitude = models.DecimalField(max_digits=9, decimal_places=6, null=True, blank=True)
+    longitude = models.DecimalField(max_digits=9, decimal_places=6, null=True, blank=True)
+    geohash = models.CharField(max_length=12, blank=True, editable=False)
     
     # Business details
     experience_years = models.PositiveIntegerField(default=0, help_text="Years of experience")
     bio = models.TextField(help_text="Brief description about the service provider")
     profile_image = models.ImageField(upload_to='providers/', blank=True, null=True)
+
+    # Bank account for payouts (services/payouts.py)
+    bank_account_name = models.CharField(max_length=100, blank=True)
+    bank_account_number = models.CharField(max_length=20, blank=True)
+    bank_ifsc = models.CharField(max_length=11, blank=True, help_text="IFSC code of the account's branch")
     
     # Verification
     verification_status = models.CharField(max_length=20, choices=VERIFICATION_STATUS, default='pending')
@@ -52,6 +104,7 @@ class ServiceProvider(models.Model):
     # Ratings
     average_rating = models.DecimalField(max_digits=3, decimal_places=2, default=0.00)
     total_reviews = models.PositiveIntegerField(default=0)
+    rating_sum = models.PositiveIntegerField(default=0, help_text="Sum of all review ratings")
     total_bookings = models.PositiveIntegerField(default=0)
     
     # Availability
@@ -64,20 +117,26 @@ class ServiceProvider(models.Model):
 
     class Meta:
         ordering = ['-average_rating', '-total_bookings']
+        indexes = [
+            models.Index(fields=['geohash'], name='provider_geohash_idx'),
+        ]
 
     def __str__(self):
         return f"{self.business_name} ({self.user.username})"
 
     def update_rating(self):
-        """Recalculate average rating from all reviews"""
-        reviews = self.reviews.all()
-        if reviews.exists():
-            self.total_reviews = reviews.count()
-            self.average_rating = reviews.aggregate(models.Avg('rating'))['rating__avg']
-            self.save()
-
-
-class Service(models.Model):
+        """
+        Recalculate rating totals from all reviews.
+        Review writes keep them current incrementally (services/ratings.py); this is for repairs.
+        """
+        totals = self.reviews.aggregate(count=models.Count('id'), total=models.Sum('rating'))
+        self.total_reviews = totals['count']
+        self.rating_sum = totals['total'] or 0
+        self.average_rating = round(self.rating_sum / self.total_reviews, 2) if self.total_reviews else 0
+        self.save(update_fields=['total_reviews', 'rating_sum', 'average_rating'])
+
+
+class Service(CountedModel):
     """Individual services offered by providers"""
     PRICING_TYPE = [
         ('fixed', 'Fixed Price'),
@@ -116,6 +175,11 @@ class Service(models.Model):
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(
+                fields=['is_active', 'approval_status', 'category'], name='service_catalog_idx'
+            ),
+        ]
 
     def __str__(self):
         return f"{self.title} - {self.provider.business_name}"
@@ -148,15 +212,14 @@ class Review(models.Model):
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['-created_at', '-id'], name='review_created_id_idx'),
+            models.Index(fields=['provider', '-created_at', '-id'], name='review_provider_created_idx'),
+        ]
 
     def __str__(self):
         return f"Review by {self.customer.username} for {self.provider.business_name} - {self.rating}★"
 
-    def save(self, *args, **kwargs):
-        super().save(*args, **kwargs)
-        # Update provider's average rating
-        self.provider.update_rating()
-
 
 class ProviderPortfolio(models.Model):
     """Portfolio/gallery images for service providers"""
@@ -221,12 +284,35 @@ class ServiceRequest(models.Model):
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['status', 'id'], name='service_request_status_idx'),
+        ]
 
     def __str__(self):
         return f"Request #{self.id} - {self.title} ({self.urgency})"
 
 
-class Booking(models.Model):
+class ServiceRequestMatch(models.Model):
+    """A ranked provider suggestion for a service request (see services/matching.py)"""
+    service_request = models.ForeignKey(ServiceRequest, on_delete=models.CASCADE, related_name='matches')
+    provider = models.ForeignKey(ServiceProvider, on_delete=models.CASCADE, related_name='request_matches')
+    rank = models.PositiveSmallIntegerField()
+    score = models.FloatField(help_text="0-1, higher is a better match")
+    distance_km = models.FloatField(null=True, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ['service_request', 'rank']
+        constraints = [
+            models.UniqueConstraint(fields=['service_request', 'rank'], name='unique_request_match_rank'),
+        ]
+        verbose_name_plural = "Service Request Matches"
+
+    def __str__(self):
+        return f"Request #{self.service_request_id} -> {self.provider_id} (#{self.rank})"
+
+
+class Booking(CountedModel):
     """Bookings made by customers for services"""
     BOOKING_STATUS = [
         ('pending', 'Pending Confirmation'),
@@ -256,6 +342,10 @@ class Booking(models.Model):
     status = models.CharField(max_length=20, choices=BOOKING_STATUS, default='pending')
     total_amount = models.DecimalField(max_digits=10, decimal_places=2)
     is_emergency = models.BooleanField(default=False)
+    recurring_booking = models.ForeignKey(
+        'RecurringBooking', on_delete=models.SET_NULL, null=True, blank=True, related_name='bookings',
+        help_text="Subscription this booking was materialized from"
+    )
     
     # Timestamps
     created_at = models.DateTimeField(default=timezone.now)
@@ -265,13 +355,101 @@ class Booking(models.Model):
     
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['-created_at', '-id'], name='booking_created_id_idx'),
+            models.Index(fields=['user', '-created_at', '-id'], name='booking_user_created_idx'),
+            models.Index(fields=['provider', '-created_at', '-id'], name='booking_provider_created_idx'),
+            models.Index(fields=['provider', 'status'], name='booking_provider_status_idx'),
+            models.Index(fields=['provider', 'booking_date', 'booking_time'], name='booking_provider_date_idx'),
+            models.Index(fields=['user', 'status'], name='booking_user_status_idx'),
+        ]
+        constraints = [
+            # A recurring booking is materialized at most once per date, however often the job runs
+            models.UniqueConstraint(fields=['recurring_booking', 'booking_date'], name='unique_recurring_occurrence'),
+        ]
     
     def __str__(self):
         return f"Booking #{self.id} - {self.service.title} by {self.customer_name}"
 
 
+class DispatchJob(models.Model):
+    """An emergency booking or urgent service request waiting for a provider (see services/dispatch.py)"""
+    PRIORITY_CHOICES = [
+        (0, 'Emergency'),
+        (1, 'High'),
+    ]
+
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('leased', 'Claimed, awaiting acceptance'),
+        ('accepted', 'Accepted'),
+        ('cancelled', 'Cancelled'),
+    ]
+
+    # Exactly one of these is set
+    booking = models.OneToOneField(
+        'Booking', on_delete=models.CASCADE, null=True, blank=True, related_name='dispatch_job'
+    )
+    service_request = models.OneToOneField(
+        ServiceRequest, on_delete=models.CASCADE, null=True, blank=True, related_name='dispatch_job'
+    )
+
+    category = models.ForeignKey(ServiceCategory, on_delete=models.CASCADE, related_name='+')
+    provider = models.ForeignKey(
+        ServiceProvider, on_delete=models.CASCADE, null=True, blank=True, related_name='targeted_dispatch_jobs',
+        help_text="The only provider who may take the job; anyone eligible nearby when empty"
+    )
+    geohash = models.CharField(max_length=12, blank=True, help_text="Where the job is, for nearby providers")
+    priority = models.PositiveSmallIntegerField(choices=PRIORITY_CHOICES)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='queued')
+
+    # Escalation
+    level = models.PositiveSmallIntegerField(default=0)
+    escalate_at = models.DateTimeField(null=True, blank=True)
+
+    # Lease held by the provider who claimed the job
+    leased_by = models.ForeignKey(ServiceProvider, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveIntegerField(default=0, help_text="Times the job was claimed")
+
+    requested_at = models.DateTimeField()
+    accepted_by = models.ForeignKey(
+        ServiceProvider, on_delete=models.SET_NULL, null=True, blank=True, related_name='accepted_dispatch_jobs'
+    )
+    accepted_at = models.DateTimeField(null=True, blank=True)
+    closed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['priority', 'requested_at', 'id']
+        constraints = [
+            models.CheckConstraint(
+                condition=(
+                    models.Q(booking__isnull=False, service_request__isnull=True)
+                    | models.Q(booking__isnull=True, service_request__isnull=False)
+                ),
+                name='dispatch_job_has_one_source',
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['status', 'priority', 'requested_at', 'id'], name='dispatch_queue_idx'),
+            models.Index(fields=['status', 'escalate_at'], name='dispatch_escalation_idx'),
+        ]
+
+    def __str__(self):
+        source = f'Booking #{self.booking_id}' if self.booking_id else f'Request #{self.service_request_id}'
+        return f"{source} ({self.get_priority_display()}, {self.status})"
+
+    @property
+    def response_seconds(self):
+        """Seconds from the request to its acceptance, or None while unaccepted"""
+        if self.accepted_at is None:
+            return None
+        return (self.accepted_at - self.requested_at).total_seconds()
+
+
 # ====================== PAYMENT & WALLET SYSTEM ======================
 
+
 class Wallet(models.Model):
     """Digital wallet for users"""
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='wallet')
@@ -284,18 +462,19 @@ class Wallet(models.Model):
     def __str__(self):
         return f"{self.user.username} - ₹{self.balance}"
 
-    def add_funds(self, amount):
-        """Add money to wallet"""
-        self.balance += amount
-        self.save()
+    def add_funds(self, amount, description='Funds added', reference_id=''):
+        """Add money to wallet (posted through services/ledger.py)"""
+        from services import ledger
+        return ledger.credit(self, amount, description, reference_id)
 
-    def deduct_funds(self, amount):
-        """Deduct money from wallet"""
-        if self.balance >= amount:
-            self.balance -= amount
-            self.save()
-            return True
-        return False
+    def deduct_funds(self, amount, description='Payment', reference_id=''):
+        """Deduct money from wallet; returns False if the balance does not cover it"""
+        from services import ledger
+        try:
+            ledger.debit(self, amount, description, reference_id)
+        except ledger.InsufficientFunds:
+            return False
+        return True
 
 
 class Payment(models.Model):
@@ -370,6 +549,9 @@ class Transaction(models.Model):
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['wallet', '-created_at'], name='wallet_transaction_idx'),
+        ]
 
     def __str__(self):
         return f"{self.transaction_type} - ₹{self.amount} - {self.wallet.user.username}"
@@ -377,9 +559,45 @@ class Transaction(models.Model):
 
 # ====================== MESSAGING SYSTEM ======================
 
-class Message(models.Model):
+class Conversation(models.Model):
+    """Inbox entry for a pair of users, maintained from their messages (see services/conversations.py)"""
+    # The pair is stored once, lower user ID first
+    user_a = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    user_b = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+
+    last_message = models.ForeignKey(
+        'Message', on_delete=models.SET_NULL, null=True, blank=True, related_name='+'
+    )
+    last_activity_at = models.DateTimeField(default=timezone.now)
+    unread_a = models.PositiveIntegerField(default=0, help_text="Messages to user_a not read yet")
+    unread_b = models.PositiveIntegerField(default=0, help_text="Messages to user_b not read yet")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user_a', 'user_b'], name='unique_conversation_pair'),
+        ]
+        indexes = [
+            models.Index(fields=['user_a', '-last_activity_at', '-id'], name='conversation_user_a_idx'),
+            models.Index(fields=['user_b', '-last_activity_at', '-id'], name='conversation_user_b_idx'),
+        ]
+
+    def __str__(self):
+        return f"Conversation between {self.user_a_id} and {self.user_b_id}"
+
+    def other_user(self, user):
+        return self.user_b if user.id == self.user_a_id else self.user_a
+
+    def unread_for(self, user):
+        return self.unread_a if user.id == self.user_a_id else self.unread_b
+
+
+class Message(CountedModel):
     """Chat messages between customers and providers"""
     booking = models.ForeignKey(Booking, on_delete=models.CASCADE, related_name='messages')
+    conversation = models.ForeignKey(
+        Conversation, on_delete=models.CASCADE, null=True, blank=True, related_name='messages'
+    )
     sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sent_messages')
     receiver = models.ForeignKey(User, on_delete=models.CASCADE, related_name='received_messages')
     
@@ -392,6 +610,14 @@ class Message(models.Model):
 
     class Meta:
         ordering = ['created_at']
+        indexes = [
+            models.Index(fields=['sender', '-created_at', '-id'], name='message_sender_created_idx'),
+            models.Index(fields=['receiver', '-created_at', '-id'], name='message_receiver_created_idx'),
+            models.Index(
+                fields=['receiver', '-created_at'], condition=models.Q(is_read=False), name='message_unread_idx'
+            ),
+            models.Index(fields=['conversation', '-created_at', '-id'], name='message_thread_idx'),
+        ]
 
     def __str__(self):
         return f"Message from {self.sender.username} to {self.receiver.username}"
@@ -399,7 +625,7 @@ class Message(models.Model):
 
 # ====================== PROVIDER ANALYTICS & EARNINGS ======================
 
-class ProviderEarnings(models.Model):
+class ProviderEarnings(CountedModel):
     """Track provider earnings"""
     provider = models.ForeignKey(ServiceProvider, on_delete=models.CASCADE, related_name='earnings')
     booking = models.OneToOneField(Booking, on_delete=models.CASCADE, related_name='provider_earning')
@@ -418,6 +644,9 @@ class ProviderEarnings(models.Model):
         ('hold', 'On Hold'),
     ]
     payout_status = models.CharField(max_length=20, choices=PAYOUT_STATUS, default='pending')
+    payout_batch = models.ForeignKey(
+        'PayoutBatch', on_delete=models.SET_NULL, null=True, blank=True, related_name='earnings'
+    )
     paid_at = models.DateTimeField(null=True, blank=True)
     
     created_at = models.DateTimeField(default=timezone.now)
@@ -425,15 +654,97 @@ class ProviderEarnings(models.Model):
     class Meta:
         ordering = ['-created_at']
         verbose_name_plural = "Provider Earnings"
+        indexes = [
+            models.Index(
+                fields=['provider', 'payout_status', 'created_at'], name='earnings_provider_payout_idx'
+            ),
+            # Payout runs claim pending earnings in id order
+            models.Index(fields=['payout_status', 'id'], name='earnings_payout_queue_idx'),
+        ]
 
     def __str__(self):
         return f"{self.provider.business_name} - ₹{self.net_amount}"
 
 
+class PayoutBatch(models.Model):
+    """One payout run: the pending earnings created before `cutoff`, paid by bank transfer (services/payouts.py)"""
+    STATUS = [
+        ('building', 'Building'),
+        ('ready', 'Ready for Transfer'),
+        ('paid', 'Paid'),
+        ('cancelled', 'Cancelled'),
+    ]
+
+    cutoff = models.DateTimeField(help_text="Earnings created before this are included")
+    status = models.CharField(max_length=20, choices=STATUS, default='building')
+    last_earning_id = models.PositiveBigIntegerField(default=0, help_text="Earnings up to this ID have been claimed")
+
+    provider_count = models.PositiveIntegerField(default=0)
+    earnings_count = models.PositiveIntegerField(default=0)
+    total_amount = models.DecimalField(max_digits=14, decimal_places=2, default=0.00)
+
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    created_at = models.DateTimeField(default=timezone.now)
+    ready_at = models.DateTimeField(null=True, blank=True)
+    closed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        verbose_name_plural = "Payout Batches"
+        constraints = [
+            # Two runs building at once would race for the same earnings
+            models.UniqueConstraint(
+                fields=['status'], condition=models.Q(status='building'), name='single_building_payout_batch'
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.reference} ({self.get_status_display()})"
+
+    @property
+    def reference(self):
+        return f"PAYOUT-{self.cutoff:%Y%m%d}-{self.pk}"
+
+
+class PayoutLine(models.Model):
+    """A provider's transfer in a payout batch, with the bank details it was sent to"""
+    STATUS = [
+        ('pending', 'Pending'),
+        ('paid', 'Paid'),
+        ('returned', 'Returned by Bank'),
+    ]
+
+    batch = models.ForeignKey(PayoutBatch, on_delete=models.CASCADE, related_name='lines')
+    provider = models.ForeignKey(ServiceProvider, on_delete=models.CASCADE, related_name='payout_lines')
+    amount = models.DecimalField(max_digits=12, decimal_places=2)
+    earnings_count = models.PositiveIntegerField()
+    status = models.CharField(max_length=20, choices=STATUS, default='pending')
+
+    account_name = models.CharField(max_length=100)
+    account_number = models.CharField(max_length=20)
+    ifsc = models.CharField(max_length=11)
+
+    class Meta:
+        ordering = ['batch', 'id']
+        constraints = [
+            models.UniqueConstraint(fields=['batch', 'provider'], name='unique_payout_line'),
+        ]
+
+    def __str__(self):
+        return f"{self.batch.reference} - {self.provider.business_name} - ₹{self.amount}"
+
+
 class ProviderStats(models.Model):
-    """Daily/monthly statistics for providers"""
+    """Daily/weekly/monthly statistics for providers, rolled up by services/rollups.py"""
+    PERIOD = [
+        ('day', 'Daily'),
+        ('week', 'Weekly'),
+        ('month', 'Monthly'),
+    ]
+
     provider = models.ForeignKey(ServiceProvider, on_delete=models.CASCADE, related_name='stats')
-    date = models.DateField()
+    period = models.CharField(max_length=5, choices=PERIOD, default='day')
+    date = models.DateField(help_text="First day of the period")
     
     # Performance metrics
     bookings_received = models.PositiveIntegerField(default=0)
@@ -455,11 +766,48 @@ class ProviderStats(models.Model):
 
     class Meta:
         ordering = ['-date']
-        unique_together = ['provider', 'date']
+        unique_together = ['provider', 'period', 'date']
         verbose_name_plural = "Provider Stats"
 
     def __str__(self):
-        return f"{self.provider.business_name} - {self.date}"
+        return f"{self.provider.business_name} - {self.get_period_display()} {self.date}"
+
+
+class ProviderCounters(models.Model):
+    """Denormalized dashboard counters, maintained incrementally by services/counters.py"""
+    provider = models.OneToOneField(ServiceProvider, on_delete=models.CASCADE, related_name='counters')
+
+    # Bookings by status
+    bookings_pending = models.IntegerField(default=0)
+    bookings_confirmed = models.IntegerField(default=0)
+    bookings_in_progress = models.IntegerField(default=0)
+    bookings_completed = models.IntegerField(default=0)
+    bookings_cancelled = models.IntegerField(default=0)
+    bookings_total = models.IntegerField(default=0)
+
+    pending_payout = models.DecimalField(max_digits=12, decimal_places=2, default=0.00)
+    unread_messages = models.IntegerField(default=0)
+    unread_notifications = models.IntegerField(default=0)
+    active_services = models.IntegerField(default=0)
+
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name_plural = "Provider Counters"
+
+    def __str__(self):
+        return f"Counters for {self.provider.business_name}"
+
+    def booking_stats(self):
+        """Booking counts keyed like the provider portal's status filter"""
+        return {
+            'all': self.bookings_total,
+            'pending': self.bookings_pending,
+            'confirmed': self.bookings_confirmed,
+            'in_progress': self.bookings_in_progress,
+            'completed': self.bookings_completed,
+            'cancelled': self.bookings_cancelled,
+        }
 
 
 # ====================== PROMOTION & MARKETING ======================
@@ -507,6 +855,28 @@ class Coupon(models.Model):
                 (self.usage_limit is None or self.used_count < self.usage_limit))
 
 
+class CouponRedemption(models.Model):
+    """One use of a coupon on a booking (services/coupons.py)"""
+    coupon = models.ForeignKey(Coupon, on_delete=models.CASCADE, related_name='redemptions')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='coupon_redemptions')
+    booking = models.OneToOneField(Booking, on_delete=models.CASCADE, related_name='coupon_redemption')
+    sequence = models.PositiveIntegerField(help_text="1 for the customer's first use of the coupon, 2 for the next, ...")
+
+    order_value = models.DecimalField(max_digits=10, decimal_places=2, help_text="Booking amount before the discount")
+    discount_amount = models.DecimalField(max_digits=10, decimal_places=2)
+    redeemed_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ['-redeemed_at']
+        constraints = [
+            # Concurrent redemptions by one customer compete for the same number; only one can have it
+            models.UniqueConstraint(fields=['coupon', 'user', 'sequence'], name='coupon_redemption_per_user'),
+        ]
+
+    def __str__(self):
+        return f"{self.coupon.code} - {self.user.username} - ₹{self.discount_amount}"
+
+
 class ServicePackage(models.Model):
     """Service bundles/packages for better pricing"""
     provider = models.ForeignKey(ServiceProvider, on_delete=models.CASCADE, related_name='packages')
@@ -567,32 +937,57 @@ class LoyaltyPoints(models.Model):
     def __str__(self):
         return f"{self.user.username} - {self.points} points ({self.tier})"
 
-    def add_points(self, points, description=""):
-        """Add loyalty points"""
-        self.points += points
-        self.total_earned += points
-        self.update_tier()
-        self.save()
+    # (total_earned needed, tier), highest first; below the last is bronze
+    TIERS = [(10000, 'platinum'), (5000, 'gold'), (2000, 'silver')]
 
-    def redeem_points(self, points):
-        """Redeem loyalty points"""
-        if self.points >= points:
-            self.points -= points
-            self.total_redeemed += points
-            self.save()
-            return True
-        return False
+    def add_points(self, points, description=""):
+        """Add loyalty points (posted through services/loyalty.py)"""
+        from services import loyalty
+        return loyalty.earn(self, points, description)
+
+    def redeem_points(self, points, description="Points redeemed"):
+        """Redeem loyalty points; returns False if the balance does not cover them"""
+        from services import loyalty
+        try:
+            loyalty.redeem(self, points, description)
+        except loyalty.InsufficientPoints:
+            return False
+        return True
 
     def update_tier(self):
         """Update loyalty tier based on total earned"""
-        if self.total_earned >= 10000:
-            self.tier = 'platinum'
-        elif self.total_earned >= 5000:
-            self.tier = 'gold'
-        elif self.total_earned >= 2000:
-            self.tier = 'silver'
-        else:
-            self.tier = 'bronze'
+        self.tier = next((tier for needed, tier in self.TIERS if self.total_earned >= needed), 'bronze')
+
+
+class LoyaltyEvent(models.Model):
+    """One change to a customer's loyalty points; the rows of a user add up to their balance"""
+    EVENT_TYPE = [
+        ('earned', 'Earned'),
+        ('redeemed', 'Redeemed'),
+        ('adjusted', 'Adjusted'),
+    ]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='loyalty_events')
+    event_type = models.CharField(max_length=10, choices=EVENT_TYPE)
+    points = models.IntegerField(help_text="Negative for redemptions")
+    booking = models.ForeignKey(Booking, on_delete=models.SET_NULL, null=True, blank=True,
+                                related_name='loyalty_events')
+    description = models.CharField(max_length=200, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['user', '-created_at'], name='loyalty_event_user_idx'),
+        ]
+        constraints = [
+            # A completed booking earns points once, however often accrual runs
+            models.UniqueConstraint(fields=['booking'], condition=models.Q(event_type='earned'),
+                                    name='loyalty_points_per_booking'),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username} {self.points:+d} ({self.event_type})"
 
 
 # ====================== CUSTOMER FEATURES ======================
@@ -645,7 +1040,7 @@ class CustomerAddress(models.Model):
         return f"{self.customer.username} - {self.label}"
 
 
-class Notification(models.Model):
+class Notification(CountedModel):
     """Push notifications for users"""
     NOTIFICATION_TYPE = [
         ('booking', 'Booking Update'),
@@ -671,6 +1066,11 @@ class Notification(models.Model):
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(
+                fields=['user', '-created_at'], condition=models.Q(is_read=False), name='notification_unread_idx'
+            ),
+        ]
 
     def __str__(self):
         return f"{self.user.username} - {self.title}"
@@ -763,6 +1163,16 @@ class RecurringBooking(models.Model):
     created_at = models.DateTimeField(default=timezone.now)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            # Due subscriptions, scanned by services/recurring.py
+            models.Index(
+                fields=['next_booking_date', 'id'],
+                condition=models.Q(is_active=True),
+                name='recurring_due_idx',
+            ),
+        ]
+
     def __str__(self):
         return f"{self.customer.username} - {self.service.title} ({self.frequency})"
 
@@ -866,3 +1276,70 @@ class ProviderLeave(models.Model):
 
     def __str__(self):
         return f"{self.provider.business_name} - {self.start_date} to {self.end_date}"
+
+
+class BookingSlotClaim(models.Model):
+    """
+    One half-hour cell of a provider's calendar held by an active booking.
+    The unique constraint is what makes double booking impossible; see services/slots.py.
+    """
+    provider = models.ForeignKey(ServiceProvider, on_delete=models.CASCADE, related_name='slot_claims')
+    booking = models.ForeignKey(Booking, on_delete=models.CASCADE, related_name='slot_claims')
+    slot_start = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['provider', 'slot_start'], name='unique_provider_slot_claim'),
+        ]
+
+    def __str__(self):
+        return f"{self.provider.business_name} - {self.slot_start}"
+
+
+# ====================== SEARCH INDEX ======================
+
+class ServiceSearchTerm(models.Model):
+    """Inverted index of service search terms (used when SQLite FTS5 is unavailable)"""
+    service = models.ForeignKey(Service, on_delete=models.CASCADE, related_name='search_terms')
+    term = models.CharField(max_length=100)
+    weight = models.PositiveIntegerField(default=1, help_text="Sum of field weights for this term")
+
+    class Meta:
+        unique_together = ['term', 'service']
+
+    def __str__(self):
+        return f"{self.term} → Service #{self.service_id}"
+
+
+# ====================== BACKGROUND JOBS ======================
+
+class JobWatermark(models.Model):
+    """How far an incremental background job has processed its source rows"""
+    name = models.CharField(max_length=100, unique=True)
+    position = models.DateTimeField(null=True, blank=True, help_text="Rows changed before this were processed")
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['name']
+
+    def __str__(self):
+        return f"{self.name} @ {self.position}"
+
+    @classmethod
+    def get_position(cls, name):
+        return cls.objects.filter(name=name).values_list('position', flat=True).first()
+
+    @classmethod
+    def set_position(cls, name, position):
+        cls.objects.update_or_create(name=name, defaults={'position': position})
+
+
+# ====================== LIVE UPDATES ======================
+
+class PushSequence(models.Model):
+    """The id of the last live-update event published to a user (see services/push.py)"""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='push_sequence')
+    last_id = models.PositiveBigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.user} @ {self.last_id}"
@@ -0,0 +1,93 @@
+"""
+Versioned response cache for the public catalogue pages
+
+Each catalogue entity has a version number in the cache: 'catalog' for
+anything that affects listings and counts, plus one per service, provider and
+category. A cached page remembers the versions of the entities it was rendered
+from; it is served only while all of them are unchanged. The signal handlers
+in services/signals.py bump versions on post_save/post_delete, so an admin
+approval is visible on the very next request without deleting any keys.
+
+Only anonymous GET requests are cached; signed-in users always get a fresh
+render (their pages show role-specific navigation).
+"""
+import time
+from functools import wraps
+
+from django.core.cache import caches
+from django.http import HttpResponse
+from django.utils.connection import ConnectionProxy
+
+PAGE_TIMEOUT = 60 * 60 * 24
+VERSION_TIMEOUT = None  # versions must outlive the pages that refer to them
+
+cache = ConnectionProxy(caches, 'shared')  # the cache every worker process sees
+
+
+def _version_key(entity):
+    return f'homeserve:version:{entity}'
+
+
+def entity(kind, pk=None):
+    return kind if pk is None else f'{kind}:{pk}'
+
+
+def bump(*entities):
+    """Invalidate every cached page rendered from any of `entities`"""
+    for name in entities:
+        key = _version_key(name)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.add(key, _initial_version(), VERSION_TIMEOUT)
+
+
+def _initial_version():
+    # Clock-based, so a version evicted from the cache never restarts at a number old pages still carry
+    return time.time_ns()
+
+
+def versions(entities):
+    """Return {entity: current version}"""
+    keys = {_version_key(name): name for name in entities}
+    found = cache.get_many(keys)
+    for key in keys.keys() - found.keys():
+        cache.add(key, _initial_version(), VERSION_TIMEOUT)
+        found[key] = cache.get(key)
+    return {keys[key]: version for key, version in found.items()}
+
+
+def depends_on(request, *entities):
+    """Declare, from inside a cached view, the entities the response is built from"""
+    dependencies = getattr(request, '_page_cache_dependencies', None)
+    if dependencies is not None:
+        dependencies.update(versions(entities))
+
+
+def cache_anonymous_page(view):
+    """
+    Serve anonymous GETs of `view` from the cache while the entity versions
+    they depend on are unchanged. The view reports its dependencies with
+    depends_on(); responses without any are not cached.
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if request.method != 'GET' or request.user.is_authenticated:
+            return view(request, *args, **kwargs)
+
+        key = f'homeserve:page:{view.__name__}:{request.get_full_path()}'
+        entry = cache.get(key)
+        if entry is not None and versions(entry['versions']) == entry['versions']:
+            return HttpResponse(entry['content'], content_type=entry['content_type'])
+
+        request._page_cache_dependencies = {}
+        response = view(request, *args, **kwargs)
+        dependencies = request._page_cache_dependencies
+        if response.status_code == 200 and dependencies and not response.streaming:
+            cache.set(key, {
+                'versions': dependencies,
+                'content': response.content,
+                'content_type': response['Content-Type'],
+            }, PAGE_TIMEOUT)
+        return response
+    return wrapper
@@ -0,0 +1,150 @@
+"""
+Pagination for the REST API
+
+High-volume lists (bookings, reviews, messages) use keyset pagination on
+(created_at, id), conversations on (last_activity_at, id): each page is one
+indexed range scan, with no COUNT(*) and no OFFSET, so page 500 costs the same
+as page 1. Clients follow the ``next`` and
+``previous`` links, which carry an opaque ``cursor``.
+
+Passing ``?page=N`` (or a custom ``?ordering=``) switches back to classic
+page-number pagination with a total ``count``, for admin screens that need it.
+"""
+import base64
+import json
+from datetime import datetime
+
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+
+class StandardPageNumberPagination(PageNumberPagination):
+    """Page-number pagination with a client-selectable page size"""
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+
+class KeysetPagination(BasePagination):
+    """Newest-first keyset pagination on (keyset_field, id), with page numbers on request"""
+    keyset_field = 'created_at'
+    page_size = api_settings.PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = 'Invalid cursor'
+    fallback_class = StandardPageNumberPagination
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.fallback = None
+        params = request.query_params
+        if self.fallback_class.page_query_param in params or params.get(api_settings.ORDERING_PARAM):
+            self.fallback = self.fallback_class()
+            return self.fallback.paginate_queryset(queryset, request, view)
+
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.page_size = self.get_page_size(request)
+        position, reverse = self.decode_cursor(request)
+        field = self.keyset_field
+
+        if reverse:
+            queryset = queryset.order_by(field, 'id')
+            if position:
+                queryset = queryset.filter(
+                    Q(**{f'{field}__gt': position[0]}) | Q(**{field: position[0], 'id__gt': position[1]})
+                )
+        else:
+            queryset = queryset.order_by(f'-{field}', '-id')
+            if position:
+                queryset = queryset.filter(
+                    Q(**{f'{field}__lt': position[0]}) | Q(**{field: position[0], 'id__lt': position[1]})
+                )
+
+        rows = list(queryset[:self.page_size + 1])
+        has_more = len(rows) > self.page_size
+        self.page = rows[:self.page_size]
+        if reverse:
+            self.page.reverse()
+            self.has_next, self.has_previous = position is not None, has_more
+        else:
+            self.has_next, self.has_previous = has_more, position is not None
+        return self.page
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(size, 1), self.max_page_size)
+
+    def decode_cursor(self, request):
+        """Return ((keyset value, id) or None, reverse)"""
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None, False
+        try:
+            data = json.loads(base64.urlsafe_b64decode(encoded.encode('ascii')))
+            return (datetime.fromisoformat(data['t']), int(data['i'])), bool(data.get('r'))
+        except (TypeError, ValueError, KeyError, UnicodeEncodeError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def encode_cursor(self, row, reverse):
+        data = {'t': getattr(row, self.keyset_field).isoformat(), 'i': row.id}
+        if reverse:
+            data['r'] = 1
+        encoded = base64.urlsafe_b64encode(json.dumps(data, separators=(',', ':')).encode('ascii')).decode('ascii')
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
+
+    def get_next_link(self):
+        if self.fallback:
+            return self.fallback.get_next_link()
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(self.page[-1], reverse=False)
+
+    def get_previous_link(self):
+        if self.fallback:
+            return self.fallback.get_previous_link()
+        if not self.has_previous or not self.page:
+            return None
+        return self.encode_cursor(self.page[0], reverse=True)
+
+    def get_paginated_response(self, data):
+        if self.fallback:
+            return self.fallback.get_paginated_response(data)
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+    def get_schema_operation_parameters(self, view):
+        return [
+            {'name': self.cursor_query_param, 'required': False, 'in': 'query',
+             'description': 'Opaque position returned in the next/previous links', 'schema': {'type': 'string'}},
+            {'name': self.page_size_query_param, 'required': False, 'in': 'query',
+             'description': 'Number of results to return per page', 'schema': {'type': 'integer'}},
+            {'name': self.fallback_class.page_query_param, 'required': False, 'in': 'query',
+             'description': 'Page number; switches to page-number pagination with a total count',
+             'schema': {'type': 'integer'}},
+        ]
+
+
+class ConversationPagination(KeysetPagination):
+    """Inbox pages: most recently active conversations first"""
+    keyset_field = 'last_activity_at'
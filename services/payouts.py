@@ -0,0 +1,226 @@
+"""
+Provider payouts
+
+A payout run pays providers what they earned before a cutoff, as one
+PayoutBatch. Earnings move pending -> processing -> paid:
+
+    start()          opens a batch, or returns the one a failed run left
+                     'building' (there is never more than one)
+    build()          claims the pending earnings created before the cutoff,
+                     CHUNK_SIZE at a time in ID order, from providers with
+                     bank details. Each chunk moves to 'processing' in its
+                     own transaction together with the batch's watermark
+                     (last_earning_id), so a run that dies part way picks up
+                     after the last chunk it finished when build() is called
+                     again. The batch is then summed per provider into
+                     PayoutLine rows, which keep the bank details the money
+                     is sent to, and is 'ready'
+    transfer_file()  yields the NEFT bulk-upload CSV of a ready batch row by
+                     row, reading the lines with a server-side cursor, so a
+                     month-end file never sits in memory
+    settle()         once the bank has made the transfers, marks the batch's
+                     earnings paid, chunk by chunk; providers whose transfer
+                     was returned get their earnings back as pending for
+                     the next run. Re-running finishes a settlement that
+                     stopped part way
+    cancel()         returns the earnings of an unpaid batch to pending
+
+Earnings on hold and providers without bank details stay pending. Every
+status change goes through chunked QuerySet.update() calls, so the
+provider counters (services/counters.py) of the providers touched are
+reconciled in the same transaction. ``python manage.py run_payouts`` runs
+the whole cycle from the command line.
+"""
+import csv
+from collections import Counter
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, Q, Sum
+from django.utils import timezone
+
+from services import counters
+from services.models import PayoutBatch, PayoutLine, ProviderEarnings
+
+CHUNK_SIZE = 2000
+TRANSFER_COLUMNS = [
+    'Transaction Type', 'Beneficiary Account Number', 'IFSC', 'Beneficiary Name', 'Amount', 'Value Date',
+    'Customer Reference', 'Remarks',
+]
+
+
+def _has_bank_details(path=''):
+    return ~Q(**{f'{path}bank_account_number': ''}) & ~Q(**{f'{path}bank_ifsc': ''})
+
+
+def start(cutoff, user=None):
+    """Return (batch, created): a new batch for `cutoff`, or the unfinished one of an earlier run"""
+    batch = PayoutBatch.objects.filter(status='building').first()
+    if batch is not None:
+        return batch, False
+    try:
+        with transaction.atomic():
+            return PayoutBatch.objects.create(cutoff=cutoff, created_by=user), True
+    except IntegrityError:
+        # Another run opened one in between
+        return PayoutBatch.objects.get(status='building'), False
+
+
+def _chunks(queryset):
+    """Yield lists of up to CHUNK_SIZE (id, provider_id) rows of `queryset` until it is exhausted"""
+    while True:
+        rows = list(queryset.order_by('id').values_list('id', 'provider_id')[:CHUNK_SIZE])
+        if not rows:
+            return
+        yield rows
+        if len(rows) < CHUNK_SIZE:
+            return
+
+
+def _claim(batch):
+    claimed = 0
+    claimable = ProviderEarnings.objects.filter(
+        _has_bank_details('provider__'), payout_status='pending', created_at__lt=batch.cutoff,
+    )
+    while True:
+        rows = list(
+            claimable.filter(id__gt=batch.last_earning_id).order_by('id').values_list('id', 'provider_id')[:CHUNK_SIZE]
+        )
+        if not rows:
+            return claimed
+        with transaction.atomic():
+            if not PayoutBatch.objects.filter(pk=batch.pk, status='building').update(last_earning_id=rows[-1][0]):
+                raise ValueError(f'{batch.reference} was closed while it was being built')
+            # Earnings put on hold since the read are left alone
+            claimed += ProviderEarnings.objects.filter(
+                pk__in=[pk for pk, _ in rows], payout_status='pending',
+            ).update(payout_status='processing', payout_batch=batch)
+            counters.reconcile({provider_id for _, provider_id in rows})
+        batch.last_earning_id = rows[-1][0]
+
+
+def _write_lines(batch):
+    totals = (
+        ProviderEarnings.objects.filter(payout_batch=batch, payout_status='processing')
+        .values('provider_id', 'provider__bank_account_name', 'provider__business_name',
+                'provider__bank_account_number', 'provider__bank_ifsc')
+        .annotate(amount=Sum('net_amount'), earnings=Count('id'))
+        .order_by('provider_id')
+    )
+    with transaction.atomic():
+        batch.lines.all().delete()
+        lines = []
+        for row in totals.iterator(chunk_size=CHUNK_SIZE):
+            lines.append(PayoutLine(
+                batch=batch, provider_id=row['provider_id'], amount=row['amount'], earnings_count=row['earnings'],
+                account_name=row['provider__bank_account_name'] or row['provider__business_name'],
+                account_number=row['provider__bank_account_number'], ifsc=row['provider__bank_ifsc'].upper(),
+            ))
+            if len(lines) >= CHUNK_SIZE:
+                PayoutLine.objects.bulk_create(lines)
+                lines = []
+        PayoutLine.objects.bulk_create(lines)
+
+        summary = batch.lines.aggregate(providers=Count('id'), earnings=Sum('earnings_count'), total=Sum('amount'))
+        batch.provider_count = summary['providers']
+        batch.earnings_count = summary['earnings'] or 0
+        batch.total_amount = summary['total'] or Decimal('0.00')
+        batch.ready_at = timezone.now()
+        if not PayoutBatch.objects.filter(pk=batch.pk, status='building').update(
+            status='ready', provider_count=batch.provider_count, earnings_count=batch.earnings_count,
+            total_amount=batch.total_amount, ready_at=batch.ready_at,
+        ):
+            raise ValueError(f'{batch.reference} was closed while it was being built')
+        batch.status = 'ready'
+
+
+def build(batch):
+    """
+    Claim the batch's earnings and write its lines; safe to call again after
+    a failure. Returns a Counter of earnings 'claimed' by this call and
+    providers 'skipped' for want of bank details.
+    """
+    if batch.status != 'building':
+        raise ValueError(f'{batch.reference} is {batch.status}, not building')
+    stats = Counter(claimed=_claim(batch))
+    _write_lines(batch)
+    stats['skipped'] = ProviderEarnings.objects.filter(
+        payout_status='pending', created_at__lt=batch.cutoff,
+    ).exclude(_has_bank_details('provider__')).values('provider_id').distinct().count()
+    return stats
+
+
+def run(cutoff, user=None):
+    """Build a batch of the earnings created before `cutoff`, resuming an unfinished run; returns (batch, stats)"""
+    batch, _ = start(cutoff, user)
+    return batch, build(batch)
+
+
+class _Echo:
+    """File-like object whose write() hands back what it was given, for csv.writer"""
+
+    def write(self, value):
+        return value
+
+
+def transfer_file(batch, value_date=None):
+    """Return an iterator over the NEFT bulk-upload CSV rows of a ready or paid batch"""
+    if batch.status not in ('ready', 'paid'):
+        raise ValueError(f'{batch.reference} has no transfer file while {batch.status}')
+    return _transfer_rows(batch, f'{value_date or timezone.localdate():%d/%m/%Y}')
+
+
+def _transfer_rows(batch, value_date):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(TRANSFER_COLUMNS)
+    for line in batch.lines.order_by('id').iterator(chunk_size=CHUNK_SIZE):
+        yield writer.writerow([
+            'NEFT', line.account_number, line.ifsc, line.account_name, f'{line.amount:.2f}', value_date,
+            f'{batch.reference}-{line.provider_id}', f'HomeServe payout {batch.cutoff:%b %Y}',
+        ])
+
+
+def _move_earnings(earnings, **changes):
+    """Update `earnings` CHUNK_SIZE rows at a time (each chunk leaves the queryset); returns the number moved"""
+    moved = 0
+    for rows in _chunks(earnings):
+        with transaction.atomic():
+            moved += ProviderEarnings.objects.filter(pk__in=[pk for pk, _ in rows]).update(**changes)
+            if changes.get('payout_status') == 'pending':
+                counters.reconcile({provider_id for _, provider_id in rows})
+    return moved
+
+
+def settle(batch, returned_provider_ids=()):
+    """
+    Mark a ready batch paid after the bank transfer. Earnings of the
+    providers in `returned_provider_ids`, whose transfer bounced, go back to
+    pending. Returns the number of earnings marked paid.
+    """
+    if batch.status not in ('ready', 'paid'):
+        raise ValueError(f'{batch.reference} is {batch.status}, not ready')
+    now = timezone.now()
+    processing = ProviderEarnings.objects.filter(payout_batch=batch, payout_status='processing')
+    returned = list(returned_provider_ids)
+    if returned:
+        batch.lines.filter(provider_id__in=returned).update(status='returned')
+        _move_earnings(processing.filter(provider_id__in=returned), payout_status='pending', payout_batch=None)
+    paid = _move_earnings(processing, payout_status='paid', paid_at=now)
+    batch.lines.filter(status='pending').update(status='paid')
+    PayoutBatch.objects.filter(pk=batch.pk).update(status='paid', closed_at=now)
+    batch.status, batch.closed_at = 'paid', now
+    return paid
+
+
+def cancel(batch):
+    """Return the earnings of a batch that was not paid to pending; returns the number returned"""
+    if batch.status not in ('building', 'ready'):
+        raise ValueError(f'{batch.reference} is {batch.status} and cannot be cancelled')
+    now = timezone.now()
+    # Close the batch first so a build() still running for it stops claiming
+    PayoutBatch.objects.filter(pk=batch.pk).update(status='cancelled', closed_at=now)
+    batch.status, batch.closed_at = 'cancelled', now
+    return _move_earnings(
+        ProviderEarnings.objects.filter(payout_batch=batch, payout_status='processing'),
+        payout_status='pending', payout_batch=None,
+    )
@@ -4,20 +4,26 @@ Provider-specific views for the provider portal
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
-from django.db.models import Sum, Avg, Count, Q
+from django.core.paginator import Paginator
+from django.db.models import Sum, Avg, Count
 from django.utils import timezone
 from datetime import date, timedelta
+from services import conversations
+from services.aggregates import histograms
+from services.counters import get_counters
 from services.models import (
     ServiceProvider, Service, Booking, Review, 
-    ProviderEarnings, ProviderStats, Message, Notification,
+    ProviderEarnings, ProviderStats, Notification,
     ProviderAvailability, ProviderLeave, ServiceCategory, Payment, BookingExtension
 )
 
+CONVERSATIONS_PER_PAGE = 20
+
 
 def provider_required(view_func):
     """Decorator to ensure user has a provider profile"""
     def wrapper(request, *args, **kwargs):
-        if not hasattr(request.user, 'provider_profile'):
+        if request.role != 'provider':
             messages.error(request, 'You need a provider account to access this page.')
             return redirect('provider_onboarding')
         return view_func(request, *args, **kwargs)
@@ -44,15 +50,9 @@ def provider_home(request):
     ).order_by('-created_at')[:5]
     
     # Pending actions
-    pending_bookings = Booking.objects.filter(
-        provider=provider,
-        status='pending'
-    ).count()
-    
-    unread_messages = Message.objects.filter(
-        receiver=request.user,
-        is_read=False
-    ).count()
+    counters = get_counters(provider)
+    pending_bookings = counters.bookings_pending
+    unread_messages = counters.unread_messages
     
     # Quick stats
     this_week_start = today - timedelta(days=today.weekday())
@@ -88,8 +88,9 @@ def provider_services(request):
     categories = ServiceCategory.objects.filter(is_active=True)
     
     # Stats
-    active_count = services.filter(is_active=True).count()
-    inactive_count = services.filter(is_active=False).count()
+    active = histograms(services, 'is_active', values={'is_active': [True, False]})['is_active']
+    active_count = active[True]
+    inactive_count = active[False]
     total_bookings = Booking.objects.filter(service__provider=provider).count()
     avg_price = services.aggregate(Avg('price'))['price__avg'] or 0
     
@@ -243,14 +244,7 @@ def provider_bookings(request):
         bookings = bookings.filter(status=status_filter)
     
     # Stats
-    stats = {
-        'all': Booking.objects.filter(provider=provider).count(),
-        'pending': Booking.objects.filter(provider=provider, status='pending').count(),
-        'confirmed': Booking.objects.filter(provider=provider, status='confirmed').count(),
-        'in_progress': Booking.objects.filter(provider=provider, status='in_progress').count(),
-        'completed': Booking.objects.filter(provider=provider, status='completed').count(),
-        'cancelled': Booking.objects.filter(provider=provider, status='cancelled').count(),
-    }
+    stats = get_counters(provider).booking_stats()
     
     context = {
         'provider': provider,
@@ -382,19 +376,24 @@ def provider_earnings(request):
     ).order_by('-created_at')
     
     # Summary
-    total_earned = earnings.aggregate(total=Sum('net_amount'))['total'] or 0
-    pending_payout = earnings.filter(payout_status='pending').aggregate(total=Sum('net_amount'))['total'] or 0
-    paid_out = earnings.filter(payout_status='paid').aggregate(total=Sum('net_amount'))['total'] or 0
+    payouts = histograms(earnings, 'payout_status', sum_of='net_amount')
+    total_earned = payouts['total']
+    pending_payout = payouts['payout_status']['pending']
+    paid_out = payouts['payout_status']['paid']
     
     # Stats by date
     daily_stats = ProviderStats.objects.filter(
         provider=provider,
+        period='day',
         date__gte=start_date
     ).order_by('-date')
     
     # Calculate totals
     total_bookings = daily_stats.aggregate(total=Sum('bookings_completed'))['total'] or 0
     avg_rating = daily_stats.aggregate(avg=Avg('average_rating_day'))['avg'] or 0
+
+    # Payouts (services/payouts.py); everything still pending is kept on the counters row
+    payout_lines = provider.payout_lines.select_related('batch').order_by('-batch__cutoff')[:10]
     
     context = {
         'provider': provider,
@@ -406,6 +405,8 @@ def provider_earnings(request):
         'total_bookings': total_bookings,
         'avg_rating': avg_rating,
         'days_filter': days,
+        'available_balance': get_counters(provider).pending_payout,
+        'payout_lines': payout_lines,
     }
     return render(request, 'provider/earnings.html', context)
 
@@ -413,31 +414,24 @@ def provider_earnings(request):
 @login_required
 @provider_required
 def provider_messages_page(request):
-    """Messages page"""
+    """Messages page: one row per conversation, most recently active first"""
     provider = request.user.provider_profile
-    
-    # Get all conversations
-    messages_list = Message.objects.filter(
-        Q(sender=request.user) | Q(receiver=request.user)
-    ).order_by('-created_at')
-    
-    # Group by conversation
-    conversations = {}
-    for msg in messages_list:
-        other_user = msg.receiver if msg.sender == request.user else msg.sender
-        if other_user.id not in conversations:
-            conversations[other_user.id] = {
-                'user': other_user,
-                'messages': [],
-                'unread': 0,
-            }
-        conversations[other_user.id]['messages'].append(msg)
-        if msg.receiver == request.user and not msg.is_read:
-            conversations[other_user.id]['unread'] += 1
-    
+
+    inbox = conversations.for_user(request.user).select_related('user_a', 'user_b', 'last_message')
+    page_obj = Paginator(inbox, CONVERSATIONS_PER_PAGE).get_page(request.GET.get('page'))
+
     context = {
         'provider': provider,
-        'conversations': conversations.values(),
+        'page_obj': page_obj,
+        'conversations': [
+            {
+                'user': conversation.other_user(request.user),
+                'last_message': conversation.last_message,
+                'last_activity_at': conversation.last_activity_at,
+                'unread': conversation.unread_for(request.user),
+            }
+            for conversation in page_obj
+        ],
     }
     return render(request, 'provider/messages.html', context)
 
@@ -500,16 +494,13 @@ def provider_reviews(request):
     reviews = Review.objects.filter(provider=provider).order_by('-created_at')
     
     # Stats
-    total_reviews = reviews.count()
-    avg_rating = reviews.aggregate(avg=Avg('rating'))['avg'] or 0
-    
-    rating_distribution = {
-        5: reviews.filter(rating=5).count(),
-        4: reviews.filter(rating=4).count(),
-        3: reviews.filter(rating=3).count(),
-        2: reviews.filter(rating=2).count(),
-        1: reviews.filter(rating=1).count(),
-    }
+    ratings = histograms(reviews, 'rating', values={'rating': range(5, 0, -1)})
+    total_reviews = ratings['total']
+    avg_rating = (
+        sum(rating * count for rating, count in ratings['rating'].items()) / total_reviews
+        if total_reviews else 0
+    )
+    rating_distribution = ratings['rating']
     
     context = {
         'provider': provider,
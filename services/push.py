@@ -0,0 +1,242 @@
+"""
+Live updates for signed-in users
+
+``GET /api/events/`` is a Server-Sent Events stream served by the ASGI app
+(homeserve/asgi.py, e.g. ``uvicorn homeserve.asgi:application``). It pushes
+
+    message          a message was sent to or by the user
+    booking_status   a booking of the user (as customer or provider) was
+                     created or changed status
+
+so the inbox and dashboards update as things happen instead of on reload.
+
+Fan-out has two layers:
+
+    in-process hub   ``send()`` hands each event straight to the queue of
+                     every stream the recipient has open in this process
+    shared cache     every event is also stored in the cache under a
+                     per-user sequence number; streams check their user's
+                     sequence every POLL_SECONDS and pick up events that
+                     another worker published
+
+The sequence numbers come from the user's PushSequence row, incremented
+with an UPDATE that holds the row until the event and the new sequence are
+in the cache, so concurrent publishers never share an id and the cached
+sequence only moves forward once its event can be read.
+
+With a process-local backend for the 'shared' cache (see CACHES) only the
+hub applies, which is all a single worker (runserver, one uvicorn process)
+needs. Events are published once the transaction that produced them commits.
+The sequence number is the SSE event id, so a browser that reconnects with
+Last-Event-ID is sent what it missed, for up to RETENTION_SECONDS.
+"""
+import asyncio
+import json
+import threading
+from collections import defaultdict
+from functools import partial
+
+from django.core.cache import caches
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import F
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils.connection import ConnectionProxy
+
+from services.models import Booking, PushSequence, ServiceProvider
+
+POLL_SECONDS = 2  # how often a stream looks for events from other workers
+KEEPALIVE_SECONDS = 15
+STREAM_SECONDS = 300  # streams end after this long; browsers reconnect on their own
+RETENTION_SECONDS = 300
+RETRY_MILLISECONDS = 3000
+QUEUE_SIZE = 100
+
+cache = ConnectionProxy(caches, 'shared')  # the cache every worker process sees
+
+
+def _sequence_key(user_id):
+    return f'push:{user_id}:seq'
+
+
+def _event_key(user_id, sequence):
+    return f'push:{user_id}:{sequence}'
+
+
+class Hub:
+    """In-process pub/sub: user ID -> queues of the streams open in this process"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = defaultdict(set)
+
+    def subscribe(self, user_id):
+        """Register a queue for `user_id` on the running event loop and return it"""
+        subscription = (asyncio.get_running_loop(), asyncio.Queue(QUEUE_SIZE))
+        with self._lock:
+            self._subscribers[user_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, user_id, subscription):
+        with self._lock:
+            self._subscribers[user_id].discard(subscription)
+            if not self._subscribers[user_id]:
+                del self._subscribers[user_id]
+
+    def deliver(self, user_id, event):
+        """Queue `event` for every stream of `user_id`; safe to call from any thread"""
+        with self._lock:
+            subscriptions = list(self._subscribers.get(user_id, ()))
+        for loop, queue in subscriptions:
+            loop.call_soon_threadsafe(_offer, queue, event)
+
+
+def _offer(queue, event):
+    # A stream that fell this far behind picks the event up from the cache instead
+    if not queue.full():
+        queue.put_nowait(event)
+
+
+hub = Hub()
+
+
+def store(user_id, event_type, data):
+    """Keep an event in the shared cache under the user's next sequence number and return it"""
+    sequences = PushSequence.objects.filter(user_id=user_id)
+    with transaction.atomic():
+        if not sequences.update(last_id=F('last_id') + 1):
+            PushSequence.objects.bulk_create([PushSequence(user_id=user_id)], ignore_conflicts=True)
+            sequences.update(last_id=F('last_id') + 1)
+        event = {'id': sequences.values_list('last_id', flat=True).get(), 'type': event_type, 'data': data}
+        cache.set(_event_key(user_id, event['id']), event, RETENTION_SECONDS)
+        cache.set(_sequence_key(user_id), event['id'], None)
+    return event
+
+
+def send(user_ids, event_type, data):
+    """Publish an event to `user_ids` right away; None entries (guest bookings) are skipped"""
+    for user_id in dict.fromkeys(user_id for user_id in user_ids if user_id):
+        hub.deliver(user_id, store(user_id, event_type, data))
+
+
+def publish(user_ids, event_type, data):
+    """Publish an event to `user_ids` once the current transaction commits"""
+    transaction.on_commit(partial(send, list(user_ids), event_type, data))
+
+
+# ====================== EVENTS ======================
+
+def message_sent(message):
+    publish([message.sender_id, message.receiver_id], 'message', {
+        'id': message.id,
+        'conversation': message.conversation_id,
+        'booking': message.booking_id,
+        'sender': message.sender_id,
+        'message_text': message.message_text,
+        'created_at': message.created_at,
+    })
+
+
+def booking_changed(booking, previous):
+    """Tell the customer and the provider that `booking` moved from `previous` status (None: created)"""
+    provider = booking.provider if Booking.provider.is_cached(booking) else None
+    data = {'booking': booking.id, 'status': booking.status, 'previous': previous}
+
+    def send_after_commit():
+        provider_user_id = provider.user_id if provider else (
+            ServiceProvider.objects.filter(pk=booking.provider_id).values_list('user_id', flat=True).first()
+        )
+        send([booking.user_id, provider_user_id], 'booking_status', data)
+
+    transaction.on_commit(send_after_commit)
+
+
+def bulk_status_change(queryset, status):
+    """Publish booking_status for the bookings of `queryset` that QuerySet.update() is about to move to `status`"""
+    rows = queryset.exclude(status=status).values_list('id', 'status', 'user_id', 'provider__user_id')
+    for booking_id, previous, user_id, provider_user_id in rows:
+        publish([user_id, provider_user_id], 'booking_status', {
+            'booking': booking_id, 'status': status, 'previous': previous,
+        })
+
+
+# ====================== STREAM ======================
+
+def _format(event):
+    data = json.dumps(event['data'], cls=DjangoJSONEncoder)
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {data}\n\n"
+
+
+async def _stored_events(user_id, after, until):
+    """Events `after` < id <= `until` that are still in the cache (at most QUEUE_SIZE), oldest first"""
+    keys = [_event_key(user_id, sequence) for sequence in range(max(after, until - QUEUE_SIZE) + 1, until + 1)]
+    found = await cache.aget_many(keys) if keys else {}
+    return [found[key] for key in keys if key in found]
+
+
+async def events(user_id, last_event_id=None, duration=None):
+    """Yield the SSE stream of `user_id` for `duration` seconds (default STREAM_SECONDS)"""
+    # Read the sequence before subscribing: anything published in between is above it and found in the cache
+    checked = await cache.aget(_sequence_key(user_id), 0)
+    subscription = hub.subscribe(user_id)
+    try:
+        yield f'retry: {RETRY_MILLISECONDS}\n\n'
+        if last_event_id is not None and last_event_id < checked:
+            for event in await _stored_events(user_id, last_event_id, checked):
+                yield _format(event)
+        sent = set()  # ids above `checked` that already came through the hub
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + (STREAM_SECONDS if duration is None else duration)
+        last_write = next_poll = loop.time()
+        while (now := loop.time()) < deadline:
+            try:
+                event = await asyncio.wait_for(
+                    subscription[1].get(), timeout=max(min(next_poll, deadline) - now, 0)
+                )
+            except asyncio.TimeoutError:
+                event = None
+            if event is not None and event['id'] > checked and event['id'] not in sent:
+                sent.add(event['id'])
+                last_write = loop.time()
+                yield _format(event)
+
+            if loop.time() >= next_poll:
+                next_poll = loop.time() + POLL_SECONDS
+                latest = await cache.aget(_sequence_key(user_id), 0)
+                if latest > checked:
+                    for event in await _stored_events(user_id, checked, latest):
+                        if event['id'] not in sent:
+                            last_write = loop.time()
+                            yield _format(event)
+                    checked = latest
+                    sent = {sequence for sequence in sent if sequence > checked}
+                if loop.time() - last_write >= KEEPALIVE_SECONDS:
+                    last_write = loop.time()
+                    yield ': keepalive\n\n'
+    finally:
+        hub.unsubscribe(user_id, subscription)
+
+
+async def event_stream(request):
+    """
+    GET /api/events/ - Server-Sent Events stream of the user's messages and
+    booking status changes. Only served by the ASGI app: under WSGI a stream
+    would hold a worker thread, so the browser is told not to reconnect (204)
+    and pages keep working without live updates.
+    """
+    user = await request.auser()
+    if not user.is_authenticated:
+        return JsonResponse({'error': 'Authentication required'}, status=401)
+    if not isinstance(request, ASGIRequest):
+        return HttpResponse(status=204)
+    try:
+        last_event_id = int(request.headers['Last-Event-ID'])
+    except (KeyError, ValueError):
+        last_event_id = None
+
+    response = StreamingHttpResponse(events(user.id, last_event_id), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # stop nginx from buffering the stream
+    return response
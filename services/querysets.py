@@ -0,0 +1,74 @@
+"""
+Queryset helpers for the REST API
+
+``optimize_for_serializer`` walks a serializer's nested fields and applies the
+matching select_related()/prefetch_related() calls, so a list page costs the
+same number of queries whatever its size.
+"""
+from django.core.exceptions import FieldDoesNotExist
+from rest_framework import serializers
+
+_related_paths_cache = {}
+
+
+def _relation(model, name):
+    """Return the model field called `name`, or None if it is not a relation"""
+    try:
+        field = model._meta.get_field(name)
+    except FieldDoesNotExist:
+        return None
+    return field if field.is_relation else None
+
+
+def _walk(serializer, model, prefix, prefetching, select, prefetch):
+    for field in serializer.fields.values():
+        if field.write_only or field.source == '*':
+            continue
+
+        if isinstance(field, serializers.ListSerializer):
+            nested = field.child
+        elif isinstance(field, serializers.BaseSerializer):
+            nested = field
+        else:
+            nested = None
+
+        # Follow every relation named in the source ('provider' or 'payment.status')
+        current_model = model
+        path = prefix
+        many = prefetching
+        for attr in field.source.split('.'):
+            relation = _relation(current_model, attr)
+            if relation is None:
+                break
+            path = f'{path}__{attr}' if path else attr
+            many = many or relation.one_to_many or relation.many_to_many
+            (prefetch if many else select).add(path)
+            current_model = relation.related_model
+        else:
+            if nested is not None and hasattr(nested, 'Meta'):
+                _walk(nested, current_model, path, many, select, prefetch)
+
+
+def related_paths(serializer_class):
+    """
+    Return (select_related, prefetch_related) lookups needed to render
+    `serializer_class` without per-row queries. Results are cached per class.
+    """
+    if serializer_class not in _related_paths_cache:
+        select, prefetch = set(), set()
+        serializer = serializer_class()
+        _walk(serializer, serializer.Meta.model, '', False, select, prefetch)
+        # select_related('a__b') already covers 'a'
+        select = {path for path in select if not any(other.startswith(path + '__') for other in select)}
+        _related_paths_cache[serializer_class] = (sorted(select), sorted(prefetch))
+    return _related_paths_cache[serializer_class]
+
+
+def optimize_for_serializer(queryset, serializer_class):
+    """Apply the select_related/prefetch_related calls `serializer_class` needs"""
+    select, prefetch = related_paths(serializer_class)
+    if select:
+        queryset = queryset.select_related(*select)
+    if prefetch:
+        queryset = queryset.prefetch_related(*prefetch)
+    return queryset
@@ -0,0 +1,88 @@
+"""
+Incrementally maintained provider ratings
+
+ServiceProvider keeps a running ``rating_sum`` next to ``total_reviews``.
+Creating, editing or deleting a review moves both with one F() UPDATE and
+derives ``average_rating`` in the same statement, so a review write costs the
+same however many reviews the provider has, and concurrent writes cannot
+overwrite each other's totals.
+
+``recompute()`` (``python manage.py recompute_provider_ratings``) rebuilds the
+columns from the reviews table for repairs and after bulk imports.
+"""
+from django.db.models import (
+    Case, Count, DecimalField, F, FloatField, IntegerField, OuterRef, Subquery, Sum, Value, When,
+)
+from django.db.models.functions import Cast, Coalesce
+
+from services.models import Review, ServiceProvider
+
+AVERAGE_FIELD = DecimalField(max_digits=3, decimal_places=2)
+
+
+def snapshot(review):
+    """Return (provider_id, rating) of a review, or None if either is deferred"""
+    values = review.__dict__
+    if 'provider_id' not in values or 'rating' not in values:
+        return None
+    return values['provider_id'], values['rating']
+
+
+def apply_change(old, new):
+    """Move provider ratings from the `old` (provider_id, rating) to the `new` one"""
+    deltas = {}
+    for values, sign in ((old, -1), (new, 1)):
+        if values is None:
+            continue
+        provider_id, rating = values
+        rating_delta, count_delta = deltas.get(provider_id, (0, 0))
+        deltas[provider_id] = (rating_delta + sign * rating, count_delta + sign)
+
+    for provider_id, (rating_delta, count_delta) in deltas.items():
+        if provider_id is None or (rating_delta == 0 and count_delta == 0):
+            continue
+        rating_sum = F('rating_sum') + rating_delta
+        total_reviews = F('total_reviews') + count_delta
+        # Every expression in an UPDATE reads the row's values from before the statement
+        ServiceProvider.objects.filter(pk=provider_id).update(
+            rating_sum=rating_sum,
+            total_reviews=total_reviews,
+            average_rating=Case(
+                When(total_reviews__gt=-count_delta, then=Cast(
+                    Cast(rating_sum, FloatField()) / total_reviews, AVERAGE_FIELD,
+                )),
+                default=Value(0, output_field=AVERAGE_FIELD),
+            ),
+        )
+
+
+def recompute(provider_ids=None, batch_size=500):
+    """
+    Rebuild rating_sum, total_reviews and average_rating from the reviews table.
+    Recomputes every provider when provider_ids is None. Returns the number of providers updated.
+    """
+    providers = ServiceProvider.objects.order_by('id')
+    if provider_ids is not None:
+        providers = providers.filter(id__in=list(provider_ids))
+
+    reviews = Review.objects.filter(provider=OuterRef('pk')).order_by().values('provider')
+    rating_sum = Coalesce(Subquery(reviews.annotate(total=Sum('rating')).values('total')), 0)
+    total_reviews = Coalesce(
+        Subquery(reviews.annotate(total=Count('id')).values('total'), output_field=IntegerField()), 0,
+    )
+    average_rating = Coalesce(
+        Subquery(reviews.annotate(
+            average=Cast(Cast(Sum('rating'), FloatField()) / Count('id'), AVERAGE_FIELD),
+        ).values('average')),
+        Value(0, output_field=AVERAGE_FIELD),
+    )
+
+    ids = list(providers.values_list('id', flat=True))
+    updated = 0
+    for start in range(0, len(ids), batch_size):
+        updated += ServiceProvider.objects.filter(id__in=ids[start:start + batch_size]).update(
+            rating_sum=rating_sum,
+            total_reviews=total_reviews,
+            average_rating=average_rating,
+        )
+    return updated
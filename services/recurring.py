@@ -0,0 +1,171 @@
+"""
+Recurring booking materializer
+
+Turns due RecurringBooking subscriptions into Booking rows, batch by batch:
+
+    1. fetch the next batch of active subscriptions whose next_booking_date
+       falls within the horizon (partial index recurring_due_idx)
+    2. plan up to ``occurrences`` dates for each, skipping dates in the past,
+       dates on which the provider is on approved leave and times already
+       claimed by another booking (services/slots.py)
+    3. in one transaction: bulk_create the bookings and their slot claims and
+       advance every subscription's next_booking_date with one bulk update
+
+Each batch commits on its own, so an interrupted run is resumed by running it
+again: committed subscriptions have moved past the dates they produced, and
+the unique (recurring_booking, booking_date) constraint guarantees that no
+date is ever materialized twice.
+
+Run it every few minutes with ``python manage.py materialize_recurring_bookings``.
+"""
+import calendar
+from collections import Counter, defaultdict
+from datetime import datetime, time, timedelta
+
+from django.db import IntegrityError, transaction
+from django.db.models import OuterRef, Q, Subquery
+from django.utils import timezone
+
+from services import counters, slots
+from services.models import Booking, BookingSlotClaim, ProviderLeave, RecurringBooking
+
+STEP_DAYS = {'daily': 1, 'weekly': 7, 'biweekly': 14}
+
+
+def next_occurrence(subscription, day):
+    """Date of the occurrence after `day`; monthly ones keep the start date's day of month where it exists"""
+    if subscription.frequency == 'monthly':
+        year, month = day.year + day.month // 12, day.month % 12 + 1
+        return day.replace(
+            year=year, month=month, day=min(subscription.start_date.day, calendar.monthrange(year, month)[1])
+        )
+    return day + timedelta(days=STEP_DAYS[subscription.frequency])
+
+
+def plan(subscription, now, horizon, limit):
+    """Return (dates to book, new next_booking_date, still active) for one subscription"""
+    end = subscription.end_date
+    day = subscription.next_booking_date
+    dates = []
+    while day <= horizon and len(dates) < limit and (end is None or day <= end):
+        if (day, subscription.preferred_time) > (now.date(), now.time()):
+            dates.append(day)
+        day = next_occurrence(subscription, day)
+    return dates, day, end is None or day <= end
+
+
+def due(horizon, started):
+    """Active subscriptions with an occurrence on or before `horizon`, not yet visited by this run"""
+    last_booking = Booking.objects.filter(user=OuterRef('customer_id')).order_by('-created_at')
+    return RecurringBooking.objects.filter(
+        is_active=True, next_booking_date__lte=horizon, updated_at__lt=started
+    ).select_related('customer', 'service').annotate(
+        # Contact details the customer gave on their latest booking
+        last_phone=Subquery(last_booking.values('customer_phone')[:1]),
+        last_address=Subquery(last_booking.values('customer_address')[:1]),
+    ).order_by('next_booking_date', 'id')
+
+
+def _occurrence(subscription, day):
+    customer = subscription.customer
+    return Booking(
+        service=subscription.service,
+        provider_id=subscription.provider_id,
+        user=customer,
+        customer_name=customer.get_full_name() or customer.username,
+        customer_email=customer.email,
+        customer_phone=subscription.last_phone or '',
+        customer_address=subscription.last_address or '',
+        booking_date=day,
+        booking_time=subscription.preferred_time,
+        total_amount=subscription.total_amount,
+        recurring_booking=subscription,
+    )
+
+
+def materialize_batch(subscriptions, now, horizon, limit):
+    """Book the planned occurrences of `subscriptions` and advance them; returns a Counter of outcomes"""
+    stats = Counter(subscriptions=len(subscriptions))
+    provider_ids = {subscription.provider_id for subscription in subscriptions}
+    today = now.date()
+
+    leaves = defaultdict(list)
+    for provider_id, start, end in ProviderLeave.objects.filter(
+        provider_id__in=provider_ids, is_approved=True, start_date__lte=horizon, end_date__gte=today
+    ).values_list('provider_id', 'start_date', 'end_date'):
+        leaves[provider_id].append((start, end))
+
+    claimed = set(BookingSlotClaim.objects.filter(
+        provider_id__in=provider_ids,
+        slot_start__gte=timezone.make_aware(datetime.combine(today, time.min)),
+        slot_start__lt=timezone.make_aware(datetime.combine(horizon + timedelta(days=2), time.min)),
+    ).values_list('provider_id', 'slot_start'))
+
+    bookings, cells = [], []
+    for subscription in subscriptions:
+        provider_id = subscription.provider_id
+        duration = subscription.service.duration_minutes or slots.DEFAULT_DURATION
+        dates, subscription.next_booking_date, subscription.is_active = plan(subscription, now, horizon, limit)
+        subscription.updated_at = now
+        for day in dates:
+            if any(start <= day <= end for start, end in leaves[provider_id]):
+                stats['on_leave'] += 1
+                continue
+            wanted = [
+                (provider_id, cell)
+                for cell in slots.claim_cells(day, subscription.preferred_time, duration)
+            ]
+            if claimed.intersection(wanted):
+                stats['taken'] += 1
+                continue
+            claimed.update(wanted)
+            bookings.append(_occurrence(subscription, day))
+            cells.append(wanted)
+
+    with transaction.atomic():
+        Booking.objects.bulk_create(bookings)
+        BookingSlotClaim.objects.bulk_create([
+            BookingSlotClaim(provider_id=provider_id, booking=booking, slot_start=cell)
+            for booking, wanted in zip(bookings, cells)
+            for provider_id, cell in wanted
+        ])
+        RecurringBooking.objects.bulk_update(subscriptions, ['next_booking_date', 'is_active', 'updated_at'])
+
+    stats['created'] += len(bookings)
+    if bookings:
+        # bulk_create bypasses the signal handlers that maintain derived data
+        provider_ids = {booking.provider_id for booking in bookings}
+        counters.reconcile(provider_ids)
+        slots.forget(*provider_ids)
+    return stats
+
+
+def run(days=28, occurrences=4, batch_size=500):
+    """
+    Materialize up to `occurrences` bookings per subscription within the next
+    `days` days. Returns a Counter with the number of subscriptions visited,
+    bookings created and occurrences skipped ('on_leave', 'taken').
+    """
+    started = timezone.now()
+    now = timezone.localtime(started)
+    horizon = now.date() + timedelta(days=days)
+    stats = Counter()
+    position = None
+
+    while True:
+        batch = due(horizon, started)
+        if position is not None:
+            batch = batch.filter(
+                Q(next_booking_date__gt=position[0]) | Q(next_booking_date=position[0], id__gt=position[1])
+            )
+        subscriptions = list(batch[:batch_size])
+        if not subscriptions:
+            return stats
+        position = (subscriptions[-1].next_booking_date, subscriptions[-1].id)
+
+        try:
+            stats += materialize_batch(subscriptions, now, horizon, occurrences)
+        except IntegrityError:
+            # A customer booked one of the planned times meanwhile; plan the batch again with fresh claims
+            ids = [subscription.id for subscription in subscriptions]
+            stats += materialize_batch(list(due(horizon, started).filter(id__in=ids)), now, horizon, occurrences)
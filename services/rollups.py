@@ -0,0 +1,237 @@
+"""
+ProviderStats rollup engine
+
+Streams the source rows that feed provider analytics in date order:
+
+    bookings received   Booking.created_at
+    bookings confirmed  Booking.confirmed_at (response time = confirmed_at - created_at)
+    bookings completed  Booking.completed_at
+    bookings cancelled  Booking.updated_at of cancelled bookings (there is no cancelled_at)
+    revenue             ProviderEarnings.created_at, net_amount
+    reviews             Review.created_at, rating
+
+and folds them into daily, weekly (Monday-based) and monthly ProviderStats
+rows in a single pass. Periods that are complete are upserted in bulk as the
+stream moves past them, so memory stays bounded by ``batch_size``.
+
+Runs are incremental: the 'provider_stats' JobWatermark records when the last
+successful run started. The next run only revisits providers whose bookings,
+earnings or reviews changed since then, from the first affected period
+onwards. Upserts are idempotent, so an interrupted run is resumed by simply
+running again from the same watermark. Deleted source rows are only noticed
+by a full rebuild (``python manage.py rollup_provider_stats --full``).
+"""
+import heapq
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+
+from django.db.models import Min
+from django.utils import timezone
+
+from services.models import Booking, JobWatermark, ProviderEarnings, ProviderStats, Review
+
+WATERMARK = 'provider_stats'
+
+STAT_FIELDS = [
+    'bookings_received', 'bookings_completed', 'bookings_cancelled', 'revenue',
+    'reviews_received', 'average_rating_day', 'average_response_time', 'updated_at',
+]
+
+
+def period_start(period, day):
+    if period == 'week':
+        return day - timedelta(days=day.weekday())
+    if period == 'month':
+        return day.replace(day=1)
+    return day
+
+
+def period_end(period, start):
+    """First day after the period beginning at `start`"""
+    if period == 'week':
+        return start + timedelta(days=7)
+    if period == 'month':
+        return (start + timedelta(days=32)).replace(day=1)
+    return start + timedelta(days=1)
+
+
+def aligned_start(day):
+    """
+    The latest day on or before `day` that starts both a week and a month's
+    worth of whole periods: streaming from there leaves no week or month that
+    contains `day` only partly covered. A week straddling a month start pulls
+    in that month, whose first week may straddle the month before, so this
+    widens until it stops moving (at the latest, back to a month that starts
+    on a Monday).
+    """
+    while True:
+        start = min(
+            day,
+            period_start('week', period_start('month', day)),
+            period_start('month', period_start('week', day)),
+        )
+        if start == day:
+            return day
+        day = start
+
+
+class _Bucket:
+    __slots__ = ('received', 'completed', 'cancelled', 'revenue', 'reviews', 'rating_sum',
+                 'responses', 'response_minutes')
+
+    def __init__(self):
+        self.received = self.completed = self.cancelled = 0
+        self.reviews = self.rating_sum = self.responses = self.response_minutes = 0
+        self.revenue = Decimal('0')
+
+    def add(self, kind, timestamp, values):
+        if kind == 'received':
+            self.received += 1
+        elif kind == 'completed':
+            self.completed += 1
+        elif kind == 'cancelled':
+            self.cancelled += 1
+        elif kind == 'confirmed':
+            self.responses += 1
+            self.response_minutes += max(int((timestamp - values[0]).total_seconds() // 60), 0)
+        elif kind == 'revenue':
+            self.revenue += values[0]
+        elif kind == 'review':
+            self.reviews += 1
+            self.rating_sum += values[0]
+
+    def to_stats(self, provider_id, period, start, now):
+        return ProviderStats(
+            provider_id=provider_id,
+            period=period,
+            date=start,
+            bookings_received=self.received,
+            bookings_completed=self.completed,
+            bookings_cancelled=self.cancelled,
+            revenue=self.revenue,
+            reviews_received=self.reviews,
+            average_rating_day=round(Decimal(self.rating_sum) / self.reviews, 2) if self.reviews else 0,
+            average_response_time=self.response_minutes // self.responses if self.responses else 0,
+            updated_at=now,
+        )
+
+
+def _stream(queryset, date_field, kind, fields, from_day, provider_ids, chunk_size):
+    """Yield (timestamp, kind, provider_id, values) in `date_field` order"""
+    queryset = queryset.filter(**{f'{date_field}__isnull': False})
+    if from_day is not None:
+        start = timezone.make_aware(datetime.combine(from_day, time.min))
+        queryset = queryset.filter(**{f'{date_field}__gte': start})
+    if provider_ids is not None:
+        queryset = queryset.filter(provider_id__in=provider_ids)
+    rows = queryset.order_by(date_field, 'id').values_list(date_field, 'provider_id', *fields)
+    for row in rows.iterator(chunk_size=chunk_size):
+        yield row[0], kind, row[1], row[2:]
+
+
+def _event_streams(from_day, provider_ids, chunk_size):
+    args = (from_day, provider_ids, chunk_size)
+    return [
+        _stream(Booking.objects.all(), 'created_at', 'received', (), *args),
+        _stream(Booking.objects.all(), 'confirmed_at', 'confirmed', ('created_at',), *args),
+        _stream(Booking.objects.filter(status='completed'), 'completed_at', 'completed', (), *args),
+        _stream(Booking.objects.filter(status='cancelled'), 'updated_at', 'cancelled', (), *args),
+        _stream(ProviderEarnings.objects.all(), 'created_at', 'revenue', ('net_amount',), *args),
+        _stream(Review.objects.all(), 'created_at', 'review', ('rating',), *args),
+    ]
+
+
+def _upsert(stats):
+    ProviderStats.objects.bulk_create(
+        stats,
+        update_conflicts=True,
+        unique_fields=['provider', 'period', 'date'],
+        update_fields=STAT_FIELDS,
+    )
+
+
+def changed_since(since):
+    """Return (provider_ids, first day to recompute) for source rows changed since `since`"""
+    first_seen = {}
+    changed = [
+        Booking.objects.filter(updated_at__gte=since),
+        Review.objects.filter(updated_at__gte=since),
+        ProviderEarnings.objects.filter(created_at__gte=since),
+    ]
+    for queryset in changed:
+        rows = queryset.order_by().values('provider_id').annotate(first=Min('created_at'))
+        for row in rows:
+            first = first_seen.get(row['provider_id'])
+            first_seen[row['provider_id']] = row['first'] if first is None else min(first, row['first'])
+    if not first_seen:
+        return [], None
+    return sorted(first_seen), timezone.localtime(min(first_seen.values())).date()
+
+
+def rollup(from_day=None, provider_ids=None, batch_size=2000):
+    """
+    Recompute ProviderStats for every period starting on or after `from_day`
+    (aligned back by ``aligned_start``), for `provider_ids` or all providers.
+    Returns the number of rows upserted.
+    """
+    now = timezone.now()
+    if from_day is not None:
+        from_day = aligned_start(from_day)
+
+    buckets = {}
+    upserted = 0
+    current_day = None
+
+    def flush(before):
+        """Upsert every bucket whose period ends on or before `before`"""
+        nonlocal upserted
+        done = [key for key in buckets if before is None or period_end(key[1], key[2]) <= before]
+        if done:
+            _upsert([buckets.pop(key).to_stats(*key, now) for key in done])
+            upserted += len(done)
+
+    events = heapq.merge(*_event_streams(from_day, provider_ids, batch_size), key=lambda event: event[0])
+    for timestamp, kind, provider_id, values in events:
+        day = timezone.localtime(timestamp).date()
+        if day != current_day:
+            if len(buckets) >= batch_size:
+                flush(day)
+            current_day = day
+        for period in ('day', 'week', 'month'):
+            key = (provider_id, period, period_start(period, day))
+            bucket = buckets.get(key)
+            if bucket is None:
+                bucket = buckets[key] = _Bucket()
+            bucket.add(kind, timestamp, values)
+    flush(None)
+
+    # Periods that no longer have any source rows
+    stale = ProviderStats.objects.filter(updated_at__lt=now)
+    if from_day is not None:
+        stale = stale.filter(date__gte=from_day)
+    if provider_ids is not None:
+        stale = stale.filter(provider_id__in=provider_ids)
+    stale.delete()
+    return upserted
+
+
+def run(full=False, since=None, batch_size=2000):
+    """
+    Bring ProviderStats up to date and advance the watermark.
+    Returns (providers revisited or None for all, rows upserted).
+    """
+    started = timezone.now()
+    if since is None and not full:
+        since = JobWatermark.get_position(WATERMARK)
+
+    if full or since is None:
+        provider_ids, from_day = None, None
+    else:
+        provider_ids, from_day = changed_since(since)
+        if not provider_ids:
+            JobWatermark.set_position(WATERMARK, started)
+            return [], 0
+
+    upserted = rollup(from_day, provider_ids, batch_size=batch_size)
+    JobWatermark.set_position(WATERMARK, started)
+    return provider_ids, upserted
@@ -0,0 +1,213 @@
+"""
+Full-text search index for services
+
+On SQLite the index is an FTS5 virtual table ranked with bm25(); on other
+databases (or SQLite builds without FTS5) it falls back to the
+ServiceSearchTerm inverted index. Both backends index the same normalized
+text, so results and prefix matching behave the same everywhere.
+
+The index is kept in sync by the signal handlers in services/signals.py and
+can be rebuilt from scratch with ``python manage.py rebuild_search_index``.
+"""
+import re
+
+from django.db import connection, transaction
+from django.db.models import Case, IntegerField, Max, OuterRef, Q, Subquery, Sum, Value, When
+
+from services.models import Service, ServiceSearchTerm
+
+FTS_TABLE = 'services_service_fts'
+
+FTS_CREATE_SQL = (
+    f'CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} '
+    "USING fts5(title, provider_name, description, tokenize='unicode61', prefix='2 3')"
+)
+
+# Relative importance of each indexed field
+FIELD_WEIGHTS = {
+    'title': 10,
+    'provider_name': 5,
+    'description': 1,
+}
+
+MAX_TERM_LENGTH = 100
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+_REPEATED_LATIN_RE = re.compile(r'([a-z])\1+')
+
+_fts_available = {}
+
+
+def normalize_token(token):
+    """
+    Fold a token to its index form.
+
+    Repeated Latin letters are collapsed so that common spelling variants of
+    transliterated Malayalam names match each other
+    (Kozhikkode/Kozhikode, Thrissur/Thrisur, Kollam/Kolam).
+    """
+    return _REPEATED_LATIN_RE.sub(r'\1', token.casefold())[:MAX_TERM_LENGTH]
+
+
+def tokenize(text):
+    """Split text into normalized index tokens"""
+    return [normalize_token(token) for token in _TOKEN_RE.findall(text or '')]
+
+
+def uses_fts():
+    """Return True when the FTS5 index table exists on the default database"""
+    if connection.vendor != 'sqlite':
+        return False
+    if connection.alias not in _fts_available:
+        _fts_available[connection.alias] = FTS_TABLE in connection.introspection.table_names()
+    return _fts_available[connection.alias]
+
+
+def build_document(title, provider_name, description):
+    """Return the normalized text indexed for each field of a service"""
+    return {
+        'title': ' '.join(tokenize(title)),
+        'provider_name': ' '.join(tokenize(provider_name)),
+        'description': ' '.join(tokenize(description)),
+    }
+
+
+def _document(service, provider_name=None):
+    if provider_name is None:
+        provider_name = service.provider.business_name
+    return build_document(service.title, provider_name, service.description)
+
+
+def term_weights(document):
+    """Map each term of a document to its summed field weight"""
+    weights = {}
+    for field, text in document.items():
+        for term in text.split():
+            weights[term] = weights.get(term, 0) + FIELD_WEIGHTS[field]
+    return weights
+
+
+def index_services(services, provider_name=None):
+    """Add or replace the index entries for the given services"""
+    services = list(services)
+    if not services:
+        return
+    ids = [service.id for service in services]
+
+    with transaction.atomic():
+        if uses_fts():
+            rows = []
+            for service in services:
+                document = _document(service, provider_name)
+                rows.append((service.id, document['title'], document['provider_name'], document['description']))
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f'DELETE FROM {FTS_TABLE} WHERE rowid IN ({", ".join(["%s"] * len(ids))})',
+                    ids
+                )
+                cursor.executemany(
+                    f'INSERT INTO {FTS_TABLE} (rowid, title, provider_name, description) VALUES (%s, %s, %s, %s)',
+                    rows
+                )
+        else:
+            ServiceSearchTerm.objects.filter(service_id__in=ids).delete()
+            terms = []
+            for service in services:
+                for term, weight in term_weights(_document(service, provider_name)).items():
+                    terms.append(ServiceSearchTerm(service_id=service.id, term=term, weight=weight))
+            ServiceSearchTerm.objects.bulk_create(terms, batch_size=1000)
+
+
+def index_service(service):
+    """Add or replace the index entry for a single service"""
+    index_services([service])
+
+
+def remove_service(service_id):
+    """Drop a service from the index"""
+    if uses_fts():
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [service_id])
+    else:
+        ServiceSearchTerm.objects.filter(service_id=service_id).delete()
+
+
+def reindex_provider(provider):
+    """Refresh the provider name of every service offered by a provider"""
+    index_services(provider.services.all(), provider_name=provider.business_name)
+
+
+def rebuild_index(batch_size=1000):
+    """Rebuild the whole index from the Service table. Returns the number of services indexed."""
+    with transaction.atomic():
+        if uses_fts():
+            with connection.cursor() as cursor:
+                cursor.execute(f'DELETE FROM {FTS_TABLE}')
+        else:
+            ServiceSearchTerm.objects.all().delete()
+
+        count = 0
+        batch = []
+        services = Service.objects.select_related('provider').order_by('id')
+        for service in services.iterator(chunk_size=batch_size):
+            batch.append(service)
+            if len(batch) >= batch_size:
+                index_services(batch)
+                count += len(batch)
+                batch = []
+        index_services(batch)
+        count += len(batch)
+    return count
+
+
+def _fts_query(terms):
+    # Every term must match; each one is a quoted prefix query
+    return ' '.join('"{}"*'.format(term.replace('"', '""')) for term in terms)
+
+
+def _fts_ranked(queryset, terms):
+    weights = ', '.join(str(FIELD_WEIGHTS[field]) for field in ('title', 'provider_name', 'description'))
+    table = queryset.model._meta.db_table
+    # Joined to the index, so the queryset's own filters apply to every match rather than to a capped top list
+    return queryset.extra(
+        select={'search_rank': f'bm25({FTS_TABLE}, {weights})'},
+        tables=[FTS_TABLE],
+        where=[f'{FTS_TABLE}.rowid = {table}.id', f'{FTS_TABLE} MATCH %s'],
+        params=[_fts_query(terms)],
+    ).order_by('search_rank', 'pk')
+
+
+def _term_ranked(queryset, terms):
+    prefix_match = Q()
+    matched = {}
+    for i, term in enumerate(terms):
+        prefix_match |= Q(term__startswith=term)
+        matched[f'matched_{i}'] = Max(Case(
+            When(term__startswith=term, then=Value(1)),
+            default=Value(0),
+            output_field=IntegerField(),
+        ))
+
+    matches = (
+        ServiceSearchTerm.objects
+        .filter(prefix_match)
+        .values('service_id')
+        .annotate(rank=Sum('weight'), **matched)
+        .filter(**{name: 1 for name in matched})
+    )
+    return (
+        queryset
+        .filter(pk__in=matches.values('service_id'))
+        .annotate(search_rank=Subquery(matches.filter(service_id=OuterRef('pk')).values('rank')))
+        .order_by('-search_rank', 'pk')
+    )
+
+
+def search_services(queryset, query):
+    """Restrict a Service queryset to services matching every word of the query, best match first"""
+    terms = list(dict.fromkeys(tokenize(query)))
+    if not terms:
+        return queryset.none()
+    if uses_fts():
+        return _fts_ranked(queryset, terms)
+    return _term_ranked(queryset, terms)
@@ -1,11 +1,31 @@
-from rest_framework import serializers
+from rest_framework import serializers, status
+from rest_framework.exceptions import APIException
 from django.contrib.auth.models import User
+from django.db import transaction
+from . import coupons, slots
 from .models import (
     ServiceCategory, ServiceProvider, Service,
-    Booking, Review, ProviderPortfolio, ServiceRequest
+    Booking, Review, ProviderPortfolio, ServiceRequest, ServiceRequestMatch, DispatchJob, Conversation, Message
 )
 
 
+class SlotConflict(APIException):
+    """409 response for a booking whose time is already taken, with the nearest free slot"""
+    status_code = status.HTTP_409_CONFLICT
+    default_code = 'slot_taken'
+
+    def __init__(self, taken):
+        alternative = taken.alternative
+        super().__init__({
+            'error': str(taken),
+            'suggested_slot': alternative and {
+                'date': alternative.date.isoformat(),
+                'start': alternative.start.strftime('%H:%M'),
+                'end': alternative.end.strftime('%H:%M'),
+            },
+        })
+
+
 class UserSerializer(serializers.ModelSerializer):
     """Serializer for User model"""
     class Meta:
@@ -22,7 +42,15 @@ class ServiceCategorySerializer(serializers.ModelSerializer):
         fields = ['id', 'name', 'description', 'icon', 'is_active', 'total_services', 'created_at']
     
     def get_total_services(self, obj):
-        return obj.services.filter(is_active=True).count()
+        # Querysets built with ServiceCategory.objects.with_service_counts() carry the count
+        if hasattr(obj, 'service_count'):
+            return obj.service_count
+        # Nested categories share one count map per serializer tree instead of a COUNT per row
+        counts = self.context.get('category_service_counts')
+        if counts is None:
+            counts = ServiceCategory.objects.service_counts()
+            self.context['category_service_counts'] = counts
+        return counts.get(obj.id, 0)
 
 
 class ServiceProviderListSerializer(serializers.ModelSerializer):
@@ -40,6 +68,17 @@ class ServiceProviderListSerializer(serializers.ModelSerializer):
         ]
 
 
+class NearbyProviderSerializer(ServiceProviderListSerializer):
+    """Provider list entry with its location and distance from the queried point"""
+    distance_km = serializers.SerializerMethodField()
+
+    class Meta(ServiceProviderListSerializer.Meta):
+        fields = ServiceProviderListSerializer.Meta.fields + ['latitude', 'longitude', 'distance_km']
+
+    def get_distance_km(self, obj):
+        return round(obj.distance_km, 2)
+
+
 class ServiceProviderDetailSerializer(serializers.ModelSerializer):
     """Detailed serializer for provider profile"""
     user = UserSerializer(read_only=True)
@@ -54,6 +93,7 @@ class ServiceProviderDetailSerializer(serializers.ModelSerializer):
             'experience_years', 'bio', 'profile_image',
             'verification_status', 'verification_status_display', 'verified_at',
             'average_rating', 'total_reviews', 'total_bookings',
+            'latitude', 'longitude',
             'is_available', 'available_from', 'available_to',
             'services_count', 'created_at', 'updated_at'
         ]
@@ -82,6 +122,17 @@ class ServiceListSerializer(serializers.ModelSerializer):
         ]
 
 
+class NearbyServiceSerializer(ServiceListSerializer):
+    """Service list entry with its provider's distance from the queried point"""
+    distance_km = serializers.SerializerMethodField()
+
+    class Meta(ServiceListSerializer.Meta):
+        fields = ServiceListSerializer.Meta.fields + ['distance_km']
+
+    def get_distance_km(self, obj):
+        return round(obj.distance_km, 2)
+
+
 class ServiceDetailSerializer(serializers.ModelSerializer):
     """Detailed serializer for service"""
     provider = ServiceProviderDetailSerializer(read_only=True)
@@ -110,32 +161,50 @@ class ServiceDetailSerializer(serializers.ModelSerializer):
         read_only_fields = ['created_at', 'updated_at']
 
 
+class CouponOfferSerializer(serializers.Serializer):
+    """A coupon rule (services/coupons.py) and what it takes off the `amount` in the context"""
+    code = serializers.CharField()
+    description = serializers.CharField()
+    coupon_type = serializers.CharField()
+    discount_value = serializers.DecimalField(max_digits=10, decimal_places=2)
+    max_discount = serializers.DecimalField(max_digits=10, decimal_places=2, allow_null=True)
+    min_order_value = serializers.DecimalField(max_digits=10, decimal_places=2)
+    valid_to = serializers.DateTimeField()
+    discount = serializers.SerializerMethodField()
+    eligible = serializers.SerializerMethodField()
+
+    def get_discount(self, rule):
+        return str(coupons.discount(rule, self.context['amount']))
+
+    def get_eligible(self, rule):
+        return self.context['amount'] >= rule.min_order_value
+
+
 class BookingListSerializer(serializers.ModelSerializer):
     """Lightweight serializer for booking lists"""
-    customer = UserSerializer(read_only=True)
+    customer = UserSerializer(source='user', read_only=True)
     service = ServiceListSerializer(read_only=True)
     provider = ServiceProviderListSerializer(read_only=True)
     status_display = serializers.CharField(source='get_status_display', read_only=True)
-    payment_status_display = serializers.CharField(source='get_payment_status_display', read_only=True)
+    payment_status = serializers.CharField(source='payment.status', read_only=True, default=None)
     
     class Meta:
         model = Booking
         fields = [
             'id', 'customer', 'service', 'provider',
-            'booking_date', 'booking_time', 'city',
-            'status', 'status_display',
-            'payment_status', 'payment_status_display',
-            'total_amount', 'created_at'
+            'booking_date', 'booking_time',
+            'status', 'status_display', 'payment_status',
+            'total_amount', 'is_emergency', 'created_at'
         ]
 
 
 class BookingDetailSerializer(serializers.ModelSerializer):
     """Detailed serializer for booking"""
-    customer = UserSerializer(read_only=True)
+    customer = UserSerializer(source='user', read_only=True)
     service = ServiceDetailSerializer(read_only=True)
     provider = ServiceProviderDetailSerializer(read_only=True)
     status_display = serializers.CharField(source='get_status_display', read_only=True)
-    payment_status_display = serializers.CharField(source='get_payment_status_display', read_only=True)
+    payment_status = serializers.CharField(source='payment.status', read_only=True, default=None)
     
     # Write-only fields for creation
     service_id = serializers.PrimaryKeyRelatedField(
@@ -143,19 +212,20 @@ class BookingDetailSerializer(serializers.ModelSerializer):
         source='service',
         write_only=True
     )
+    coupon_code = serializers.CharField(write_only=True, required=False, allow_blank=True, max_length=50)
     
     class Meta:
         model = Booking
         fields = [
             'id', 'customer', 'service', 'service_id', 'provider',
-            'booking_date', 'booking_time', 'address', 'city', 'pincode',
-            'customer_notes', 'estimated_duration',
+            'customer_name', 'customer_email', 'customer_phone', 'customer_address',
+            'booking_date', 'booking_time', 'notes', 'is_emergency',
             'status', 'status_display',
-            'total_amount', 'payment_status', 'payment_status_display', 'payment_method',
+            'total_amount', 'coupon_code', 'payment_status',
             'created_at', 'updated_at', 'confirmed_at', 'completed_at'
         ]
         read_only_fields = [
-            'customer', 'provider', 'status', 'payment_status',
+            'customer', 'provider', 'status',
             'created_at', 'updated_at', 'confirmed_at', 'completed_at'
         ]
     
@@ -165,13 +235,43 @@ class BookingDetailSerializer(serializers.ModelSerializer):
         validated_data['provider'] = service.provider
         
         # Set customer from request context
-        validated_data['customer'] = self.context['request'].user
+        validated_data['user'] = self.context['request'].user
         
         # Calculate total amount from service price
         if 'total_amount' not in validated_data:
             validated_data['total_amount'] = service.price
+        coupon_code = validated_data.pop('coupon_code', '')
         
-        return super().create(validated_data)
+        try:
+            with transaction.atomic():
+                booking = super().create(validated_data)
+                slots.claim(booking)
+                if coupon_code:
+                    coupons.apply(booking, coupon_code)
+        except slots.SlotTaken as taken:
+            raise SlotConflict(taken)
+        except coupons.CouponError as error:
+            raise serializers.ValidationError({'coupon_code': [str(error)]})
+        return booking
+    
+    def update(self, instance, validated_data):
+        # Coupons are only redeemed when the booking is made
+        validated_data.pop('coupon_code', None)
+        moved = any(
+            field in validated_data and validated_data[field] != getattr(instance, field)
+            for field in ('service', 'booking_date', 'booking_time')
+        )
+        if not moved:
+            return super().update(instance, validated_data)
+        try:
+            with transaction.atomic():
+                booking = super().update(instance, validated_data)
+                slots.release(booking)
+                if booking.status in slots.BLOCKING_STATUSES:
+                    slots.claim(booking)
+        except slots.SlotTaken as taken:
+            raise SlotConflict(taken)
+        return booking
 
 
 class ReviewListSerializer(serializers.ModelSerializer):
@@ -211,7 +311,7 @@ class ReviewDetailSerializer(serializers.ModelSerializer):
     
     def create(self, validated_data):
         booking = validated_data.get('booking')
-        validated_data['customer'] = booking.customer
+        validated_data['customer'] = booking.user
         validated_data['provider'] = booking.provider
         return super().create(validated_data)
 
@@ -288,3 +388,94 @@ class ServiceRequestDetailSerializer(serializers.ModelSerializer):
     def create(self, validated_data):
         validated_data['customer'] = self.context['request'].user
         return super().create(validated_data)
+
+
+class ServiceRequestMatchSerializer(serializers.ModelSerializer):
+    """Ranked provider suggestion for a service request"""
+    provider = ServiceProviderListSerializer(read_only=True)
+
+    class Meta:
+        model = ServiceRequestMatch
+        fields = ['rank', 'score', 'distance_km', 'provider']
+
+
+class DispatchJobSerializer(serializers.ModelSerializer):
+    """Dispatch queue entry with a summary of the booking or request behind it"""
+    priority_display = serializers.CharField(source='get_priority_display', read_only=True)
+    category = serializers.CharField(source='category.name', read_only=True)
+    title = serializers.SerializerMethodField()
+    city = serializers.SerializerMethodField()
+
+    class Meta:
+        model = DispatchJob
+        fields = [
+            'id', 'booking', 'service_request', 'category', 'title', 'city',
+            'priority', 'priority_display', 'status', 'level',
+            'requested_at', 'escalate_at', 'lease_expires_at', 'accepted_at'
+        ]
+        read_only_fields = fields
+
+    def get_title(self, obj):
+        return obj.booking.service.title if obj.booking_id else obj.service_request.title
+
+    def get_city(self, obj):
+        return obj.booking.provider.city if obj.booking_id else obj.service_request.city
+
+
+class MessageSerializer(serializers.ModelSerializer):
+    """Serializer for booking chat messages"""
+    sender = UserSerializer(read_only=True)
+    receiver = UserSerializer(read_only=True)
+    booking_id = serializers.PrimaryKeyRelatedField(
+        queryset=Booking.objects.select_related('provider'),
+        source='booking'
+    )
+
+    class Meta:
+        model = Message
+        fields = [
+            'id', 'booking_id', 'conversation', 'sender', 'receiver', 'message_text',
+            'attachment', 'is_read', 'read_at', 'created_at'
+        ]
+        read_only_fields = ['conversation', 'sender', 'receiver', 'is_read', 'read_at', 'created_at']
+
+    def validate_booking_id(self, booking):
+        user = self.context['request'].user
+        if user.id not in (booking.user_id, booking.provider.user_id):
+            raise serializers.ValidationError('You are not part of this booking.')
+        if booking.user_id is None:
+            raise serializers.ValidationError('This booking was made by a guest, who has no account to message.')
+        return booking
+
+    def create(self, validated_data):
+        booking = validated_data['booking']
+        sender = self.context['request'].user
+        validated_data['sender'] = sender
+        validated_data['receiver_id'] = (
+            booking.provider.user_id if sender.id == booking.user_id else booking.user_id
+        )
+        return super().create(validated_data)
+
+
+class MessagePreviewSerializer(serializers.ModelSerializer):
+    """Last message of a conversation, as shown in the inbox"""
+    class Meta:
+        model = Message
+        fields = ['id', 'sender', 'message_text', 'is_read', 'created_at']
+
+
+class ConversationSerializer(serializers.ModelSerializer):
+    """Inbox entry, seen from the requesting user's side"""
+    other_user = serializers.SerializerMethodField()
+    unread = serializers.SerializerMethodField()
+    last_message = MessagePreviewSerializer(read_only=True)
+
+    class Meta:
+        model = Conversation
+        fields = ['id', 'other_user', 'last_message', 'last_activity_at', 'unread']
+
+    def get_other_user(self, obj):
+        return UserSerializer(obj.other_user(self.context['request'].user)).data
+
+    def get_unread(self, obj):
+        return obj.unread_for(self.context['request'].user)
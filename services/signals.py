@@ -0,0 +1,310 @@
+"""
+Signal handlers that keep derived data in sync with the core models
+"""
+from django.db.models.signals import m2m_changed, post_init, post_save, post_delete, pre_delete, pre_save
+from django.dispatch import receiver
+
+from services import conversations, counters, coupons, dispatch, geo, matching, page_cache, push, ratings, search, slots
+from services.middleware import forget_role
+from services.models import (
+    Booking, Coupon, CouponRedemption, Message, ProviderAvailability, ProviderLeave, Review, Service, ServiceCategory, ServiceProvider,
+    ServiceRequest,
+)
+
+
+# ====================== SEARCH INDEX ======================
+
+@receiver(post_save, sender=Service)
+def index_service_on_save(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    search.index_service(instance)
+
+
+@receiver(post_delete, sender=Service)
+def remove_service_from_index(sender, instance, **kwargs):
+    search.remove_service(instance.id)
+
+
+@receiver(post_init, sender=ServiceProvider)
+def remember_indexed_name(sender, instance, **kwargs):
+    # None when business_name was deferred, which forces a reindex on save
+    instance._indexed_name = instance.__dict__.get('business_name')
+
+
+@receiver(post_save, sender=ServiceProvider)
+def reindex_provider_services(sender, instance, created=False, raw=False, update_fields=None, **kwargs):
+    if raw or created:
+        return
+    if update_fields is not None and 'business_name' not in update_fields:
+        return
+    if instance.business_name == instance._indexed_name:
+        # Rating, counter and profile saves leave the indexed text alone
+        return
+    search.reindex_provider(instance)
+    instance._indexed_name = instance.business_name
+
+
+# ====================== PROVIDER COUNTERS ======================
+
+UNTOUCHED = object()  # the save could not change any tracked field
+
+
+def lock_counter_snapshot(sender, instance, raw=False, update_fields=None, **kwargs):
+    if raw or instance._state.adding:
+        instance._counter_snapshot = None
+    elif update_fields is not None and not counters.touches(sender, update_fields):
+        instance._counter_snapshot = UNTOUCHED
+    else:
+        instance._counter_snapshot = counters.stored_snapshot(instance)
+
+
+def update_counters_on_save(sender, instance, created=False, raw=False, **kwargs):
+    if raw:
+        return
+    old = getattr(instance, '_counter_snapshot', None)
+    if old is UNTOUCHED:
+        return
+    counters.apply_change(sender, None if created else old, counters.snapshot(instance, old))
+
+
+def lock_counter_snapshot_for_delete(sender, instance, **kwargs):
+    instance._counter_snapshot = counters.stored_snapshot(instance)
+
+
+def update_counters_on_delete(sender, instance, **kwargs):
+    counters.apply_change(sender, instance._counter_snapshot, None)
+
+
+for tracked_model in counters.TRACKED_MODELS:
+    pre_save.connect(lock_counter_snapshot, sender=tracked_model)
+    post_save.connect(update_counters_on_save, sender=tracked_model)
+    pre_delete.connect(lock_counter_snapshot_for_delete, sender=tracked_model)
+    post_delete.connect(update_counters_on_delete, sender=tracked_model)
+
+
+# ====================== PROVIDER RATINGS ======================
+
+@receiver(post_init, sender=Review)
+def remember_rating_snapshot(sender, instance, **kwargs):
+    instance._rating_snapshot = ratings.snapshot(instance)
+
+
+@receiver(post_save, sender=Review)
+def update_rating_on_save(sender, instance, created=False, raw=False, **kwargs):
+    if raw:
+        return
+    page_cache.bump('catalog', page_cache.entity('provider', instance.provider_id))
+    new = ratings.snapshot(instance)
+    if not created and instance._rating_snapshot is None:
+        # Loaded with deferred fields, so the previous rating is unknown
+        ratings.recompute([instance.provider_id])
+    else:
+        ratings.apply_change(None if created else instance._rating_snapshot, new)
+    instance._rating_snapshot = new
+
+
+@receiver(post_delete, sender=Review)
+def update_rating_on_delete(sender, instance, **kwargs):
+    page_cache.bump('catalog', page_cache.entity('provider', instance.provider_id))
+    if instance._rating_snapshot is None:
+        ratings.recompute([instance.provider_id])
+    else:
+        ratings.apply_change(instance._rating_snapshot, None)
+
+
+# ====================== PAGE CACHE ======================
+
+@receiver(post_save, sender=Service)
+@receiver(post_delete, sender=Service)
+def bump_service_pages(sender, instance, **kwargs):
+    page_cache.bump(
+        'catalog',
+        page_cache.entity('service', instance.id),
+        page_cache.entity('provider', instance.provider_id),
+    )
+
+
+@receiver(post_save, sender=ServiceCategory)
+@receiver(post_delete, sender=ServiceCategory)
+def bump_category_pages(sender, instance, **kwargs):
+    page_cache.bump('catalog', page_cache.entity('category', instance.id))
+
+
+@receiver(post_save, sender=ServiceProvider)
+@receiver(post_delete, sender=ServiceProvider)
+def bump_provider_pages(sender, instance, **kwargs):
+    page_cache.bump('catalog', page_cache.entity('provider', instance.id))
+
+
+# ====================== ROLE CACHE ======================
+
+@receiver(post_save, sender=ServiceProvider)
+def forget_role_on_provider_created(sender, instance, created=False, **kwargs):
+    if created:
+        forget_role(instance.user_id)
+
+
+@receiver(post_delete, sender=ServiceProvider)
+def forget_role_on_provider_deleted(sender, instance, **kwargs):
+    forget_role(instance.user_id)
+
+
+# ====================== SLOT INDEX ======================
+
+@receiver(post_save, sender=Booking)
+@receiver(post_delete, sender=Booking)
+@receiver(post_save, sender=ProviderAvailability)
+@receiver(post_delete, sender=ProviderAvailability)
+@receiver(post_save, sender=ProviderLeave)
+@receiver(post_delete, sender=ProviderLeave)
+@receiver(post_save, sender=Service)
+def forget_provider_slots(sender, instance, **kwargs):
+    slots.forget(instance.provider_id)
+
+
+@receiver(post_save, sender=ServiceProvider)
+def forget_slots_on_provider_save(sender, instance, **kwargs):
+    slots.forget(instance.id)
+
+
+@receiver(post_save, sender=Booking)
+def release_cancelled_booking_slots(sender, instance, raw=False, **kwargs):
+    if not raw and instance.status == 'cancelled':
+        slots.release(instance)
+
+
+# ====================== CONVERSATIONS ======================
+
+@receiver(pre_save, sender=Message)
+def attach_message_to_conversation(sender, instance, raw=False, **kwargs):
+    if not raw and instance.conversation_id is None:
+        instance.conversation = conversations.conversation_for(instance)
+
+
+@receiver(post_init, sender=Message)
+def remember_conversation_snapshot(sender, instance, **kwargs):
+    instance._conversation_snapshot = conversations.snapshot(instance)
+
+
+@receiver(post_save, sender=Message)
+def update_conversation_on_save(sender, instance, created=False, raw=False, **kwargs):
+    if raw:
+        return
+    new = conversations.snapshot(instance)
+    if created:
+        conversations.record_message(instance)
+    elif instance._conversation_snapshot is None:
+        # Loaded with deferred fields, so the previous state is unknown
+        conversations.reconcile([instance.conversation_id])
+    else:
+        conversations.apply_change(instance._conversation_snapshot, new)
+    instance._conversation_snapshot = new
+
+
+@receiver(post_delete, sender=Message)
+def update_conversation_on_delete(sender, instance, **kwargs):
+    if instance.conversation_id is not None:
+        conversations.reconcile([instance.conversation_id])
+
+
+# ====================== LIVE UPDATES ======================
+
+@receiver(post_save, sender=Message)
+def push_new_message(sender, instance, created=False, raw=False, **kwargs):
+    if created and not raw:
+        push.message_sent(instance)
+
+
+@receiver(post_init, sender=Booking)
+def remember_pushed_status(sender, instance, **kwargs):
+    instance._pushed_status = instance.__dict__.get('status')
+
+
+@receiver(post_save, sender=Booking)
+def push_booking_status(sender, instance, created=False, raw=False, **kwargs):
+    if raw:
+        return
+    if created or instance.status != instance._pushed_status:
+        push.booking_changed(instance, None if created else instance._pushed_status)
+    instance._pushed_status = instance.status
+
+
+# ====================== PROVIDER LOCATION ======================
+
+@receiver(post_init, sender=ServiceProvider)
+def remember_location_snapshot(sender, instance, **kwargs):
+    instance._geo_snapshot = geo.snapshot(instance)
+
+
+LOCATION_FIELDS = {'pincode', 'city', 'latitude', 'longitude'}
+
+
+@receiver(pre_save, sender=ServiceProvider)
+def place_provider(sender, instance, raw=False, update_fields=None, **kwargs):
+    if raw or (update_fields is not None and not LOCATION_FIELDS & update_fields):
+        return
+    geo.place(instance)
+
+
+@receiver(post_save, sender=ServiceProvider)
+def save_provider_location(sender, instance, raw=False, update_fields=None, **kwargs):
+    if not raw and update_fields is not None and LOCATION_FIELDS & update_fields:
+        # save(update_fields=...) only wrote the fields it names
+        ServiceProvider.objects.filter(pk=instance.pk).update(
+            latitude=instance.latitude, longitude=instance.longitude, geohash=instance.geohash,
+        )
+    instance._geo_snapshot = geo.snapshot(instance)
+
+
+# ====================== REQUEST MATCHING ======================
+
+@receiver(post_save, sender=ServiceRequest)
+def match_new_request(sender, instance, created=False, raw=False, **kwargs):
+    if created and not raw and instance.status == 'open':
+        matching.match(instance)
+
+
+# ====================== DISPATCH QUEUE ======================
+
+@receiver(post_save, sender=Booking)
+def dispatch_emergency_booking(sender, instance, created=False, raw=False, **kwargs):
+    if raw or not instance.is_emergency:
+        return
+    if created:
+        if instance.status == 'pending':
+            dispatch.enqueue_booking(instance)
+    else:
+        dispatch.booking_changed(instance)
+
+
+@receiver(post_save, sender=ServiceRequest)
+def dispatch_urgent_request(sender, instance, created=False, raw=False, **kwargs):
+    if raw:
+        return
+    # Registered after match_new_request, so an emergency already carries its matched provider
+    if created:
+        dispatch.enqueue_request(instance)
+    else:
+        dispatch.request_changed(instance)
+
+
+# ====================== COUPON INDEX ======================
+
+@receiver(post_save, sender=Coupon)
+@receiver(post_delete, sender=Coupon)
+def bump_coupon_index(sender, instance, **kwargs):
+    # Redemptions raise used_count with QuerySet.update(), so they never get here
+    page_cache.bump('coupons')
+
+
+@receiver(post_delete, sender=CouponRedemption)
+def release_coupon_use(sender, instance, **kwargs):
+    coupons.release(instance)
+
+
+@receiver(m2m_changed, sender=Coupon.applicable_categories.through)
+@receiver(m2m_changed, sender=Coupon.applicable_services.through)
+def bump_coupon_applicability(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        page_cache.bump('coupons')
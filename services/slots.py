@@ -0,0 +1,281 @@
+"""
+Free-slot engine
+
+A provider is free when all of these hold:
+
+    working hours   ProviderAvailability for the weekday, minus its break
+                    (providers without a weekly schedule work every day from
+                    available_from to available_to)
+    not on leave    no approved ProviderLeave covers the date
+    not booked      no pending/confirmed/in-progress Booking overlaps; a
+                    booking lasts its Service.duration_minutes
+
+Each process keeps an interval index per provider (working intervals by
+weekday, leave ranges, booked intervals by date) in ``_index``. Entries are
+validated against a per-provider version in the shared cache; the signal
+handlers in services/signals.py bump it whenever a schedule, leave, booking
+or service of the provider changes, so only that provider is reloaded, in
+whichever process next asks for it. Changes that bypass signals
+(QuerySet.update()) must call ``forget()``.
+
+The index only answers "when is the provider free?". Reserving time is
+``claim()``: it inserts a BookingSlotClaim for every half-hour cell (counted
+from midnight) a booking covers, in the transaction that saves the booking.
+Slots are offered on the same grid, even when working hours start between
+cells, so slots offered back to back never share a cell. The unique constraint on
+(provider, slot_start) lets exactly one of two concurrent bookings of the same
+cell commit; the other raises SlotTaken with the nearest free alternative.
+Claims are released when a booking stops being active.
+"""
+import bisect
+from collections import defaultdict, namedtuple
+from datetime import datetime, time, timedelta
+
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from services import page_cache
+from services.models import Booking, BookingSlotClaim, ProviderAvailability, ProviderLeave, ServiceProvider
+
+SLOT_STEP = 30  # minutes between candidate start times
+DEFAULT_DURATION = 60
+MAX_RANGE_DAYS = 31
+BLOCKING_STATUSES = ('pending', 'confirmed', 'in_progress')
+MINUTES_PER_DAY = 24 * 60
+SUGGESTION_DAYS = 7  # how far ahead SlotTaken looks for an alternative
+
+Slot = namedtuple('Slot', 'date start end')
+
+_index = {}
+
+
+def _minutes(value):
+    return value.hour * 60 + value.minute
+
+
+def _time(minutes):
+    return time(minutes // 60, minutes % 60) if minutes < MINUTES_PER_DAY else time(23, 59)
+
+
+def _align(minutes):
+    """Round `minutes` up to the next boundary of the SLOT_STEP grid that claim cells are on"""
+    return minutes + -minutes % SLOT_STEP
+
+
+def _version_entity(provider_id):
+    return page_cache.entity('schedule', provider_id)
+
+
+class Schedule:
+    """Interval index of one provider"""
+    __slots__ = ('provider_id', 'version', 'weekly', 'leave_starts', 'leave_ends', 'busy')
+
+    def __init__(self, provider_id, version):
+        self.provider_id = provider_id
+        self.version = version
+        self.weekly = {}  # weekday -> [(start, end)] in minutes
+        self.leave_starts = []  # sorted; leave_ends[i] is the last day of the leave starting leave_starts[i]
+        self.leave_ends = []
+        self.busy = defaultdict(list)  # date -> sorted [(start, end)] in minutes
+
+    def on_leave(self, day):
+        # Leaves may overlap, so check every leave that starts on or before `day`
+        position = bisect.bisect_right(self.leave_starts, day)
+        return any(end >= day for end in self.leave_ends[:position])
+
+    def free(self, day, duration, window=(0, MINUTES_PER_DAY), earliest=0):
+        """Yield the start minute of every free slot of `duration` on `day`"""
+        if self.on_leave(day):
+            return
+        busy = self.busy.get(day, ())
+        for start, end in self.weekly.get(day.weekday(), ()):
+            end = min(end, window[1])
+            slot = _align(max(start, window[0], earliest))
+            position = 0
+            while slot + duration <= end:
+                # Sweep past bookings that end before this slot starts
+                while position < len(busy) and busy[position][1] <= slot:
+                    position += 1
+                if position < len(busy) and busy[position][0] < slot + duration:
+                    slot = _align(busy[position][1])
+                    continue
+                yield slot
+                slot += SLOT_STEP
+
+
+def _load(provider_ids, versions, exclude_booking=None):
+    """Build fresh Schedules for `provider_ids` with four queries"""
+    today = timezone.localdate()
+    schedules = {pid: Schedule(pid, versions[_version_entity(pid)]) for pid in provider_ids}
+
+    default_hours = {}
+    for pid, is_available, start, end in ServiceProvider.objects.filter(id__in=provider_ids).values_list(
+        'id', 'is_available', 'available_from', 'available_to'
+    ):
+        default_hours[pid] = [(_minutes(start), _minutes(end))] if is_available else None
+
+    weekly_rows = ProviderAvailability.objects.filter(provider_id__in=provider_ids).values_list(
+        'provider_id', 'weekday', 'is_available', 'start_time', 'end_time', 'break_start', 'break_end'
+    )
+    has_weekly = set()
+    for pid, weekday, is_available, start, end, break_start, break_end in weekly_rows:
+        has_weekly.add(pid)
+        if not is_available:
+            continue
+        start, end = _minutes(start), _minutes(end)
+        if break_start and break_end and start < _minutes(break_start) < _minutes(break_end) <= end:
+            shifts = [(start, _minutes(break_start)), (_minutes(break_end), end)]
+        else:
+            shifts = [(start, end)]
+        schedules[pid].weekly[weekday] = shifts
+
+    for pid, schedule in schedules.items():
+        hours = default_hours.get(pid)
+        if hours is None:
+            schedule.weekly = {}  # unavailable (or deleted) providers have no slots
+        elif pid not in has_weekly:
+            schedule.weekly = {weekday: hours for weekday in range(7)}
+
+    leaves = ProviderLeave.objects.filter(
+        provider_id__in=provider_ids, is_approved=True, end_date__gte=today
+    ).order_by('start_date').values_list('provider_id', 'start_date', 'end_date')
+    for pid, start, end in leaves:
+        schedules[pid].leave_starts.append(start)
+        schedules[pid].leave_ends.append(end)
+
+    bookings = Booking.objects.filter(
+        provider_id__in=provider_ids, status__in=BLOCKING_STATUSES, booking_date__gte=today
+    ).exclude(id=exclude_booking).values_list('provider_id', 'booking_date', 'booking_time', 'service__duration_minutes')
+    for pid, day, start, duration in bookings:
+        start = _minutes(start)
+        schedules[pid].busy[day].append((start, start + (duration or DEFAULT_DURATION)))
+    for schedule in schedules.values():
+        for intervals in schedule.busy.values():
+            intervals.sort()
+    return schedules
+
+
+def schedules(provider_ids):
+    """Return {provider_id: Schedule}, reloading only providers that changed since they were indexed"""
+    provider_ids = list(dict.fromkeys(provider_ids))
+    current = page_cache.versions([_version_entity(pid) for pid in provider_ids])
+    stale = [
+        pid for pid in provider_ids
+        if pid not in _index or _index[pid].version != current[_version_entity(pid)]
+    ]
+    if stale:
+        _index.update(_load(stale, current))
+    return {pid: _index[pid] for pid in provider_ids}
+
+
+def forget(*provider_ids):
+    """Mark providers' slot indexes stale in every process"""
+    entities = [_version_entity(pid) for pid in provider_ids]
+    page_cache.bump(*entities)
+    # Again once committed, in case another process reloaded the provider before the change was visible
+    transaction.on_commit(lambda: page_cache.bump(*entities))
+
+
+def free_slots(provider_ids, start_date, end_date, duration=DEFAULT_DURATION, window=None):
+    """
+    Return {provider_id: [Slot]} with every free slot of `duration` minutes
+    between `start_date` and `end_date` (inclusive). `window` is an optional
+    (from, to) pair of times that each slot must fall within. Slots in the
+    past are never returned.
+    """
+    window = (0, MINUTES_PER_DAY) if window is None else (_minutes(window[0]), _minutes(window[1]))
+    now = timezone.localtime()
+    days = [start_date + timedelta(days=offset) for offset in range((end_date - start_date).days + 1)]
+    days = [day for day in days if day >= now.date()]
+
+    result = {}
+    for pid, schedule in schedules(provider_ids).items():
+        result[pid] = [
+            Slot(day, _time(start), _time(start + duration))
+            for day in days
+            for start in schedule.free(day, duration, window, _minutes(now) + 1 if day == now.date() else 0)
+        ]
+    return result
+
+
+def is_free(provider_id, day, start_time, duration=DEFAULT_DURATION):
+    """Return True when the provider can take a booking of `duration` minutes at `start_time` on `day`"""
+    start = _minutes(start_time)
+    schedule = schedules([provider_id])[provider_id]
+    if schedule.on_leave(day):
+        return False
+    if not any(begin <= start and start + duration <= end for begin, end in schedule.weekly.get(day.weekday(), ())):
+        return False
+    return not any(begin < start + duration and start < end for begin, end in schedule.busy.get(day, ()))
+
+
+# ====================== RESERVATIONS ======================
+
+class SlotTaken(Exception):
+    """Raised by claim() when part of the requested time is already booked"""
+
+    def __init__(self, alternative):
+        self.alternative = alternative  # the nearest free Slot, or None
+        message = 'This time is already booked.'
+        if alternative is not None:
+            message += (
+                f' The next free slot is {alternative.date:%d %b %Y} at {alternative.start:%H:%M}.'
+            )
+        super().__init__(message)
+
+
+def claim_cells(day, start_time, duration):
+    """Return the aware start of every SLOT_STEP cell that a booking at `start_time` overlaps"""
+    start = _minutes(start_time)
+    first = start - start % SLOT_STEP
+    midnight = datetime.combine(day, time.min)
+    return [
+        timezone.make_aware(midnight + timedelta(minutes=minute))
+        for minute in range(first, start + duration, SLOT_STEP)
+    ]
+
+
+def claim(booking):
+    """
+    Reserve the calendar cells covered by `booking`, which must already be
+    saved. Call it inside the transaction that saves the booking (and its
+    payment) so that a conflict rolls all of them back; raises SlotTaken.
+    """
+    duration = booking.service.duration_minutes or DEFAULT_DURATION
+    claims = [
+        BookingSlotClaim(provider_id=booking.provider_id, booking=booking, slot_start=cell)
+        for cell in claim_cells(booking.booking_date, booking.booking_time, duration)
+    ]
+    try:
+        with transaction.atomic():  # savepoint, so the caller can still query after a conflict
+            BookingSlotClaim.objects.bulk_create(claims)
+    except IntegrityError:
+        raise SlotTaken(suggest(
+            booking.provider_id, booking.booking_date, booking.booking_time, duration, exclude_booking=booking.id
+        ))
+
+
+def release(booking):
+    """Give up the cells held by `booking` (cancelled, completed or moved)"""
+    BookingSlotClaim.objects.filter(booking=booking).delete()
+
+
+def suggest(provider_id, day, start_time, duration=DEFAULT_DURATION, exclude_booking=None):
+    """
+    Return the first free Slot at or after `start_time` on `day`, within
+    SUGGESTION_DAYS, or None. `exclude_booking` is the rejected booking itself.
+    """
+    # Read straight from the database: the caller's transaction may be about to roll back,
+    # and a schedule loaded inside it must not end up in the shared index.
+    schedule = _load([provider_id], {_version_entity(provider_id): None}, exclude_booking)[provider_id]
+    now = timezone.localtime()
+    for offset in range(SUGGESTION_DAYS):
+        candidate = day + timedelta(days=offset)
+        if candidate < now.date():
+            continue
+        earliest = _minutes(start_time) if offset == 0 else 0
+        if candidate == now.date():
+            earliest = max(earliest, _minutes(now) + 1)
+        for start in schedule.free(candidate, duration, earliest=earliest):
+            return Slot(candidate, _time(start), _time(start + duration))
+    return None
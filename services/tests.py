@@ -1,3 +1,2450 @@
-from django.test import TestCase
+import csv
+import gzip
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time as time_module
+from collections import Counter
+from contextlib import contextmanager
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.test import Client, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from services import (
+    conversations, counters, coupons, dispatch, exports, geo, ledger, loyalty, matching, payouts, push, ratings,
+    recurring, rollups, search, slots,
+)
+from services.aggregates import histograms
+from services.models import (
+    ServiceCategory, ServiceProvider, Service, Booking, Review, ProviderPortfolio, ServiceRequest,
+    ServiceRequestMatch, DispatchJob, Payment, ProviderEarnings, Conversation, Message, Notification, Wallet, LoyaltyPoints,
+    ProviderAvailability, ProviderLeave, BookingSlotClaim, ProviderCounters, ProviderStats, JobWatermark, RecurringBooking,
+    Referral, Transaction, Coupon, CouponRedemption, LoyaltyEvent,
+)
+from services.serializers import ServiceListSerializer
+
+
+# Each test class gets a private in-memory cache instead of the shared file cache
+# Both aliases use the same LOCATION, so they share one in-memory store and cache.clear() empties both
+ISOLATED_CACHE = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'shared': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+}
+
+
+class QueryBudgetMixin:
+    """Assertion helpers for keeping per-endpoint query counts in check"""
+
+    @contextmanager
+    def assertMaxQueries(self, max_queries):
+        with CaptureQueriesContext(connection) as context:
+            yield context
+        executed = len(context.captured_queries)
+        if executed > max_queries:
+            queries = '\n'.join(
+                f'{i}. {query["sql"]}' for i, query in enumerate(context.captured_queries, start=1)
+            )
+            self.fail(f'{executed} queries executed, budget is {max_queries}\n{queries}')
+
+
+def create_catalog(categories=5, services_per_category=4):
+    """Create verified providers with approved services spread over several categories"""
+    services = []
+    for c in range(categories):
+        category = ServiceCategory.objects.create(name=f'Category {c}', description='Test category')
+        for s in range(services_per_category):
+            user = User.objects.create(username=f'provider_{c}_{s}')
+            provider = ServiceProvider.objects.create(
+                user=user,
+                business_name=f'Provider {c}-{s}',
+                contact_number='9876543210',
+                email=f'provider_{c}_{s}@homeserve.com',
+                address='MG Road',
+                city='Kochi',
+                state='Kerala',
+                pincode='682001',
+                bio='Test provider',
+                verification_status='verified',
+            )
+            services.append(Service.objects.create(
+                provider=provider,
+                category=category,
+                title=f'Service {c}-{s}',
+                description='Test service',
+                price=500,
+                approval_status='approved',
+            ))
+    return services
+
+
+@override_settings(CACHES=ISOLATED_CACHE)
+class CategoryServiceCountTests(QueryBudgetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        create_catalog()
+        Service.objects.filter(title='Service 0-0').update(is_active=False)
+
+    def test_with_service_counts_only_counts_active_services(self):
+        counts = {c.name: c.service_count for c in ServiceCategory.objects.with_service_counts()}
+        self.assertEqual(counts['Category 0'], 3)
+        self.assertEqual(counts['Category 1'], 4)
+        self.assertEqual(ServiceCategory.objects.service_counts()[ServiceCategory.objects.get(name='Category 0').id], 3)
+
+    def test_category_list_api_query_budget(self):
+        with self.assertMaxQueries(2):
+            response = self.client.get('/api/categories/')
+        self.assertEqual(response.status_code, 200)
+        totals = {c['name']: c['total_services'] for c in response.json()['results']}
+        self.assertEqual(totals['Category 0'], 3)
+
+    def test_nested_categories_share_one_count_query(self):
+        services = Service.objects.filter(is_active=True).select_related('provider__user', 'category')
+        with self.assertMaxQueries(2):
+            data = ServiceListSerializer(services, many=True).data
+        self.assertEqual(len(data), 19)
+        self.assertEqual(data[0]['category']['total_services'], 4)
+
+    def test_home_page_query_budget(self):
+        with self.assertMaxQueries(4):
+            response = self.client.get('/')
+        self.assertEqual(response.status_code, 200)
+        counts = {c.name: c.service_count for c in response.context['categories']}
+        self.assertEqual(counts['Category 0'], 3)
+
+
+@override_settings(CACHES=ISOLATED_CACHE)
+class SearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        service = create_catalog(categories=1, services_per_category=1)[0]
+        cls.provider = service.provider
+        # More strong but hidden matches than any single ranked page would hold
+        Service.objects.bulk_create([
+            Service(provider=cls.provider, category=service.category, title=f'Plumbing repair {i}',
+                    description='Plumbing', price=500, is_active=False, approval_status='approved')
+            for i in range(1100)
+        ])
+        cls.wiring = Service.objects.create(
+            provider=cls.provider, category=service.category, title='Wiring', description='Also fixes plumbing',
+            price=500, approval_status='approved',
+        )
+        cls.plumbing = Service.objects.create(
+            provider=cls.provider, category=service.category, title='Plumbing', description='Pipes',
+            price=500, approval_status='approved',
+        )
+
+    def search(self, query):
+        return list(search.search_services(Service.objects.filter(is_active=True), query).values_list('pk', flat=True))
+
+    def test_filters_apply_to_every_match_on_both_backends(self):
+        for fts in (True, False):
+            with self.subTest(fts=fts), mock.patch.object(search, 'uses_fts', return_value=fts):
+                search.rebuild_index()
+                self.assertEqual(self.search('plumb'), [self.plumbing.pk, self.wiring.pk])
+                self.assertEqual(self.search('plumbing fixes'), [self.wiring.pk])
+                self.assertEqual(self.search('   '), [])
+
+    def test_only_renaming_a_provider_reindexes_its_services(self):
+        with mock.patch.object(search, 'reindex_provider') as reindex:
+            self.provider.bio = 'Twenty years of experience'
+            self.provider.save()
+            self.provider.save(update_fields=['bio'])
+            self.assertFalse(reindex.called)
+
+            self.provider.business_name = 'Pipe Masters'
+            self.provider.save()
+            self.provider.save()
+            self.assertEqual(reindex.call_count, 1)
+
+
+class ProviderCountersTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.service = create_catalog(categories=1, services_per_category=1)[0]
+        cls.provider = cls.service.provider
+        cls.customer = User.objects.create(username='counter_customer')
+
+    def book(self, status='pending'):
+        return Booking.objects.create(
+            user=self.customer, provider=self.provider, service=self.service,
+            customer_name='Customer', customer_email='customer@homeserve.com', customer_phone='9876543210',
+            customer_address='MG Road', booking_date=date.today(), booking_time=time(10), total_amount=500,
+            status=status,
+        )
+
+    def assertMatchesSource(self):
+        maintained = counters.get_counters(self.provider)
+        counters.reconcile([self.provider.id])
+        recomputed = counters.get_counters(self.provider)
+        for field in ProviderCounters._meta.fields:
+            if field.name not in ('id', 'updated_at'):
+                self.assertEqual(getattr(maintained, field.name), getattr(recomputed, field.name), field.name)
+        return maintained
+
+    def test_signals_keep_counters_in_step_with_source(self):
+        counters.get_counters(self.provider)
+        pending = self.book()
+        done = self.book()
+        done.status = 'completed'
+        done.save()
+        payment = Payment.objects.create(
+            booking=done, amount=500, payment_method='upi', transaction_id='TXN1', provider_amount=450,
+        )
+        ProviderEarnings.objects.create(
+            provider=self.provider, booking=done, payment=payment,
+            gross_amount=500, commission_percentage=10, commission_amount=50, net_amount=450,
+        )
+        message = Message.objects.create(
+            booking=done, sender=self.customer, receiver=self.provider.user, message_text='Hi',
+        )
+        Notification.objects.create(user=self.provider.user, notification_type='booking', title='New', message='New')
+        pending.delete()
+
+        row = self.assertMatchesSource()
+        self.assertEqual(row.booking_stats(), {
+            'all': 1, 'pending': 0, 'confirmed': 0, 'in_progress': 0, 'completed': 1, 'cancelled': 0,
+        })
+        self.assertEqual(row.pending_payout, Decimal('450'))
+        self.assertEqual((row.unread_messages, row.unread_notifications, row.active_services), (1, 1, 1))
+
+        message.is_read = True
+        message.save()
+        self.assertEqual(self.assertMatchesSource().unread_messages, 0)
+
+    def test_stale_instances_move_the_counters_from_the_stored_row(self):
+        counters.get_counters(self.provider)
+        booking = self.book()
+        first, second = Booking.objects.get(pk=booking.pk), Booking.objects.get(pk=booking.pk)
+        first.status = 'confirmed'
+        first.save()
+        # Loaded as pending too, but the row is confirmed by now
+        second.status = 'cancelled'
+        second.save()
+        row = self.assertMatchesSource()
+        self.assertEqual((row.bookings_pending, row.bookings_confirmed, row.bookings_cancelled), (0, 0, 1))
+
+        # Saves that cannot change a tracked field skip the locking read
+        with CaptureQueriesContext(connection) as queries:
+            second.save(update_fields=['notes'])
+        self.assertFalse([q for q in queries if 'FOR UPDATE' in q['sql'] or q['sql'].startswith('SELECT')])
+
+    def test_deleting_a_deferred_instance_still_counts(self):
+        counters.get_counters(self.provider)
+        self.book('completed')
+        # Only what the other delete handlers read is loaded; status is deferred
+        Booking.objects.only('id', 'provider').get().delete()
+        self.assertEqual(self.assertMatchesSource().bookings_completed, 0)
+
+    def test_histograms_bucket_every_choice_in_one_query(self):
+        self.book()
+        self.book('completed')
+        self.book('completed')
+        with self.assertNumQueries(1):
+            result = histograms(Booking.objects.all(), 'status')
+        self.assertEqual(result['total'], 3)
+        self.assertEqual(result['status'], {
+            'pending': 1, 'confirmed': 0, 'in_progress': 0, 'completed': 2, 'cancelled': 0,
+        })
+        amounts = histograms(Booking.objects.all(), 'status', sum_of='total_amount')
+        self.assertEqual(amounts['status']['completed'], Decimal('1000'))
+        self.assertEqual(amounts['status']['cancelled'], 0)
+
+    def test_reconcile_repairs_queryset_updates(self):
+        self.book()
+        counters.get_counters(self.provider)
+        Booking.objects.filter(provider=self.provider).update(status='confirmed')
+        self.assertEqual(counters.get_counters(self.provider).bookings_pending, 1)
+        counters.reconcile([self.provider.id])
+        self.assertEqual(counters.get_counters(self.provider).bookings_confirmed, 1)
+
+
+class ProviderRatingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.service = create_catalog(categories=1, services_per_category=1)[0]
+        cls.provider = cls.service.provider
+        cls.customer = User.objects.create(username='rating_customer')
+
+    def review(self, rating):
+        booking = Booking.objects.create(
+            user=self.customer, provider=self.provider, service=self.service,
+            customer_name='Customer', customer_email='customer@homeserve.com', customer_phone='9876543210',
+            customer_address='MG Road', booking_date=date.today(), booking_time=time(10), total_amount=500,
+            status='completed',
+        )
+        return Review.objects.create(booking=booking, provider=self.provider, customer=self.customer, rating=rating)
+
+    def totals(self):
+        provider = ServiceProvider.objects.get(pk=self.provider.pk)
+        return provider.rating_sum, provider.total_reviews, provider.average_rating
+
+    def test_review_writes_update_running_totals(self):
+        first = self.review(5)
+        self.review(4)
+        self.assertEqual(self.totals(), (9, 2, Decimal('4.50')))
+
+        first.rating = 2
+        first.save()
+        self.assertEqual(self.totals(), (6, 2, Decimal('3.00')))
+
+        first.delete()
+        self.assertEqual(self.totals(), (4, 1, Decimal('4.00')))
+
+        Review.objects.all().delete()
+        self.assertEqual(self.totals(), (0, 0, Decimal('0.00')))
+
+    def test_review_submission_cost_does_not_grow_with_review_count(self):
+        for _ in range(3):
+            self.review(3)
+        booking = Booking.objects.create(
+            user=self.customer, provider=self.provider, service=self.service,
+            customer_name='Customer', customer_email='customer@homeserve.com', customer_phone='9876543210',
+            customer_address='MG Road', booking_date=date.today(), booking_time=time(10), total_amount=500,
+        )
+        with self.assertNumQueries(2):
+            Review.objects.create(booking=booking, provider=self.provider, customer=self.customer, rating=5)
+
+    def test_recompute_matches_incremental_totals(self):
+        self.review(1)
+        self.review(4)
+        self.review(5)
+        incremental = self.totals()
+        self.assertEqual(incremental, (10, 3, Decimal('3.33')))
+        ServiceProvider.objects.filter(pk=self.provider.pk).update(rating_sum=0, total_reviews=0, average_rating=0)
+        self.assertEqual(ratings.recompute([self.provider.pk]), 1)
+        self.assertEqual(self.totals(), incremental)
+
+
+@override_settings(CACHES=ISOLATED_CACHE)
+class PageCacheTests(QueryBudgetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.service = create_catalog(categories=1, services_per_category=2)[0]
+
+    def test_anonymous_pages_are_served_from_cache(self):
+        for url in ['/', '/services/', f'/service/{self.service.id}/', f'/provider/{self.service.provider_id}/']:
+            with self.subTest(url=url):
+                first = self.client.get(url)
+                with self.assertMaxQueries(0):
+                    second = self.client.get(url)
+                self.assertEqual(second.content, first.content)
+
+    def test_saving_a_service_invalidates_its_pages(self):
+        url = f'/service/{self.service.id}/'
+        self.client.get(url)
+        self.client.get('/services/')
+        self.service.title = 'Emergency Pipe Repair'
+        self.service.save()
+        self.assertContains(self.client.get(url), 'Emergency Pipe Repair')
+        self.assertContains(self.client.get('/services/'), 'Emergency Pipe Repair')
+
+    def test_admin_bulk_approval_invalidates_catalogue(self):
+        Service.objects.filter(pk=self.service.pk).update(approval_status='pending')
+        self.assertNotContains(self.client.get('/services/'), self.service.title)
+
+        admin = Client()
+        admin.force_login(User.objects.create(username='cache_admin', is_staff=True, is_superuser=True))
+        admin.post('/admin/services/service/', {'action': 'approve_services', '_selected_action': [self.service.pk]})
+        self.assertContains(self.client.get('/services/'), self.service.title)
+
+    def test_signed_in_users_are_not_served_cached_pages(self):
+        self.client.get('/')
+        self.client.force_login(User.objects.create(username='cache_customer'))
+        with CaptureQueriesContext(connection) as context:
+            self.client.get('/')
+        self.assertGreater(len(context.captured_queries), 0)
+
+
+@override_settings(CACHES=ISOLATED_CACHE)
+class RoleMiddlewareTests(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        cache.clear()  # user ids are reused after each test's rollback
+        self.user = User.objects.create(username='role_user')
+        self.client.force_login(self.user)
+
+    def test_role_is_cached_between_requests(self):
+        self.assertRedirects(self.client.get('/dashboard/'), '/dashboard/customer/', fetch_redirect_response=False)
+        # Session and user only; the role comes from the cache
+        with self.assertMaxQueries(2):
+            self.client.get('/dashboard/')
+
+    def test_creating_a_provider_profile_changes_the_role(self):
+        self.client.get('/dashboard/')
+        ServiceProvider.objects.create(
+            user=self.user, business_name='Role Repairs', contact_number='9999999999',
+            email='role@example.com', address='1 Main St', city='Kochi', state='Kerala', pincode='682001',
+        )
+        self.assertRedirects(self.client.get('/dashboard/'), '/provider/', fetch_redirect_response=False)
+
+
+class PortalIndexTests(TestCase):
+    def test_portal_queries_use_indexes(self):
+        call_command('explain_portal_queries', stdout=StringIO())
+
+    def test_unindexed_filter_is_reported_as_full_scan(self):
+        from services.management.commands.explain_portal_queries import full_scans
+        self.assertTrue(full_scans(Booking.objects.filter(customer_name='Anu')))
+
+    def test_booking_indexes_are_not_duplicated(self):
+        # Partial or not, two indexes over the same columns are both maintained on every booking write
+        columns = [tuple(index.fields) for index in Booking._meta.indexes]
+        self.assertEqual(len(columns), len(set(columns)))
+
+
+class KeysetPaginationTests(QueryBudgetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.service = create_catalog(categories=1, services_per_category=1)[0]
+        cls.customer = User.objects.create(username='paging_customer')
+        created_at = timezone.now()
+        # Pairs share a timestamp so the id tie-breaker is exercised
+        Booking.objects.bulk_create([
+            Booking(
+                user=cls.customer, provider=cls.service.provider, service=cls.service,
+                customer_name='Customer', customer_email='customer@homeserve.com', customer_phone='9876543210',
+                customer_address='MG Road', booking_date=date.today(), booking_time=time(10), total_amount=500,
+                created_at=created_at - timedelta(minutes=i // 2),
+            )
+            for i in range(7)
+        ])
+
+    def setUp(self):
+        self.client.force_login(self.customer)
+
+    def test_cursor_walk_visits_every_row_once_without_counting(self):
+        expected = list(Booking.objects.order_by('-created_at', '-id').values_list('id', flat=True))
+        seen = []
+        url = '/api/bookings/?page_size=3'
+        while url:
+            with self.assertMaxQueries(4):
+                data = self.client.get(url).json()
+            self.assertNotIn('count', data)
+            seen.extend(row['id'] for row in data['results'])
+            last = data
+            url = data['next']
+        self.assertEqual(seen, expected)
+
+        previous = self.client.get(last['previous']).json()
+        self.assertEqual([row['id'] for row in previous['results']], expected[3:6])
+        self.assertIsNotNone(previous['next'])
+
+    def test_page_param_falls_back_to_page_numbers(self):
+        data = self.client.get('/api/bookings/?page=2&page_size=3').json()
+        self.assertEqual(data['count'], 7)
+        self.assertEqual(len(data['results']), 3)
+
+    def test_invalid_cursor_is_not_found(self):
+        self.assertEqual(self.client.get('/api/bookings/?cursor=not-a-cursor').status_code, 404)
+
+
+@override_settings(CACHES=ISOLATED_CACHE)
+class ConversationTests(QueryBudgetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.service = create_catalog(categories=1, services_per_category=1)[0]
+        cls.provider_user = cls.service.provider.user
+        cls.customers = [User.objects.create(username=f'chat_customer_{i}') for i in range(3)]
+        cls.bookings = [
+            Booking.objects.create(
+                user=customer, provider=cls.service.provider, service=cls.service,
+                customer_name='Customer', customer_email='customer@homeserve.com', customer_phone='9876543210',
+                customer_address='MG Road', booking_date=date.today(), booking_time=time(10), total_amount=500,
+            )
+            for customer in cls.customers
+        ]
+
+    def setUp(self):
+        cache.clear()  # user ids are reused after each test's rollback
+
+    def send(self, customer, to_provider=True, text='Hello'):
+        booking = self.bookings[self.customers.index(customer)]
+        sender, receiver = (customer, self.provider_user) if to_provider else (self.provider_user, customer)
+        return Message.objects.create(booking=booking, sender=sender, receiver=receiver, message_text=text)
+
+    def inbox_fields(self, conversation):
+        conversation.refresh_from_db()
+        return conversation.last_message_id, conversation.last_activity_at, conversation.unread_a, conversation.unread_b
+
+    def test_messages_keep_inbox_fields_in_step(self):
+        customer = self.customers[0]
+        first = self.send(customer)
+        self.send(customer, to_provider=False)
+        last = self.send(customer)
+        conversation = first.conversation
+        self.assertEqual(Conversation.objects.count(), 1)
+        conversation.refresh_from_db()
+        self.assertEqual(conversation.last_message_id, last.id)
+        self.assertEqual(conversation.unread_for(self.provider_user), 2)
+        self.assertEqual(conversation.unread_for(customer), 1)
+
+        first.is_read = True
+        first.save()
+        self.assertEqual(conversations.for_user(customer).get().unread_for(self.provider_user), 1)
+
+        with CaptureQueriesContext(connection) as context:
+            last.delete()
+        # Only the message's own conversation is recomputed, without looking for orphans
+        self.assertFalse([query for query in context if '"conversation_id" IS NULL' in query['sql']])
+        maintained = self.inbox_fields(conversation)
+        self.assertEqual(conversations.reconcile(), 1)
+        self.assertEqual(self.inbox_fields(conversation), maintained)
+        self.assertNotEqual(maintained[0], last.id)
+
+    def test_guest_bookings_cannot_be_messaged(self):
+        guest_booking = Booking.objects.create(
+            provider=self.service.provider, service=self.service, customer_name='Guest',
+            customer_email='guest@example.com', customer_phone='9876543210', customer_address='MG Road',
+            booking_date=date.today(), booking_time=time(11), total_amount=500,
+        )
+        self.client.force_login(self.provider_user)
+        response = self.client.post('/api/messages/', {'booking_id': guest_booking.id, 'message_text': 'On my way'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('booking_id', response.json())
+        self.assertFalse(Message.objects.exists())
+
+    def test_reconcile_attaches_bulk_created_messages(self):
+        customer = self.customers[1]
+        Message.objects.bulk_create([
+            Message(booking=self.bookings[1], sender=customer, receiver=self.provider_user, message_text='Hi')
+            for _ in range(3)
+        ])
+        conversations.reconcile()
+        conversation = conversations.for_user(self.provider_user).get()
+        self.assertEqual(conversation.messages.count(), 3)
+        self.assertEqual(conversation.unread_for(self.provider_user), 3)
+
+    def test_inbox_page_cost_does_not_grow_with_history(self):
+        for customer in self.customers:
+            self.send(customer)
+        self.client.force_login(self.provider_user)
+        self.client.get('/provider/messages/')  # warm the role cache
+        with CaptureQueriesContext(connection) as before:
+            response = self.client.get('/provider/messages/')
+        self.assertEqual(len(response.context['conversations']), 3)
+
+        for customer in self.customers:
+            for _ in range(10):
+                self.send(customer)
+        with self.assertMaxQueries(len(before.captured_queries)):
+            response = self.client.get('/provider/messages/')
+        self.assertEqual([row['unread'] for row in response.context['conversations']], [11, 11, 11])
+
+    def test_thread_api_pages_messages_and_marks_them_read(self):
+        customer = self.customers[0]
+        for i in range(5):
+            self.send(customer, text=f'Message {i}')
+        self.send(self.customers[1])
+        self.client.force_login(self.provider_user)
+
+        inbox = self.client.get('/api/conversations/?page_size=1').json()
+        self.assertEqual(inbox['results'][0]['other_user']['id'], self.customers[1].id)
+        self.assertIsNotNone(inbox['next'])
+        conversation = conversations.for_user(customer).get()
+
+        texts, url = [], f'/api/conversations/{conversation.id}/messages/?page_size=2'
+        while url:
+            with self.assertMaxQueries(4):
+                page = self.client.get(url).json()
+            texts += [message['message_text'] for message in page['results']]
+            url = page['next']
+        self.assertEqual(texts, [f'Message {i}' for i in reversed(range(5))])
+
+        data = self.client.post(f'/api/conversations/{conversation.id}/read/').json()
+        self.assertEqual(data['unread'], 0)
+        self.assertFalse(Message.objects.filter(receiver=self.provider_user, conversation=conversation, is_read=False))
+        self.assertEqual(counters.get_counters(self.service.provider).unread_messages, 1)
+
+        self.client.force_login(self.customers[2])
+        self.assertEqual(self.client.get(f'/api/conversations/{conversation.id}/').status_code, 404)
+
+
+@override_settings(CACHES=ISOLATED_CACHE)
+class PushTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.service = create_catalog(categories=1, services_per_category=1)[0]
+        cls.provider_user = cls.service.provider.user
+        cls.customer = User.objects.create(username='push_customer')
+
+    def setUp(self):
+        cache.clear()
+
+    def stored(self, user):
+        """Events kept in the cache for `user`, oldest first"""
+        latest = cache.get(push._sequence_key(user.id), 0)
+        return [cache.get(push._event_key(user.id, sequence)) for sequence in range(1, latest + 1)]
+
+    def book(self):
+        return Booking.objects.create(
+            user=self.customer, provider=self.service.provider, service=self.service,
+            customer_name='Customer', customer_email='customer@homeserve.com', customer_phone='9876543210',
+            customer_address='MG Road', booking_date=date.today(), booking_time=time(10), total_amount=500,
+        )
+
+    def test_messages_and_status_changes_are_published_on_commit(self):
+        self.book()
+        self.assertEqual(self.stored(self.customer), [])  # nothing before the commit
+
+        with self.captureOnCommitCallbacks(execute=True):
+            booking = self.book()
+            booking.notes = 'Ring twice'
+            booking.save()
+            booking.status = 'confirmed'
+            booking.save()
+            Message.objects.create(
+                booking=booking, sender=self.customer, receiver=self.provider_user, message_text='See you',
+            )
+        for user in (self.customer, self.provider_user):
+            events = self.stored(user)
+            self.assertEqual([event['type'] for event in events], ['booking_status', 'booking_status', 'message'])
+            self.assertEqual(
+                [(event['data']['status'], event['data']['previous']) for event in events[:2]],
+                [('pending', None), ('confirmed', 'pending')],
+            )
+            self.assertEqual(events[2]['data']['message_text'], 'See you')
+
+    def test_guest_bookings_only_notify_the_provider(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            booking = Booking.objects.create(
+                provider=self.service.provider, service=self.service, customer_name='Guest',
+                customer_email='guest@example.com', customer_phone='9876543210', customer_address='MG Road',
+                booking_date=date.today(), booking_time=time(11), total_amount=500,
+            )
+            booking.status = 'confirmed'
+            booking.save()
+        self.assertEqual([event['data']['status'] for event in self.stored(self.provider_user)], ['pending', 'confirmed'])
+
+    async def test_stream_delivers_local_and_other_worker_events_once(self):
+        await self.async_client.aforce_login(self.customer)
+        with mock.patch.object(push, 'POLL_SECONDS', 0.05), mock.patch.object(push, 'STREAM_SECONDS', 0.5):
+            response = await self.async_client.get('/api/events/')
+            self.assertEqual(response['Content-Type'], 'text/event-stream')
+            chunks = aiter(response.streaming_content)
+            self.assertTrue((await anext(chunks)).startswith(b'retry:'))
+
+            await sync_to_async(push.send)([self.customer.id], 'message', {'id': 7})
+            self.assertIn(b'event: message', await anext(chunks))
+            # Another worker only reaches this one through the cache
+            await sync_to_async(push.store)(self.customer.id, 'booking_status', {'booking': 3})
+            self.assertIn(b'event: booking_status', await anext(chunks))
+
+            rest = [chunk async for chunk in chunks]
+        self.assertFalse([chunk for chunk in rest if b'event:' in chunk])
+
+    def test_sequence_ids_come_from_the_database(self):
+        first = push.store(self.customer.id, 'message', {'id': 1})
+        # The cached sequence is only a pointer: losing it (or racing on it) cannot hand out an id twice
+        cache.delete(push._sequence_key(self.customer.id))
+        second = push.store(self.customer.id, 'message', {'id': 2})
+        self.assertEqual((first['id'], second['id']), (1, 2))
+        self.assertEqual(cache.get(push._sequence_key(self.customer.id)), 2)
+        self.assertEqual(push.store(self.provider_user.id, 'message', {'id': 3})['id'], 1)
+
+    def test_wsgi_requests_are_told_not_to_reconnect(self):
+        self.client.force_login(self.customer)
+        self.assertEqual(self.client.get('/api/events/').status_code, 204)
+
+    async def test_reconnect_replays_missed_events(self):
+        for booking_id in range(3):
+            await sync_to_async(push.store)(self.customer.id, 'booking_status', {'booking': booking_id})
+        await self.async_client.aforce_login(self.customer)
+        with mock.patch.object(push, 'STREAM_SECONDS', 0):
+            response = await self.async_client.get('/api/events/', headers={'Last-Event-ID': '1'})
+            body = b''.join([chunk async for chunk in response.streaming_content])
+        self.assertEqual(body.count(b'event: booking_status'), 2)
+        self.assertIn(b'id: 3\n', body)
+
+
+@override_settings(CACHES=ISOLATED_CACHE)
+class SlotEngineTests(QueryBudgetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.service = create_catalog(categories=1, services_per_category=2)[0]
+        cls.provider = cls.service.provider
+        cls.day = date.today() + timedelta(days=1)
+        ProviderAvailability.objects.create(
+            provider=cls.provider, weekday=cls.day.weekday(),
+            start_time=time(9), end_time=time(13), break_start=time(11), break_end=time(11, 30),
+        )
+
+    def setUp(self):
+        cache.clear()
+        slots._index.clear()
+
+    def book(self, at):
+        return Booking.objects.create(
+            service=self.service, provider=self.provider, customer_name='Anu', customer_email='anu@example.com',
+            customer_phone='9876543210', customer_address='Kochi', booking_date=self.day, booking_time=at,
+            total_amount=500,
+        )
+
+    def starts(self):
+        found = slots.free_slots([self.provider.id], self.day, self.day)[self.provider.id]
+        return [slot.start.strftime('%H:%M') for slot in found]
+
+    def test_slots_skip_breaks_and_bookings(self):
+        self.book(time(10))
+        self.assertEqual(self.starts(), ['09:00', '11:30', '12:00'])
+        self.assertTrue(slots.is_free(self.provider.id, self.day, time(11, 30)))
+        self.assertFalse(slots.is_free(self.provider.id, self.day, time(10, 30)))
+
+    def test_index_is_rebuilt_when_bookings_and_leaves_change(self):
+        self.assertEqual(self.starts(), ['09:00', '09:30', '10:00', '11:30', '12:00'])
+        with self.assertMaxQueries(0):
+            self.starts()
+        booking = self.book(time(11, 30))
+        self.assertEqual(self.starts(), ['09:00', '09:30', '10:00'])
+        booking.status = 'cancelled'
+        booking.save()
+        self.assertEqual(len(self.starts()), 5)
+        ProviderLeave.objects.create(provider=self.provider, leave_type='personal', start_date=self.day, end_date=self.day)
+        self.assertEqual(self.starts(), [])
+
+    def test_off_grid_hours_offer_slots_on_the_claim_grid(self):
+        ProviderAvailability.objects.filter(provider=self.provider).update(
+            start_time=time(9, 15), break_start=None, break_end=None,
+        )
+        slots.forget(self.provider.id)
+        starts = self.starts()
+        self.assertEqual(starts[:3], ['09:30', '10:00', '10:30'])
+
+        # Back-to-back slots claim disjoint cells, so both bookings go through
+        for at in (time(9, 30), time(10, 30)):
+            slots.claim(self.book(at))
+        self.assertEqual(BookingSlotClaim.objects.filter(provider=self.provider).count(), 4)
+
+    def test_bulk_endpoint_answers_for_a_city_and_window(self):
+        other = Service.objects.exclude(provider=self.provider).get().provider
+        self.book(time(9))
+        params = {'city': 'kochi', 'start': self.day.isoformat(), 'from': '09:00', 'to': '11:00'}
+        with self.assertMaxQueries(5):
+            response = self.client.get('/api/providers/slots/', params)
+        self.assertEqual(response.status_code, 200)
+        found = {row['id']: [slot['start'] for slot in row['slots']] for row in response.json()}
+        self.assertEqual(found, {self.provider.id: ['10:00'], other.id: ['09:00', '09:30', '10:00']})
+
+    def test_provider_endpoint_validates_parameters(self):
+        url = f'/api/providers/{self.provider.id}/slots/'
+        response = self.client.get(url, {'start': self.day.isoformat(), 'duration': 90})
+        self.assertEqual([slot['end'] for slot in response.json()['slots']], ['10:30', '11:00', '13:00'])
+        self.assertEqual(self.client.get(url, {'start': 'tomorrow'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'duration': 5}).status_code, 400)
+        self.assertEqual(self.client.get('/api/providers/slots/').status_code, 400)
+
+
+KOCHI = (9.9658, 76.2421)
+
+
+@override_settings(CACHES=ISOLATED_CACHE)
+class GeoTests(QueryBudgetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.services = create_catalog(categories=2, services_per_category=2)
+        cls.category = cls.services[0].category
+        # Providers scattered up to ~40 km around Kochi, and a crowd in Thiruvananthapuram
+        rng = random.Random(18)
+        points = [(KOCHI[0] + rng.uniform(-0.35, 0.35), KOCHI[1] + rng.uniform(-0.35, 0.35)) for _ in range(150)]
+        points += [(8.5241 + rng.uniform(-0.02, 0.02), 76.9366 + rng.uniform(-0.02, 0.02)) for _ in range(100)]
+        users = User.objects.bulk_create([User(username=f'geo{i}') for i in range(len(points))])
+        ServiceProvider.objects.bulk_create([
+            ServiceProvider(
+                user=user, business_name=f'Geo {i}', contact_number='9876543210', email=f'geo{i}@homeserve.com',
+                address='MG Road', city='Kochi', state='Kerala', pincode='682001', verification_status='verified',
+                latitude=Decimal(f'{latitude:.6f}'), longitude=Decimal(f'{longitude:.6f}'),
+            )
+            for i, (user, (latitude, longitude)) in enumerate(zip(users, points))
+        ])
+        geo.backfill()
+
+    def setUp(self):
+        cache.clear()
+
+    def brute_force(self, latitude, longitude, radius_km):
+        return sorted(
+            (geo.distance_km(latitude, longitude, float(provider.latitude), float(provider.longitude)), provider.id)
+            for provider in ServiceProvider.objects.exclude(latitude=None)
+            if geo.distance_km(latitude, longitude, float(provider.latitude), float(provider.longitude)) <= radius_km
+        )
+
+    def test_radius_and_nearest_match_brute_force(self):
+        for radius in (0.5, 3, 12, 30):
+            found = geo.within(ServiceProvider.objects.all(), *KOCHI, radius)
+            self.assertEqual([provider.id for provider in found], [pk for _, pk in self.brute_force(*KOCHI, radius)])
+        nearest = geo.nearest(ServiceProvider.objects.all(), 10.2, 76.1, 7)
+        self.assertEqual([provider.id for provider in nearest], [pk for _, pk in self.brute_force(10.2, 76.1, 50)][:7])
+
+    def test_far_providers_are_never_read(self):
+        cells = geo.covering_cells(8.5241, 76.9366, 5)
+        self.assertEqual(ServiceProvider.objects.filter(geo.cell_filter('', cells)).count(), 100)
+        with self.assertMaxQueries(1):
+            found = geo.within(ServiceProvider.objects.all(), *KOCHI, 2)
+        self.assertTrue(all(provider.distance_km <= 2 for provider in found))
+
+    def test_coordinates_follow_the_pincode(self):
+        provider = self.services[0].provider
+        self.assertEqual((float(provider.latitude), float(provider.longitude)), KOCHI)
+        self.assertEqual(provider.geohash, geo.encode(*KOCHI))
+
+        provider.pincode = '695001'
+        provider.save(update_fields=['pincode'])
+        provider.refresh_from_db()
+        self.assertEqual(float(provider.latitude), 8.5241)
+        self.assertEqual(provider.geohash, geo.encode(8.5241, 76.9366))
+
+        # Explicit coordinates win over the centroid, and unknown pincodes fall back to the sorting district
+        provider.latitude, provider.longitude = Decimal('8.500000'), Decimal('76.950000')
+        provider.save()
+        self.assertEqual(provider.geohash, geo.encode(8.5, 76.95))
+        self.assertEqual(geo.locate('686999'), geo.locate('686'))
+        self.assertEqual(geo.locate('', 'Wayanad'), (11.6085, 76.083))
+        self.assertIsNone(geo.locate('110001'))
+
+    def test_geocoding_reports_providers_it_cannot_place(self):
+        lost = self.services[1].provider
+        ServiceProvider.objects.filter(pk=lost.pk).update(pincode='110001', city='Delhi', latitude=None, longitude=None)
+        out = StringIO()
+        call_command('geocode_providers', stdout=out)
+        self.assertEqual(list(geo.unlocated()), [lost])
+        self.assertIn('1 provider(s) have no coordinates', out.getvalue())
+        self.assertIn(f'#{lost.id} {lost.business_name} (110001, Delhi)', out.getvalue())
+
+    def test_nearby_endpoints_filter_by_category_and_availability(self):
+        busy = self.services[1].provider
+        busy.is_available = False
+        busy.save()
+        params = {'pincode': '682001', 'radius': 1, 'category': self.category.id}
+        with self.assertMaxQueries(1):
+            response = self.client.get('/api/providers/nearby/', params)
+        self.assertEqual([row['id'] for row in response.json()], [self.services[0].provider_id, busy.id])
+        self.assertEqual(response.json()[0]['distance_km'], 0)
+
+        response = self.client.get('/api/services/nearby/', {**params, 'available': 'true'})
+        self.assertEqual([row['id'] for row in response.json()], [self.services[0].id])
+
+        response = self.client.get('/api/providers/nearby/', {'lat': 10.2, 'lng': 76.1, 'k': 3})
+        self.assertEqual([row['id'] for row in response.json()], [pk for _, pk in self.brute_force(10.2, 76.1, 10)][:3])
+
+        invalid = [
+            {}, {'pincode': '110001'}, {'lat': 10}, {'lat': 10, 'lng': 76, 'radius': 500}, {'pincode': '682001', 'k': 0},
+        ]
+        for bad in invalid:
+            self.assertEqual(self.client.get('/api/providers/nearby/', bad).status_code, 400)
+
+
+@override_settings(CACHES=ISOLATED_CACHE)
+class MatchingTests(QueryBudgetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        services = create_catalog(categories=2, services_per_category=4)
+        cls.category = services[0].category
+        cls.near, cls.best, cls.far, cls.busy = (service.provider for service in services[:4])
+        ServiceProvider.objects.filter(pk=cls.best.pk).update(average_rating=Decimal('4.90'))
+        ServiceProvider.objects.filter(pk=cls.near.pk).update(average_rating=Decimal('4.00'))
+        cls.far.pincode = '695001'  # Thiruvananthapuram, ~160 km from Kochi
+        cls.far.save()
+        ServiceProvider.objects.filter(pk=cls.busy.pk).update(is_available=False)
+        Service.objects.filter(pk=services[0].pk).update(is_emergency_available=True)
+        cls.customer = User.objects.create(username='matching_customer')
+
+    def setUp(self):
+        cache.clear()
+
+    def request(self, **fields):
+        return ServiceRequest.objects.create(**{
+            'customer': self.customer, 'category': self.category, 'title': 'Leaking tap', 'description': 'Kitchen',
+            'urgency': 'medium', 'address': 'MG Road', 'city': 'Kochi', 'pincode': '682001', **fields,
+        })
+
+    def suggested(self, service_request):
+        return list(service_request.matches.order_by('rank').values_list('provider_id', flat=True))
+
+    def test_new_requests_get_ranked_suggestions(self):
+        service_request = self.request()
+        self.assertEqual(self.suggested(service_request), [self.best.id, self.near.id])
+        match = service_request.matches.get(rank=1)
+        self.assertEqual(match.distance_km, 0)
+        self.assertGreater(match.score, service_request.matches.get(rank=2).score)
+        self.assertEqual(ServiceRequest.objects.get(pk=service_request.pk).status, 'open')
+
+        # Without a known pincode the request is matched on its city
+        self.assertEqual(self.suggested(self.request(pincode='', city='Trivandrum')), [])
+
+    def test_backlog_run_accounts_for_load(self):
+        service_request = self.request()
+        ServiceRequest.objects.bulk_create([
+            ServiceRequest(
+                customer=self.customer, category=self.category, title='Earlier job', description='Done soon',
+                address='MG Road', city='Kochi', pincode='682001', status='assigned', assigned_provider=self.best,
+            )
+            for _ in range(matching.FULL_LOAD)
+        ])
+        stats = matching.run()
+        self.assertEqual((stats['requests'], stats['unmatched'], stats['assigned']), (1, 0, 0))
+        self.assertEqual(self.suggested(service_request), [self.near.id, self.best.id])
+
+    def test_emergency_requests_are_assigned_to_the_best_emergency_provider(self):
+        service_request = self.request(urgency='emergency')
+        self.assertEqual(self.suggested(service_request), [self.near.id])
+        service_request.refresh_from_db()
+        self.assertEqual((service_request.status, service_request.assigned_provider_id), ('assigned', self.near.id))
+        self.assertTrue(Notification.objects.filter(user=self.near.user, notification_type='system').exists())
+        # Already assigned, so re-scoring leaves the assignment alone
+        self.assertEqual(matching.run()['assigned'], 0)
+
+    def test_pools_are_reused_until_the_catalogue_changes(self):
+        matching.pools([self.category.id])
+        with self.assertMaxQueries(0):
+            pool = matching.pools([self.category.id])[self.category.id]
+        self.assertEqual({candidate.provider_id for candidate in pool}, {self.near.id, self.best.id, self.far.id})
+        self.far.is_available = False
+        self.far.save()
+        pool = matching.pools([self.category.id])[self.category.id]
+        self.assertEqual({candidate.provider_id for candidate in pool}, {self.near.id, self.best.id})
+
+    def test_suggestions_endpoint_and_command(self):
+        service_request = self.request()
+        ServiceRequestMatch.objects.all().delete()
+        out = StringIO()
+        call_command('match_service_requests', stdout=out)
+        self.assertIn('Matched 1 open request(s)', out.getvalue())
+        self.client.force_login(self.customer)
+        response = self.client.get(f'/api/service-requests/{service_request.id}/suggestions/')
+        self.assertEqual([row['provider']['id'] for row in response.json()], [self.best.id, self.near.id])
+
+
+@override_settings(CACHES=ISOLATED_CACHE)
+class DispatchTests(QueryBudgetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.services = create_catalog(categories=1, services_per_category=3)
+        cls.first, cls.second, cls.third = (service.provider for service in cls.services)
+        Service.objects.filter(pk=cls.services[0].pk).update(is_emergency_available=True)
+        cls.customer = User.objects.create(username='dispatch_customer')
+        cls.staff = User.objects.create(username='dispatcher', is_staff=True)
+
+    def setUp(self):
+        cache.clear()
+
+    def request(self, urgency, **fields):
+        return ServiceRequest.objects.create(**{
+            'customer': self.customer, 'category': self.services[0].category, 'title': 'Burst pipe',
+            'description': 'Flooding', 'urgency': urgency, 'address': 'MG Road', 'city': 'Kochi',
+            'pincode': '682001', **fields,
+        })
+
+    def emergency_booking(self):
+        return Booking.objects.create(
+            service=self.services[1], provider=self.second, user=self.customer, customer_name='Anu',
+            customer_email='anu@example.com', customer_phone='9876543210', customer_address='Kochi',
+            booking_date=date.today(), booking_time=time(10), total_amount=500, is_emergency=True,
+        )
+
+    def test_emergency_booking_is_leased_and_accepted_by_its_provider(self):
+        booking = self.emergency_booking()
+        job = booking.dispatch_job
+        self.assertEqual((job.priority, job.status, job.provider_id), (dispatch.EMERGENCY, 'queued', self.second.id))
+        self.assertIsNone(dispatch.claim(self.first))
+
+        claimed = dispatch.claim(self.second)
+        self.assertEqual((claimed.id, claimed.status), (job.id, 'leased'))
+        self.assertEqual(dispatch.claim(self.second).id, job.id)
+        dispatch.accept(claimed, self.second, now=claimed.requested_at + timedelta(minutes=1))
+
+        booking.refresh_from_db()
+        job.refresh_from_db()
+        self.assertEqual((booking.status, job.status, job.accepted_by_id), ('confirmed', 'accepted', self.second.id))
+        self.assertEqual(job.response_seconds, 60)
+        emergency = dispatch.metrics()[0]
+        self.assertEqual((emergency['requested'], emergency['accepted'], emergency['median_seconds']), (1, 1, 60))
+        self.assertEqual(emergency['within_target'], 1)
+
+    def test_only_one_provider_holds_a_lease(self):
+        job = self.request('high').dispatch_job
+        self.assertIsNone(job.provider_id)
+        self.assertEqual(dispatch.claim(self.first).id, job.id)
+        self.assertIsNone(dispatch.claim(self.second))
+
+        later = timezone.now() + timedelta(seconds=dispatch.LEASE_SECONDS + 60)
+        with self.assertRaises(dispatch.LeaseLost):
+            dispatch.accept(job, self.first, now=later)
+        self.assertEqual(dispatch.claim(self.second, now=later).id, job.id)
+        dispatch.accept(job, self.second, now=later)
+        self.assertEqual(ServiceRequest.objects.get(dispatch_job=job).assigned_provider, self.second)
+        self.assertEqual(DispatchJob.objects.get(pk=job.pk).attempts, 2)
+
+    def test_queue_orders_by_urgency_then_age(self):
+        high = self.request('high').dispatch_job
+        emergency = self.request('emergency').dispatch_job
+        # Matching assigned the emergency to the only emergency provider, so only they are offered it
+        self.assertEqual(emergency.provider_id, self.first.id)
+        self.client.force_login(self.first.user)
+        with self.assertMaxQueries(6):
+            response = self.client.get('/api/dispatch/')
+        self.assertEqual([row['id'] for row in response.json()['results']], [emergency.id, high.id])
+        self.client.force_login(self.second.user)
+        self.assertEqual([row['id'] for row in self.client.get('/api/dispatch/').json()['results']], [high.id])
+
+    def test_unaccepted_jobs_escalate(self):
+        job = self.request('emergency').dispatch_job
+        requested = job.requested_at
+        self.assertEqual(dispatch.escalate(now=requested + timedelta(minutes=4)), 0)
+        self.assertEqual(dispatch.escalate(now=requested + timedelta(minutes=6)), 1)
+        job.refresh_from_db()
+        # Matching assigned the emergency, so the job is not opened to anyone else
+        self.assertEqual((job.level, job.provider_id), (1, self.first.id))
+        self.assertIsNone(dispatch.claim(self.second, now=requested + timedelta(minutes=6)))
+        self.assertTrue(Notification.objects.filter(user=self.first.user, title__contains='waiting for 6 min').exists())
+        self.assertEqual(self.first.counters.unread_notifications, 2)  # assignment and escalation
+
+        self.assertEqual(dispatch.escalate(now=requested + timedelta(minutes=16)), 1)
+        self.assertTrue(Notification.objects.filter(user=self.staff).exists())
+        self.assertEqual(dispatch.escalate(now=requested + timedelta(hours=1)), 0)
+        self.assertEqual(dispatch.metrics()[0]['escalated'], 1)
+
+    def test_unassigned_request_opens_at_level_one(self):
+        job = self.request('high').dispatch_job
+        dispatch.escalate(now=job.requested_at + timedelta(minutes=31))
+        job.refresh_from_db()
+        self.assertEqual((job.level, job.provider_id), (1, None))
+
+    def test_assigned_requests_are_not_handed_to_another_provider(self):
+        service_request = self.request('high')
+        job = service_request.dispatch_job
+        self.assertEqual(dispatch.claim(self.second).id, job.id)
+        # Assigned meanwhile without signals, as matching.auto_assign does
+        ServiceRequest.objects.filter(pk=service_request.pk).update(status='assigned', assigned_provider=self.third)
+        with self.assertRaises(dispatch.LeaseLost):
+            dispatch.accept(job, self.second)
+        service_request.refresh_from_db()
+        self.assertEqual(service_request.assigned_provider, self.third)
+        self.assertEqual(DispatchJob.objects.get(pk=job.pk).status, 'leased')
+
+        # Nor queued again when their job is missing
+        DispatchJob.objects.all().delete()
+        self.assertEqual(dispatch.backfill(), 0)
+
+    def test_jobs_close_when_handled_elsewhere(self):
+        booking = self.emergency_booking()
+        booking.status = 'cancelled'
+        booking.save()
+        self.assertEqual(DispatchJob.objects.get(booking=booking).status, 'cancelled')
+
+        service_request = self.request('high')
+        self.client.force_login(self.customer)
+        self.client.post(f'/api/service-requests/{service_request.id}/assign/', {'provider_id': self.third.id})
+        job = DispatchJob.objects.get(service_request=service_request)
+        self.assertEqual((job.status, job.accepted_by_id), ('accepted', self.third.id))
+        self.request('medium')
+        self.assertFalse(DispatchJob.objects.filter(service_request__urgency='medium').exists())
+
+    def test_api_leases_and_reports(self):
+        job = self.request('high').dispatch_job
+        self.client.force_login(self.customer)
+        self.assertEqual(self.client.post('/api/dispatch/claim/').status_code, 403)
+        self.assertEqual(self.client.get('/api/dispatch/metrics/').status_code, 403)
+
+        self.client.force_login(self.third.user)
+        self.assertEqual(self.client.post('/api/dispatch/claim/').json()['id'], job.id)
+        self.assertEqual(self.client.post(f'/api/dispatch/{job.id}/release/').json()['status'], 'queued')
+        self.client.post('/api/dispatch/claim/')
+        response = self.client.post(f'/api/dispatch/{job.id}/accept/')
+        self.assertEqual(response.json()['status'], 'accepted')
+        self.assertEqual(self.client.post('/api/dispatch/claim/').status_code, 204)
+
+        self.client.force_login(self.staff)
+        high = self.client.get('/api/dispatch/metrics/').json()[1]
+        self.assertEqual((high['priority'], high['accepted'], high['waiting']), ('high', 1, 0))
+
+
+def booking_form(day, at):
+    return {
+        'customer_name': 'Anu', 'customer_email': 'anu@example.com', 'customer_phone': '9876543210',
+        'customer_address': 'Kochi', 'booking_date': day.isoformat(), 'booking_time': at,
+    }
+
+
+@override_settings(CACHES=ISOLATED_CACHE)
+class DoubleBookingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.service = create_catalog(categories=1, services_per_category=1)[0]
+        Service.objects.filter(pk=cls.service.pk).update(duration_minutes=90)
+        cls.service.refresh_from_db()
+        cls.day = date.today() + timedelta(days=1)
+        cls.customer = User.objects.create(username='double_booker')
+
+    def setUp(self):
+        cache.clear()
+        slots._index.clear()
+        self.client.force_login(self.customer)
+
+    def test_overlapping_api_booking_is_rejected_with_an_alternative(self):
+        data = {'service_id': self.service.id, **booking_form(self.day, '10:00'), 'total_amount': 500}
+        self.assertEqual(self.client.post('/api/bookings/', data).status_code, 201)
+
+        response = self.client.post('/api/bookings/', {**data, 'booking_time': '11:00'})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['suggested_slot'], {
+            'date': self.day.isoformat(), 'start': '11:30', 'end': '13:00',
+        })
+        self.assertEqual(Booking.objects.count(), 1)
+
+    def test_conflicting_form_booking_rolls_back_booking_and_payment(self):
+        url = f'/book/{self.service.id}/'
+        self.assertEqual(self.client.post(url, booking_form(self.day, '10:00')).status_code, 302)
+        response = self.client.post(url, booking_form(self.day, '10:30'))
+        self.assertContains(response, 'The next free slot is')
+        self.assertEqual((Booking.objects.count(), Payment.objects.count()), (1, 1))
+
+    def test_cancelling_releases_the_slot(self):
+        url = f'/book/{self.service.id}/'
+        self.client.post(url, booking_form(self.day, '10:00'))
+        booking = Booking.objects.get()
+        booking.status = 'cancelled'
+        booking.save()
+        self.assertFalse(booking.slot_claims.exists())
+        self.assertEqual(self.client.post(url, booking_form(self.day, '10:30')).status_code, 302)
+
+
+@override_settings(CACHES=ISOLATED_CACHE)
+class DoubleBookingStressTests(TransactionTestCase):
+    """Many clients race for the same few slots; every slot must end up booked exactly once"""
+    THREADS = 6
+    ATTEMPTS = 5
+    TIMES = ['09:00', '10:00', '11:00']
+    MAX_RETRIES = 200
+
+    def test_concurrent_submissions_never_double_book(self):
+        service = create_catalog(categories=1, services_per_category=1)[0]
+        day = date.today() + timedelta(days=1)
+        customer = User.objects.create(username='stress_customer')
+        statuses = []
+        start = threading.Barrier(self.THREADS)
+        clients = [Client() for _ in range(self.THREADS)]
+        for client in clients:
+            client.force_login(customer)
+
+        def submit(worker):
+            client = clients[worker]
+            start.wait()
+            try:
+                for attempt in range(self.ATTEMPTS):
+                    data = {'service_id': service.id, **booking_form(day, self.TIMES[(worker + attempt) % 3]),
+                            'total_amount': 500}
+                    for retry in range(self.MAX_RETRIES):
+                        try:
+                            statuses.append(client.post('/api/bookings/', data).status_code)
+                            break
+                        except OperationalError:
+                            # SQLite allows one writer at a time; back off and retry like a client would
+                            time_module.sleep(random.uniform(0, 0.002 * 2 ** min(retry, 6)))
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=submit, args=(worker,)) for worker in range(self.THREADS)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        # A retried request may find its own earlier attempt committed, so check the outcome in the database
+        self.assertEqual(len(statuses), self.THREADS * self.ATTEMPTS)
+        self.assertLessEqual(set(statuses), {201, 409})
+        booked = Booking.objects.filter(provider=service.provider).values_list('booking_time', flat=True)
+        self.assertEqual(sorted(booked), [time(int(at[:2])) for at in self.TIMES])
+
+
+@override_settings(CACHES=ISOLATED_CACHE)
+class WalletLedgerTests(QueryBudgetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.service = create_catalog(categories=1, services_per_category=1)[0]
+        cls.customer = User.objects.create(username='wallet_customer')
+        cls.friend = User.objects.create(username='wallet_friend')
+
+    def setUp(self):
+        cache.clear()
+        self.wallet = Wallet.objects.create(user=self.customer, balance=Decimal('100.00'))
+
+    def paid_booking(self, amount, reference):
+        booking = Booking.objects.create(
+            service=self.service, provider=self.service.provider, user=self.customer, customer_name='Anu',
+            customer_email='anu@example.com', customer_phone='9876543210', customer_address='Kochi',
+            booking_date=date.today() + timedelta(days=1), booking_time=time(10), total_amount=amount,
+        )
+        return Payment.objects.create(
+            booking=booking, user=self.customer, amount=amount, payment_method='card', status='completed',
+            transaction_id=reference, provider_amount=amount,
+        )
+
+    def test_postings_record_balance_after(self):
+        self.wallet.add_funds(Decimal('50.00'), 'Top-up', 'TOPUP1')
+        self.assertTrue(self.wallet.deduct_funds(Decimal('120.00')))
+        self.assertFalse(self.wallet.deduct_funds(Decimal('30.01')))
+
+        self.wallet.refresh_from_db()
+        self.assertEqual(self.wallet.balance, Decimal('30.00'))
+        self.assertEqual(
+            list(self.wallet.transactions.order_by('id').values_list('transaction_type', 'amount', 'balance_after')),
+            [('credit', Decimal('50.00'), Decimal('150.00')), ('debit', Decimal('120.00'), Decimal('30.00'))],
+        )
+
+    def test_stale_wallet_cannot_overdraw(self):
+        # Two holders of the same row both think 100 is available; only one debit may pass
+        stale = Wallet.objects.get(pk=self.wallet.pk)
+        ledger.debit(self.wallet, Decimal('80.00'))
+        self.assertFalse(stale.deduct_funds(Decimal('80.00')))
+        self.assertEqual(Wallet.objects.get(pk=self.wallet.pk).balance, Decimal('20.00'))
+
+    def test_batch_is_all_or_nothing(self):
+        other = Wallet.objects.create(user=self.friend, balance=Decimal('10.00'))
+        with self.assertRaises(ledger.InsufficientFunds):
+            ledger.post_many([
+                ledger.Entry(self.wallet.pk, 'debit', Decimal('40.00'), 'Booking'),
+                ledger.Entry(other.pk, 'credit', Decimal('5.00'), 'Cashback'),
+                ledger.Entry(other.pk, 'debit', Decimal('20.00'), 'Booking'),
+            ])
+        self.assertFalse(Transaction.objects.exists())
+        self.assertEqual(Wallet.objects.get(pk=other.pk).balance, Decimal('10.00'))
+
+        # A credit earlier in the batch covers a later debit
+        posted = ledger.post_many([
+            ledger.Entry(other.pk, 'credit', Decimal('15.00'), 'Cashback'),
+            ledger.Entry(other.pk, 'debit', Decimal('20.00'), 'Booking'),
+        ])
+        self.assertEqual([row.balance_after for row in posted], [Decimal('25.00'), Decimal('5.00')])
+
+        Wallet.objects.filter(pk=other.pk).update(is_active=False)
+        with self.assertRaisesMessage(ledger.LedgerError, 'inactive'):
+            ledger.credit(other, Decimal('1.00'))
+
+    def test_batch_cost_does_not_grow_with_its_size(self):
+        users = User.objects.bulk_create([User(username=f'payee_{i}') for i in range(50)])
+        wallets = ledger.wallets_for(user.id for user in users)
+        entries = [ledger.Entry(wallet_id, 'credit', Decimal('25.00'), 'Payout') for wallet_id in wallets.values()]
+        with self.assertMaxQueries(5):
+            ledger.post_many(entries)
+        self.assertEqual(set(Wallet.objects.filter(pk__in=wallets.values()).values_list('balance', flat=True)),
+                         {Decimal('25.00')})
+
+    def test_refunds_are_credited_once(self):
+        payments = [self.paid_booking(Decimal('300.00'), 'TXN1'), self.paid_booking(Decimal('200.00'), 'TXN2')]
+        posted = ledger.refund_payments(payments, reason='Provider no-show')
+        self.assertEqual([row.transaction_type for row in posted], ['refund', 'refund'])
+        self.assertEqual(ledger.refund_payments(payments), [])
+
+        self.wallet.refresh_from_db()
+        self.assertEqual(self.wallet.balance, Decimal('600.00'))
+        self.assertEqual(set(Payment.objects.values_list('status', 'refund_amount')), {
+            ('refunded', Decimal('300.00')), ('refunded', Decimal('200.00')),
+        })
+
+    def test_referral_rewards_are_paid_once(self):
+        referral = Referral.objects.create(
+            referrer=self.customer, referred=self.friend, referral_code='ANU100', is_completed=True,
+        )
+        Referral.objects.create(referrer=self.friend, referred=self.customer, referral_code='PENDING')
+        self.assertEqual(len(ledger.pay_referral_rewards()), 2)
+        self.assertEqual(ledger.pay_referral_rewards(), [])
+
+        referral.refresh_from_db()
+        self.assertTrue(referral.rewards_credited)
+        self.assertEqual(Wallet.objects.get(user=self.customer).balance, Decimal('200.00'))
+        self.assertEqual(Wallet.objects.get(user=self.friend).balance, Decimal('50.00'))
+
+
+class WalletLedgerBenchmarkTests(TransactionTestCase):
+    """
+    Throughput of concurrent wallet postings. Every worker hammers one shared
+    wallet (and its own) with debits, credits and small batches; the ledger
+    must stay consistent and the shared balance never negative. Scale it
+    with HOMESERVE_BENCHMARK_SCALE.
+    """
+    THREADS = 6
+    OPERATIONS = 25
+    MAX_RETRIES = 200
+
+    def test_concurrent_postings_keep_the_ledger_consistent(self):
+        operations = self.OPERATIONS * BENCHMARK_SCALE
+        shared = Wallet.objects.create(user=User.objects.create(username='shared_wallet'), balance=Decimal('100.00'))
+        own = [
+            Wallet.objects.create(user=User.objects.create(username=f'wallet_worker_{worker}'))
+            for worker in range(self.THREADS)
+        ]
+        outcomes, retries = [], []
+        start = threading.Barrier(self.THREADS)
+
+        def operation(worker, step):
+            kind = (worker + step) % 3
+            if kind == 0:
+                return ledger.debit(shared, Decimal('30.00'), 'Booking')
+            if kind == 1:
+                return ledger.credit(shared, Decimal('20.00'), 'Top-up')
+            return ledger.post_many([
+                ledger.Entry(own[worker].pk, 'credit', Decimal('10.00'), 'Payout'),
+                ledger.Entry(shared.pk, 'debit', Decimal('10.00'), 'Payout'),
+            ])
+
+        def work(worker):
+            start.wait()
+            try:
+                for step in range(operations):
+                    for retry in range(self.MAX_RETRIES):
+                        try:
+                            operation(worker, step)
+                            outcomes.append('posted')
+                            break
+                        except ledger.InsufficientFunds:
+                            outcomes.append('refused')
+                            break
+                        except OperationalError:
+                            # SQLite allows one writer at a time; back off and retry
+                            retries.append(worker)
+                            time_module.sleep(random.uniform(0, 0.002 * 2 ** min(retry, 6)))
+            finally:
+                connection.close()
+
+        started = time_module.perf_counter()
+        workers = [threading.Thread(target=work, args=(worker,)) for worker in range(self.THREADS)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time_module.perf_counter() - started
+
+        self.assertEqual(len(outcomes), self.THREADS * operations)
+        for wallet, opening in [(shared, Decimal('100.00'))] + [(wallet, Decimal('0.00')) for wallet in own]:
+            balance = opening
+            for transaction_type, amount, balance_after in wallet.transactions.order_by('id').values_list(
+                'transaction_type', 'amount', 'balance_after'
+            ):
+                balance += ledger.SIGN[transaction_type] * amount
+                self.assertEqual(balance_after, balance)
+                self.assertGreaterEqual(balance, 0)
+            self.assertEqual(Wallet.objects.get(pk=wallet.pk).balance, balance)
+
+        print(
+            f'\nWallet ledger: {len(outcomes)} operations on {self.THREADS} threads in {elapsed:.2f}s '
+            f'({len(outcomes) / elapsed:.0f} ops/s, {outcomes.count("refused")} refused, {len(retries)} retries)'
+        )
+
+
+@override_settings(CACHES=ISOLATED_CACHE)
+class PayoutTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.services = create_catalog(categories=1, services_per_category=3)
+        cls.first, cls.second, cls.unbanked = (service.provider for service in cls.services)
+        for provider, account in ((cls.first, '001122334455'), (cls.second, '998877665544')):
+            provider.bank_account_name = provider.business_name
+            provider.bank_account_number = account
+            provider.bank_ifsc = 'sbin0070123'
+            provider.save()
+        cls.customer = User.objects.create(username='payout_customer')
+        cls.cutoff = timezone.now() - timedelta(days=1)
+
+    def setUp(self):
+        cache.clear()
+
+    def earn(self, provider, amount, days_ago=5, payout_status='pending'):
+        service = next(service for service in self.services if service.provider_id == provider.id)
+        booking = Booking.objects.create(
+            service=service, provider=provider, user=self.customer, customer_name='Anu',
+            customer_email='anu@example.com', customer_phone='9876543210', customer_address='Kochi',
+            booking_date=date.today(), booking_time=time(10), total_amount=amount, status='completed',
+        )
+        payment = Payment.objects.create(
+            booking=booking, amount=amount, payment_method='upi', transaction_id=f'TXN{booking.id}',
+            provider_amount=amount, status='completed',
+        )
+        return ProviderEarnings.objects.create(
+            provider=provider, booking=booking, payment=payment, gross_amount=amount, commission_percentage=0,
+            commission_amount=0, net_amount=amount, payout_status=payout_status,
+            created_at=timezone.now() - timedelta(days=days_ago),
+        )
+
+    def test_batch_pays_pending_earnings_before_the_cutoff(self):
+        self.earn(self.first, 400)
+        self.earn(self.first, 100)
+        later = self.earn(self.first, 700, days_ago=0)
+        held = self.earn(self.first, 900, payout_status='hold')
+        self.earn(self.second, 250)
+        self.earn(self.unbanked, 300)
+
+        batch, stats = payouts.run(self.cutoff)
+        self.assertEqual((stats['claimed'], stats['skipped']), (3, 1))
+        self.assertEqual((batch.status, batch.provider_count, batch.earnings_count), ('ready', 2, 3))
+        self.assertEqual(batch.total_amount, Decimal('750'))
+        self.assertEqual(
+            list(batch.lines.values_list('provider_id', 'amount', 'earnings_count')),
+            [(self.first.id, Decimal('500'), 2), (self.second.id, Decimal('250'), 1)],
+        )
+        later.refresh_from_db()
+        held.refresh_from_db()
+        self.assertEqual((later.payout_status, held.payout_status), ('pending', 'hold'))
+        self.assertEqual(counters.get_counters(self.first).pending_payout, Decimal('700'))
+
+        rows = list(csv.reader(StringIO(''.join(payouts.transfer_file(batch, value_date=date(2026, 10, 31))))))
+        self.assertEqual(rows[0], payouts.TRANSFER_COLUMNS)
+        self.assertEqual(rows[1][:7], [
+            'NEFT', '001122334455', 'SBIN0070123', self.first.business_name, '500.00', '31/10/2026',
+            f'{batch.reference}-{self.first.id}',
+        ])
+        self.assertEqual(len(rows), 3)
+
+    def test_failed_build_resumes_after_the_last_finished_chunk(self):
+        earnings = [self.earn(self.first, 100) for _ in range(5)]
+        batch, created = payouts.start(self.cutoff)
+        self.assertTrue(created)
+        reconcile = counters.reconcile
+        calls = []
+
+        def fail_second_chunk(provider_ids):
+            calls.append(provider_ids)
+            if len(calls) == 2:
+                raise OperationalError('connection lost')
+            return reconcile(provider_ids)
+
+        with mock.patch.object(payouts, 'CHUNK_SIZE', 2), \
+                mock.patch.object(payouts.counters, 'reconcile', side_effect=fail_second_chunk):
+            with self.assertRaises(OperationalError):
+                payouts.build(batch)
+        batch.refresh_from_db()
+        self.assertEqual((batch.status, batch.last_earning_id), ('building', earnings[1].id))
+        self.assertEqual(ProviderEarnings.objects.filter(payout_status='processing').count(), 2)
+
+        resumed, created = payouts.start(self.cutoff)
+        self.assertEqual((resumed.id, created), (batch.id, False))
+        with mock.patch.object(payouts, 'CHUNK_SIZE', 2):
+            self.assertEqual(payouts.build(resumed)['claimed'], 3)
+        self.assertEqual((resumed.status, resumed.earnings_count, resumed.total_amount), ('ready', 5, Decimal('500')))
+        with self.assertRaises(ValueError):
+            payouts.build(resumed)
+
+    def test_settle_marks_paid_and_returns_bounced_transfers(self):
+        paid = self.earn(self.first, 400)
+        bounced = self.earn(self.second, 250)
+        batch, _ = payouts.run(self.cutoff)
+
+        self.assertEqual(payouts.settle(batch, returned_provider_ids=[self.second.id]), 1)
+        paid.refresh_from_db()
+        bounced.refresh_from_db()
+        self.assertEqual(paid.payout_status, 'paid')
+        self.assertIsNotNone(paid.paid_at)
+        self.assertEqual((bounced.payout_status, bounced.payout_batch_id), ('pending', None))
+        self.assertEqual(dict(batch.lines.values_list('provider_id', 'status')), {
+            self.first.id: 'paid', self.second.id: 'returned',
+        })
+        self.assertEqual(counters.get_counters(self.second).pending_payout, Decimal('250'))
+
+        # The bounced earning goes into the next run, which can be cancelled
+        retry, stats = payouts.run(self.cutoff)
+        self.assertEqual((retry.id != batch.id, stats['claimed']), (True, 1))
+        self.assertEqual(payouts.cancel(retry), 1)
+        bounced.refresh_from_db()
+        self.assertEqual(bounced.payout_status, 'pending')
+        with self.assertRaises(ValueError):
+            payouts.transfer_file(retry)
+
+
+@override_settings(CACHES=ISOLATED_CACHE)
+class CouponTests(QueryBudgetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.service, cls.other = create_catalog(categories=2, services_per_category=1)
+        cls.customer = User.objects.create(username='coupon_customer')
+        cls.day = date.today() + timedelta(days=1)
+
+    def setUp(self):
+        cache.clear()
+        slots._index.clear()
+
+    def coupon(self, code, **fields):
+        now = timezone.now()
+        fields = {
+            'description': f'{code} offer', 'coupon_type': 'percentage', 'discount_value': 10,
+            'valid_from': now - timedelta(days=1), 'valid_to': now + timedelta(days=1), **fields,
+        }
+        return Coupon.objects.create(code=code, **fields)
+
+    def book(self, amount=1000, user=None, at=10, service=None):
+        service = service or self.service
+        return Booking.objects.create(
+            service=service, provider=service.provider, user=user or self.customer, customer_name='Anu',
+            customer_email='anu@example.com', customer_phone='9876543210', customer_address='Kochi',
+            booking_date=self.day, booking_time=time(at), total_amount=Decimal(amount),
+        )
+
+    def test_deleting_a_booking_gives_the_use_back(self):
+        coupon = self.coupon('THRICE', per_user_limit=3)
+        first = self.book(at=9)
+        coupons.apply(first, 'THRICE')
+        coupons.apply(self.book(at=11), 'THRICE')
+        first.delete()
+        coupon.refresh_from_db()
+        self.assertEqual(coupon.used_count, 1)
+
+        # The deleted booking's number is free again, and the limit still holds
+        coupons.apply(self.book(at=13), 'THRICE')
+        coupons.apply(self.book(at=15), 'THRICE')
+        with self.assertRaisesMessage(coupons.CouponError, 'You have already used THRICE'):
+            coupons.apply(self.book(at=17), 'THRICE')
+        self.assertEqual(
+            sorted(CouponRedemption.objects.filter(coupon=coupon).values_list('sequence', flat=True)), [1, 2, 3],
+        )
+        coupon.refresh_from_db()
+        self.assertEqual(coupon.used_count, 3)
+
+    def test_every_rule_is_evaluated(self):
+        self.coupon('CAPPED', discount_value=20, max_discount=150)
+        self.coupon('FLAT', coupon_type='fixed', discount_value=300, min_order_value=800)
+        self.coupon('ELSEWHERE').applicable_categories.add(self.other.category)
+        self.coupon('WELCOME', coupon_type='first_booking', discount_value=50)
+        self.coupon('LATER', valid_from=timezone.now() + timedelta(days=1), valid_to=timezone.now() + timedelta(days=2))
+
+        self.assertEqual(coupons.evaluate(' capped ', self.service, Decimal(1000))[1], Decimal(150))
+        self.assertEqual(coupons.evaluate('FLAT', self.service, Decimal(800))[1], Decimal(300))
+        self.assertEqual(coupons.evaluate('ELSEWHERE', self.other, Decimal(1000))[1], Decimal(100))
+        for code, amount in (('FLAT', 799), ('ELSEWHERE', 1000), ('LATER', 1000), ('NOPE', 1000)):
+            with self.subTest(code=code), self.assertRaises(coupons.CouponError):
+                coupons.evaluate(code, self.service, Decimal(amount))
+        self.assertEqual({rule.code for rule in coupons.for_service(self.service)}, {'WELCOME', 'FLAT', 'CAPPED'})
+
+        self.assertEqual(coupons.apply(self.book(), 'WELCOME'), Decimal(500))
+        with self.assertRaises(coupons.CouponError):
+            coupons.apply(self.book(at=12), 'WELCOME')
+
+    def test_redemption_is_recorded_and_the_per_user_limit_enforced(self):
+        coupon = self.coupon('TWICE', per_user_limit=2, max_discount=None)
+        first, second, third = self.book(), self.book(at=12), self.book(at=14)
+        coupons.apply(first, 'TWICE')
+        coupons.apply(second, 'twice')
+        with self.assertRaises(coupons.CouponError):
+            coupons.apply(third, 'TWICE')
+
+        first.refresh_from_db()
+        third.refresh_from_db()
+        self.assertEqual((first.total_amount, third.total_amount), (Decimal(900), Decimal(1000)))
+        self.assertEqual(list(coupon.redemptions.order_by('sequence').values_list('booking_id', 'sequence')), [(first.id, 1), (second.id, 2)])
+        coupon.refresh_from_db()
+        self.assertEqual(coupon.used_count, 2)
+
+        # A redemption racing for the same use breaks the unique sequence
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            CouponRedemption.objects.create(coupon=coupon, user=self.customer, booking=third, sequence=2,
+                                            order_value=1000, discount_amount=100)
+
+    def test_usage_limit_is_never_oversubscribed(self):
+        coupon = self.coupon('FLASH', usage_limit=2)
+        customers = [User.objects.create(username=f'flash_{i}') for i in range(3)]
+        bookings = [self.book(user=customer, at=9 + 2 * i) for i, customer in enumerate(customers)]
+        coupons.apply(bookings[0], 'FLASH')
+        coupons.apply(bookings[1], 'FLASH')
+        with self.assertRaisesMessage(coupons.CouponError, 'fully redeemed'):
+            coupons.apply(bookings[2], 'FLASH')
+        coupon.refresh_from_db()
+        self.assertEqual((coupon.used_count, coupon.redemptions.count()), (2, 2))
+
+    def test_index_follows_coupon_changes_but_not_redemptions(self):
+        coupon = self.coupon('SUMMER')
+        coupons.rules()
+        coupons.apply(self.book(), 'SUMMER')
+        with self.assertNumQueries(0):
+            coupons.rules()
+
+        coupon.applicable_services.add(self.other)
+        with self.assertRaises(coupons.CouponError):
+            coupons.evaluate('SUMMER', self.service, Decimal(1000))
+        coupon.applicable_services.clear()
+        coupon.is_active = False
+        coupon.save()
+        self.assertNotIn('SUMMER', coupons.rules().by_code)
+
+    def test_applying_costs_the_same_queries_however_many_coupons_exist(self):
+        for i in range(30):
+            self.coupon(f'BULK{i}').applicable_services.add(self.other)
+        self.coupon('ONE')
+        coupons.rules()
+        booking = self.book()
+        with self.assertMaxQueries(6):
+            coupons.apply(booking, 'ONE')
+
+    def test_booking_api_applies_the_coupon(self):
+        self.coupon('API10')
+        self.client.force_login(self.customer)
+        data = {'service_id': self.service.id, **booking_form(self.day, '10:00'), 'total_amount': 500}
+
+        response = self.client.post('/api/bookings/', {**data, 'coupon_code': 'WRONG'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('coupon_code', response.json())
+        self.assertFalse(Booking.objects.exists())
+
+        response = self.client.post('/api/bookings/', {**data, 'coupon_code': 'API10'})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Decimal(response.json()['total_amount']), Decimal(450))
+
+        offers = self.client.get(f'/api/services/{self.service.id}/coupons/', {'amount': '200'}).json()
+        self.assertEqual([(offer['code'], offer['discount']) for offer in offers], [('API10', '20.00')])
+        self.assertEqual(self.client.get(f'/api/services/{self.service.id}/coupons/', {'amount': 'x'}).status_code, 400)
+
+    def test_booking_form_applies_the_coupon_to_booking_and_payment(self):
+        self.coupon('FORM', coupon_type='fixed', discount_value=50)
+        self.client.force_login(self.customer)
+        url = f'/book/{self.service.id}/'
+        self.assertContains(self.client.get(url), 'FORM')
+
+        response = self.client.post(url, {**booking_form(self.day, '10:00'), 'coupon_code': 'NOPE'})
+        self.assertContains(response, 'invalid or has expired')
+        self.assertEqual(self.client.post(url, {**booking_form(self.day, '10:00'), 'coupon_code': 'form'}).status_code,
+                         302)
+        booking = Booking.objects.get()
+        self.assertEqual(booking.total_amount, self.service.price - 50)
+        self.assertEqual(booking.payment.amount, booking.total_amount)
+
+
+@override_settings(CACHES=ISOLATED_CACHE)
+class LoyaltyTests(QueryBudgetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.service = create_catalog(categories=1, services_per_category=1)[0]
+        cls.customers = [User.objects.create(username=f'loyal_{i}') for i in range(3)]
+
+    def setUp(self):
+        cache.clear()
+
+    def complete(self, user, amount, hours_ago=1, status='completed'):
+        return Booking.objects.create(
+            service=self.service, provider=self.service.provider, user=user, customer_name=user.username,
+            customer_email='anu@example.com', customer_phone='9876543210', customer_address='Kochi',
+            booking_date=date.today(), booking_time=time(10), total_amount=Decimal(amount), status=status,
+            completed_at=timezone.now() - timedelta(hours=hours_ago) if status == 'completed' else None,
+        )
+
+    def test_accrual_awards_each_completed_booking_once(self):
+        first, second, third = self.customers
+        LoyaltyPoints.objects.create(user=first, points=1990, total_earned=1990)
+        self.complete(first, 150)
+        self.complete(first, 95)
+        self.complete(second, 2000)
+        self.complete(third, 5000, status='confirmed')
+
+        stats = loyalty.accrue()
+        self.assertEqual((stats['bookings'], stats['customers'], stats['points']), (3, 2, 224))
+        self.assertEqual(
+            list(LoyaltyPoints.objects.order_by('user_id').values_list('user_id', 'points', 'tier')),
+            [(first.id, 2014, 'silver'), (second.id, 200, 'bronze')],
+        )
+        self.assertEqual(loyalty.accrue(), Counter(bookings=0, customers=0, points=0))
+
+        # Only bookings completed since the last run are read, plus those completed in the LATE_COMMITS window
+        self.complete(third, 300, hours_ago=24 * 30)
+        late = self.complete(third, 400, hours_ago=0)
+        Booking.objects.filter(pk=late.pk).update(completed_at=timezone.now() - loyalty.LATE_COMMITS / 2)
+        self.assertEqual(loyalty.accrue()['points'], 40)
+        self.assertEqual(LoyaltyEvent.objects.get(user=third).booking, late)
+
+    def test_accrual_queries_do_not_grow_with_bookings(self):
+        for i in range(40):
+            self.complete(self.customers[i % 3], 100 + 10 * i)
+        with self.assertMaxQueries(14):
+            stats = loyalty.accrue()
+        self.assertEqual(stats['bookings'], 40)
+        self.assertEqual(loyalty.audit(), [])
+
+    def test_balances_add_up_from_the_ledger(self):
+        account = LoyaltyPoints.objects.create(user=self.customers[0])
+        account.add_points(5000, 'Welcome bonus')
+        self.assertEqual((account.points, account.tier), (5000, 'gold'))
+        self.assertTrue(account.redeem_points(1200))
+        self.assertFalse(account.redeem_points(4000))
+        self.assertEqual((account.points, account.total_redeemed), (3800, 1200))
+        self.assertEqual(
+            list(account.user.loyalty_events.order_by('id').values_list('event_type', 'points', 'description')),
+            [('earned', 5000, 'Welcome bonus'), ('redeemed', -1200, 'Points redeemed')],
+        )
+        self.assertEqual(loyalty.audit(), [])
+
+        LoyaltyPoints.objects.filter(pk=account.pk).update(points=9999)
+        self.assertEqual(loyalty.audit(), [(account.user_id, 9999, 3800, 5000, 5000)])
+
+    def test_command_reports_the_run(self):
+        self.complete(self.customers[0], 500)
+        out = StringIO()
+        call_command('accrue_loyalty_points', '--audit', stdout=out)
+        self.assertIn('Awarded 50 points for 1 booking(s) to 1 customer(s)', out.getvalue())
+        self.assertIn('Every balance matches the ledger', out.getvalue())
+
+
+def read_export(directory, label):
+    with gzip.open(os.path.join(directory, f'{label}.jsonl.gz'), 'rt', encoding='utf-8') as handle:
+        return [json.loads(line) for line in handle]
+
+
+@override_settings(CACHES=ISOLATED_CACHE)
+class DataExportTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.services = create_catalog(categories=2, services_per_category=2)
+        customer = User.objects.create(username='export_customer')
+        for i, service in enumerate(cls.services):
+            Booking.objects.create(
+                service=service, provider=service.provider, user=customer, customer_name='Anu',
+                customer_email='anu@example.com', customer_phone='9876543210', customer_address='Kochi',
+                booking_date=date.today(), booking_time=time(9 + i), total_amount=500,
+            )
+
+    def setUp(self):
+        cache.clear()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_each_model_is_streamed_to_its_own_file_and_loads_back(self):
+        directory, manifest, exported = exports.run(self.directory, chunk_size=2)
+        self.assertEqual(directory, os.path.join(self.directory, manifest['run']))
+        self.assertIsNotNone(manifest['finished_at'])
+        self.assertEqual(exported, list(manifest['models']))
+        self.assertNotIn('contenttypes.contenttype', exported)
+        self.assertLess(exported.index('services.service'), exported.index('services.booking'))
+        self.assertEqual(manifest['models']['services.booking']['rows'], 4)
+        self.assertIsNone(manifest['models']['services.review']['file'])
+
+        rows = read_export(directory, 'services.booking')
+        self.assertEqual([row['model'] for row in rows], ['services.booking'] * 4)
+        self.assertEqual(rows[0]['fields']['user'], ['export_customer'])
+
+        Booking.objects.all().delete()
+        call_command('loaddata', os.path.join(directory, 'services.booking.jsonl.gz'), verbosity=0)
+        self.assertEqual(Booking.objects.count(), 4)
+
+    def test_incremental_export_only_writes_changed_rows(self):
+        exports.run(self.directory, labels={'services', 'auth.user'})
+        # A full export over some models leaves the watermark alone
+        self.assertIsNone(JobWatermark.get_position(exports.WATERMARK))
+        full, _, _ = exports.run(self.directory)
+        since = JobWatermark.get_position(exports.WATERMARK)
+        self.assertIsNotNone(since)
+
+        long_ago = since - timedelta(days=1)
+        Booking.objects.update(updated_at=long_ago)
+        Service.objects.update(updated_at=long_ago)
+        changed = Booking.objects.first()
+        changed.notes = 'Ring twice'
+        changed.save()
+
+        directory, manifest, _ = exports.run(self.directory, incremental=True)
+        self.assertNotEqual(directory, full)
+        self.assertEqual(manifest['since'], since.isoformat())
+        self.assertEqual([row['pk'] for row in read_export(directory, 'services.booking')], [changed.pk])
+        self.assertEqual(manifest['models']['services.service']['rows'], 0)
+        self.assertFalse(os.path.exists(os.path.join(directory, 'services.service.jsonl.gz')))
+        # Models without a timestamp are exported in full
+        self.assertEqual(manifest['models']['auth.user']['rows'], User.objects.count())
+
+        # The full export is left as it was
+        self.assertEqual(len(read_export(full, 'services.booking')), 4)
+        self.assertEqual(len(read_export(full, 'services.service')), 4)
+        self.assertIsNone(exports.read_manifest(full)['since'])
+
+    def test_unfinished_export_is_resumed(self):
+        export_model = exports.export_model
+
+        def fail_on_bookings(label, *args):
+            if label == 'services.booking':
+                raise OperationalError('disk I/O error')
+            return export_model(label, *args)
+
+        with mock.patch('services.exports.export_model', side_effect=fail_on_bookings):
+            with self.assertRaises(OperationalError):
+                exports.run(self.directory)
+        directory, unfinished = exports.latest_run(self.directory)
+        self.assertIsNone(unfinished['finished_at'])
+        self.assertEqual(unfinished['models']['services.booking']['status'], 'pending')
+        self.assertFalse(os.path.exists(os.path.join(directory, 'services.booking.jsonl.gz')))
+
+        out = StringIO()
+        call_command('export_data', '--output', self.directory, '--workers', '1', stdout=out)
+        self.assertIn('Resuming the export', out.getvalue())
+        self.assertEqual(os.listdir(self.directory), [unfinished['run']])
+        manifest = exports.read_manifest(directory)
+        self.assertEqual(manifest['started_at'], unfinished['started_at'])
+        self.assertEqual(manifest['models']['services.booking']['rows'], 4)
+        self.assertEqual({entry['status'] for entry in manifest['models'].values()}, {'done'})
+
+
+@override_settings(CACHES=ISOLATED_CACHE)
+class ParallelDataExportTests(TransactionTestCase):
+    def test_workers_export_the_same_rows(self):
+        create_catalog(categories=3, services_per_category=3)
+        counts = []
+        for workers in (1, 4):
+            with tempfile.TemporaryDirectory() as directory:
+                _, manifest, _ = exports.run(directory, workers=workers, chunk_size=4)
+                # The first run's watermark is itself a row the second run exports
+                counts.append({
+                    label: entry['rows'] for label, entry in manifest['models'].items() if label != 'services.jobwatermark'
+                })
+        self.assertEqual(counts[0], counts[1])
+        self.assertEqual(counts[1]['services.service'], 9)
+
+
+@override_settings(CACHES=ISOLATED_CACHE)
+class RecurringMaterializerTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.service = create_catalog(categories=1, services_per_category=1)[0]
+        cls.customer = User.objects.create(username='subscriber', email='subscriber@example.com')
+        cls.start = date.today() + timedelta(days=1)
+
+    def subscribe(self, **fields):
+        return RecurringBooking.objects.create(**{
+            'customer': self.customer, 'service': self.service, 'provider': self.service.provider,
+            'frequency': 'weekly', 'start_date': self.start, 'next_booking_date': self.start,
+            'preferred_time': time(10), 'total_amount': 500, **fields,
+        })
+
+    def test_materializes_next_occurrences_once(self):
+        subscription = self.subscribe()
+        stats = recurring.run(days=28, occurrences=4)
+        self.assertEqual((stats['subscriptions'], stats['created']), (1, 4))
+        self.assertEqual(
+            list(subscription.bookings.order_by('booking_date').values_list('booking_date', flat=True)),
+            [self.start + timedelta(weeks=week) for week in range(4)],
+        )
+        subscription.refresh_from_db()
+        self.assertEqual(subscription.next_booking_date, self.start + timedelta(weeks=4))
+        self.assertEqual(BookingSlotClaim.objects.count(), 8)
+        self.assertEqual(self.service.provider.counters.bookings_pending, 4)
+
+        self.assertEqual(recurring.run(days=28, occurrences=4)['created'], 0)
+        self.assertEqual(recurring.run(days=35, occurrences=4)['created'], 1)
+        self.assertEqual(Booking.objects.count(), 5)
+
+    def test_queries_per_batch_do_not_grow_with_subscriptions(self):
+        for _ in range(10):
+            self.subscribe(frequency='daily')
+        # Per batch: fetch, leaves, claims, two inserts, one update, counters; plus the final empty fetch
+        with CaptureQueriesContext(connection) as context:
+            stats = recurring.run(days=7, occurrences=2, batch_size=5)
+        self.assertEqual((stats['subscriptions'], stats['created']), (10, 2))
+        self.assertEqual(stats['taken'], 18)
+        self.assertLessEqual(len(context.captured_queries), 2 * 15 + 1)
+
+    def test_skips_leave_and_taken_times_and_ends(self):
+        subscription = self.subscribe(end_date=self.start + timedelta(weeks=2))
+        ProviderLeave.objects.create(
+            provider=self.service.provider, leave_type='vacation', start_date=self.start, end_date=self.start,
+        )
+        self.client.force_login(self.customer)
+        self.client.post('/api/bookings/', {
+            'service_id': self.service.id, **booking_form(self.start + timedelta(weeks=1), '10:30'),
+            'total_amount': 500,
+        })
+
+        stats = recurring.run(days=28, occurrences=4)
+        self.assertEqual((stats['created'], stats['on_leave'], stats['taken']), (1, 1, 1))
+        subscription.refresh_from_db()
+        self.assertFalse(subscription.is_active)
+        self.assertEqual(subscription.bookings.get().booking_date, self.start + timedelta(weeks=2))
+
+    def test_monthly_occurrences_keep_their_day(self):
+        subscription = RecurringBooking(frequency='monthly', start_date=date(2025, 1, 31))
+        days = [date(2025, 1, 31)]
+        for _ in range(3):
+            days.append(recurring.next_occurrence(subscription, days[-1]))
+        self.assertEqual(days, [date(2025, 1, 31), date(2025, 2, 28), date(2025, 3, 31), date(2025, 4, 30)])
+
+    def test_command_reports_created_bookings(self):
+        self.subscribe(frequency='daily')
+        out = StringIO()
+        call_command('materialize_recurring_bookings', '--days', '7', '--occurrences', '3', stdout=out)
+        self.assertIn('Created 3 booking(s) for 1 recurring booking(s)', out.getvalue())
+
+
+class ProviderStatsRollupTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.service, cls.other_service = create_catalog(categories=1, services_per_category=2)
+        cls.provider = cls.service.provider
+        cls.customer = User.objects.create(username='rollup_customer')
+
+    def book(self, created_at, status='pending', **fields):
+        return Booking.objects.create(
+            user=self.customer, provider=self.provider, service=self.service,
+            customer_name='Customer', customer_email='customer@homeserve.com', customer_phone='9876543210',
+            customer_address='MG Road', booking_date=created_at.date(), booking_time=time(10), total_amount=500,
+            status=status, created_at=created_at, **fields,
+        )
+
+    def stats(self, period, day):
+        return ProviderStats.objects.get(provider=self.provider, period=period, date=day)
+
+    def test_rollup_builds_daily_weekly_and_monthly_rows(self):
+        monday = timezone.make_aware(datetime(2026, 3, 30, 9))
+        wednesday = monday + timedelta(days=2)
+        self.book(monday, 'completed', confirmed_at=monday + timedelta(minutes=30),
+                  completed_at=monday + timedelta(hours=3))
+        booking = self.book(wednesday, 'completed', confirmed_at=wednesday + timedelta(minutes=90),
+                            completed_at=wednesday + timedelta(hours=2))
+        Review.objects.create(booking=booking, provider=self.provider, customer=self.customer,
+                              rating=4, created_at=wednesday + timedelta(hours=5))
+
+        rollups.run()
+
+        day = self.stats('day', date(2026, 3, 30))
+        self.assertEqual((day.bookings_received, day.bookings_completed, day.average_response_time), (1, 1, 30))
+        week = self.stats('week', date(2026, 3, 30))
+        self.assertEqual((week.bookings_received, week.reviews_received, week.average_response_time), (2, 1, 60))
+        self.assertEqual(week.average_rating_day, Decimal('4.00'))
+        self.assertEqual(self.stats('month', date(2026, 3, 1)).bookings_received, 1)
+        self.assertEqual(self.stats('month', date(2026, 4, 1)).bookings_received, 1)
+        self.assertIsNotNone(JobWatermark.get_position(rollups.WATERMARK))
+
+    def test_incremental_run_only_revisits_changed_providers(self):
+        created_at = timezone.now() - timedelta(days=3)
+        booking = self.book(created_at)
+        rollups.run()
+        self.assertEqual(rollups.run(), ([], 0))
+
+        booking.status = 'cancelled'
+        booking.save()
+        provider_ids, _ = rollups.run()
+        self.assertEqual(provider_ids, [self.provider.id])
+        self.assertEqual(self.stats('day', timezone.localdate()).bookings_cancelled, 1)
+        self.assertFalse(ProviderStats.objects.filter(provider=self.other_service.provider).exists())
+
+    def test_incremental_run_recomputes_weeks_that_straddle_a_month(self):
+        days = [datetime(2025, 9, 29, 9), datetime(2025, 9, 30, 9), datetime(2025, 10, 1, 9), datetime(2025, 10, 8, 9)]
+        bookings = [self.book(timezone.make_aware(day)) for day in days]
+        rollups.run(full=True)
+        self.assertEqual(self.stats('week', date(2025, 9, 29)).bookings_received, 3)
+
+        bookings[-1].customer_address = 'Marine Drive'
+        bookings[-1].save()
+        rollups.run()
+        # From Oct 8 the run reaches back to Oct 1, then Monday Sep 29, then Sep 1 (a Monday)
+        self.assertEqual(self.stats('week', date(2025, 9, 29)).bookings_received, 3)
+        self.assertEqual(self.stats('month', date(2025, 9, 1)).bookings_received, 2)
+        self.assertEqual(self.stats('month', date(2025, 10, 1)).bookings_received, 2)
+        self.assertEqual(rollups.aligned_start(date(2025, 10, 8)), date(2025, 9, 1))
+
+
+# ====================== ENDPOINT QUERY BUDGETS ======================
+#
+# Seeds a realistic dataset and records queries, wall time and response size
+# for every route in services/urls.py, provider_urls.py and frontend_urls.py.
+# The default scale keeps the suite fast; for release benchmarking run e.g.
+#
+#   HOMESERVE_BENCHMARK_SCALE=100 python manage.py test services.tests.EndpointBudgetTests
+#
+# which seeds ~2000 providers, ~6000 services and ~20000 bookings.
+
+BENCHMARK_SCALE = int(os.environ.get('HOMESERVE_BENCHMARK_SCALE', '1'))
+
+# Multiplier applied to every wall-time budget (slow CI machines can raise it)
+BENCHMARK_TIME_FACTOR = float(os.environ.get('HOMESERVE_BENCHMARK_TIME_FACTOR', '1'))
+
+# Wall-time budget of a month-end payout run per unit of scale (20 providers)
+PAYOUT_RUN_SECONDS = 0.5
+# ... and of the loyalty accrual over every completed booking
+LOYALTY_ACCRUAL_SECONDS = 0.5
+
+KERALA_DISTRICTS = [
+    'Thiruvananthapuram', 'Kollam', 'Pathanamthitta', 'Alappuzha', 'Kottayam', 'Idukki', 'Ernakulam',
+    'Thrissur', 'Palakkad', 'Malappuram', 'Kozhikode', 'Wayanad', 'Kannur', 'Kasaragod',
+]
+
+BENCHMARK_CATEGORIES = [
+    ('Plumbing', 'Professional plumbing services for homes and offices', '🔧'),
+    ('Electrical Work', 'Licensed electricians for all electrical needs', '⚡'),
+    ('Home Cleaning', 'Professional cleaning services for residential spaces', '🧹'),
+    ('AC Repair', 'Air conditioning installation and repair services', '❄️'),
+    ('Carpentry', 'Custom woodwork and furniture repair', '🪚'),
+    ('Painting', 'Interior and exterior painting', '🎨'),
+    ('Pest Control', 'Professional pest control services', '🐜'),
+    ('Landscaping', 'Garden and lawn maintenance', '🌿'),
+]
+
+BOOKING_STATUSES = ['pending', 'confirmed', 'in_progress', 'completed', 'completed', 'cancelled']
+
+
+def seed_dataset(scale=BENCHMARK_SCALE):
+    """
+    Bulk-create a marketplace dataset shaped like create_test_data.py and
+    populate_all_features.py. Returns the objects the endpoint table refers to.
+    """
+    providers_count = 20 * scale
+    customers_count = 20 * scale
+    services_per_provider = 3
+    bookings_per_provider = 10
+    today = date.today()
+    now = timezone.now()
+
+    categories = ServiceCategory.objects.bulk_create([
+        ServiceCategory(name=name, description=description, icon=icon)
+        for name, description, icon in BENCHMARK_CATEGORIES
+    ])
+
+    customers = User.objects.bulk_create([
+        User(username=f'customer{i}', email=f'customer{i}@example.com', first_name='Customer', last_name=str(i))
+        for i in range(customers_count)
+    ])
+    provider_users = User.objects.bulk_create([
+        User(username=f'provider{i}', email=f'provider{i}@homeserve.com', first_name='Provider', last_name=str(i))
+        for i in range(providers_count)
+    ])
+
+    def location(i):
+        # Spread each district's providers over a few kilometres around its centroid
+        latitude, longitude = geo.locate('', KERALA_DISTRICTS[i % len(KERALA_DISTRICTS)])
+        step = i // len(KERALA_DISTRICTS)
+        return {
+            'latitude': Decimal(f'{latitude + step % 7 * 0.005:.6f}'),
+            'longitude': Decimal(f'{longitude + step // 7 % 7 * 0.005:.6f}'),
+        }
+
+    providers = ServiceProvider.objects.bulk_create([
+        ServiceProvider(
+            user=user,
+            business_name=f'{KERALA_DISTRICTS[i % len(KERALA_DISTRICTS)]} Home Services {i}',
+            contact_number=f'98{i:08d}',
+            email=user.email,
+            address=f'{i + 100} MG Road',
+            city=KERALA_DISTRICTS[i % len(KERALA_DISTRICTS)],
+            state='Kerala',
+            pincode=f'{680001 + i % 100}',
+            **location(i),
+            experience_years=i % 15,
+            bio='Professional home services with experienced technicians',
+            verification_status='verified' if i % 10 else 'pending',
+            verified_at=now,
+            average_rating=Decimal('4.50'),
+            total_reviews=0,
+            # Every tenth provider has not given bank details yet
+            bank_account_name=f'Provider {i}' if i % 10 != 3 else '',
+            bank_account_number=f'{5010000000 + i}' if i % 10 != 3 else '',
+            bank_ifsc=f'SBIN00{i % 100000:05d}' if i % 10 != 3 else '',
+        )
+        for i, user in enumerate(provider_users)
+    ])
+
+    services = Service.objects.bulk_create([
+        Service(
+            provider=provider,
+            category=categories[(i + s) % len(categories)],
+            title=f'{categories[(i + s) % len(categories)].name} Service {i}-{s}',
+            description='Quick response, experienced technicians and a service warranty',
+            pricing_type=['fixed', 'hourly', 'negotiable'][s % 3],
+            price=Decimal(500 + 100 * s),
+            duration_minutes=60 + 30 * s,
+            approval_status='approved' if (i + s) % 7 else 'pending',
+            is_emergency_available=s == 0,
+        )
+        for i, provider in enumerate(providers)
+        for s in range(services_per_provider)
+    ])
+
+    bookings = Booking.objects.bulk_create([
+        Booking(
+            service=services[p * services_per_provider + b % services_per_provider],
+            provider=provider,
+            user=customers[(p + b) % customers_count],
+            customer_name=customers[(p + b) % customers_count].username,
+            customer_email=customers[(p + b) % customers_count].email,
+            customer_phone='9876543210',
+            customer_address='321 Customer Street, Kochi',
+            booking_date=today + timedelta(days=b - bookings_per_provider // 2),
+            booking_time=time(9 + b % 8, 0),
+            status=BOOKING_STATUSES[b % len(BOOKING_STATUSES)],
+            total_amount=Decimal(500 + 100 * (b % services_per_provider)),
+            is_emergency=b % 9 == 0,
+            created_at=now - timedelta(days=bookings_per_provider - b, minutes=p),
+        )
+        for p, provider in enumerate(providers)
+        for b in range(bookings_per_provider)
+    ])
+    completed = [booking for booking in bookings if booking.status == 'completed']
+
+    payments = Payment.objects.bulk_create([
+        Payment(
+            booking=booking,
+            user=booking.user,
+            amount=booking.total_amount,
+            payment_method='upi',
+            status='completed',
+            transaction_id=f'TXN{booking.id}',
+            provider_amount=booking.total_amount * Decimal('0.85'),
+            paid_at=now,
+        )
+        for booking in completed
+    ])
+    ProviderEarnings.objects.bulk_create([
+        ProviderEarnings(
+            provider=payment.booking.provider,
+            booking=payment.booking,
+            payment=payment,
+            gross_amount=payment.amount,
+            commission_percentage=Decimal('15.00'),
+            commission_amount=payment.amount * Decimal('0.15'),
+            net_amount=payment.provider_amount,
+            payout_status=['pending', 'paid'][i % 2],
+        )
+        for i, payment in enumerate(payments)
+    ])
+    Review.objects.bulk_create([
+        Review(
+            booking=booking,
+            provider=booking.provider,
+            customer=booking.user,
+            rating=1 + i % 5,
+            review_text='Good work, arrived on time',
+        )
+        for i, booking in enumerate(completed)
+    ])
+    Message.objects.bulk_create([
+        Message(
+            booking=booking,
+            sender=sender,
+            receiver=receiver,
+            message_text='Please confirm the visit time',
+            is_read=i % 3 == 0,
+        )
+        for i, booking in enumerate(bookings)
+        for sender, receiver in [(booking.user, booking.provider.user), (booking.provider.user, booking.user)]
+    ])
+    Notification.objects.bulk_create([
+        Notification(
+            user=user,
+            notification_type='booking',
+            title='Booking update',
+            message='Your booking status changed',
+            is_read=i % 2 == 0,
+        )
+        for user in customers + provider_users
+        for i in range(3)
+    ])
+    Wallet.objects.bulk_create([Wallet(user=user, balance=Decimal('500.00')) for user in customers])
+    LoyaltyPoints.objects.bulk_create([LoyaltyPoints(user=user, points=100, total_earned=100) for user in customers])
+    ProviderAvailability.objects.bulk_create([
+        ProviderAvailability(provider=provider, weekday=day, start_time=time(9, 0), end_time=time(18, 0))
+        for provider in providers
+        for day in range(6)
+    ])
+    ProviderLeave.objects.bulk_create([
+        ProviderLeave(
+            provider=provider,
+            leave_type='personal',
+            start_date=today + timedelta(days=20),
+            end_date=today + timedelta(days=22),
+        )
+        for provider in providers
+    ])
+    ServiceRequest.objects.bulk_create([
+        ServiceRequest(
+            customer=customer,
+            category=categories[i % len(categories)],
+            title='Need urgent help',
+            description='Water leaking from the ceiling',
+            urgency=['low', 'medium', 'high', 'emergency'][i % 4],
+            address='321 Customer Street',
+            city=KERALA_DISTRICTS[i % len(KERALA_DISTRICTS)],
+            pincode='682001',
+        )
+        for i, customer in enumerate(customers)
+    ])
+    ProviderPortfolio.objects.bulk_create([
+        ProviderPortfolio(provider=provider, title='Recent work', image='portfolio/work.jpg')
+        for provider in providers
+    ])
+
+    # bulk_create bypasses the signal handlers that maintain derived data
+    search.rebuild_index()
+    counters.reconcile()
+    ratings.recompute()
+    conversations.reconcile()
+    geo.backfill()
+    matching.run()
+    dispatch.backfill()
+    slots.forget(*(provider.id for provider in providers))
+
+    provider = providers[1]
+    provider_bookings = [booking for booking in bookings if booking.provider_id == provider.id]
+    customer = provider_bookings[0].user
+    return {
+        'customer': customer,
+        'provider_user': provider.user,
+        'provider': provider,
+        'other_provider': providers[2],
+        'category': categories[0],
+        'service': services[services_per_provider],
+        'booking': provider_bookings[0],
+        'pending_booking': next(b for b in provider_bookings if b.status == 'pending'),
+        'confirmed_booking': next(b for b in provider_bookings if b.status == 'confirmed'),
+        'customer_booking': next(b for b in provider_bookings if b.user_id == customer.id),
+        'review': Review.objects.filter(provider=provider).first(),
+        'message': Message.objects.filter(receiver=provider.user, is_read=False).first(),
+        'conversation': Conversation.objects.get(
+            user_a_id=min(customer.id, provider.user_id), user_b_id=max(customer.id, provider.user_id)
+        ),
+        'portfolio': ProviderPortfolio.objects.filter(provider=provider).first(),
+        'service_request': ServiceRequest.objects.filter(customer=customer).first(),
+        'dispatch_job': DispatchJob.objects.order_by('priority', 'requested_at').first(),
+        'week_ahead': (today + timedelta(days=6)).isoformat(),
+    }
+
+
+class Endpoint:
+    """One route to benchmark: who calls it, how, and what it may cost"""
+
+    def __init__(self, route, path, user=None, method='get', data=None, max_queries=None,
+                 max_seconds=1.0, status=(200,)):
+        self.route = route
+        self.path = path
+        self.user = user
+        self.method = method
+        self.data = data or {}
+        self.max_queries = max_queries
+        self.max_seconds = max_seconds
+        self.status = status
+
+
+REDIRECT = (302,)
+
+# route is the URL name (namespaced for the provider portal) so coverage can be checked.
+# Saving a booking, message or earning reads its stored row back under a lock for the counters (one query each).
+ENDPOINTS = [
+    # REST API (services/urls.py)
+    Endpoint('api-root', '/api/', max_queries=0),
+    Endpoint('event-stream', '/api/events/', max_queries=0, status=(401,)),
+    Endpoint('category-list', '/api/categories/', max_queries=2),
+    Endpoint('category-detail', '/api/categories/{category.id}/', max_queries=1),
+    Endpoint('provider-list', '/api/providers/', max_queries=2),
+    Endpoint('provider-detail', '/api/providers/{provider.id}/', max_queries=2),
+    Endpoint('provider-services', '/api/providers/{provider.id}/services/', max_queries=3),
+    Endpoint('provider-reviews', '/api/providers/{provider.id}/reviews/', max_queries=2),
+    Endpoint('provider-portfolio', '/api/providers/{provider.id}/portfolio/', max_queries=2),
+    Endpoint('provider-slots', '/api/providers/{provider.id}/slots/', data={'end': '{week_ahead}'}, max_queries=5),
+    Endpoint('provider-bulk-slots', '/api/providers/slots/', data={'city': 'Ernakulam', 'end': '{week_ahead}'},
+             max_queries=5),
+    Endpoint('provider-nearby', '/api/providers/nearby/', data={'pincode': '682001', 'category': '{category.id}'},
+             max_queries=1),
+    Endpoint('service-list', '/api/services/', max_queries=3),
+    Endpoint('service-detail', '/api/services/{service.id}/', max_queries=3),
+    Endpoint('service-search', '/api/services/search/?q=plumbing', max_queries=3),
+    Endpoint('service-nearby', '/api/services/nearby/', data={'lat': '9.9658', 'lng': '76.2421', 'k': '10'},
+             max_queries=5),
+    Endpoint('service-coupons', '/api/services/{service.id}/coupons/', max_queries=5),
+    Endpoint('booking-list', '/api/bookings/', user='customer', max_queries=4),
+    Endpoint('booking-detail', '/api/bookings/{customer_booking.id}/', user='customer', max_queries=6),
+    Endpoint('booking-confirm', '/api/bookings/{pending_booking.id}/confirm/', user='provider_user',
+             method='post', max_queries=10),
+    Endpoint('booking-complete', '/api/bookings/{confirmed_booking.id}/complete/', user='provider_user',
+             method='post', max_queries=9),
+    Endpoint('booking-cancel', '/api/bookings/{customer_booking.id}/cancel/', user='customer',
+             method='post', max_queries=11),
+    Endpoint('review-list', '/api/reviews/', max_queries=1),
+    Endpoint('review-detail', '/api/reviews/{review.id}/', max_queries=2),
+    Endpoint('message-list', '/api/messages/', user='provider_user', max_queries=3),
+    Endpoint('message-detail', '/api/messages/{message.id}/', user='provider_user', max_queries=3),
+    Endpoint('message-read', '/api/messages/{message.id}/read/', user='provider_user', method='post',
+             max_queries=7),
+    Endpoint('conversation-list', '/api/conversations/', user='provider_user', max_queries=3),
+    Endpoint('conversation-detail', '/api/conversations/{conversation.id}/', user='provider_user',
+             max_queries=3),
+    Endpoint('conversation-messages', '/api/conversations/{conversation.id}/messages/', user='provider_user',
+             max_queries=4),
+    Endpoint('conversation-read', '/api/conversations/{conversation.id}/read/', user='provider_user',
+             method='post', max_queries=6),
+    Endpoint('portfolio-list', '/api/portfolio/', max_queries=2),
+    Endpoint('portfolio-detail', '/api/portfolio/{portfolio.id}/', max_queries=1),
+    Endpoint('service-request-list', '/api/service-requests/', max_queries=3),
+    Endpoint('service-request-detail', '/api/service-requests/{service_request.id}/', user='customer',
+             max_queries=4),
+    Endpoint('service-request-assign', '/api/service-requests/{service_request.id}/assign/', user='customer',
+             method='post', data={'provider_id': '{provider.id}'}, max_queries=8),
+    Endpoint('service-request-suggestions', '/api/service-requests/{service_request.id}/suggestions/',
+             user='customer', max_queries=4),
+    Endpoint('dispatch-list', '/api/dispatch/', user='provider_user', max_queries=6),
+    Endpoint('dispatch-detail', '/api/dispatch/{dispatch_job.id}/', user='provider_user', max_queries=6,
+             status=(200, 404)),
+    Endpoint('dispatch-claim', '/api/dispatch/claim/', user='provider_user', method='post', max_queries=9,
+             status=(200, 204)),
+    Endpoint('dispatch-accept', '/api/dispatch/{dispatch_job.id}/accept/', user='provider_user', method='post',
+             max_queries=6, status=(404, 409)),
+    Endpoint('dispatch-release', '/api/dispatch/{dispatch_job.id}/release/', user='provider_user', method='post',
+             max_queries=6, status=(404, 409)),
+    Endpoint('dispatch-metrics', '/api/dispatch/metrics/', user='customer', max_queries=2, status=(403,)),
+
+    # Provider portal (services/provider_urls.py)
+    Endpoint('provider:home', '/provider/', user='provider_user', max_queries=11),
+    Endpoint('provider:services', '/provider/services/', user='provider_user', max_queries=8),
+    Endpoint('provider:add_service', '/provider/services/add/', user='provider_user', max_queries=4),
+    Endpoint('provider:edit_service', '/provider/services/edit/{service.id}/', user='provider_user',
+             max_queries=6),
+    Endpoint('provider:delete_service', '/provider/services/delete/{service.id}/', user='provider_user',
+             max_queries=5),
+    Endpoint('provider:bookings', '/provider/bookings/', user='provider_user', max_queries=25),
+    Endpoint('provider:confirm_booking', '/provider/bookings/{pending_booking.id}/confirm/',
+             user='provider_user', max_queries=8, status=REDIRECT),
+    Endpoint('provider:complete_booking', '/provider/bookings/{confirmed_booking.id}/complete/',
+             user='provider_user', max_queries=8, status=REDIRECT),
+    Endpoint('provider:cancel_booking', '/provider/bookings/{pending_booking.id}/cancel/',
+             user='provider_user', max_queries=9, status=REDIRECT),
+    Endpoint('provider:booking_detail', '/provider/bookings/{booking.id}/', user='provider_user',
+             max_queries=8),
+    Endpoint('provider:earnings', '/provider/earnings/', user='provider_user', max_queries=15),
+    Endpoint('provider:messages', '/provider/messages/', user='provider_user', max_queries=5),
+    Endpoint('provider:calendar', '/provider/calendar/', user='provider_user', max_queries=8),
+    Endpoint('provider:set_availability', '/provider/calendar/set-availability/', user='provider_user',
+             max_queries=3),
+    Endpoint('provider:add_leave', '/provider/calendar/add-leave/', user='provider_user', max_queries=3),
+    Endpoint('provider:profile', '/provider/profile/', user='provider_user', max_queries=4),
+    Endpoint('provider:edit_profile', '/provider/profile/edit/', user='provider_user', max_queries=3),
+    Endpoint('provider:change_password', '/provider/profile/change-password/', user='provider_user',
+             max_queries=3),
+    Endpoint('provider:reviews', '/provider/reviews/', user='provider_user', max_queries=14),
+
+    # Frontend pages (services/frontend_urls.py)
+    Endpoint('home', '/', max_queries=3),
+    Endpoint('services', '/services/', max_queries=3),
+    Endpoint('how_it_works', '/how-it-works/', max_queries=0),
+    # Two: the provider and category ids are read first so the page depends on them before the full read
+    Endpoint('service_detail', '/service/{service.id}/', max_queries=2),
+    Endpoint('provider_detail', '/provider/{other_provider.id}/', max_queries=5),
+    Endpoint('book_service', '/book/{service.id}/', user='customer', max_queries=4),
+    Endpoint('booking_confirmation', '/booking/confirmation/{customer_booking.id}/', user='customer',
+             max_queries=6),
+    Endpoint('dashboard', '/dashboard/', user='customer', max_queries=2, status=REDIRECT),
+    Endpoint('provider_dashboard', '/dashboard/provider/', user='provider_user', max_queries=29),
+    Endpoint('customer_dashboard', '/dashboard/customer/', user='customer', max_queries=30),
+    Endpoint('provider_confirm_booking', '/dashboard/provider/booking/{pending_booking.id}/confirm/',
+             user='provider_user', method='post', max_queries=7, status=REDIRECT),
+    Endpoint('provider_complete_booking', '/dashboard/provider/booking/{confirmed_booking.id}/complete/',
+             user='provider_user', method='post', max_queries=13, status=REDIRECT),
+    Endpoint('customer_cancel_booking', '/dashboard/customer/booking/{customer_booking.id}/cancel/',
+             user='customer', method='post', max_queries=9, status=REDIRECT),
+    Endpoint('register', '/register/', max_queries=0),
+    Endpoint('provider_onboarding', '/register/provider/', user='customer', max_queries=2),
+    Endpoint('login', '/login/', max_queries=0),
+    Endpoint('logout', '/logout/', user='customer', max_queries=4, status=REDIRECT),
+    Endpoint('profile', '/profile/', user='customer', max_queries=2),
+]
+
+
+def _format(value, objects):
+    if isinstance(value, str):
+        return value.format(**objects)
+    if isinstance(value, dict):
+        return {key: _format(item, objects) for key, item in value.items()}
+    return value
+
+
+def route_names():
+    """Yield the (namespaced) name of every route in the three URL modules"""
+    from services import frontend_urls, provider_urls, urls
+
+    for module, namespace in [(urls, ''), (provider_urls, 'provider:'), (frontend_urls, '')]:
+        for pattern in module.urlpatterns:
+            patterns = getattr(pattern, 'url_patterns', [pattern])
+            for inner in patterns:
+                if inner.name:
+                    yield namespace + inner.name
+
+
+@override_settings(CACHES=ISOLATED_CACHE)
+class EndpointBudgetTests(QueryBudgetMixin, TestCase):
+    """Query-count and wall-time regression budgets for every route"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.objects = seed_dataset()
+
+    def test_every_route_has_a_budget(self):
+        covered = {endpoint.route for endpoint in ENDPOINTS}
+        missing = sorted(set(route_names()) - covered)
+        self.assertEqual(missing, [], 'Add these routes to ENDPOINTS')
+
+    def measure(self, endpoint):
+        """Run one request inside a rolled-back transaction; returns (status, queries, seconds, bytes)"""
+        client = Client(raise_request_exception=False)
+        if endpoint.user:
+            client.force_login(self.objects[endpoint.user])
+        request = getattr(client, endpoint.method)
+        path = _format(endpoint.path, self.objects)
+        data = _format(endpoint.data, self.objects)
+
+        with transaction.atomic():
+            with CaptureQueriesContext(connection) as context:
+                started = time_module.perf_counter()
+                response = request(path, data)
+                elapsed = time_module.perf_counter() - started
+            transaction.set_rollback(True)
+        return response.status_code, len(context.captured_queries), elapsed, len(response.content)
+
+    def test_month_end_payout_run(self):
+        started = time_module.perf_counter()
+        batch, stats = payouts.run(timezone.now() + timedelta(days=1))
+        transfers = sum(1 for _ in payouts.transfer_file(batch)) - 1
+        elapsed = time_module.perf_counter() - started
+
+        self.assertEqual(transfers, batch.provider_count)
+        self.assertEqual(stats['claimed'], batch.earnings_count)
+        self.assertFalse(ProviderEarnings.objects.filter(
+            payout_status='pending', provider__bank_account_number__gt='',
+        ).exists())
+        self.assertLessEqual(elapsed, PAYOUT_RUN_SECONDS * BENCHMARK_SCALE * BENCHMARK_TIME_FACTOR)
+        print(
+            f'\nPayout run: {batch.earnings_count} earnings to {batch.provider_count} providers '
+            f'in {elapsed:.2f}s ({stats["skipped"]} providers without bank details)'
+        )
+
+    def test_loyalty_accrual(self):
+        completed = Booking.objects.filter(status='completed', user__isnull=False).count()
+        started = time_module.perf_counter()
+        stats = loyalty.accrue()
+        elapsed = time_module.perf_counter() - started
+
+        self.assertEqual(stats['bookings'], completed)
+        self.assertEqual(LoyaltyEvent.objects.count(), completed)
+        self.assertLessEqual(elapsed, LOYALTY_ACCRUAL_SECONDS * BENCHMARK_SCALE * BENCHMARK_TIME_FACTOR)
+        print(
+            f'\nLoyalty accrual: {stats["points"]} points for {stats["bookings"]} bookings '
+            f'to {stats["customers"]} customers in {elapsed:.2f}s'
+        )
+
+    def test_endpoint_budgets(self):
+        rows = []
+        for endpoint in ENDPOINTS:
+            status_code, queries, elapsed, size = self.measure(endpoint)
+            rows.append((endpoint, status_code, queries, elapsed, size))
+
+            with self.subTest(route=endpoint.route):
+                self.assertIn(status_code, endpoint.status)
+                if endpoint.max_queries is not None:
+                    self.assertLessEqual(queries, endpoint.max_queries, 'query budget exceeded')
+                self.assertLessEqual(elapsed, endpoint.max_seconds * BENCHMARK_TIME_FACTOR, 'time budget exceeded')
+
+        print_budget_table(rows)
+
+
+def print_budget_table(rows):
+    print(f'\nEndpoint budgets (scale={BENCHMARK_SCALE})')
+    print(f'{"route":<32} {"method":<6} {"status":>6} {"queries":>8} {"budget":>7} {"ms":>9} {"bytes":>9}')
+    for endpoint, status_code, queries, elapsed, size in rows:
+        budget = '-' if endpoint.max_queries is None else endpoint.max_queries
+        print(
+            f'{endpoint.route:<32} {endpoint.method.upper():<6} {status_code:>6} {queries:>8} {budget:>7} '
+            f'{elapsed * 1000:>9.1f} {size:>9}'
+        )
@@ -1,13 +1,17 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
+from . import push
 from .views import (
     ServiceCategoryViewSet,
     ServiceProviderViewSet,
     ServiceViewSet,
     BookingViewSet,
     ReviewViewSet,
+    MessageViewSet,
+    ConversationViewSet,
     ProviderPortfolioViewSet,
-    ServiceRequestViewSet
+    ServiceRequestViewSet,
+    DispatchViewSet
 )
 
 # Create router and register viewsets
@@ -17,9 +21,13 @@ router.register(r'providers', ServiceProviderViewSet, basename='provider')
 router.register(r'services', ServiceViewSet, basename='service')
 router.register(r'bookings', BookingViewSet, basename='booking')
 router.register(r'reviews', ReviewViewSet, basename='review')
+router.register(r'messages', MessageViewSet, basename='message')
+router.register(r'conversations', ConversationViewSet, basename='conversation')
 router.register(r'portfolio', ProviderPortfolioViewSet, basename='portfolio')
 router.register(r'service-requests', ServiceRequestViewSet, basename='service-request')
+router.register(r'dispatch', DispatchViewSet, basename='dispatch')
 
 urlpatterns = [
     path('', include(router.urls)),
+    path('events/', push.event_stream, name='event-stream'),
 ]
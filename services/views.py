@@ -1,27 +1,141 @@
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal, InvalidOperation
+
 from rest_framework import viewsets, filters, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated, IsAuthenticatedOrReadOnly
 from django_filters.rest_framework import DjangoFilterBackend
-from django.db.models import Q
-from django.shortcuts import render
+from django.db.models import Exists, OuterRef, Q
+from django.shortcuts import get_object_or_404, render
 from django.http import JsonResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_time
 
+from . import conversations, coupons, dispatch, geo
+from .pagination import ConversationPagination, KeysetPagination
+from .querysets import optimize_for_serializer
+from .search import search_services
+from .slots import DEFAULT_DURATION, MAX_RANGE_DAYS, free_slots
 from .models import (
     ServiceCategory, ServiceProvider, Service,
-    Booking, Review, ProviderPortfolio, ServiceRequest
+    Booking, Review, ProviderPortfolio, ServiceRequest, DispatchJob, Conversation, Message
 )
 from .serializers import (
     ServiceCategorySerializer,
-    ServiceProviderListSerializer, ServiceProviderDetailSerializer,
-    ServiceListSerializer, ServiceDetailSerializer,
+    ServiceProviderListSerializer, ServiceProviderDetailSerializer, NearbyProviderSerializer,
+    ServiceListSerializer, ServiceDetailSerializer, NearbyServiceSerializer, CouponOfferSerializer,
     BookingListSerializer, BookingDetailSerializer,
     ReviewListSerializer, ReviewDetailSerializer,
     ProviderPortfolioSerializer,
-    ServiceRequestListSerializer, ServiceRequestDetailSerializer
+    ServiceRequestListSerializer, ServiceRequestDetailSerializer, ServiceRequestMatchSerializer,
+    MessageSerializer, ConversationSerializer, DispatchJobSerializer
 )
 
 
+def slot_query(params):
+    """
+    Parse the free-slot query parameters shared by the slot endpoints:
+    start/end (YYYY-MM-DD, default today), duration (minutes) and
+    from/to (HH:MM). Raises ValueError with a message for the client.
+    """
+    today = timezone.localdate()
+    start = parse_date(params['start']) if params.get('start') else today
+    end = parse_date(params['end']) if params.get('end') else start
+    if start is None or end is None:
+        raise ValueError('start and end must be dates (YYYY-MM-DD)')
+    if end < start or (end - start).days >= MAX_RANGE_DAYS:
+        raise ValueError(f'end must be on or after start and at most {MAX_RANGE_DAYS} days later')
+
+    try:
+        duration = int(params.get('duration', DEFAULT_DURATION))
+    except ValueError:
+        raise ValueError('duration must be a number of minutes')
+    if not 15 <= duration <= 12 * 60:
+        raise ValueError('duration must be between 15 and 720 minutes')
+
+    window = None
+    if params.get('from') or params.get('to'):
+        window = (parse_time(params.get('from') or '00:00'), parse_time(params.get('to') or '23:59'))
+        if None in window:
+            raise ValueError('from and to must be times (HH:MM)')
+    return {'start_date': start, 'end_date': end, 'duration': duration, 'window': window}
+
+
+DEFAULT_RADIUS_KM = 10
+MAX_NEARBY_RESULTS = 50
+
+
+def point_query(params):
+    """
+    Parse the proximity query parameters shared by the nearby endpoints:
+    lat/lng (or a pincode), radius (km, default 10), k (the k nearest
+    within the radius instead of everything in it) and date (YYYY-MM-DD,
+    only providers with a free slot that day). Raises ValueError with a
+    message for the client.
+    """
+    if params.get('lat') or params.get('lng'):
+        try:
+            point = (float(params['lat']), float(params['lng']))
+        except (KeyError, ValueError):
+            raise ValueError('lat and lng must both be numbers')
+        if not (-90 <= point[0] <= 90 and -180 <= point[1] <= 180):
+            raise ValueError('lat and lng must be a valid coordinate')
+    elif params.get('pincode'):
+        point = geo.locate(params['pincode'])
+        if point is None:
+            raise ValueError('Unknown pincode')
+    else:
+        raise ValueError('lat and lng, or pincode, are required')
+
+    try:
+        radius = float(params.get('radius', DEFAULT_RADIUS_KM))
+        k = int(params['k']) if params.get('k') else None
+    except ValueError:
+        raise ValueError('radius and k must be numbers')
+    if not 0 < radius <= geo.MAX_RADIUS_KM:
+        raise ValueError(f'radius must be more than 0 and at most {geo.MAX_RADIUS_KM} km')
+    if k is not None and not 1 <= k <= MAX_NEARBY_RESULTS:
+        raise ValueError(f'k must be between 1 and {MAX_NEARBY_RESULTS}')
+
+    day = None
+    if params.get('date'):
+        day = parse_date(params['date'])
+        if day is None:
+            raise ValueError('date must be a date (YYYY-MM-DD)')
+    return {'latitude': point[0], 'longitude': point[1], 'radius_km': radius, 'k': k, 'date': day}
+
+
+def nearby(queryset, query, path=''):
+    """Rows of `queryset` matching a point_query(), nearest first; `path` leads to the provider"""
+    if query['k']:
+        found = geo.nearest(
+            queryset, query['latitude'], query['longitude'], query['k'], path, max_radius_km=query['radius_km'],
+        )
+    else:
+        found = geo.within(queryset, query['latitude'], query['longitude'], query['radius_km'], path)
+    return found[:MAX_NEARBY_RESULTS]
+
+
+def with_free_slot(rows, day, provider_id, duration):
+    """Keep the rows whose provider has a free slot of the row's duration on `day`"""
+    wanted = defaultdict(set)
+    for row in rows:
+        wanted[duration(row)].add(provider_id(row))
+    free = {
+        minutes: free_slots(list(ids), day, day, duration=minutes) for minutes, ids in wanted.items()
+    }
+    return [row for row in rows if free[duration(row)][provider_id(row)]]
+
+
+def slot_data(slots):
+    return [
+        {'date': slot.date.isoformat(), 'start': slot.start.strftime('%H:%M'), 'end': slot.end.strftime('%H:%M')}
+        for slot in slots
+    ]
+
+
 def home(request):
     """Home page view with API stats"""
     stats = {
@@ -37,6 +151,16 @@ def home(request):
     return render(request, 'home.html', {'stats': stats})
 
 
+class OptimizedQuerysetMixin:
+    """
+    Add the select_related/prefetch_related calls required by the serializer
+    used for the current action, so list pages cost a constant number of queries.
+    """
+
+    def get_queryset(self):
+        return optimize_for_serializer(super().get_queryset(), self.get_serializer_class())
+
+
 class ServiceCategoryViewSet(viewsets.ModelViewSet):
     """
     ViewSet for Service Categories
@@ -46,7 +170,7 @@ class ServiceCategoryViewSet(viewsets.ModelViewSet):
     PUT/PATCH /api/categories/{id}/ - Update category
     DELETE /api/categories/{id}/ - Delete category
     """
-    queryset = ServiceCategory.objects.filter(is_active=True)
+    queryset = ServiceCategory.objects.filter(is_active=True).with_service_counts()
     serializer_class = ServiceCategorySerializer
     permission_classes = [IsAuthenticatedOrReadOnly]
     filter_backends = [filters.SearchFilter, filters.OrderingFilter]
@@ -55,7 +179,7 @@ class ServiceCategoryViewSet(viewsets.ModelViewSet):
     ordering = ['name']
 
 
-class ServiceProviderViewSet(viewsets.ModelViewSet):
+class ServiceProviderViewSet(OptimizedQuerysetMixin, viewsets.ModelViewSet):
     """
     ViewSet for Service Providers
     GET /api/providers/ - List all verified providers
@@ -67,8 +191,12 @@ class ServiceProviderViewSet(viewsets.ModelViewSet):
     Custom actions:
     GET /api/providers/{id}/services/ - Get all services by provider
     GET /api/providers/{id}/reviews/ - Get all reviews for provider
+    GET /api/providers/{id}/slots/ - Get free booking slots of the provider
+    GET /api/providers/slots/ - Get free slots of many providers (by id, category or city)
+    GET /api/providers/nearby/ - Providers near a point, nearest first
     GET /api/providers/search/ - Search providers by location/rating
     """
+    MAX_SLOT_PROVIDERS = 200
     queryset = ServiceProvider.objects.filter(verification_status='verified')
     permission_classes = [IsAuthenticatedOrReadOnly]
     filter_backends = [DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter]
@@ -80,13 +208,15 @@ class ServiceProviderViewSet(viewsets.ModelViewSet):
     def get_serializer_class(self):
         if self.action == 'list':
             return ServiceProviderListSerializer
+        if self.action == 'nearby':
+            return NearbyProviderSerializer
         return ServiceProviderDetailSerializer
     
     @action(detail=True, methods=['get'])
     def services(self, request, pk=None):
         """Get all active services offered by this provider"""
         provider = self.get_object()
-        services = provider.services.filter(is_active=True)
+        services = optimize_for_serializer(provider.services.filter(is_active=True), ServiceListSerializer)
         serializer = ServiceListSerializer(services, many=True)
         return Response(serializer.data)
     
@@ -94,7 +224,7 @@ class ServiceProviderViewSet(viewsets.ModelViewSet):
     def reviews(self, request, pk=None):
         """Get all reviews for this provider"""
         provider = self.get_object()
-        reviews = provider.reviews.all()
+        reviews = optimize_for_serializer(provider.reviews.all(), ReviewListSerializer)
         serializer = ReviewListSerializer(reviews, many=True)
         return Response(serializer.data)
     
@@ -102,12 +232,96 @@ class ServiceProviderViewSet(viewsets.ModelViewSet):
     def portfolio(self, request, pk=None):
         """Get provider's portfolio"""
         provider = self.get_object()
-        portfolio = provider.portfolio.all()
+        portfolio = optimize_for_serializer(provider.portfolio.all(), ProviderPortfolioSerializer)
         serializer = ProviderPortfolioSerializer(portfolio, many=True)
         return Response(serializer.data)
 
+    @action(detail=True, methods=['get'])
+    def slots(self, request, pk=None):
+        """
+        Free booking slots of this provider
+        Query params: start, end (YYYY-MM-DD), duration (minutes), from, to (HH:MM)
+        """
+        provider = self.get_object()
+        try:
+            query = slot_query(request.query_params)
+        except ValueError as error:
+            return Response({'error': str(error)}, status=status.HTTP_400_BAD_REQUEST)
+        found = free_slots([provider.id], **query)
+        return Response({'provider': provider.id, 'slots': slot_data(found[provider.id])})
 
-class ServiceViewSet(viewsets.ModelViewSet):
+    @action(detail=False, methods=['get'], url_path='slots', url_name='bulk-slots')
+    def bulk_slots(self, request):
+        """
+        Free booking slots of many providers in one call, best rated first;
+        providers without a free slot are left out.
+        Query params: provider (comma-separated ids), category, city, plus those of slots
+        """
+        params = request.query_params
+        if not any(params.get(name) for name in ('provider', 'category', 'city')):
+            return Response(
+                {'error': 'provider, category or city is required'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        try:
+            query = slot_query(params)
+        except ValueError as error:
+            return Response({'error': str(error)}, status=status.HTTP_400_BAD_REQUEST)
+
+        providers = self.get_queryset().filter(is_available=True)
+        try:
+            if params.get('provider'):
+                providers = providers.filter(id__in=[int(pk) for pk in params['provider'].split(',')])
+            if params.get('category'):
+                providers = providers.filter(
+                    services__category_id=int(params['category']),
+                    services__is_active=True,
+                    services__approval_status='approved',
+                ).distinct()
+        except ValueError:
+            return Response(
+                {'error': 'provider and category must be ids'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if params.get('city'):
+            providers = providers.filter(city__iexact=params['city'])
+
+        providers = list(providers.values('id', 'business_name', 'city')[:self.MAX_SLOT_PROVIDERS])
+        found = free_slots([provider['id'] for provider in providers], **query)
+        return Response([
+            {**provider, 'slots': slot_data(found[provider['id']])}
+            for provider in providers if found[provider['id']]
+        ])
+
+    @action(detail=False, methods=['get'])
+    def nearby(self, request):
+        """
+        Providers near a point, nearest first, with their distance
+        Query params: lat, lng or pincode, radius (km), k, category,
+        available (true: only providers taking bookings), date (YYYY-MM-DD)
+        """
+        params = request.query_params
+        try:
+            query = point_query(params)
+            category = int(params['category']) if params.get('category') else None
+        except ValueError as error:
+            return Response({'error': str(error)}, status=status.HTTP_400_BAD_REQUEST)
+
+        providers = self.get_queryset()
+        if category is not None:
+            providers = providers.filter(Exists(Service.objects.filter(
+                provider=OuterRef('pk'), category_id=category, is_active=True, approval_status='approved',
+            )))
+        if params.get('available') in ('true', '1') or query['date']:
+            providers = providers.filter(is_available=True)
+
+        found = nearby(providers, query)
+        if query['date']:
+            found = with_free_slot(found, query['date'], lambda row: row.id, lambda row: DEFAULT_DURATION)
+        return Response(NearbyProviderSerializer(found, many=True, context={'request': request}).data)
+
+
+class ServiceViewSet(OptimizedQuerysetMixin, viewsets.ModelViewSet):
     """
     ViewSet for Services
     GET /api/services/ - List all active services
@@ -121,6 +335,11 @@ class ServiceViewSet(viewsets.ModelViewSet):
     - provider: Filter by provider ID
     - pricing_type: Filter by pricing type
     - is_emergency_available: Filter emergency services
+
+    Custom actions:
+    GET /api/services/search/ - Search services by keyword, city, price or category
+    GET /api/services/nearby/ - Services whose providers are near a point, nearest first
+    GET /api/services/{id}/coupons/ - Coupons that can be used on the service, best first
     """
     queryset = Service.objects.filter(is_active=True)
     permission_classes = [IsAuthenticatedOrReadOnly]
@@ -131,8 +350,10 @@ class ServiceViewSet(viewsets.ModelViewSet):
     ordering = ['-created_at']
     
     def get_serializer_class(self):
-        if self.action == 'list':
+        if self.action in ('list', 'search'):
             return ServiceListSerializer
+        if self.action == 'nearby':
+            return NearbyServiceSerializer
         return ServiceDetailSerializer
     
     @action(detail=False, methods=['get'])
@@ -146,11 +367,7 @@ class ServiceViewSet(viewsets.ModelViewSet):
         # Search term
         search_term = request.query_params.get('q', None)
         if search_term:
-            queryset = queryset.filter(
-                Q(title__icontains=search_term) |
-                Q(description__icontains=search_term) |
-                Q(provider__business_name__icontains=search_term)
-            )
+            queryset = search_services(queryset, search_term)
         
         # Filter by city
         city = request.query_params.get('city', None)
@@ -170,8 +387,51 @@ class ServiceViewSet(viewsets.ModelViewSet):
         serializer = ServiceListSerializer(queryset, many=True)
         return Response(serializer.data)
 
+    @action(detail=False, methods=['get'])
+    def nearby(self, request):
+        """
+        Approved services of verified providers near a point, nearest first
+        Query params: lat, lng or pincode, radius (km), k, category,
+        available (true: only providers taking bookings), date (YYYY-MM-DD)
+        """
+        params = request.query_params
+        try:
+            query = point_query(params)
+            category = int(params['category']) if params.get('category') else None
+        except ValueError as error:
+            return Response({'error': str(error)}, status=status.HTTP_400_BAD_REQUEST)
+
+        services = self.get_queryset().filter(approval_status='approved', provider__verification_status='verified')
+        if category is not None:
+            services = services.filter(category_id=category)
+        if params.get('available') in ('true', '1') or query['date']:
+            services = services.filter(provider__is_available=True)
+
+        found = nearby(services, query, path='provider__')
+        if query['date']:
+            found = with_free_slot(
+                found, query['date'], lambda row: row.provider_id, lambda row: row.duration_minutes or DEFAULT_DURATION,
+            )
+        return Response(NearbyServiceSerializer(found, many=True, context={'request': request}).data)
+
+    @action(detail=True, methods=['get'])
+    def coupons(self, request, pk=None):
+        """
+        Coupons that can be used on this service now, largest discount first
+        Query params: amount (order value, default the service price)
+        """
+        service = get_object_or_404(Service.objects.filter(is_active=True), pk=pk)
+        try:
+            amount = Decimal(request.query_params.get('amount', service.price))
+        except InvalidOperation:
+            amount = None
+        if amount is None or not amount.is_finite() or amount < 0:
+            return Response({'error': 'amount must be a positive number'}, status=status.HTTP_400_BAD_REQUEST)
+        offers = coupons.for_service(service)
+        return Response(CouponOfferSerializer(offers, many=True, context={'amount': amount}).data)
+
 
-class BookingViewSet(viewsets.ModelViewSet):
+class BookingViewSet(OptimizedQuerysetMixin, viewsets.ModelViewSet):
     """
     ViewSet for Bookings
     GET /api/bookings/ - List user's bookings
@@ -185,16 +445,18 @@ class BookingViewSet(viewsets.ModelViewSet):
     POST /api/bookings/{id}/complete/ - Mark as completed (provider)
     POST /api/bookings/{id}/cancel/ - Cancel booking
     """
+    queryset = Booking.objects.all()
     permission_classes = [IsAuthenticated]
+    pagination_class = KeysetPagination
     filter_backends = [DjangoFilterBackend, filters.OrderingFilter]
-    filterset_fields = ['status', 'payment_status', 'booking_date']
+    filterset_fields = ['status', 'payment__status', 'booking_date', 'is_emergency']
     ordering_fields = ['booking_date', 'created_at']
-    ordering = ['-created_at']
+    ordering = ['-created_at', '-id']
     
     def get_queryset(self):
         """Return bookings for the current user"""
         user = self.request.user
-        return Booking.objects.filter(Q(customer=user) | Q(provider__user=user))
+        return super().get_queryset().filter(Q(user=user) | Q(provider__user=user))
     
     def get_serializer_class(self):
         if self.action == 'list':
@@ -213,7 +475,9 @@ class BookingViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_403_FORBIDDEN
             )
         
-        booking.confirm_booking()
+        booking.status = 'confirmed'
+        booking.confirmed_at = timezone.now()
+        booking.save()
         serializer = self.get_serializer(booking)
         return Response(serializer.data)
     
@@ -228,7 +492,9 @@ class BookingViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_403_FORBIDDEN
             )
         
-        booking.complete_booking()
+        booking.status = 'completed'
+        booking.completed_at = timezone.now()
+        booking.save()
         serializer = self.get_serializer(booking)
         return Response(serializer.data)
     
@@ -238,7 +504,7 @@ class BookingViewSet(viewsets.ModelViewSet):
         booking = self.get_object()
         
         # Only customer or provider can cancel
-        if booking.customer != request.user and booking.provider.user != request.user:
+        if booking.user != request.user and booking.provider.user != request.user:
             return Response(
                 {'error': 'You do not have permission to cancel this booking'},
                 status=status.HTTP_403_FORBIDDEN
@@ -250,7 +516,7 @@ class BookingViewSet(viewsets.ModelViewSet):
         return Response(serializer.data)
 
 
-class ReviewViewSet(viewsets.ModelViewSet):
+class ReviewViewSet(OptimizedQuerysetMixin, viewsets.ModelViewSet):
     """
     ViewSet for Reviews
     GET /api/reviews/ - List all reviews
@@ -261,10 +527,11 @@ class ReviewViewSet(viewsets.ModelViewSet):
     """
     queryset = Review.objects.all()
     permission_classes = [IsAuthenticatedOrReadOnly]
+    pagination_class = KeysetPagination
     filter_backends = [DjangoFilterBackend, filters.OrderingFilter]
     filterset_fields = ['provider', 'rating']
     ordering_fields = ['rating', 'created_at']
-    ordering = ['-created_at']
+    ordering = ['-created_at', '-id']
     
     def get_serializer_class(self):
         if self.action == 'list':
@@ -272,7 +539,85 @@ class ReviewViewSet(viewsets.ModelViewSet):
         return ReviewDetailSerializer
 
 
-class ProviderPortfolioViewSet(viewsets.ModelViewSet):
+class MessageViewSet(OptimizedQuerysetMixin, viewsets.ModelViewSet):
+    """
+    ViewSet for booking chat messages
+    GET /api/messages/ - List messages sent or received by the user (newest first)
+    POST /api/messages/ - Send a message about a booking
+    GET /api/messages/{id}/ - Get message details
+
+    Custom actions:
+    POST /api/messages/{id}/read/ - Mark a received message as read
+    """
+    queryset = Message.objects.all()
+    serializer_class = MessageSerializer
+    permission_classes = [IsAuthenticated]
+    pagination_class = KeysetPagination
+    http_method_names = ['get', 'post', 'head', 'options']
+    filter_backends = [DjangoFilterBackend, filters.OrderingFilter]
+    filterset_fields = ['booking', 'conversation', 'is_read']
+    ordering_fields = ['created_at']
+    ordering = ['-created_at', '-id']
+
+    def get_queryset(self):
+        """Return messages the current user sent or received"""
+        user = self.request.user
+        return super().get_queryset().filter(Q(sender=user) | Q(receiver=user))
+
+    @action(detail=True, methods=['post'])
+    def read(self, request, pk=None):
+        """Mark a message as read (receiver only)"""
+        message = self.get_object()
+        if message.receiver_id != request.user.id:
+            return Response(
+                {'error': 'Only the receiver can mark a message as read'},
+                status=status.HTTP_403_FORBIDDEN
+            )
+        if not message.is_read:
+            message.is_read = True
+            message.read_at = timezone.now()
+            message.save()
+        return Response(self.get_serializer(message).data)
+
+
+class ConversationViewSet(viewsets.ReadOnlyModelViewSet):
+    """
+    ViewSet for the message inbox
+    GET /api/conversations/ - List the user's conversations (most recently active first)
+    GET /api/conversations/{id}/ - Get conversation details
+
+    Custom actions:
+    GET /api/conversations/{id}/messages/ - Messages of the conversation (newest first)
+    POST /api/conversations/{id}/read/ - Mark every message the user received in it as read
+    """
+    queryset = Conversation.objects.all()
+    serializer_class = ConversationSerializer
+    permission_classes = [IsAuthenticated]
+    pagination_class = ConversationPagination
+
+    def get_queryset(self):
+        """Return the conversations the current user takes part in"""
+        return conversations.for_user(self.request.user).select_related('user_a', 'user_b', 'last_message')
+
+    @action(detail=True, methods=['get'])
+    def messages(self, request, pk=None):
+        """Page through the conversation's messages"""
+        conversation = self.get_object()
+        thread = optimize_for_serializer(conversation.messages.all(), MessageSerializer)
+        paginator = KeysetPagination()
+        page = paginator.paginate_queryset(thread, request, view=self)
+        data = MessageSerializer(page, many=True, context=self.get_serializer_context()).data
+        return paginator.get_paginated_response(data)
+
+    @action(detail=True, methods=['post'])
+    def read(self, request, pk=None):
+        """Mark the user's unread messages in the conversation as read"""
+        conversation = self.get_object()
+        conversations.mark_read(conversation, request.user, timezone.now())
+        return Response(self.get_serializer(conversation).data)
+
+
+class ProviderPortfolioViewSet(OptimizedQuerysetMixin, viewsets.ModelViewSet):
     """
     ViewSet for Provider Portfolio
     GET /api/portfolio/ - List portfolio items
@@ -288,7 +633,7 @@ class ProviderPortfolioViewSet(viewsets.ModelViewSet):
     filterset_fields = ['provider', 'service_category']
 
 
-class ServiceRequestViewSet(viewsets.ModelViewSet):
+class ServiceRequestViewSet(OptimizedQuerysetMixin, viewsets.ModelViewSet):
     """
     ViewSet for Service Requests
     GET /api/service-requests/ - List all open requests
@@ -298,8 +643,10 @@ class ServiceRequestViewSet(viewsets.ModelViewSet):
     DELETE /api/service-requests/{id}/ - Delete request
     
     Custom actions:
+    GET /api/service-requests/{id}/suggestions/ - Best matching providers
     POST /api/service-requests/{id}/assign/ - Assign to provider
     """
+    queryset = ServiceRequest.objects.all()
     permission_classes = [IsAuthenticatedOrReadOnly]
     filter_backends = [DjangoFilterBackend, filters.OrderingFilter]
     filterset_fields = ['status', 'urgency', 'category', 'city']
@@ -309,15 +656,24 @@ class ServiceRequestViewSet(viewsets.ModelViewSet):
     def get_queryset(self):
         """Return open requests or user's own requests"""
         user = self.request.user
+        queryset = super().get_queryset()
         if user.is_authenticated:
-            return ServiceRequest.objects.filter(Q(status='open') | Q(customer=user))
-        return ServiceRequest.objects.filter(status='open')
+            return queryset.filter(Q(status='open') | Q(customer=user))
+        return queryset.filter(status='open')
     
     def get_serializer_class(self):
         if self.action == 'list':
             return ServiceRequestListSerializer
         return ServiceRequestDetailSerializer
     
+    @action(detail=True, methods=['get'])
+    def suggestions(self, request, pk=None):
+        """Providers best suited to this request, best first (see services/matching.py)"""
+        service_request = self.get_object()
+        matches = optimize_for_serializer(service_request.matches.all(), ServiceRequestMatchSerializer)
+        serializer = ServiceRequestMatchSerializer(matches, many=True)
+        return Response(serializer.data)
+
     @action(detail=True, methods=['post'])
     def assign(self, request, pk=None):
         """Assign request to a provider"""
@@ -343,3 +699,98 @@ class ServiceRequestViewSet(viewsets.ModelViewSet):
                 {'error': 'Provider not found'},
                 status=status.HTTP_404_NOT_FOUND
             )
+
+
+class DispatchViewSet(viewsets.ReadOnlyModelViewSet):
+    """
+    Priority queue of emergency bookings and urgent service requests
+    (see services/dispatch.py)
+    GET /api/dispatch/ - Open jobs the provider may take, most urgent first (staff: all open jobs)
+    GET /api/dispatch/{id}/ - Job details
+
+    Custom actions:
+    POST /api/dispatch/claim/ - Lease the next job (204 when the queue is empty)
+    POST /api/dispatch/{id}/accept/ - Accept a leased job
+    POST /api/dispatch/{id}/release/ - Hand a leased job back
+    GET /api/dispatch/metrics/ - Request-to-accept times per priority (staff only)
+    """
+    RELATED = ['category', 'booking__service', 'booking__provider', 'service_request']
+    serializer_class = DispatchJobSerializer
+    permission_classes = [IsAuthenticated]
+    filter_backends = []
+
+    def get_provider(self):
+        if not hasattr(self, '_provider'):
+            self._provider = ServiceProvider.objects.filter(user=self.request.user).first()
+        return self._provider
+
+    def get_queryset(self):
+        provider = self.get_provider()
+        if provider is not None:
+            queryset = dispatch.queue(provider)
+        elif self.request.user.is_staff:
+            queryset = DispatchJob.objects.filter(status__in=dispatch.OPEN_STATUSES)
+        else:
+            queryset = DispatchJob.objects.none()
+        return queryset.select_related(*self.RELATED).order_by('priority', 'requested_at', 'id')
+
+    def provider_required(self):
+        return Response(
+            {'error': 'Only service providers can take dispatch jobs'},
+            status=status.HTTP_403_FORBIDDEN
+        )
+
+    @action(detail=False, methods=['post'])
+    def claim(self, request):
+        """Lease the most urgent job this provider may take"""
+        provider = self.get_provider()
+        if provider is None:
+            return self.provider_required()
+        job = dispatch.claim(provider)
+        if job is None:
+            return Response(status=status.HTTP_204_NO_CONTENT)
+        job = DispatchJob.objects.select_related(*self.RELATED).get(pk=job.pk)
+        return Response(self.get_serializer(job).data)
+
+    @action(detail=True, methods=['post'])
+    def accept(self, request, pk=None):
+        """Accept a job this provider holds the lease on"""
+        provider = self.get_provider()
+        if provider is None:
+            return self.provider_required()
+        job = self.get_object()
+        try:
+            job = dispatch.accept(job, provider)
+        except dispatch.LeaseLost as error:
+            return Response({'error': str(error)}, status=status.HTTP_409_CONFLICT)
+        return Response(self.get_serializer(job).data)
+
+    @action(detail=True, methods=['post'])
+    def release(self, request, pk=None):
+        """Hand a leased job back to the queue"""
+        provider = self.get_provider()
+        if provider is None:
+            return self.provider_required()
+        job = self.get_object()
+        if not dispatch.release(job, provider):
+            return Response(
+                {'error': 'You do not hold the lease on this job'},
+                status=status.HTTP_409_CONFLICT
+            )
+        job.refresh_from_db()
+        return Response(self.get_serializer(job).data)
+
+    @action(detail=False, methods=['get'])
+    def metrics(self, request):
+        """Request-to-accept statistics per priority; ?days= sets the window (default 7)"""
+        if not request.user.is_staff:
+            return Response(
+                {'error': 'Only staff can view dispatch metrics'},
+                status=status.HTTP_403_FORBIDDEN
+            )
+        try:
+            days = int(request.query_params.get('days', dispatch.METRICS_DAYS))
+        except ValueError:
+            return Response({'error': 'days must be a number'}, status=status.HTTP_400_BAD_REQUEST)
+        since = timezone.now() - timedelta(days=days)
+        return Response(dispatch.metrics(since=since))